@@ -67,12 +67,6 @@ def get_dependencies_version(dico=False):
         versions['matplotlib'] = matplotlib.__version__
     except ImportError:
         versions['matplotlib'] = 'Not found'
-    try:
-        mcl, _ = Popen(['mcl', '--version'], stdout=PIPE,
-                         stderr=PIPE, universal_newlines=True).communicate()
-        versions['MCL'] = mcl.split()[1]
-    except:
-        versions['MCL'] = 'Not found'
     # try:
     #     chi, err = Popen(['chimera', '--version'], stdout=PIPE,
     #                      stderr=PIPE).communicate()
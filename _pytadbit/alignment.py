@@ -7,11 +7,14 @@ from __future__ import print_function
 
 from pytadbit.utils.extraviews         import colorize, tadbit_savefig
 from pytadbit.utils.extraviews         import _tad_density_plot
-from random                            import random, shuffle
+from random                            import random, shuffle, Random
 from sys                               import stdout
-from pytadbit.boundary_aligner.aligner import align
+from pytadbit.boundary_aligner.aligner import batch_align_scores
+import multiprocessing                 as mu
 
+import numpy as np
 import pandas as pd
+from scipy.stats import norm as sc_norm
 
 try:
     from scipy.interpolate import interp1d
@@ -456,11 +459,17 @@ def _interpolation(experiments):
 
 
 def randomization_test(xpers, score=None, num=1000, verbose=False, max_dist=100000,
-                       rnd_method='interpolate', r_size=None, method='reciprocal'):
+                       rnd_method='interpolate', r_size=None, method='reciprocal',
+                       n_cpus=1, seed=None, alpha=None, confidence=0.99,
+                       chunk_size=50):
     """
     Return the probability that original alignment is better than an
     alignment of randomized boundaries.
 
+    Randomizations are done by blocks of chunk_size, each with its own random
+    seed (derived from the given seed), so that the result does not depend on
+    the number of CPUs used.
+
     :param tads: original TADs of each experiment to align
     :param distr: the function to interpolate TAD lengths from probability
     :param None score: just to print it when verbose
@@ -472,6 +481,12 @@ def randomization_test(xpers, score=None, num=1000, verbose=False, max_dist=1000
        :func:`pytadbit.alignment.generate_rnd_tads`). In contrast, the 'shuffle'
        method uses directly the set of observed TADs and shuffle them (see
        :func:`pytadbit.alignment.generate_shuffle_tads`).
+    :param 1 n_cpus: number of CPUs used to run the randomizations
+    :param None seed: random seed, if None, it is drawn from the random module
+    :param None alpha: if given, randomizations stop as soon as the confidence
+       interval of the p-value is entirely above or below this value
+    :param 0.99 confidence: confidence level of the interval of the p-value
+    :param 50 chunk_size: number of randomizations per block
     """
     if not rnd_method in ['interpolate', 'shuffle']:
         raise Exception('method should be either "interpolate" or ' +
@@ -484,52 +499,83 @@ def randomization_test(xpers, score=None, num=1000, verbose=False, max_dist=1000
             raise Exception('No TADs defined, use find_tad function.\n')
         tads.append([(t['end'] - t['start']) * \
                      xpr.resolution for t in list(xpr.tads.values())])
-    rnd_distr = []
-    # rnd_len = []
     distr = _interpolation(xpers) if rnd_method == 'interpolate' else None
-    rnd_exp = lambda : tads[int(random() * len(tads))]
-    for val in range(num):
-        if verbose:
-            val = float(val)
-            if not val / num * 100 % 5:
+    if seed is None:
+        seed = int(random() * 2**30)
+    jobs = ((tads, distr, r_size, rnd_method, method, max_dist,
+             min(chunk_size, num - beg), seed + beg)
+            for beg in range(0, num, chunk_size))
+    pool = mu.Pool(n_cpus) if n_cpus > 1 else None
+    try:
+        results = (pool.imap if pool else map)(_random_alignment_scores, jobs)
+        rnd_distr = []
+        nbetter = 0
+        for rnd_scores in results:
+            rnd_distr.extend(rnd_scores)
+            nbetter += sum(1 for n in rnd_scores if n > score)
+            if verbose:
                 stdout.write('\r' + ' ' * 10 +
                              ' randomizing: '
-                             '%.2f completed' % (100 * val/num))
+                             '%.2f completed' % (100. * len(rnd_distr) / num))
                 stdout.flush()
-        if rnd_method == 'interpolate':
-            rnd_tads = [generate_rnd_tads(r_size, distr)
-                        for _ in range(len(tads))]
-            # rnd_len.append(float(sum([len(r) for r in rnd_tads]))
-            #                / len(rnd_tads))
-        else:
-            rnd_tads = [generate_shuffle_tads(rnd_exp())
-                        for _ in range(len(tads))]
-            # rnd_len.append(len(tads))
-        rnd_distr.append(align(rnd_tads, verbose=False, method=method,
-                               max_dist=max_dist)[0][1])
-        # aligns, sc = align(rnd_tads, verbose=False)
-        # rnd_distr.append(sc)
-        # for xpr in aligns:
-        #     print sc, '|'.join(['%5s' % (str(x/1000)[:-2] \
-        # if x!='-' else '-' * 4)\
-        #                         for x in xpr])
-        # print ''
-    pval = float(len([n for n in rnd_distr if n > score])) / len(rnd_distr)
+            if alpha is not None:
+                low, upp = _pvalue_interval(nbetter, len(rnd_distr), confidence)
+                if upp < alpha or low > alpha:
+                    break
+    finally:
+        # also stops the workers still randomizing after an early stop
+        if pool:
+            pool.terminate()
+            pool.join()
+    pval = float(nbetter) / len(rnd_distr)
     if verbose:
-        stdout.write('\n %s randomizations finished.' % (num))
+        stdout.write('\n %s randomizations finished.' % (len(rnd_distr)))
         stdout.flush()
         print('  Observed alignment score: %s' % (score))
-        # print '  Mean number of boundaries: {}; observed: {}'.format (
-        #     sum(rnd_len)/len(rnd_len),
-        #     str([len(self.experiments[e].brks)
-        #          for e in self.experiments]))
         print('Randomized scores between %s and %s; observed: %s' % (
             min(rnd_distr), max(rnd_distr), score))
-        print('p-value: %s' % (pval if pval else '<%s' % (1./num)))
+        print('p-value: %s' % (pval if pval else '<%s' % (1. / len(rnd_distr))))
     return pval
 
 
-def generate_rnd_tads(chromosome_len, distr, start=0):
+def _random_alignment_scores(args):
+    """
+    Alignment scores of a block of randomizations, each aligning one set of
+    random TADs per experiment.
+    """
+    tads, distr, r_size, rnd_method, method, max_dist, num, seed = args
+    rng = Random(seed)
+    groups = []
+    for _ in range(num):
+        if rnd_method == 'interpolate':
+            groups.append([generate_rnd_tads(r_size, distr, rng=rng)
+                           for _ in range(len(tads))])
+        else:
+            groups.append([generate_shuffle_tads(
+                tads[int(rng.random() * len(tads))], rng=rng)
+                           for _ in range(len(tads))])
+    return batch_align_scores(groups, method=method, max_dist=max_dist)
+
+
+def _pvalue_interval(nbetter, total, confidence):
+    """
+    Wilson score interval of a p-value estimated from randomizations
+
+    :param nbetter: number of randomizations scoring better than observed
+    :param total: number of randomizations
+    :param confidence: confidence level of the interval
+
+    :returns: lower and upper bounds of the interval
+    """
+    z = sc_norm.ppf(0.5 + confidence / 2.)
+    pval = float(nbetter) / total
+    denom = 1 + z**2 / total
+    center = (pval + z**2 / (2. * total)) / denom
+    width = z * (pval * (1 - pval) / total + z**2 / (4. * total**2))**0.5 / denom
+    return center - width, center + width
+
+
+def generate_rnd_tads(chromosome_len, distr, start=0, rng=None):
     """
     Generates random TADs over a chromosome of a given size according to a given
     distribution of lengths of TADs.
@@ -538,29 +584,37 @@ def generate_rnd_tads(chromosome_len, distr, start=0):
     :param distr: function that returns a TAD length depending on a p value
     :param bin_size: size of the bin of the Hi-C experiment
     :param 0 start: starting position in the chromosome
+    :param None rng: random generator (random.Random instance), if None the
+       random module is used
 
     :returns: list of TADs
     """
+    rnd = rng.random if rng else random
     pos = start
     tads = []
     while True:
-        pos += distr(random())
+        pos += distr(rnd())
         if pos > chromosome_len:
             break
         tads.append(float(pos))
     return tads
 
 
-def generate_shuffle_tads(tads):
+def generate_shuffle_tads(tads, rng=None):
     """
     Returns a shuffle version of a given list of TADs
 
     :param tads: list of TADs
+    :param None rng: random generator (random.Random instance), if None the
+       random module is used
 
     :returns: list of shuffled TADs
     """
     rnd_tads = tads[:]
-    shuffle(rnd_tads)
+    if rng:
+        rng.shuffle(rnd_tads)
+    else:
+        shuffle(rnd_tads)
     tads = []
     for tad in rnd_tads:
         if tads:
@@ -4,6 +4,7 @@
 
 """
 from pytadbit.boundary_aligner.globally     import needleman_wunsch
+from pytadbit.boundary_aligner.globally     import batch_needleman_wunsch
 from pytadbit.boundary_aligner.reciprocally import reciprocal
 
 def consensusize(ali1, ali2, passed):
@@ -100,3 +101,46 @@ def align(sequences, method='reciprocal', **kwargs):
     consensus = consensusize(align1, align2, sequences[1])
     return ([align1, align2], score, p1, p2), consensus
 
+
+def batch_align_scores(groups, method='reciprocal', **kwargs):
+    """
+    Scores of the alignments of several groups of TAD borders, as returned by
+    :func:`align`. Only the consensus is kept along the multiple alignments,
+    and the pairwise alignments of the same step are computed together for
+    all groups.
+
+    :param groups: list of lists of sequences of TAD borders
+    :param reciprocal method: method used to align
+
+    :returns: a list with the alignment score of each group
+    """
+    if method == 'global':
+        aligner = lambda pairs: batch_needleman_wunsch(pairs, **kwargs)
+    elif method == 'reciprocal':
+        aligner = lambda pairs: [reciprocal(seq1, seq2, **kwargs)[:2]
+                                 for seq1, seq2 in pairs]
+    else:
+        raise NotImplementedError(('Only "global" and "reciprocal" are ' +
+                                   'implemented right now.\n'))
+    consensus = []
+    sequences = []
+    for group in groups:
+        if len(group) > 2:
+            # same order and starting consensus as in align
+            group = [seq for _, seq in sorted(enumerate(group),
+                                              key=lambda x: x[1])]
+            consensus.append(None)
+            for seq in group:
+                consensus[-1] = consensus[-1] or seq
+        else:
+            consensus.append(group[0])
+        sequences.append(group)
+    scores = [0] * len(groups)
+    for other in range(1, max([len(group) for group in groups] + [0])):
+        todo = [g for g, group in enumerate(sequences) if other < len(group)]
+        results = aligner([(consensus[g], sequences[g][other]) for g in todo])
+        for g, ([align1, align2], score) in zip(todo, results):
+            scores[g] += score
+            if other + 1 < len(sequences[g]):
+                consensus[g] = consensusize(align1, align2, other)
+    return scores
@@ -6,6 +6,8 @@ global aligner for Topologically Associated Domains
 from __future__ import print_function
 from math import log
 
+import numpy as np
+
 
 def needleman_wunsch(tads1, tads2, penalty=-6., ext_pen=-5.6,
                      max_dist=500000, verbose=False):
@@ -23,34 +25,103 @@ def needleman_wunsch(tads1, tads2, penalty=-6., ext_pen=-5.6,
 
     :returns: the max score in the Needleman-Wunsch score matrix.
     """
-    ##############
-    tads1 = [0.0] + tads1
-    tads2 = [0.0] + tads2
-    l_tads1  = len(tads1)
-    l_tads2  = len(tads2)
-    max_dist = log(1. / (abs(max_dist) + 1))
+    [align1, align2], max_score = batch_needleman_wunsch(
+        [(tads1, tads2)], penalty=penalty, ext_pen=ext_pen,
+        max_dist=max_dist)[0]
+    if verbose:
+        print('\n Alignment:')
+        print('TADS 1: '+'|'.join(['%9s' % (str(int(x)) if x!='-' else '-'*3) \
+                                   for x in align1]))
+        print('TADS 2: '+'|'.join(['%9s' % (str(int(x)) if x!='-' else '-'*3) \
+                                   for x in align2]))
+    return [align1, align2], max_score
+
+
+def batch_needleman_wunsch(pairs, penalty=-6., ext_pen=-5.6, max_dist=500000,
+                           block_size=2**22):
+    """
+    Align several pairs of lists of TAD boundaries (see
+    :func:`needleman_wunsch`). The score matrices of the pairs are filled
+    together.
+
+    :param pairs: list of tuples with two lists of boundaries
+    :param -0.1 penalty: penalty to open a gap in the alignment of boundaries
+    :param 500000 max_dist: distance from which match are denied
+    :param 2**22 block_size: maximum number of cells in the score matrices
+       filled at once
+
+    :returns: a list with, for each pair, the alignment and the max score in
+       the Needleman-Wunsch score matrix.
+    """
+    pairs = [([0.0] + list(tads1), [0.0] + list(tads2))
+             for tads1, tads2 in pairs]
+    results = []
+    beg = 0
+    while beg < len(pairs):
+        # group pairs until the block of score matrices is too big
+        end = beg + 1
+        nrows, ncols = len(pairs[beg][0]), len(pairs[beg][1])
+        while end < len(pairs):
+            nrows = max(nrows, len(pairs[end][0]))
+            ncols = max(ncols, len(pairs[end][1]))
+            if (end + 1 - beg) * nrows * ncols > block_size:
+                break
+            end += 1
+        for (tads1, tads2), scores in zip(
+                pairs[beg:end], _fill_scores(pairs[beg:end], penalty,
+                                             ext_pen, max_dist)):
+            results.append(_traceback(scores, tads1, tads2, penalty, ext_pen))
+        beg = end
+    return results
+
+
+def _fill_scores(pairs, penalty, ext_pen, max_dist):
+    """
+    Fills the Needleman-Wunsch score matrices of a batch of pairs of lists of
+    boundaries (starting by 0.0). Rows are computed one after the other for
+    all pairs at once, the extension of gaps along a row being obtained with
+    a cumulative maximum.
+
+    :returns: a list of score matrices (lists of lists)
+    """
+    nrows = max(len(tads1) for tads1, _ in pairs)
+    ncols = max(len(tads2) for _, tads2 in pairs)
+    tads1 = np.zeros((len(pairs), nrows))
+    tads2 = np.zeros((len(pairs), ncols))
+    for b, (t1, t2) in enumerate(pairs):
+        tads1[b, :len(t1)] = t1
+        tads2[b, :len(t2)] = t2
+    scores = np.empty((len(pairs), nrows, ncols))
+    scores[:, 0] = penalty * np.arange(ncols)
+    scores[:, :, 0] = penalty * np.arange(nrows)[None]
+    max_dist = np.log(1. / (abs(max_dist) + 1))
+    exts = ext_pen * np.arange(ncols - 1)
+    for i in range(1, nrows if ncols > 1 else 1):
+        d_dist = np.log(1. / (abs(tads2[:, 1:] - tads1[:, i, None]) + 1))
+        insert = scores[:, i - 1, 1:] + ext_pen
+        # only the first cell of the matrix uses the gap opening penalty
+        pen = penalty if i == 1 else ext_pen
+        insert[:, 0] = scores[:, i - 1, 1] + pen
+        best = np.where(d_dist < max_dist, insert,
+                        np.maximum(d_dist + scores[:, i - 1, :-1], insert))
+        best[:, 0] = np.maximum(best[:, 0], scores[:, i, 0] + pen)
+        # deletions: score[j] = max(best[j], score[j - 1] + ext_pen)
+        scores[:, i, 1:] = np.maximum.accumulate(best - exts, axis=1) + exts
+    return [scores[b, :len(t1), :len(t2)].tolist()
+            for b, (t1, t2) in enumerate(pairs)]
+
+
+def _traceback(scores, tads1, tads2, penalty, ext_pen):
+    """
+    Follows the best path in a Needleman-Wunsch score matrix.
+
+    :returns: the alignment and the max score along the path
+    """
     dister = lambda x, y: log(1. / (abs(x - y) + 1))
-    scores = _virgin_score(penalty, l_tads1, l_tads2)
-    pen = penalty
-    for i in range(1, l_tads1):
-        for j in range(1, l_tads2):
-            d_dist = dister(tads2[j], tads1[i])
-            match  = d_dist + scores[i-1][j-1]
-            insert = scores[i-1][j] + pen
-            delete = scores[i][j-1] + pen
-            if d_dist < max_dist:
-                scores[i][j] = max((insert, delete))
-                pen = ext_pen
-            else:
-                if match >= max(insert, delete):
-                    pen = ext_pen
-                else:
-                    pen = ext_pen
-                scores[i][j] = max((match, insert, delete))
     align1 = []
     align2 = []
-    i = l_tads1 -1
-    j = l_tads2 -1
+    i = len(tads1) - 1
+    j = len(tads2) - 1
     max_score = float('-inf')
     while i and j:
         score      = scores[i][j]
@@ -92,25 +163,9 @@ def needleman_wunsch(tads1, tads2, penalty=-6., ext_pen=-5.6,
         align1.insert(0, '-')
         align2.insert(0, tads2[j])
         j -= 1
-        
-    if verbose:
-        print('\n Alignment:')
-        print('TADS 1: '+'|'.join(['%9s' % (str(int(x)) if x!='-' else '-'*3) \
-                                   for x in align1]))
-        print('TADS 2: '+'|'.join(['%9s' % (str(int(x)) if x!='-' else '-'*3) \
-                                   for x in align2]))
     return [align1, align2], max_score
 
 
-def _virgin_score(penalty, l_tads1, l_tads2):
-    """
-    creates empty matrix
-    """
-    zeros    = [0.0 for _ in range(l_tads2)]
-    return [[penalty * j for j in range(l_tads2)]] + \
-           [[penalty * i] + zeros for i in range(1, l_tads1)]
-
-
 def _equal(a, b, cut_off=1e-9):
     """
     """
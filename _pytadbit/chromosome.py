@@ -365,7 +365,8 @@ class Chromosome(object):
 
     def align_experiments(self, names=None, verbose=False, randomize=False,
                           rnd_method='interpolate', rnd_num=1000,
-                          get_score=False, **kwargs):
+                          get_score=False, n_cpus=1, seed=None, alpha=None,
+                          confidence=0.99, chunk_size=50, **kwargs):
         """
         Align the predicted boundaries of two different experiments. The
         resulting alignment will be stored in the self.experiment list.
@@ -389,6 +390,13 @@ class Chromosome(object):
            distribution. The alternative method is 'shuffle', where TADs are
            simply shuffled
         :param 1000 rnd_num: number of randomizations to do
+        :param 1 n_cpus: number of CPUs used to run the randomizations
+        :param None seed: random seed of the randomizations, a given seed gives
+           the same p-value whatever the number of CPUs
+        :param None alpha: if given, randomizations stop as soon as the
+           confidence interval of the p-value is entirely above or below alpha
+        :param 0.99 confidence: confidence level of the interval of the p-value
+        :param 50 chunk_size: number of randomizations per block
         :param reciprocal method: if global, Needleman-Wunsch is used to align
             (see :func:`pytadbit.boundary_aligner.globally.needleman_wunsch`);
             if reciprocal, a method based on reciprocal closest boundaries is
@@ -433,7 +441,9 @@ class Chromosome(object):
                 return ali
         p_value = randomization_test(xpers, score=score, rnd_method=rnd_method,
                                      verbose=verbose, r_size=self.r_size,
-                                     num=rnd_num, **kwargs)
+                                     num=rnd_num, n_cpus=n_cpus, seed=seed,
+                                     alpha=alpha, confidence=confidence,
+                                     chunk_size=chunk_size, **kwargs)
         return ali, (score, p_value, perc1, perc2)
 
 
@@ -17,7 +17,7 @@ from pytadbit                            import HiC_data
 from pytadbit.parsers.hic_parser         import read_matrix
 from pytadbit.utils.extraviews           import nicer
 from pytadbit.utils.extraviews           import tadbit_savefig
-from pytadbit.utils.tadmaths             import zscore
+from pytadbit.utils.tadmaths             import zscore_array, ZscoreDict
 from pytadbit.utils.normalize_hic        import iterative
 from pytadbit.utils.hic_filtering        import hic_filtering_for_modelling
 from pytadbit.parsers.tad_parser         import parse_tads
@@ -108,6 +108,84 @@ def load_experiment_from_reads(name, fnam, genome_seq, resolution,
                       cell_type=cell_type, enzyme=enzyme, exp_type=exp_type,
                       **kw_descr)
 
+def _coarsen_matrix(hic, size, fact, new_size):
+    """
+    Sum the cells of a Hi-C matrix by blocks of fact x fact (the last block of
+    each row and column may be smaller).
+
+    :param hic: HiC_data object
+    :param size: number of rows of the original matrix
+    :param fact: number of original bins per new bin
+    :param new_size: number of rows of the new matrix
+
+    :returns: a HiC_data object with the non-zero sums
+    """
+    keys = np.fromiter(hic.keys(), dtype=np.int64)
+    vals = np.array(list(hic.values()))
+    # sum each block in row-major order of the original cells
+    order = np.argsort(keys, kind='stable')
+    keys  = keys[order]
+    vals  = vals[order]
+    new_keys = (keys // size // fact) * new_size + (keys % size) // fact
+    uniq, inv = np.unique(new_keys, return_inverse=True)
+    sums = np.zeros(len(uniq), dtype=vals.dtype)
+    np.add.at(sums, inv, vals)
+    kept = sums != 0
+    mtrx = HiC_data((), new_size)
+    dict.update(mtrx, zip(uniq[kept].tolist(), sums[kept].tolist()))
+    return mtrx
+
+def _sum_matrices(hic1, hic2, size):
+    """
+    Sum two Hi-C matrices of the same size.
+
+    :returns: a HiC_data object with the cells of hic1 followed by the cells
+       found only in hic2
+    """
+    keys = np.fromiter(list(hic1.keys()) + list(hic2.keys()), dtype=np.int64)
+    vals = np.array(list(hic1.values()) + list(hic2.values()))
+    uniq, first, inv = np.unique(keys, return_index=True, return_inverse=True)
+    sums = np.zeros(len(uniq), dtype=vals.dtype)
+    np.add.at(sums, inv, vals)
+    order = np.argsort(first)
+    mtrx = HiC_data((), size)
+    dict.update(mtrx, zip(uniq[order].tolist(), sums[order].tolist()))
+    return mtrx
+
+def _matrix_values(mtrx, keys):
+    """
+    :param mtrx: HiC_data object (or dictionary), or flat list of values
+    :param keys: array of positions in the matrix
+
+    :returns: an array, with the shape of keys, of the values at these
+       positions (0 for positions missing in a dictionary)
+    """
+    keys = np.asarray(keys, dtype=np.int64)
+    if not isinstance(mtrx, dict):
+        return np.asarray(mtrx)[keys]
+    pos  = np.fromiter(mtrx.keys(), dtype=np.int64)
+    vals = np.array(list(mtrx.values()))
+    flat = keys.ravel()
+    order = np.argsort(flat, kind='stable')
+    sorted_keys = flat[order]
+    idx = np.searchsorted(sorted_keys, pos)
+    found = idx < len(flat)
+    found[found] = sorted_keys[idx[found]] == pos[found]
+    values = np.zeros(len(flat), dtype=vals.dtype if len(vals) else float)
+    values[order[idx[found]]] = vals[found]
+    return values.reshape(keys.shape)
+
+def _coarsen_columns(zeros, size, fact):
+    """
+    :returns: dictionary of the new bins for which all the original bins are
+       in zeros (filtered columns)
+    """
+    new_size = size // fact + (1 if size % fact else 0)
+    bins = np.fromiter((z for z in zeros if 0 <= z < size), dtype=np.int64)
+    counts = np.bincount(bins // fact, minlength=new_size)
+    widths = np.minimum(fact, size - np.arange(new_size) * fact)
+    return dict((b, None) for b in np.flatnonzero(counts == widths).tolist())
+
 class Experiment(object):
     """
     Hi-C experiment.
@@ -195,6 +273,8 @@ class Experiment(object):
         self._filtered_cols  = False
         self._zeros          = {}
         self._zscores        = {}
+        self._ori_zeros      = {}
+        self._ori_zscores    = {}
         if hic_data:
             self.load_hic_data(hic_data, parser, **kw_descr)
         if norm_data:
@@ -242,9 +322,9 @@ class Experiment(object):
             self.set_resolution(resolution)
             other.set_resolution(resolution)
             if not silent:
-                stderr.write('WARNING: experiments of different resolution, ' +
-                             'setting both resolution of %s, and normalizing ' +
-                             'at this resolution\n' % (resolution))
+                stderr.write(('WARNING: experiments of different resolution, ' +
+                              'setting both resolution of %s, and normalizing ' +
+                              'at this resolution\n') % (resolution))
             norm1 = copy(self.norm)
             norm2 = copy(other.norm)
             if self._normalization:
@@ -253,11 +333,8 @@ class Experiment(object):
                 other.normalize_hic()
             changed_reso = True
         if self.hic_data:
-            new_hicdata = HiC_data([], size=self.size)
-            for i in self.hic_data[0]:
-                new_hicdata[i] = self.hic_data[0].get(i)
-            for i in other.hic_data[0]:
-                new_hicdata[i] += other.hic_data[0].get(i)
+            new_hicdata = _sum_matrices(self.hic_data[0], other.hic_data[0],
+                                        self.size)
         else:
             new_hicdata = None
         xpr = Experiment(name='%s+%s' % (self.name, other.name),
@@ -268,11 +345,8 @@ class Experiment(object):
         if self._normalization != None and other._normalization != None:
             if (self._normalization.split('_factor:')[0] ==
                 other._normalization.split('_factor:')[0]):
-                xpr.norm = [HiC_data([], size=self.size)]
-                for i in self.norm[0]:
-                    xpr.norm[0][i] = self.norm[0].get(i)
-                for i in other.norm[0]:
-                    xpr.norm[0][i] += other.norm[0].get(i)
+                xpr.norm = [_sum_matrices(self.norm[0], other.norm[0],
+                                          self.size)]
                 # The final value of the factor should be the sum of each
                 try:
                     xpr._normalization = (
@@ -342,9 +416,9 @@ class Experiment(object):
             self.set_resolution(resolution)
             other.set_resolution(resolution)
             if not silent:
-                stderr.write('WARNING: experiments of different resolution, ' +
-                             'setting both resolution of %s, and normalizing ' +
-                             'at this resolution\n' % (resolution))
+                stderr.write(('WARNING: experiments of different resolution, ' +
+                              'setting both resolution of %s, and normalizing ' +
+                              'at this resolution\n') % (resolution))
             norm1 = copy(self.norm)
             norm2 = copy(other.norm)
             if self._normalization:
@@ -453,9 +527,13 @@ class Experiment(object):
             self.norm       = self._ori_norm
             self.size       = self._ori_size
             self.resolution = self._ori_resolution
+            self._zeros     = self._ori_zeros
+            self._zscores   = self._ori_zscores
             return
         # if current resolution is the original one
         if self.resolution == self._ori_resolution:
+            self._ori_zeros   = self._zeros
+            self._ori_zscores = self._zscores
             if self.hic_data:
                 self._ori_hic  = copy(self.hic_data)
             if self.norm:
@@ -471,47 +549,32 @@ class Experiment(object):
                     pass
         self.resolution = resolution
         fact = self.resolution // self._ori_resolution
-        # super for!
         try:
             size = len(self._ori_hic[0])
         except TypeError:
             size = len(self._ori_norm[0])
-        self.size     = size // fact
-        rest = size % fact
-        if rest:
-            self.size += 1
-        self.hic_data = [HiC_data([], size // fact + (1 if rest else 0))]
-        self.norm     = [HiC_data([], size // fact + (1 if rest else 0))]
-        def resize(mtrx, copee):
-            "resize both hic_data and normalized data"
-            for i in range(0, size, fact):
-                for j in range(0, size, fact):
-                    val = 0
-                    for k in range(fact):
-                        if i + k >= size:
-                            break
-                        for l in  range(fact):
-                            if j + l >= size:
-                                break
-                            val += copee[(i + k) * size + j + l]
-                    if val:
-                        mtrx[i//fact * self.size + j//fact] = val
+        self.size = size // fact + (1 if size % fact else 0)
+        self.hic_data = [HiC_data([], self.size)]
+        self.norm     = [HiC_data([], self.size)]
         try:
-            resize(self.hic_data[0], self._ori_hic[0])
+            self.hic_data = [_coarsen_matrix(self._ori_hic[0], size, fact,
+                                             self.size)]
         except TypeError:
             pass
         try:
-            resize(self.norm[0], self._ori_norm[0])
+            self.norm = [_coarsen_matrix(self._ori_norm[0], size, fact,
+                                         self.size)]
         except TypeError:
             pass
-        # we need to recalculate zeros:
-        if self._filtered_cols:
-            stderr.write('WARNING: definition of filtered columns lost at ' +
-                         'this resolution\n')
-            self._filtered_cols = False
+        # a new bin is filtered out if all its original bins are, z-scores
+        # need to be recomputed at this resolution
+        self._zeros   = _coarsen_columns(self._ori_zeros, size, fact)
+        self._zscores = {}
         if not keep_original:
             del(self._ori_hic)
             del(self._ori_norm)
+            del(self._ori_zeros)
+            del(self._ori_zscores)
 
 
     def filter_columns(self, silent=False, draw_hist=False, savefig=None,
@@ -751,7 +814,9 @@ class Experiment(object):
     def get_hic_zscores(self, normalized=True, zscored=True, remove_zeros=True):
         """
         Normalize the Hi-C raw data. The result will be stored into
-        the private Experiment._zscore list.
+        the private Experiment._zscores, read as a nested dictionary
+        (rows are built from arrays only when accessed, see
+        :class:`pytadbit.utils.tadmaths.ZscoreDict`).
 
         :param True normalized: whether to normalize the result using the
            weights (see :func:`normalize_hic`)
@@ -760,49 +825,33 @@ class Experiment(object):
            interaction are informative.
 
         """
-        values = {}
-        zeros  = {}
-        self._zscores = {}
+        # pairs of bins (i < j) without filtered columns, in row-major order
+        # zeros are rows or columns having a zero in the diagonal
+        bins = np.array([i for i in range(self.size) if i not in self._zeros],
+                        dtype=np.int64)
+        rows, cols = np.triu_indices(len(bins), 1)
+        rows = bins[rows]
+        cols = bins[cols]
         if normalized:
-            for i in range(self.size):
-                # zeros are rows or columns having a zero in the diagonal
-                if i in self._zeros:
-                    continue
-                for j in range(i + 1, self.size):
-                    if j in self._zeros:
-                        continue
-                    if (not self.norm[0][i * self.size + j]
-                        and remove_zeros):
-                        zeros[(i, j)] = None
-                        continue
-                    values[(i, j)] = self.norm[0][i * self.size + j]
+            values = _matrix_values(self.norm[0], rows * self.size + cols)
+            if remove_zeros:
+                kept   = values != 0
+                rows   = rows[kept]
+                cols   = cols[kept]
+                values = values[kept]
         else:
-            for i in range(self.size):
-                if i in self._zeros:
-                    continue
-                for j in range(i + 1, self.size):
-                    if j in self._zeros:
-                        continue
-                    values[(i, j)] = self.hic_data[0][i * self.size + j]
+            values = _matrix_values(self.hic_data[0], rows * self.size + cols)
         # compute Z-score
         if zscored:
-            zscore(values)
-        for i in range(self.size):
-            if i in self._zeros:
-                continue
-            for j in range(i + 1, self.size):
-                if j in self._zeros:
-                    continue
-                if (i, j) in zeros and remove_zeros:
-                    continue
-                self._zscores.setdefault(str(i), {})
-                self._zscores[str(i)][str(j)] = values[(i, j)]
+            values = zscore_array(values)
+        self._zscores = ZscoreDict(rows, cols, values)
 
 
     def model_region(self, start=1, end=None, n_models=5000, n_keep=1000,
                      n_cpus=1, verbose=0, keep_all=False, close_bins=1,
                      outfile=None, config=CONFIG, container=None,
-                     single_particle_restraints=None, use_HiC=True):
+                     single_particle_restraints=None, use_HiC=True,
+                     checkpoint=None, convergence=None, round_size=None):
         """
         Generates of three-dimensional models using IMP, for a given segment of
         chromosome.
@@ -878,6 +927,14 @@ class Experiment(object):
                 type: 'Harmonic', 'HarmonicLowerBound', 'HarmonicUpperBound'
                 kforce: weigth of the restraint
                 radius (nm): radius of the sphere
+        :param None checkpoint: path to a file where each model is stored as
+           soon as it is generated, models already in this file are not
+           generated again (allowing to resume an interrupted run)
+        :param None convergence: tolerance used to stop the generation of
+           models before reaching n_models, once the best models are stable
+           (see :func:`pytadbit.modelling.imp_modelling.generate_3d_models`)
+        :param None round_size: number of models generated between two checks
+           of convergence (by default n_keep)
         :returns: a :class:`pytadbit.imp.structuralmodels.StructuralModels` object.
 
         """
@@ -924,7 +981,9 @@ class Experiment(object):
                                   close_bins=close_bins, config=config, container=container,
                                   experiment=self, coords=coords, zeros=zeros,
                                   single_particle_restraints=single_particle_restraints,
-                                  use_HiC=use_HiC)
+                                  use_HiC=use_HiC, checkpoint=checkpoint,
+                                  convergence=convergence,
+                                  round_size=round_size)
 
     def optimal_imp_parameters(self, start=1, end=None, n_models=500, n_keep=100,
                                n_cpus=1, upfreq_range=(0, 1, 0.1), close_bins=1,
@@ -1035,21 +1094,19 @@ class Experiment(object):
         start -= 1 # things starts at 0 for python. we keep the end coordinate
                    # at its original value because it is inclusive
         siz = self.size
+        # positions of the region in the full matrix
+        region = np.arange(start, end)
+        region = region[:, None] + siz * region[None, :]
         try:
-            matrix = self.get_hic_matrix()
-            new_matrix = [[matrix[i][j] for i in range(start, end)]
-                          for j in range(start, end)]
+            new_matrix = _matrix_values(self.hic_data[0], region).tolist()
             tmp = Chromosome('tmp')
             tmp.add_experiment('exp1', hic_data=[new_matrix],
                                resolution=self.resolution, filter_columns=False)
             exp = tmp.experiments[0]
             # We want the weights and zeros calculated in the full chromosome
-            exp.norm = [[self.norm[0][i + siz * j] for i in range(start, end)
-                         for j in range(start, end)]]
+            exp.norm = [_matrix_values(self.norm[0], region).ravel().tolist()]
         except TypeError: # no Hi-C data provided
-            matrix = self.get_hic_matrix(normalized=True)
-            new_matrix = [[matrix[i][j] for i in range(start, end)]
-                           for j in range(start, end)]
+            new_matrix = _matrix_values(self.norm[0], region).tolist()
             tmp = Chromosome('tmp')
             tmp.add_experiment('exp1', norm_data=[new_matrix],
                                resolution=self.resolution, filter_columns=False)
@@ -1060,19 +1117,16 @@ class Experiment(object):
             raise Exception('ERROR: no interaction found in selected regions')
         # ... but the z-scores in this particular region
         exp.get_hic_zscores()
-        values = [[float('nan') for _ in range(exp.size)]
-                  for _ in range(exp.size)]
-        for i in range(exp.size):
-            # zeros are rows or columns having a zero in the diagonal
-            if i in exp._zeros:
-                continue
-            for j in range(i + 1, exp.size):  # NaNs kept in the diagonal
-                if j in exp._zeros:
-                    continue
-                val = exp.norm[0][i * exp.size + j]
-                values[i][j] = val
-                values[j][i] = val
-        return exp._zscores, values, exp._zeros
+        # NaNs kept in the diagonal and in filtered columns
+        bins = np.array([i for i in range(exp.size) if i not in exp._zeros],
+                        dtype=np.int64)
+        rows, cols = np.triu_indices(len(bins), 1)
+        rows = bins[rows]
+        cols = bins[cols]
+        values = np.full((exp.size, exp.size), np.nan)
+        values[rows, cols] = values[cols, rows] = _matrix_values(
+            exp.norm[0], rows * exp.size + cols)
+        return exp._zscores, values.tolist(), exp._zeros
 
 
     def write_interaction_pairs(self, fname, normalized=True, zscored=True,
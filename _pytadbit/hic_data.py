@@ -7,17 +7,20 @@ from __future__ import print_function
 from future import standard_library
 standard_library.install_aliases()
 import os
+import multiprocessing as mu
 from sys                            import stderr, modules
 from collections                    import OrderedDict
 from warnings                       import warn
 from bisect                         import bisect_right as bisect
-from pickle                         import HIGHEST_PROTOCOL, dump, load
+from pickle                         import HIGHEST_PROTOCOL, dump
+from itertools                      import repeat
 
 from numpy.linalg                   import LinAlgError
 from numpy                          import corrcoef, nansum, array, isnan, mean
 from numpy                          import meshgrid, asarray, exp, linspace, std
 from numpy                          import nanpercentile as npperc, log as nplog
 from numpy                          import nanmax, ma, zeros_like
+import numpy as np
 from scipy.stats                    import ttest_ind, spearmanr
 from scipy.special                  import gammaincc
 from scipy.cluster.hierarchy        import linkage, fcluster, dendrogram
@@ -31,6 +34,7 @@ from pytadbit.utils.hic_filtering   import filter_by_mean, filter_by_zero_count
 from pytadbit.utils.normalize_hic   import iterative, expected
 from pytadbit.parsers.genome_parser import parse_fasta
 from pytadbit.parsers.bed_parser    import parse_bed
+from pytadbit.parsers.biases_parser import read_biases, write_binary_biases
 from pytadbit.utils.file_handling   import mkdir
 from pytadbit.utils.hmm             import gaussian_prob, best_path, train
 from pytadbit.utils.tadmaths        import calinski_harabasz
@@ -163,22 +167,85 @@ class HiC_data(dict):
                                                              self.__size))
             super(HiC_data, self).__setitem__(row_col, val)
 
-    def get_hic_data_as_csr(self):
+    def get_hic_data_as_csr(self, normalized=False, masked=None):
         """
         Returns a scipy sparse matrix in Compressed Sparse Row format of the Hi-C data in the dictionary
 
+        :param False normalized: divide each cell by the biases of its row and
+           column
+        :param None masked: list of columns (and rows) to remove from the
+           matrix, remaining columns are renumbered keeping their order
+
         :returns: scipy sparse matrix in Compressed Sparse Row format
         """
-        values = []
-        cols = []
-        rows = []
-        for key, value in self.items():
-            row, col = round(key // self.__size), key % self.__size
-            values.append(float(value))
-            cols.append(col)
-            rows.append(row)
+        if normalized and not self.bias:
+            raise Exception('ERROR: experiment not normalized yet')
+        size   = self.__size
+        nitems = dict.__len__(self)
+        keys   = np.fromiter(self.keys(), dtype=np.int64, count=nitems)
+        values = np.fromiter(self.values(), dtype=float, count=nitems)
+        rows   = keys // size
+        cols   = keys % size
+        if normalized:
+            bias = np.fromiter((self.bias.get(i, np.nan) for i in range(size)),
+                               dtype=float, count=size)
+            values = values / bias[rows] / bias[cols]
+        if masked:
+            # new index of each column, -1 for removed ones
+            newidx = np.ones(size, dtype=np.int64)
+            newidx[[b for b in masked if 0 <= b < size]] = 0
+            size   = int(newidx.sum())
+            newidx = np.where(newidx > 0, np.cumsum(newidx) - 1, -1)
+            rows   = newidx[rows]
+            cols   = newidx[cols]
+            keep   = (rows >= 0) & (cols >= 0)
+            rows, cols, values = rows[keep], cols[keep], values[keep]
+        return csr_matrix((values, (rows, cols)), shape=(size, size))
+
+    def get_diagonals(self, dists, normalized=False):
+        """
+        Returns diagonals of the Hi-C matrix as numpy arrays, read directly
+        from the sparse storage (the whole dictionary is scanned only when it
+        holds less cells than the requested diagonals).
 
-        return csr_matrix((values, (rows, cols)), shape=(self.__size,self.__size))
+        :param dists: list of distances from the main diagonal (in bins)
+        :param False normalized: divide each cell by the biases of its row and
+           column (missing biases are set to NaN)
+
+        :returns: a dictionary with, for each distance d, an array of length
+           len(self) - d where the element j corresponds to the cell (j, j + d)
+        """
+        if normalized and not self.bias:
+            raise Exception('ERROR: data should be normalized by visibility '
+                            'to get normalized diagonals')
+        size  = self.__size
+        dists = sorted(set(d for d in dists if 0 <= d < size))
+        diags = {}
+        if dict.__len__(self) < sum(size - d for d in dists):
+            for d in dists:
+                diags[d] = np.zeros(size - d)
+            nitems = dict.__len__(self)
+            keys = np.fromiter(self.keys(), dtype=np.int64, count=nitems)
+            vals = np.fromiter(self.values(), dtype=float, count=nitems)
+            rows = keys // size
+            dist = keys % size - rows
+            keep = np.isin(dist, dists)
+            rows, dist, vals = rows[keep], dist[keep], vals[keep]
+            for d in dists:
+                here = dist == d
+                diags[d][rows[here]] = vals[here]
+        else:
+            for d in dists:
+                pos = np.arange(size - d, dtype=np.int64) * (size + 1) + d
+                diags[d] = np.fromiter(map(self.get, pos.tolist(),
+                                           repeat(0, size - d)),
+                                       dtype=float, count=size - d)
+        if normalized:
+            bias = np.fromiter((self.bias.get(i, np.nan) for i in range(size)),
+                               dtype=float, count=size)
+            for d in dists:
+                diags[d] = diags[d] / bias[d:] / bias[:size - d]
+        return diags
 
     def add_sections_from_fasta(self, fasta):
         """
@@ -343,6 +410,8 @@ class HiC_data(dict):
             self.bads.update(filter_by_mean(
                 self, draw_hist=draw_hist, silent=silent,
                 savefig=savefig, bads=self.bads))
+        # expected values computed before are not valid anymore
+        self.expected = None
         if not silent:
             print('Found %d of %d columns with poor signal' % (len(self.bads),
                                                                len(self)))
@@ -375,6 +444,14 @@ class HiC_data(dict):
         return norm_sum
 
     def normalize_expected(self, **kwargs):
+        """
+        Computes the expected interactions at each genomic distance (see
+        :func:`pytadbit.utils.normalize_hic.expected`) and stores them in
+        HiC_data.expected. They are kept until bad columns or biases change,
+        and saved with the biases (see :func:`HiC_data.save_biases`).
+
+        :param kwargs: passed to :func:`pytadbit.utils.normalize_hic.expected`
+        """
         self.expected = expected(self, bads=self.bads, **kwargs)
 
     def normalize_hic(self, iterations=0, max_dev=0.1, silent=False,
@@ -411,30 +488,36 @@ class HiC_data(dict):
             target = (norm_sum / float(len(self) * len(self) * factor))**0.5
             bias = dict([(b, bias[b] * target) for b in bias])
         self.bias = bias
+        # expected values computed before are not valid anymore
+        self.expected = None
 
-    def save_biases(self, fnam, protocol=None):
+    def save_biases(self, fnam, protocol=None, binary=False):
         """
         Save biases, decay and bad columns in pickle format (to be loaded by
         the function load_hic_data_from_bam)
 
         :param fnam: path to output file
+        :param False binary: save in TADbit binary biases format (see
+           :mod:`pytadbit.parsers.biases_parser`) instead of pickle
         """
+        biases = {'biases'    : self.bias,
+                  'decay'     : self.expected,
+                  'badcol'    : self.bads,
+                  'resolution': self.resolution}
+        if binary:
+            write_binary_biases(fnam, biases, size=len(self))
+            return
         out = open(fnam, 'wb')
-
-        dump({'biases'    : self.bias,
-              'decay'     : self.expected,
-              'badcol'    : self.bads,
-              'resolution': self.resolution}, out,
-             protocol if protocol else HIGHEST_PROTOCOL)
+        dump(biases, out, protocol if protocol else HIGHEST_PROTOCOL)
         out.close()
 
     def load_biases(self, fnam, protocol=None):
         """
-        Load biases, decay and bad columns from pickle file
+        Load biases, decay and bad columns from pickle (or binary) file
 
         :param fnam: path to input pickle file
         """
-        biases = load(open(fnam,'rb'))
+        biases = read_biases(fnam)
         if biases['resolution'] != self.resolution:
             raise Exception(('Error: resolution in Pickle (%d) does not match '
                              'the one of this HiC_data object (%d)') % (
@@ -444,9 +527,14 @@ class HiC_data(dict):
         self.bads     = biases['badcol']
 
     def get_as_tuple(self):
-        return tuple([self[i, j]
-                      for j in range(len(self))
-                      for i in range(len(self))])
+        size = self.__size
+        nitems = dict.__len__(self)
+        keys = np.fromiter(self.keys(), dtype=np.int64, count=nitems)
+        values = np.array(list(self.values()))
+        matrix = np.zeros(size * size, dtype=values.dtype if nitems else int)
+        matrix[keys] = values
+        # cell (i, j) stored at position i + j * size
+        return tuple(matrix.reshape(size, size).T.ravel().tolist())
 
     def write_coord_table(self, fname, focus=None, diagonal=True,
                           normalized=False, format='BED'):
@@ -732,11 +820,55 @@ class HiC_data(dict):
             end1   = end2   = siz
         return start1, start2, end1, end2
 
+    def _compartment_jobs(self, secs, max_ev, smoothing_window, keep_matrix):
+        """
+        Yields, for each chromosome, the arguments of
+        :func:`_compartment_eigenvectors`: the non-null cells of the upper
+        triangle of its observed/expected matrix, without bad columns (the
+        whole matrix is read only once).
+        """
+        size   = self.__size
+        good   = np.ones(size, dtype=bool)
+        good[[b for b in self.bads if 0 <= b < size]] = False
+        newidx = np.cumsum(good) - 1
+        nitems = dict.__len__(self)
+        keys   = np.fromiter(self.keys(), dtype=np.int64, count=nitems)
+        values = np.fromiter(self.values(), dtype=float, count=nitems)
+        rows   = keys // size
+        cols   = keys % size
+        keep   = (rows <= cols) & good[rows] & good[cols]
+        keys, values = keys[keep], values[keep]
+        order  = np.argsort(keys)
+        keys, values = keys[order], values[order]
+        rows   = keys // size
+        cols   = keys % size
+        bias   = np.fromiter((self.bias.get(i, np.nan) for i in range(size)),
+                             dtype=float, count=size)
+        for sec in secs:
+            sec_b, sec_e = self.section_pos[sec]
+            nbins = int(good[sec_b:sec_e].sum())
+            if not nbins or (sec in self.expected and not self.expected[sec]):
+                yield None, None, None, 0, max_ev, smoothing_window, keep_matrix
+                continue
+            decay = self.expected[sec] if sec in self.expected else self.expected
+            gbins = np.flatnonzero(good[sec_b:sec_e])
+            decay = np.array([decay[d] for d in range(gbins[-1] - gbins[0] + 1)],
+                             dtype=float)
+            beg, end = np.searchsorted(rows, [sec_b, sec_e])
+            inside = cols[beg:end] < sec_e
+            sec_rows = rows[beg:end][inside]
+            sec_cols = cols[beg:end][inside]
+            sec_vals = (values[beg:end][inside] / decay[sec_cols - sec_rows]
+                        / bias[sec_rows] / bias[sec_cols])
+            offset = int(good[:sec_b].sum())
+            yield (newidx[sec_rows] - offset, newidx[sec_cols] - offset,
+                   sec_vals, nbins, max_ev, smoothing_window, keep_matrix)
+
     def find_compartments(self, crms=None, savefig=None, savedata=None,
                           savecorr=None, show=False, suffix='', ev_index=None,
                           rich_in_A=None, format='png', savedir=None, 
                           max_ev=3, show_compartment_labels=False, 
-                          smoothing_window=0, **kwargs):
+                          smoothing_window=0, n_cpus=1, **kwargs):
         """
         Search for A/B compartments in each chromosome of the Hi-C matrix.
         Hi-C matrix is normalized by the number interaction expected at a given
@@ -791,8 +923,7 @@ class HiC_data(dict):
            scipy.ndimage. The parameter is passed as `size` to the median_filter 
            function.
         :param False show_compartment_labels: if True draw A and B compartment blocks.
-
-        TODO: this is really slow...
+        :param 1 n_cpus: number of chromosomes processed in parallel
 
         Notes: building the distance matrix using the amount of interactions
                instead of the mean correlation, gives generally worse results.
@@ -814,15 +945,15 @@ class HiC_data(dict):
                 self.bads = {}
                 warn('WARNING: all columns would have been filtered out, '
                      'filtering disabled')
-        if not self.expected:
-            if kwargs.get('verbose', False):
-                print('Normalizing by expected values')
-            self.expected = expected(self, bads=self.bads, **kwargs)
         if not self.bias:
             if kwargs.get('verbose', False):
                 print('Normalizing by ICE (1 round)')
             self.normalize_hic(iterations=0,
                                silent=not kwargs.get('verbose', False))
+        if not self.expected:
+            if kwargs.get('verbose', False):
+                print('Normalizing by expected values')
+            self.normalize_expected(**kwargs)
         if savefig:
             mkdir(savefig)
         if savecorr:
@@ -841,192 +972,169 @@ class HiC_data(dict):
         count = 0
         richA_stats = dict((sec, None) for sec in self.section_pos)
 
-        for sec, (sec_b, sec_e) in self.section_pos.items():
-            if crms and sec not in crms:
-                continue
-            if kwargs.get('verbose', False):
-                print('Processing chromosome', sec)
-            # get chromosomal matrix
-            try:
-                matrix = [[(float(self[i,j]) / self.expected[sec][abs(j-i)]
-                            / self.bias[i] / self.bias[j])
-                        for i in range(sec_b, sec_e)
-                        if not i in self.bads]
-                        for j in range(sec_b, sec_e)
-                        if not j in self.bads]
-            except KeyError:
-                if sec in self.expected and not self.expected[sec]:
-                    matrix = []
-                else:
-                    matrix = [[(float(self[i,j]) / self.expected[abs(j-i)]
-                                / self.bias[i] / self.bias[j])
-                            for i in range(sec_b, sec_e)
-                            if not i in self.bads]
-                            for j in range(sec_b, sec_e)
-                            if not j in self.bads]
-            if not matrix: # MT chromosome will fall there
-                warn('Chromosome %s is probably MT :)' % (sec))
-                cmprts[sec] = []
-                count += 1
-                continue
-
-            # enforce symmetry
-            for i, row in enumerate(matrix):
-                for j, val in enumerate(row[:i]):
-                    matrix[j][i] = val
+        secs = [sec for sec in self.section_pos if not crms or sec in crms]
+        jobs = self._compartment_jobs(
+            secs, max_ev, smoothing_window,
+            keep_matrix=bool(savecorr or savefig or show))
+        pool = mu.Pool(n_cpus) if n_cpus > 1 else None
+        try:
+            if pool:
+                results = pool.imap(_compartment_eigenvectors, jobs)
+            else:
+                results = map(_compartment_eigenvectors, jobs)
 
-            # compute correlation coefficient
-            try:
-                matrix = [list(m) for m in corrcoef(matrix)]
-            except TypeError:
-                # very small chromosome?
-                warn('Chromosome %s is probably MT :)' % (sec))
-                cmprts[sec] = []
-                count += 1
-                continue
-            # replace nan in correlation matrix
-            matrix = [[0. if isnan(v) else v for v in l] for l in matrix]
-            # write correlation matrix to file. replaces filtered row/columns by NaN
-            if savecorr:
-                out = open(os.path.join(savecorr, '%s_corr-matrix%s.tsv' % (sec, suffix)),
-                           'w')
-                out.write('# MASKED %s\n' % (' '.join([str(k - sec_b)
-                                                       for k in self.bads
-                                                       if sec_b <= k <= sec_e])))
-                rownam = ['%s\t%d-%d' % (k[0],
-                                         k[1] * self.resolution,
-                                         (k[1] + 1) * self.resolution)
-                          for k in sorted(self.sections,
-                                          key=lambda x: self.sections[x])
-                          if k[0] == sec]
-                length = sec_e - sec_b
-                empty = 'NaN\t' * (length - 1) + 'NaN\n'
-                badrows = 0
-                for row, posx in enumerate(range(sec_b, sec_e)):
-                    if posx in self.bads:
-                        out.write(rownam.pop(0) + '\t' + empty)
-                        badrows += 1
-                        continue
-                    vals = []
-                    badcols = 0
-                    for col, posy in enumerate(range(sec_b, sec_e)):
-                        if posy in self.bads:
-                            vals.append('NaN')
-                            badcols += 1
+            for sec, result in zip(secs, results):
+                sec_b, sec_e = self.section_pos[sec]
+                if kwargs.get('verbose', False):
+                    print('Processing chromosome', sec)
+                if result is None: # MT chromosome will fall there
+                    warn('Chromosome %s is probably MT :)' % (sec))
+                    cmprts[sec] = []
+                    count += 1
+                    continue
+                matrix, smoothed, evals, evect = result
+                # write correlation matrix to file. replaces filtered row/columns by NaN
+                if savecorr:
+                    matrix = matrix.tolist()
+                    out = open(os.path.join(savecorr, '%s_corr-matrix%s.tsv' % (sec, suffix)),
+                               'w')
+                    out.write('# MASKED %s\n' % (' '.join([str(k - sec_b)
+                                                           for k in self.bads
+                                                           if sec_b <= k <= sec_e])))
+                    rownam = ['%s\t%d-%d' % (k[0],
+                                             k[1] * self.resolution,
+                                             (k[1] + 1) * self.resolution)
+                              for k in sorted(self.sections,
+                                              key=lambda x: self.sections[x])
+                              if k[0] == sec]
+                    length = sec_e - sec_b
+                    empty = 'NaN\t' * (length - 1) + 'NaN\n'
+                    badrows = 0
+                    for row, posx in enumerate(range(sec_b, sec_e)):
+                        if posx in self.bads:
+                            out.write(rownam.pop(0) + '\t' + empty)
+                            badrows += 1
                             continue
-                        vals.append(str(matrix[row-badrows][col-badcols]))
-                    out.write(rownam.pop(0) + '\t' +'\t'.join(vals) + '\n')
-                out.close()
-
-            if smoothing_window:
-                matrix = [[v for v in l] for l in median_filter(
-                    matrix, size=smoothing_window)]
-
-            # get eigenvectors
-            try:
-                # This eighs is very very fast, only ask for one eigenvector
-                evals, evect = eigsh(array(matrix),
-                                     k=max_ev if max_ev else (len(matrix) - 1))
-            except (LinAlgError, ValueError):
-                warn(f'Chromosome {sec} too small to compute PC1')
-                cmprts[sec] = [] # Y chromosome, or so...
-                count += 1
-                continue
-            # define breakpoints, and store first EVs
-            n_first = [list(evect[:, -i])
-                       for i in range(1, (max_ev + 1)
-                                       if max_ev else len(matrix))]
-            ev_num = (ev_index[count] - 1) if ev_index else 0
-            breaks = [i for i, (a, b) in
-                      enumerate(zip(n_first[ev_num][1:], n_first[ev_num][:-1]))
-                      if a * b < 0] + [len(n_first[ev_num]) - 1]
-            breaks = [{'start': breaks[i-1] + 1 if i else 0, 'end': b}
-                      for i, b in enumerate(breaks)]
+                        vals = []
+                        badcols = 0
+                        for col, posy in enumerate(range(sec_b, sec_e)):
+                            if posy in self.bads:
+                                vals.append('NaN')
+                                badcols += 1
+                                continue
+                            vals.append(str(matrix[row-badrows][col-badcols]))
+                        out.write(rownam.pop(0) + '\t' +'\t'.join(vals) + '\n')
+                    out.close()
+
+                if evect is None:
+                    warn(f'Chromosome {sec} too small to compute PC1')
+                    cmprts[sec] = [] # Y chromosome, or so...
+                    count += 1
+                    continue
+                matrix = None if smoothed is None else smoothed.tolist()
+                # define breakpoints, and store first EVs
+                n_first = [list(evect[:, -i])
+                           for i in range(1, evect.shape[1] + 1)]
+                ev_num = (ev_index[count] - 1) if ev_index else 0
+                breaks = [i for i, (a, b) in
+                          enumerate(zip(n_first[ev_num][1:], n_first[ev_num][:-1]))
+                          if a * b < 0] + [len(n_first[ev_num]) - 1]
+                breaks = [{'start': breaks[i-1] + 1 if i else 0, 'end': b}
+                          for i, b in enumerate(breaks)]
 
-            # rescale EVs, matrix and breaks by inserting NaNs in bad column places
-            beg, end = self.section_pos[sec]
-            bads = [k - beg for k in sorted(self.bads) if beg <= k <= end]
-            for evect in n_first:
-                _ = [evect.insert(b, float('nan')) for b in bads]
-            _ = [matrix.insert(b, [float('nan')] * len(matrix[0]))
-                 for b in bads]
-            _ = [matrix[i].insert(b, float('nan'))
-                 for b in bads for i in range(len(n_first[0]))]
-            for b in bads:  # they are sorted
-                for brk in breaks:
-                    if brk['start'] >= b:
-                        brk['start'] += 1
-                        brk['end'  ] += 1
-                    else:
-                        brk['end'  ] += brk['end'] > b
-            bads = set(bads)
-
-            # rescale first EV and change sign according to rich_in_A
-            richA_stats[sec] = None
-            sign = 1
-            if rich_in_A and sec in rich_in_A:
-                eves = []
-                gccs = []
-                for i, v in enumerate(n_first[ev_num]):
-                    if i in bads:
-                        continue
-                    try:
-                        gc = rich_in_A[sec][i]
-                    except KeyError:
-                        continue
-                    gccs.append(gc)
-                    eves.append(v)
-                r_stat, richA_pval = spearmanr(eves, gccs)
-                if kwargs.get('verbose', False):
-                    print ('  - Spearman correlation between "rich in A" and '
-                           'Eigenvector:\n'
-                           '      rho: %.7f p-val:%.7f' % (r_stat, richA_pval))
-                richA_stats[sec] = r_stat
-                # switch sign and normalize
-                sign = 1 if r_stat > 0 else -1
-            for i in range(len(n_first)):
-                n_first[i] = [sign * v for v in n_first[i]]
-            # store it
-            ev_nums[sec] = ev_num + 1
-            cmprts[sec] = breaks
-            if rich_in_A:
-                for cmprt in cmprts[sec]:
+                # rescale EVs, matrix and breaks by inserting NaNs in bad column places
+                beg, end = self.section_pos[sec]
+                bads = [k - beg for k in sorted(self.bads) if beg <= k <= end]
+                for evect in n_first:
+                    _ = [evect.insert(b, float('nan')) for b in bads]
+                if matrix is not None:
+                    _ = [matrix.insert(b, [float('nan')] * len(matrix[0]))
+                         for b in bads]
+                    _ = [matrix[i].insert(b, float('nan'))
+                         for b in bads for i in range(len(n_first[0]))]
+                for b in bads:  # they are sorted
+                    for brk in breaks:
+                        if brk['start'] >= b:
+                            brk['start'] += 1
+                            brk['end'  ] += 1
+                        else:
+                            brk['end'  ] += brk['end'] > b
+                bads = set(bads)
+
+                # rescale first EV and change sign according to rich_in_A
+                richA_stats[sec] = None
+                sign = 1
+                if rich_in_A and sec in rich_in_A:
+                    eves = []
+                    gccs = []
+                    for i, v in enumerate(n_first[ev_num]):
+                        if i in bads:
+                            continue
+                        try:
+                            gc = rich_in_A[sec][i]
+                        except KeyError:
+                            continue
+                        gccs.append(gc)
+                        eves.append(v)
+                    r_stat, richA_pval = spearmanr(eves, gccs)
+                    if kwargs.get('verbose', False):
+                        print ('  - Spearman correlation between "rich in A" and '
+                               'Eigenvector:\n'
+                               '      rho: %.7f p-val:%.7f' % (r_stat, richA_pval))
+                    richA_stats[sec] = r_stat
+                    # switch sign and normalize
+                    sign = 1 if r_stat > 0 else -1
+                for i in range(len(n_first)):
+                    n_first[i] = [sign * v for v in n_first[i]]
+                # store it
+                ev_nums[sec] = ev_num + 1
+                cmprts[sec] = breaks
+                if rich_in_A:
+                    for cmprt in cmprts[sec]:
+                        try:
+                            cmprt['dens'] = sum(rich_in_A.get(sec, {None: 0}).get(i, 0)
+                                                for i in range(cmprt['start'], cmprt['end'] + 1)
+                                                if not i in bads) / float(cmprt['end'] - cmprt['start'])
+                        except ZeroDivisionError:
+                            cmprt['dens'] = float('nan')
+                        cmprt['type'] = 'A' if n_first[ev_num][cmprt['start']] > 0 else'B'
+                firsts[sec] = (evals[::-1], n_first)
+
+                # needed for the plotting
+                if savefig or show:
+                    vmin = kwargs.get('vmin', -1)
+                    vmax = kwargs.get('vmax',  1)
+                    if vmin == 'auto' == vmax:
+                        vmax = max([abs(npperc(matrix, 99.5)),
+                                    abs(npperc(matrix, 0.5))])
+                        vmin = -vmax
                     try:
-                        cmprt['dens'] = sum(rich_in_A.get(sec, {None: 0}).get(i, 0)
-                                            for i in range(cmprt['start'], cmprt['end'] + 1)
-                                            if not i in bads) / float(cmprt['end'] - cmprt['start'])
-                    except ZeroDivisionError:
-                        cmprt['dens'] = float('nan')
-                    cmprt['type'] = 'A' if n_first[ev_num][cmprt['start']] > 0 else'B'
-            firsts[sec] = (evals[::-1], n_first)
+                        if savefig:
+                            fnam = os.path.join(savefig,
+                                                '%s_EV%d%s.%s' % (str(sec),
+                                                                  ev_nums[sec],
+                                                                  suffix,
+                                                                  format))
+                        else:
+                            fnam = None
+                        plot_compartments(
+                            sec, n_first[ev_num], cmprts, matrix, show, fnam,
+                            vmin=vmin, vmax=vmax, whichpc=ev_num + 1,
+                            showAB=show_compartment_labels)
+                    except AttributeError:
+                        warn(('WARNING: chromosome %s too small for plotting.'
+                              'Skipping image creation.') % sec)
+                    except ValueError:
+                        warn(('WARNING: chromosome %s too small for plotting.'
+                              'Skipping image creation.') % sec)
 
-            # needed for the plotting
-            if savefig or show:
-                vmin = kwargs.get('vmin', -1)
-                vmax = kwargs.get('vmax',  1)
-                if vmin == 'auto' == vmax:
-                    vmax = max([abs(npperc(matrix, 99.5)),
-                                abs(npperc(matrix, 0.5))])
-                    vmin = -vmax
-                try:
-                    if savefig:
-                        fnam = os.path.join(savefig,
-                                            '%s_EV%d%s.%s' % (str(sec),
-                                                              ev_nums[sec],
-                                                              suffix,
-                                                              format))
-                    else:
-                        fnam = None
-                    plot_compartments(
-                        sec, n_first[ev_num], cmprts, matrix, show, fnam,
-                        vmin=vmin, vmax=vmax, whichpc=ev_num + 1,
-                        showAB=show_compartment_labels)
-                except AttributeError:
-                    warn(('WARNING: chromosome %s too small for plotting.'
-                          'Skipping image creation.') % sec)
-                except ValueError:
-                    warn(('WARNING: chromosome %s too small for plotting.'
-                          'Skipping image creation.') % sec)
+            if pool:
+                pool.close()
+        finally:
+            # stops workers if one of them, or the processing, failed
+            if pool:
+                pool.terminate()
+                pool.join()
 
         self.compartments = cmprts
         if savedata:
@@ -1125,15 +1233,15 @@ class HiC_data(dict):
                 self.bads = {}
                 warn('WARNING: all columns would have been filtered out, '
                      'filtering disabled')
-        if not self.expected:
-            if kwargs.get('verbose', False):
-                print('Normalizing by expected values')
-            self.expected = expected(self, bads=self.bads, **kwargs)
         if not self.bias:
             if kwargs.get('verbose', False):
                 print('Normalizing by ICE (1 round)')
             self.normalize_hic(iterations=0,
                                silent=not kwargs.get('verbose', False))
+        if not self.expected:
+            if kwargs.get('verbose', False):
+                print('Normalizing by expected values')
+            self.normalize_expected(**kwargs)
         if savefig:
             mkdir(savefig)
         if savecorr:
@@ -1580,6 +1688,49 @@ class HiC_data(dict):
                            [self[i, j] for j in range(i + 1, end1)])
 
 
+def _compartment_eigenvectors(job):
+    """
+    Correlation matrix of a chromosomal observed/expected matrix, and its
+    first eigenvectors.
+
+    :param job: tuple with the rows, columns and values of the cells of the
+       upper triangle of the observed/expected matrix, its size, the number of
+       eigenvectors to compute, the size of the smoothing window and whether
+       to return the correlation matrices
+
+    :returns: None if the correlation matrix can not be computed, otherwise
+       the correlation matrix, the smoothed correlation matrix (both None if
+       not requested), the eigenvalues and the eigenvectors (both None if
+       they can not be computed)
+    """
+    rows, cols, values, size, max_ev, smoothing_window, keep_matrix = job
+    if not size:
+        return None
+    matrix = np.zeros((size, size))
+    matrix[rows, cols] = values
+    matrix[cols, rows] = values
+    # compute correlation coefficient
+    matrix = corrcoef(matrix)
+    if matrix.ndim < 2:  # very small chromosome?
+        return None
+    # replace nan in correlation matrix
+    matrix[isnan(matrix)] = 0.
+    smoothed = matrix
+    if smoothing_window:
+        smoothed = median_filter(matrix, size=smoothing_window)
+    try:
+        # only ask for the first eigenvectors, starting from a fixed vector
+        # to get the same signs in each run
+        evals, evect = eigsh(smoothed,
+                             k=max_ev if max_ev else (size - 1),
+                             v0=np.random.RandomState(1).rand(size))
+    except (LinAlgError, ValueError):
+        evals = evect = None
+    if not keep_matrix:
+        matrix = smoothed = None
+    return matrix, smoothed, evals, evect
+
+
 def _hmm_refine_compartments(xsec, models, bads, verbose):
     prevll = float('-inf')
     prevdf = 0
@@ -8,8 +8,9 @@ from collections                  import OrderedDict
 
 from pysam                        import AlignmentFile
 from scipy.stats                  import norm as sc_norm, skew, kurtosis
-from scipy.stats                  import pearsonr, spearmanr, linregress
-from scipy.sparse.linalg          import eigsh
+from scipy.stats                  import pearsonr, linregress
+from scipy.sparse.linalg          import eigsh, LinearOperator, aslinearoperator
+from scipy.sparse                 import csr_matrix, diags
 from numpy.linalg                 import eigh
 import numpy as np
 
@@ -940,8 +941,95 @@ Number of reads{' (all)' if nreads is None else ''}: {count:,}""",
         out.write('\n')
         out.close()
 
-def _unitize(vals):
-    return np.argsort(vals) / float(len(vals))
+def _grouped_ranks(vals, groups):
+    """
+    Ranks of values inside each group (ties get their average rank), as in
+    scipy.stats.rankdata, but shifted by a constant in each group.
+
+    :param vals: array of values
+    :param groups: array of group indexes, of the same length as vals
+
+    :returns: array of ranks
+    """
+    order = np.lexsort((vals, groups))
+    svals = vals[order]
+    sgrps = groups[order]
+    # a new block of ties starts when the value or the group changes
+    new = np.ones(len(vals), dtype=bool)
+    new[1:] = (svals[1:] != svals[:-1]) | (sgrps[1:] != sgrps[:-1])
+    block = np.cumsum(new) - 1
+    first = np.flatnonzero(new)
+    last = np.append(first[1:], len(vals)) - 1
+    ranks = np.empty(len(vals))
+    ranks[order] = ((first + last) / 2.)[block]
+    return ranks
+
+
+def _grouped_pearson(vals1, vals2, groups, ngroups):
+    """
+    Pearson correlation coefficients between two arrays of values inside
+    each group.
+
+    :param vals1: array of values
+    :param vals2: array of values
+    :param groups: array of group indexes, of the same length as vals1
+    :param ngroups: number of groups
+
+    :returns: array of correlations (NaN for groups with less than 2 values
+       or with constant values)
+    """
+    count = np.bincount(groups, minlength=ngroups)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cent1 = vals1 - (np.bincount(groups, vals1, ngroups) / count)[groups]
+        cent2 = vals2 - (np.bincount(groups, vals2, ngroups) / count)[groups]
+        corr = (np.bincount(groups, cent1 * cent2, ngroups) /
+                np.sqrt(np.bincount(groups, cent1**2, ngroups) *
+                        np.bincount(groups, cent2**2, ngroups)))
+    corr[count < 2] = np.nan
+    return np.clip(corr, -1., 1.)
+
+
+def _correlate_diagonals(diags1, diags2, spearman=True):
+    """
+    Correlates pairs of diagonals, all at once.
+
+    :param diags1: list of arrays, one per diagonal
+    :param diags2: list of arrays, of the same lengths as in diags1
+    :param True spearman: also computes Spearman rank correlations
+
+    :returns: Pearson correlations, Spearman rank correlations (None if not
+       computed) and SCC weights of each diagonal (arrays)
+    """
+    ngroups = len(diags1)
+    lens = np.array([len(d) for d in diags1], dtype=int)
+    groups = np.repeat(np.arange(ngroups), lens)
+    vals1 = np.concatenate(diags1) if ngroups else np.zeros(0)
+    vals2 = np.concatenate(diags2) if ngroups else np.zeros(0)
+    pearsons = _grouped_pearson(vals1, vals2, groups, ngroups)
+    spearmans = None
+    if spearman:
+        spearmans = _grouped_pearson(_grouped_ranks(vals1, groups),
+                                     _grouped_ranks(vals2, groups),
+                                     groups, ngroups)
+        nans = np.bincount(groups, np.isnan(vals1) | np.isnan(vals2), ngroups)
+        spearmans[nans > 0] = np.nan
+    # unitized ranks are a permutation of range(n) / n, the product of their
+    # variances does not depend on the values
+    with np.errstate(invalid='ignore'):
+        weigs = np.where(lens > 1, (lens + 1) / 12., np.nan)
+    return pearsons, spearmans, weigs
+
+
+def _scc_from_correlations(pearsons, weigs):
+    """
+    Weighted average of the correlations of each diagonal (SCC) and its
+    standard deviation.
+    """
+    tot_weigth = weigs.sum()
+    scc = (pearsons * weigs / tot_weigth).sum()
+    var_corr = np.var(pearsons, ddof=1) if len(pearsons) > 1 else np.nan
+    std = ((weigs**2).sum() * var_corr / tot_weigth**2)**0.5
+    return scc, std
 
 
 def correlate_matrices(hic_data1, hic_data2, max_dist=10, intra=False, axe=None,
@@ -956,6 +1044,8 @@ def correlate_matrices(hic_data1, hic_data2, max_dist=10, intra=False, axe=None,
        by the version implemented in dryhic by Enrique Vidal
        (https://github.com/qenvio/dryhic).
 
+    Diagonals are read at once from both matrices, and the correlations of all
+       the distances are computed together.
 
     :param hic_data1: Hi-C-data object
     :param hic_data2: Hi-C-data object
@@ -974,74 +1064,41 @@ def correlate_matrices(hic_data1, hic_data2, max_dist=10, intra=False, axe=None,
     :returns: list of correlations, list of genomic distances, SCC and standard
        deviation of SCC
     """
-    spearmans = []
-    pearsons = []
-    dists = []
-    weigs = []
-
-    if normalized:
-        get_the_guy1 = lambda i, j: (hic_data1[j, i] / hic_data1.bias[i] /
-                                     hic_data1.bias[j])
-        get_the_guy2 = lambda i, j: (hic_data2[j, i] / hic_data2.bias[i] /
-                                     hic_data2.bias[j])
-    else:
-        get_the_guy1 = lambda i, j: hic_data1[j, i]
-        get_the_guy2 = lambda i, j: hic_data2[j, i]
-
+    size = len(hic_data1)
+    bads = {}
     if remove_bad_columns:
         # union of bad columns
         bads = hic_data1.bads.copy()
         bads.update(hic_data2.bads)
+    masked = np.zeros(size, dtype=bool)
+    masked[[b for b in bads if 0 <= b < size]] = True
 
+    chrom = None
     if (intra and hic_data1.sections and hic_data2.sections and
         hic_data1.sections == hic_data2.sections):
-        for dist in range(1, max_dist + 1):
-            diag1 = []
-            diag2 = []
-            for crm in hic_data1.section_pos:
-                for j in range(hic_data1.section_pos[crm][0],
-                                hic_data1.section_pos[crm][1] - dist):
-                    i = j + dist
-                    if j in bads or i in bads:
-                        continue
-                    diag1.append(get_the_guy1(i, j))
-                    diag2.append(get_the_guy2(i, j))
-            spearmans.append(spearmanr(diag1, diag2)[0])
-            pearsons.append(spearmanr(diag1, diag2)[0])
-            r1 = _unitize(diag1)
-            r2 = _unitize(diag2)
-            weigs.append((np.var(r1, ddof=1) *
-                          np.var(r2, ddof=1))**0.5 * len(diag1))
-            dists.append(dist)
-    else:
-        if intra:
-            warn('WARNING: hic_dta does not contain chromosome coordinates, ' +
-                 'intra set to False')
-        for dist in range(min_dist, max_dist + min_dist):
-            diag1 = []
-            diag2 = []
-            for j in range(len(hic_data1) - dist):
-                i = j + dist
-                if j in bads or i in bads:
-                    continue
-                diag1.append(get_the_guy1(i, j))
-                diag2.append(get_the_guy2(i, j))
-            spearmans.append(spearmanr(diag1, diag2)[0])
-            pearsons.append(pearsonr(diag1, diag2)[0])
-            r1 = _unitize(diag1)
-            r2 = _unitize(diag2)
-            weigs.append((np.var(r1, ddof=1) *
-                          np.var(r2, ddof=1))**0.5 * len(diag1))
-            dists.append(dist)
+        # index of the chromosome of each bin
+        chrom = np.full(size, -1)
+        for num, (beg, end) in enumerate(hic_data1.section_pos.values()):
+            chrom[beg:end] = num
+    elif intra:
+        warn('WARNING: hic_dta does not contain chromosome coordinates, ' +
+             'intra set to False')
+
+    dists = [d for d in range(min_dist, max_dist + min_dist) if d < size]
+    all_diags1 = hic_data1.get_diagonals(dists, normalized=normalized)
+    all_diags2 = hic_data2.get_diagonals(dists, normalized=normalized)
+    diags1 = []
+    diags2 = []
+    for dist in dists:
+        keep = ~(masked[:size - dist] | masked[dist:])
+        if chrom is not None:
+            keep &= (chrom[:size - dist] == chrom[dist:]) & (chrom[dist:] >= 0)
+        diags1.append(all_diags1[dist][keep])
+        diags2.append(all_diags2[dist][keep])
+    pearsons, spearmans, weigs = _correlate_diagonals(diags1, diags2)
+    spearmans = spearmans.tolist()
     # compute scc
-    # print pearsons
-    # print weigs
-    tot_weigth = sum(weigs)
-    scc = sum(pearsons[i] * weigs[i] / tot_weigth
-              for i in range(len(pearsons)))
-    var_corr = np.var(pearsons, ddof=1)
-    std = (sum(weigs[i]**2 for i in range(len(pearsons))) * var_corr /
-           sum(weigs)**2)**0.5
+    scc, std = _scc_from_correlations(pearsons, weigs)
     # plot
     if show or savefig or axe:
         if not axe:
@@ -1071,41 +1128,34 @@ def correlate_matrices(hic_data1, hic_data2, max_dist=10, intra=False, axe=None,
     return spearmans, dists, scc, std
 
 def scc(mat1, mat2, max_dist=50, min_dist=1):
-    
-    pearsons=[]
-    dists = []
-    weigs=[]
-
-    for dist in range(min_dist, max_dist + min_dist):
-        diag1 = []
-        diag2 = []
-        for j in range(len(mat1) - dist):
-            i = j + dist
-            if np.isnan(mat1[i][j]) or np.isnan(mat1[i][j]):
-                continue
-            diag1.append(mat1[i][j])
-            diag2.append(mat2[i][j])
-        if len(diag1) > 1:
-            with catch_warnings():
-                simplefilter("ignore")
-                p_corr = pearsonr(diag1, diag2)[0]
-            if not np.isnan(p_corr):
-                pearsons.append(p_corr)
-                r1 = _unitize(diag1)
-                r2 = _unitize(diag2)
-                weigs.append((np.var(r1, ddof=1) *
-                              np.var(r2, ddof=1))**0.5 * len(diag1))
-                dists.append(dist)
-    if len(pearsons) == 0:
-        return 0, 0
-    tot_weigth = sum(weigs)
-    scc = sum(pearsons[i] * weigs[i] / tot_weigth
-              for i in range(len(pearsons)))
-    var_corr = np.var(pearsons, ddof=1)
-    std = (sum(weigs[i]**2 for i in range(len(pearsons))) * var_corr /
-           sum(weigs)**2)**0.5
+    """
+    SCC reproducibility score between two dense matrices (see
+       :func:`correlate_matrices`). Cells with NaN values in any of the
+       matrices are skipped, and only diagonals with a defined Pearson
+       correlation are used.
 
-    return scc, std
+    :param mat1: matrix (list of lists or numpy array)
+    :param mat2: matrix (list of lists or numpy array)
+    :param 50 max_dist: maximum distance from diagonal
+    :param 1 min_dist: minimum distance from diagonal
+
+    :returns: SCC and standard deviation of SCC
+    """
+    mat1 = np.asarray(mat1, dtype=float)
+    mat2 = np.asarray(mat2, dtype=float)
+    diags1 = []
+    diags2 = []
+    for dist in range(min_dist, min(max_dist + min_dist, len(mat1))):
+        diag1 = np.diagonal(mat1, -dist)
+        diag2 = np.diagonal(mat2, -dist)
+        keep = ~(np.isnan(diag1) | np.isnan(diag2))
+        diags1.append(diag1[keep])
+        diags2.append(diag2[keep])
+    pearsons, _, weigs = _correlate_diagonals(diags1, diags2, spearman=False)
+    defined = ~np.isnan(pearsons)
+    if not defined.any():
+        return 0, 0
+    return _scc_from_correlations(pearsons[defined], weigs[defined])
 
 def _evec_dist(v1,v2):
     d1=np.dot(v1-v2,v1-v2)
@@ -1117,22 +1167,53 @@ def _evec_dist(v1,v2):
     return np.sqrt(d)
 
 
-def _get_Laplacian(M):
-    S=M.sum(1)
+def _get_normalized_matrix(M):
+    """
+    Symmetric normalization of a sparse matrix, D^-1/2 M D^-1/2 (D being the
+    diagonal matrix of row sums), restricted to rows with positive sums. The
+    normalized Laplacian is its difference with the identity matrix, so they
+    share their eigenvectors.
+    """
+    S=np.asarray(M.sum(1)).ravel()
     i_nz=np.where(S>0)[0]
-    S=S[i_nz]
-    M=(M[i_nz].T)[i_nz].T
-    S=1/np.sqrt(S)
-    M=S*M
-    M=(S*M.T).T
-    n=np.size(S)
-    M=np.identity(n)-M
+    S=1/np.sqrt(S[i_nz])
+    M=M[i_nz][:,i_nz]
+    M=diags(S).dot(M).dot(diags(S))
     M=(M+M.T)/2
     return M
 
 
+def _masked_matrices(hic_data1, hic_data2, normalized, remove_bad_columns):
+    """
+    Sparse matrices of two Hi-C-data objects, without the union of their bad
+    columns.
+    """
+    bads = {}
+    if remove_bad_columns:
+        # union of bad columns
+        bads = hic_data1.bads.copy()
+        bads.update(hic_data2.bads)
+    M1 = hic_data1.get_hic_data_as_csr(normalized=normalized, masked=bads)
+    M2 = hic_data2.get_hic_data_as_csr(normalized=normalized, masked=bads)
+    return M1, M2, bads
+
+
+def _largest_eigenpairs(matrix, k):
+    """
+    Eigenvalues (in ascending order) and eigenvectors of the k largest
+    eigenvalues of a symmetric matrix (sparse matrix or linear operator).
+    ARPACK needs k to be smaller than the size of the matrix, small matrices
+    are solved densely.
+    """
+    size = matrix.shape[0]
+    if size > k + 1:
+        return eigsh(matrix, k=k, which='LA')
+    evals, evect = eigh(aslinearoperator(matrix).matmat(np.eye(size)))
+    return evals[-k:], evect[:, -k:]
+
+
 def get_ipr(evec):
-    ipr=1.0/(evec*evec*evec*evec).sum()
+    ipr=1.0/(evec*evec*evec*evec).sum(0)
     return ipr
 
 
@@ -1148,57 +1229,37 @@ def get_reproducibility(hic_data1, hic_data2, num_evec, verbose=True,
 
     :returns: reproducibility score (bellow 0.5 ~ different cell types)
     """
-    M1 = hic_data1.get_matrix(normalized=normalized)
-    M2 = hic_data2.get_matrix(normalized=normalized)
+    M1, M2, _ = _masked_matrices(hic_data1, hic_data2, normalized,
+                                 remove_bad_columns)
 
-    if remove_bad_columns:
-        # union of bad columns
-        bads = hic_data1.bads.copy()
-        bads.update(hic_data2.bads)
-        # remove them form both matrices
-        for bad in sorted(bads, reverse=True):
-            del(M1[bad])
-            del(M2[bad])
-            for i in range(len(M1)):
-                _ = M1[i].pop(bad)
-                _ = M2[i].pop(bad)
-
-    M1 = np.matrix(M1)
-    M2 = np.matrix(M2)
-
-    k1=np.sign(M1.A).sum(1)
-    d1=np.diag(M1.A)
+    k1=np.asarray(M1.sign().sum(1)).ravel()
+    d1=M1.diagonal()
     kd1=~((k1==1)*(d1>0))
-    k2=np.sign(M2.A).sum(1)
-    d2=np.diag(M2.A)
+    k2=np.asarray(M2.sign().sum(1)).ravel()
+    d2=M2.diagonal()
     kd2=~((k2==1)*(d2>0))
     iz=np.nonzero((k1+k2>0)*(kd1>0)*(kd2>0))[0]
-    M1b=(M1[iz].A.T)[iz].T
-    M2b=(M2[iz].A.T)[iz].T
-
-    i_nz1=np.where(M1b.sum(1)>0)[0]
-    i_nz2=np.where(M2b.sum(1)>0)[0]
-    i_z1=np.where(M1b.sum(1)==0)[0]
-    i_z2=np.where(M2b.sum(1)==0)[0]
+    M1b=M1[iz][:,iz]
+    M2b=M2[iz][:,iz]
 
-    M1b_L=_get_Laplacian(M1b)
-    M2b_L=_get_Laplacian(M2b)
+    i_nz1=np.where(np.asarray(M1b.sum(1)).ravel()>0)[0]
+    i_nz2=np.where(np.asarray(M2b.sum(1)).ravel()>0)[0]
 
-    a1, b1=eigsh(M1b_L,k=num_evec,which="SM")
-    a2, b2=eigsh(M2b_L,k=num_evec,which="SM")
+    # eigenvectors of the Laplacian with the smallest eigenvalues are the ones
+    # of the normalized matrix with the largest eigenvalues (faster to get)
+    _, b1=_largest_eigenpairs(_get_normalized_matrix(M1b),num_evec)
+    _, b2=_largest_eigenpairs(_get_normalized_matrix(M2b),num_evec)
+    b1=b1[:,::-1]
+    b2=b2[:,::-1]
 
-    b1_extend=np.zeros((np.size(M1b,0),num_evec))
-    b2_extend=np.zeros((np.size(M2b,0),num_evec))
-    for i in range(num_evec):
-        b1_extend[i_nz1,i]=b1[:,i]
-        b2_extend[i_nz2,i]=b2[:,i]
+    b1_extend=np.zeros((M1b.shape[0],num_evec))
+    b2_extend=np.zeros((M2b.shape[0],num_evec))
+    b1_extend[i_nz1]=b1
+    b2_extend[i_nz2]=b2
 
     ipr_cut=5
-    ipr1=np.zeros(num_evec)
-    ipr2=np.zeros(num_evec)
-    for i in range(num_evec):
-        ipr1[i]=get_ipr(b1_extend[:,i])
-        ipr2[i]=get_ipr(b2_extend[:,i])
+    ipr1=get_ipr(b1_extend)
+    ipr2=get_ipr(b2_extend)
 
     b1_extend_eff=b1_extend[:,ipr1>ipr_cut]
     b2_extend_eff=b2_extend[:,ipr2>ipr_cut]
@@ -1217,13 +1278,37 @@ def get_reproducibility(hic_data1, hic_data2, num_evec, verbose=True,
         if (np.sum(ipr1>N/100)<=1)|(np.sum(ipr2>N/100)<=1):
             print("at least one of the maps does not look like typical Hi-C maps")
         else:
-            print("size of maps: %d" %(np.size(M1,0)))
+            print("size of maps: %d" %(M1.shape[0]))
             print("reproducibility score: %6.3f " %(evs))
             print("num_evec_eff: %d" %(num_evec_eff))
 
     return evs
 
 
+def _nozero_log_operator(matrix, transformation):
+    """
+    Transformed sparse matrix, with null cells set to the transformation of half
+    the non-null minimum (as in :func:`pytadbit.utils.tadmaths.nozero_log_matrix`),
+    as a linear operator: the sparse part holds the difference to this
+    constant, that is added to each product.
+    """
+    matrix = csr_matrix(matrix)
+    nonull = matrix.data != 0
+    try:
+        minv = float(np.nanmin(matrix.data[nonull])) / 2
+    except ValueError:
+        minv = 1
+    logminv = transformation(minv)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        matrix.data = np.where(nonull, transformation(matrix.data) - logminv, 0)
+    matrix.eliminate_zeros()
+    size = matrix.shape[0]
+    return LinearOperator(
+        (size, size), dtype=float,
+        matvec=lambda x: matrix.dot(x) + logminv * x.sum(axis=0),
+        matmat=lambda x: matrix.dot(x) + logminv * x.sum(axis=0))
+
+
 def eig_correlate_matrices(hic_data1, hic_data2, nvect=6, normalized=False,
                            savefig=None, show=False, savedata=None,
                            remove_bad_columns=True, **kwargs):
@@ -1243,34 +1328,19 @@ def eig_correlate_matrices(hic_data1, hic_data2, nvect=6, normalized=False,
 
     :returns: matrix of correlations
     """
-    data1 = hic_data1.get_matrix(normalized=normalized)
-    data2 = hic_data2.get_matrix(normalized=normalized)
     ## reduce matrices to remove bad columns
-    if remove_bad_columns:
-        # union of bad columns
-        bads = hic_data1.bads.copy()
-        bads.update(hic_data2.bads)
-        # remove them form both matrices
-        for bad in sorted(bads, reverse=True):
-            del(data1[bad])
-            del(data2[bad])
-            for i in range(len(data1)):
-                _ = data1[i].pop(bad)
-                _ = data2[i].pop(bad)
-    # get the log
-    data1 = nozero_log(data1, np.log2)
-    data2 = nozero_log(data2, np.log2)
-    # get the eigenvectors
-    ev1, evect1 = eigh(data1)
-    ev2, evect2 = eigh(data2)
+    data1, data2, bads = _masked_matrices(hic_data1, hic_data2, normalized,
+                                          remove_bad_columns)
+    # get the eigenvectors of the log, with largest eigenvalues (sorted in
+    # ascending order => first is last!!)
+    if data1.shape[0] < nvect:
+        raise Exception('ERROR: not enough bins (%d) to compare %d '
+                        'eigenvectors' % (data1.shape[0], nvect))
+    ev1, evect1 = _largest_eigenpairs(_nozero_log_operator(data1, np.log2),
+                                      nvect)
+    ev2, evect2 = _largest_eigenpairs(_nozero_log_operator(data2, np.log2),
+                                      nvect)
     corr = [[0 for _ in range(nvect)] for _ in range(nvect)]
-    # sort eigenvectors according to their eigenvalues => first is last!!
-    sort_perm = ev1.argsort()
-    ev1.sort()
-    evect1 = evect1[sort_perm]
-    sort_perm = ev2.argsort()
-    ev2.sort()
-    evect2 = evect2[sort_perm]
     # calculate Pearson correlation
     for i in range(nvect):
         for j in range(nvect):
@@ -0,0 +1,281 @@
+"""
+18 Oct 2026
+
+Per-particle structural descriptors computed in batch over an ensemble of
+models.
+"""
+
+from warnings import catch_warnings, simplefilter
+
+import numpy as np
+
+from pytadbit.utils.three_dim_stats import models_to_array
+
+
+class ModelEnsemble(object):
+    """
+    Coordinates of a group of models stored as a single array, with the
+    descriptors computed for all models and particles at once.
+
+    Intermediate results (distances between particles separated by a given
+    number of positions, number of interactions...) are cached, in order to
+    be reused by the different descriptors.
+
+    :param models: list of models (dictionaries with 'x', 'y' and 'z' keys)
+    :param nloci: number of particles in each model
+
+    """
+
+    def __init__(self, models, nloci):
+        self.coords = models_to_array(models, nloci)
+        self.nloci  = nloci
+        self._cache = {}
+
+    def __len__(self):
+        return len(self.coords)
+
+    def _cached(self, key, func, *args):
+        try:
+            return self._cache[key]
+        except KeyError:
+            self._cache[key] = func(*args)
+        return self._cache[key]
+
+    def square_distances(self, offset):
+        """
+        :param offset: number of positions between the two particles
+
+        :returns: an array of shape (number of models, nloci - offset) with the
+           square distance between each particle i and particle i + offset
+        """
+        def _compute():
+            diff = self.coords[:, offset:] - self.coords[:, :self.nloci - offset]
+            return (diff[..., 0]**2 + diff[..., 1]**2) + diff[..., 2]**2
+        return self._cached(('sqdist', offset), _compute)
+
+    def distances(self, offset):
+        """
+        :param offset: number of positions between the two particles
+
+        :returns: an array of shape (number of models, nloci - offset) with the
+           distance between each particle i and particle i + offset
+        """
+        return self._cached(('dist', offset), lambda: np.sqrt(
+            self.square_distances(offset)))
+
+    def pair_square_distances(self, part1, part2):
+        """
+        :param part1: index of the first particle (starting at 0)
+        :param part2: index of the second particle (starting at 0)
+
+        :returns: an array with the square distance between the two particles
+           in each model
+        """
+        diff = self.coords[:, part1] - self.coords[:, part2]
+        return (diff[:, 0]**2 + diff[:, 1]**2) + diff[:, 2]**2
+
+    def interactions(self, cutoff, block_size=2**22):
+        """
+        Number of particles found closer than a given distance of each
+        particle. Square distances are computed by blocks of rows, and only the
+        counts are kept.
+
+        :param cutoff: distance cutoff (nm)
+        :param 2**22 block_size: maximum number of pairwise distances computed
+           at once
+
+        :returns: an integer array of shape (number of models, nloci)
+        """
+        def _compute():
+            cutoff2 = cutoff**2
+            nmodels = len(self.coords)
+            counts = np.zeros((nmodels, self.nloci), dtype=int)
+            if not nmodels:
+                return counts
+            rchunk = max(1, block_size // (nmodels * self.nloci))
+            for beg in range(0, self.nloci, rchunk):
+                end = min(beg + rchunk, self.nloci)
+                diff = (self.coords[:, beg:end, None, :] -
+                        self.coords[:, None, :, :])
+                sqd = ((diff[..., 0]**2 + diff[..., 1]**2) + diff[..., 2]**2)
+                counts[:, beg:end] = (sqd < cutoff2).sum(axis=-1)
+            # a particle is not in interaction with itself
+            counts -= int(0 < cutoff2)
+            return counts
+        return self._cached(('interactions', cutoff), _compute)
+
+    def angles(self, step=3):
+        """
+        Angle (in degrees) formed by particles i, i + step and i + 2 * step in
+        each model, computed from the distances between these particles (see
+        :func:`pytadbit.modelling.structuralmodels.StructuralModels.angle_between_3_particles`).
+
+        :param 3 step: number of positions between the particles
+
+        :returns: an array of shape (number of models, nloci - 2 * step)
+        """
+        def _compute():
+            size = self.nloci - 2 * step
+            c2 = self.square_distances(step)[:, :size]
+            a2 = self.square_distances(step)[:, step:step + size]
+            b2 = self.square_distances(2 * step)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                val = (a2 - b2 + c2) / (2 * a2**0.5 * c2**0.5)
+                # out of domain values of the arc-cosine are set to 0
+                return np.degrees(np.where(abs(val) > 1, 0., np.arccos(val)))
+        return self._cached(('angles', step), _compute)
+
+    def angle_signs(self, step=3):
+        """
+        Sign of the angle formed by particles i, i + step and i + 2 * step in
+        each model (as used by
+        :func:`pytadbit.modelling.structuralmodels.StructuralModels.walking_angle`).
+
+        :param 3 step: number of positions between the particles
+
+        :returns: an array of shape (number of models, nloci - 2 * step) with
+           1 or -1 values
+        """
+        size = self.nloci - 2 * step
+        res1 = self.coords[:, :size]
+        res2 = self.coords[:, step:step + size]
+        res3 = self.coords[:, 2 * step:2 * step + size]
+        vec1 = res1 - res2 / np.linalg.norm(res1 - res2, axis=-1)[..., None]
+        vec2 = res1 - res3 / np.linalg.norm(res1 - res3, axis=-1)[..., None]
+        return np.where(np.cross(vec1, vec2).sum(axis=-1) < 0, -1, 1)
+
+    def dihedrals(self, span=(-2, 1, 0, 1, 3)):
+        """
+        Dihedral angle (in degrees) between the planes formed by particles
+        (i + span[0], i + span[1], i + span[2]) and (i + span[2], i + span[3],
+        i + span[4]), as in :func:`pytadbit.utils.three_dim_stats.dihedral`.
+
+        :param (-2, 1, 0, 1, 3) span: relative positions of the particles
+
+        :returns: an array of shape (number of models,
+           nloci - span[-1] + span[0]), the first value corresponding to
+           particle -span[0] (starting at 0)
+        """
+        def _compute():
+            pos = np.arange(-span[0] - 1, self.nloci - span[-1] - 1)
+            parta, partb, partc, partd, parte = [self.coords[:, pos + s]
+                                                 for s in span]
+            v1 = _normed(partb - parta)
+            v2 = _normed(partb - partc)
+            v4 = _normed(partd - partc)
+            v3 = _normed(partc - parte)
+            v1v2 = np.cross(v1, v2)
+            v3v4 = np.cross(v3, v4)
+            sign = np.where(np.linalg.det(np.stack([v2, v1v2, v3v4], axis=-2))
+                            < 0, 1, -1)
+            with np.errstate(invalid='ignore'):
+                angle = np.rad2deg(np.arccos((_normed(v1v2) *
+                                              _normed(v3v4)).sum(axis=-1)))
+            return sign * angle
+        return self._cached(('dihedrals', tuple(span)), _compute)
+
+    def densities(self, interval, resolution, use_mass_center=False,
+                  zeros=None):
+        """
+        Density of chromatin (in bp/nm) around each particle, as used by
+        :func:`pytadbit.modelling.structuralmodels.StructuralModels.density_plot`.
+
+        :param interval: number of particles at each side of the particle
+        :param resolution: number of nucleotides per particle
+        :param False use_mass_center: use the distance between the centers of
+           mass of the particles at each side of the particle, instead of the
+           distance to the particles at *interval* positions.
+        :param None zeros: list of True/False representing particles to be
+           used in the computation of the centers of mass
+
+        :returns: an array of shape (number of models, nloci - 2 * interval),
+           the first value corresponding to particle *interval* (starting at 0)
+        """
+        size = self.nloci - 2 * interval
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if not use_mass_center:
+                dists = self.distances(interval)
+                return (float(interval * resolution * 2) /
+                        (dists[:, :size] + dists[:, interval:interval + size]))
+            if zeros is None:
+                weights = np.ones(self.nloci)
+            else:
+                weights = np.array([1. if zeros[i] else 0.
+                                    for i in range(self.nloci)])
+            # centers of mass of the windows of particles [p, p + interval)
+            wcoords = np.cumsum(np.concatenate((
+                np.zeros((len(self.coords), 1, 3)),
+                self.coords * weights[None, :, None]), axis=1), axis=1)
+            wcounts = np.cumsum(np.concatenate(([0], weights)))
+            centers = ((wcoords[:, interval:] - wcoords[:, :-interval]) /
+                       (wcounts[interval:] - wcounts[:-interval])[None, :, None])
+            diff = centers[:, interval:interval + size] - centers[:, :size]
+            return float(interval * resolution) / np.sqrt((diff**2).sum(axis=-1))
+
+
+def _normed(vectors):
+    """
+    Normalizes an array of 3D vectors (last dimension)
+    """
+    return vectors / np.linalg.norm(vectors, axis=-1)[..., None]
+
+
+def windowize(values, steps, nloci, missing=None, average=True, interval=0,
+              minerr=0.):
+    """
+    Average per-particle values over windows of consecutive particles, and
+    summarizes the values of each window over the models.
+
+    :param values: array of shape (number of particles, number of models)
+    :param steps: sizes of the windows
+    :param nloci: number of particles
+    :param None missing: boolean array, of the same shape as values, marking
+       missing values (ignored in averages)
+    :param True average: summarizes values with the mean, otherwise, the median
+    :param 0 interval: number of particles skipped at each side
+    :param 0. minerr: minimum value of the lower and upper error bars
+
+    :returns: three dictionaries (one entry per window size), with lists of
+       summarized values, lower error and upper error (None where no value
+       can be computed)
+    """
+    values = np.asarray(values, dtype=float)
+    if missing is None:
+        missing = np.zeros(values.shape, dtype=bool)
+    windows = {1: (values, missing, 0)}
+    for k in steps[1:] if steps[0] == 1 else steps:
+        size = nloci - k - 2 * interval + 1
+        wsum = np.zeros((max(size, 0), values.shape[1]))
+        wcnt = np.zeros((max(size, 0), values.shape[1]), dtype=int)
+        for j in range(k):
+            rows = slice(interval + j, interval + j + size)
+            wsum += np.where(missing[rows], 0., values[rows])
+            wcnt += ~missing[rows]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            windows[k] = (wsum / wcnt, wcnt == 0, k // 2 + interval)
+    new_distsk = {}
+    errorp     = {}
+    errorn     = {}
+    for k, (vals, miss, nskip) in list(windows.items()):
+        vals = np.where(miss, np.nan, vals)
+        # NaN values (not missing) are propagated to the summary
+        has_nan = np.isnan(vals).any(axis=1) & ~(np.isnan(vals) == miss).all(axis=1)
+        with catch_warnings():
+            simplefilter("ignore", category=RuntimeWarning)
+            mean_part = (np.nanmean(vals, axis=1) if average else
+                         np.nanmedian(vals, axis=1))
+            std_part = np.nanstd(vals, axis=1)
+        mean_part[has_nan] = np.nan
+        std_part[has_nan] = np.nan
+        with np.errstate(invalid='ignore'):
+            low = mean_part - 2 * std_part
+            low[low < minerr] = minerr
+            upp = mean_part + 2 * std_part
+            upp[upp < minerr] = minerr
+        if not vals.shape[1]:  # no model
+            mean_part = low = upp = np.array([None] * len(vals))
+        new_distsk[k] = [None] * nskip + mean_part.tolist()
+        errorn[k] = [None] * nskip + low.tolist()
+        errorp[k] = [None] * nskip + upp.tolist()
+    return new_distsk, errorn, errorp
+
@@ -8,16 +8,21 @@ from __future__ import print_function
 from future import standard_library
 standard_library.install_aliases()
 from math            import fabs
-from pickle         import load, dump
+from pickle         import load, dump, UnpicklingError
 from sys             import stdout
 from os.path         import exists
+from copy            import deepcopy
+from heapq           import heappush, heappushpop
+from tempfile        import TemporaryFile
 import multiprocessing as mu
 from scipy           import polyfit
+from numpy           import corrcoef, triu_indices, errstate
 
 from pytadbit.modelling.IMP_CONFIG       import CONFIG, NROUNDS, STEPS, LSTEPS
 from pytadbit.modelling.structuralmodels import StructuralModels
 from pytadbit.modelling.impmodel         import IMPmodel
 from pytadbit.modelling.restraints       import HiCBasedRestraints
+from pytadbit.utils.three_dim_stats      import calc_contact_matrices
 
 #Local application/library specific imports
 import IMP.core
@@ -38,7 +43,8 @@ def generate_3d_models(zscores, resolution, nloci, start=1, n_models=5000,
                        values=None, experiment=None, coords=None, zeros=None,
                        first=None, container=None, use_HiC=True,
                        use_confining_environment=True, use_excluded_volume=True,
-                       single_particle_restraints=None):
+                       single_particle_restraints=None, checkpoint=None,
+                       convergence=None, round_size=None):
     """
     This function generates three-dimensional models starting from Hi-C data.
     The final analysis will be performed on the n_keep top models.
@@ -134,6 +140,18 @@ def generate_3d_models(zscores, resolution, nloci, start=1, n_models=5000,
                 type: 'Harmonic', 'HarmonicLowerBound', 'HarmonicUpperBound'
                 kforce: weigth of the restraint
                 radius (nm): radius of the sphere
+    :param None checkpoint: path to a file where each model is stored as soon
+       as it is generated. If this file already exists, the models it contains
+       are not generated again (allowing to resume an interrupted run).
+    :param None convergence: if set, models are generated by rounds, and the
+       generation stops before reaching n_models when, from one round to the
+       next, both the objective function of the worst of the n_keep best models
+       and the contact map of these models (correlation) change by less than
+       this tolerance (e.g.: 0.01). The number of models actually generated is
+       stored in the config of the StructuralModels, under the key
+       'generated_models'.
+    :param None round_size: number of models generated in each round (by
+       default n_keep), only used with convergence
 
     :returns: a StructuralModels object
 
@@ -196,11 +214,12 @@ def generate_3d_models(zscores, resolution, nloci, start=1, n_models=5000,
                                        zscores, chromosomes=coords,
                                        close_bins=close_bins, first=first)
 
-    models, bad_models = multi_process_model_generation(
+    models, bad_models, CONFIG['generated_models'] = multi_process_model_generation(
         n_cpus, n_models, n_keep, keep_all, HiCRestraints,
         use_HiC=use_HiC, use_confining_environment=use_confining_environment,
         use_excluded_volume=use_excluded_volume,
-        single_particle_restraints=single_particle_restraints)
+        single_particle_restraints=single_particle_restraints,
+        checkpoint=checkpoint, convergence=convergence, round_size=round_size)
 
     try:
         xpr = experiment
@@ -247,41 +266,208 @@ def generate_3d_models(zscores, resolution, nloci, start=1, n_models=5000,
 
 def multi_process_model_generation(n_cpus, n_models, n_keep, keep_all,HiCRestraints, use_HiC=True,
                                    use_confining_environment=True, use_excluded_volume=True,
-                                   single_particle_restraints=None):
+                                   single_particle_restraints=None, checkpoint=None,
+                                   batch_size=None, convergence=None, round_size=None):
     """
     Parallelize the
     :func:`pytadbit.modelling.imp_model.StructuralModels.generate_IMPmodel`.
 
+    Models are generated by long-lived worker processes, each taking batches
+    of random initial numbers. Only the best n_keep models are kept in memory
+    while the others are generated, the discarded ones being written to disk
+    if keep_all is True.
+
     :param n_cpus: number of CPUs to use
     :param n_models: number of models to generate
+    :param n_keep: number of best models to keep
+    :param keep_all: whether or not to return also the discarded models
+    :param None checkpoint: path to a file where each model is stored as soon
+       as it is generated. If this file already exists, the models it contains
+       are loaded and not generated again.
+    :param None batch_size: number of models generated by a worker at each
+       call (by default the number of models, or of models per round, is
+       divided into 4 batches per CPU, each of at most 100 models)
+    :param None convergence: tolerance used to stop the generation of models
+       before reaching n_models (see :func:`generate_3d_models`)
+    :param None round_size: number of models generated between two checks of
+       convergence (by default n_keep)
+
+    :returns: the dictionary of the best models, the dictionary of the
+       discarded models (empty if keep_all is False), both sorted by objective
+       function, and the number of models generated
     """
+    rand_inits = set(range(START, n_models + START))
+    best = []  # heap with the best models, the worst one on top
+    if checkpoint:
+        # discarded models are already stored in the checkpoint file
+        spill = None
+        done = set()
+        for model in _load_checkpoint(checkpoint):
+            rand_init = int(model['rand_init'])
+            if not rand_init in rand_inits or rand_init in done:
+                continue
+            done.add(rand_init)
+            _push_best_model(best, model, n_keep, spill)
+        rand_inits -= done
+        n_generated = len(done)
+        checkpoint = open(checkpoint, 'ab')
+    else:
+        spill = TemporaryFile() if keep_all else None
+        n_generated = 0
 
-    pool = mu.Pool(n_cpus, maxtasksperchild=1)
-    jobs = {}
-    for rand_init in range(START, n_models + START):
-        jobs[rand_init] = pool.apply_async(generate_IMPmodel,
-                                           args=(rand_init,HiCRestraints, use_HiC,
-                                                 use_confining_environment, use_excluded_volume,
-                                                 single_particle_restraints))
-
-    pool.close()
-    pool.join()
-
-    results = []
-    for rand_init in range(START, n_models + START):
-        results.append((rand_init, jobs[rand_init].get()))
+    rand_inits = sorted(rand_inits)
+    if convergence:
+        round_size = round_size or n_keep
+    else:
+        round_size = len(rand_inits)
+    batch_size = batch_size or max(1, min(100, round_size // (4 * n_cpus)))
+    # split random initial numbers in rounds, and each round in batches
+    rounds = []
+    for beg in range(0, len(rand_inits), max(1, round_size)):
+        round_inits = rand_inits[beg:beg + max(1, round_size)]
+        rounds.append([(round_inits[i:i + batch_size], HiCRestraints, use_HiC,
+                        use_confining_environment, use_excluded_volume,
+                        single_particle_restraints)
+                       for i in range(0, len(round_inits), batch_size)])
+    if rounds:
+        pool = mu.Pool(n_cpus)
+        previous = None
+        try:
+            for batches in rounds:
+                for results in pool.imap_unordered(_generate_IMPmodels, batches):
+                    for model in results:
+                        if checkpoint:
+                            dump(model, checkpoint)
+                        _push_best_model(best, model, n_keep, spill)
+                    n_generated += len(results)
+                    if checkpoint:
+                        checkpoint.flush()
+                if not convergence or len(best) < n_keep:
+                    continue
+                current = _ensemble_statistics(best)
+                if previous and _has_converged(previous, current, convergence):
+                    break
+                previous = current
+            pool.close()
+        finally:
+            # stops workers if interrupted
+            pool.terminate()
+            pool.join()
 
     models = {}
-    bad_models = {}
-    for i, (_, m) in enumerate(
-        sorted(results, key=lambda x: x[1]['objfun'])[:n_keep]):
+    for i, (_, _, m) in enumerate(sorted(best, reverse=True)):
         models[i] = m
+    bad_models = {}
     if keep_all:
-        for i, (_, m) in enumerate(
-        sorted(results, key=lambda x: x[1]['objfun'])[n_keep:]):
-            bad_models[i+n_keep] = m
-    return models, bad_models
+        kept = set(m['rand_init'] for m in models.values())
+        if checkpoint:
+            checkpoint.close()
+            discarded = (m for m in _load_checkpoint(checkpoint.name)
+                         if int(m['rand_init']) >= START and
+                         int(m['rand_init']) < n_models + START and
+                         not m['rand_init'] in kept)
+        else:
+            spill.seek(0)
+            discarded = _load_checkpoint(spill)
+        discarded = dict((m['rand_init'], m) for m in discarded)
+        for i, m in enumerate(sorted(list(discarded.values()), key=_model_rank)):
+            bad_models[i + n_keep] = m
+    if spill:
+        spill.close()
+    if checkpoint:
+        checkpoint.close()
+    return models, bad_models, n_generated
+
+
+def _ensemble_statistics(best):
+    """
+    Objective function of the worst of the best models, and their contact map
+    (upper triangle).
+    """
+    cutoff = (2 * SCALE)**2
+    matrix = calc_contact_matrices([m for _, _, m in best], len(LOCI),
+                                   [cutoff])[cutoff]
+    return -best[0][0], matrix[triu_indices(len(matrix), 1)]
+
 
+def _has_converged(previous, current, convergence):
+    """
+    Checks whether the objective function threshold and the contact map of the
+    best models changed by less than the convergence tolerance.
+    """
+    prev_objfun, prev_matrix = previous
+    objfun, matrix = current
+    if abs(objfun - prev_objfun) > convergence * abs(prev_objfun):
+        return False
+    with errstate(invalid='ignore', divide='ignore'):
+        corr = corrcoef(prev_matrix, matrix)[0, 1]
+    return 1 - corr <= convergence
+
+
+def _model_rank(model):
+    """
+    Models are ranked by objective function, and then by random initial
+    number.
+    """
+    return model['objfun'], int(model['rand_init'])
+
+
+def _push_best_model(best, model, n_keep, spill=None):
+    """
+    Adds a model to the heap of the n_keep best models. The model discarded (if
+    any) is written to spill.
+    """
+    objfun, rand_init = _model_rank(model)
+    entry = (-objfun, -rand_init, model)
+    if len(best) < n_keep:
+        heappush(best, entry)
+        return
+    _, _, worst = heappushpop(best, entry)
+    if spill:
+        dump(worst, spill)
+
+
+def _load_checkpoint(checkpoint):
+    """
+    Reads the models stored one after the other in a file (path or file
+    handler). If the last one is incomplete (interrupted run), the file is
+    truncated to the last complete model.
+    """
+    if isinstance(checkpoint, str):
+        if not exists(checkpoint):
+            return
+        fhandler = open(checkpoint, 'rb+')
+    else:
+        fhandler = checkpoint
+    position = fhandler.tell()
+    while True:
+        try:
+            model = load(fhandler)
+        except EOFError:
+            break
+        except (UnpicklingError, ValueError, AttributeError, IndexError):
+            fhandler.seek(position)
+            fhandler.truncate()
+            break
+        position = fhandler.tell()
+        yield model
+    if isinstance(checkpoint, str):
+        fhandler.close()
+
+
+def _generate_IMPmodels(args):
+    """
+    Generates the models of a batch of random initial numbers (see
+    :func:`generate_IMPmodel`).
+    """
+    rand_inits, HiCRestraints = args[:2]
+    use_HiC, use_confining_environment, use_excluded_volume = args[2:5]
+    single_particle_restraints = args[5]
+    # single particle restraints are rescaled by each model
+    return [generate_IMPmodel(rand_init, HiCRestraints, use_HiC,
+                              use_confining_environment, use_excluded_volume,
+                              deepcopy(single_particle_restraints))
+            for rand_init in rand_inits]
 
 
 def generate_IMPmodel(rand_init, HiCRestraints,use_HiC=True, use_confining_environment=True,
@@ -9,11 +9,11 @@ from math                           import sqrt, pi
 import hashlib
 
 import numpy as np
+from scipy.spatial                  import cKDTree
 
 from pytadbit.utils.extraviews      import color_residues, chimera_view
 from pytadbit.utils.extraviews      import plot_3d_model
 from pytadbit.utils.three_dim_stats import generate_sphere_points
-from pytadbit.utils.three_dim_stats import fast_square_distance
 from pytadbit.utils.three_dim_stats import build_mesh
 from pytadbit.utils.extraviews      import tad_coloring
 from pytadbit.utils.extraviews      import tad_border_coloring
@@ -37,6 +37,34 @@ def model_header(model):
     return outstr
 
 
+def _dilate_grid(grid, width):
+    """
+    Extends the occupied cells of a 3D boolean grid to the cells at a distance
+    lower or equal to width (in each dimension).
+    """
+    for axis in range(grid.ndim):
+        dilated = grid.copy()
+        grid = np.moveaxis(grid, axis, 0)
+        view = np.moveaxis(dilated, axis, 0)
+        for shift in range(1, width + 1):
+            view[shift:] |= grid[:-shift]
+            view[:-shift] |= grid[shift:]
+        grid = dilated
+    return grid
+
+
+def _closest_square_distance(tree, points, dots):
+    """
+    Square distance from each dot to its closest point, the points being
+    indexed in a KD-tree.
+    """
+    if not len(dots):
+        return np.zeros(0)
+    _, idx = tree.query(dots)
+    diff = dots - points[idx]
+    return (diff[:, 0]**2 + diff[:, 1]**2) + diff[:, 2]**2
+
+
 class StructuralModel(dict):
     """
     A container for the structural modelling results. The container is a dictionary
@@ -371,52 +399,30 @@ class StructuralModel(dict):
             self['x'], self['y'], self['z'], len(self), nump, radius,
             superradius, include_edges)
 
-        # calculates the number of inaccessible peaces of surface
+        # calculates the number of inaccessible peaces of surface, searching
+        # for the closest particle (or point along edges) of each dot
+        tree = cKDTree(points)
         if superradius:
             radius2 = (superradius - 4)**2
-            outdot  = []
-            for x2, y2, z2 in superdots:
-                for j, (x1, y1, z1) in enumerate(points):
-                    if fast_square_distance(x1, y1, z1, x2, y2, z2) < radius2:
-                        outdot.append(False)
-                        break
-                else:
-                    outdot.append(True)
-                    continue
-                points.insert(0, points.pop(j))
+            outdot  = _closest_square_distance(tree, points, superdots) >= radius2
         else:
-            outdot = [False] * len(superdots)
+            outdot = np.zeros(len(superdots), dtype=bool)
 
         # calculates the number of inaccessible peaces of surface
         radius2 = (radius - 2)**2
         grey    = (0.6, 0.6, 0.6)
         red     = (1, 0, 0)
         green   = (0, 1, 0)
-        colors  = []
-        for i, (x2, y2, z2) in enumerate(dots):
-            if outdot[i]:
-                colors.append(grey)
-                continue
-            for j, (x1, y1, z1) in enumerate(points):
-                if fast_square_distance(x1, y1, z1, x2, y2, z2) < radius2:
-                    colors.append(red)
-                    break
-            else:
-                colors.append(green)
-                continue
-            points.insert(0, points.pop(j))
-        possibles = colors.count(green)
+        inaccessible = _closest_square_distance(tree, points, dots) < radius2
+        accessible   = ~outdot & ~inaccessible
+        inaccessible &= ~outdot
+        possibles = int(accessible.sum())
 
         acc_parts = []
         for p in sorted(points2dots.keys()):
-            acc = 0
-            ina = 0
-            for dot in points2dots[p]:
-                if colors[dot]==green:
-                    acc += 1
-                elif colors[dot]==red:
-                    ina += 1
-            acc_parts.append((p + 1, acc, ina))
+            acc_parts.append((p + 1, int(accessible[points2dots[p]].sum()),
+                              int(inaccessible[points2dots[p]].sum())))
+        outdot = outdot.tolist()
 
         # some stats
         dot_area = 4 * pi * (float(radius) / 1000)**2 / nump
@@ -443,8 +449,10 @@ class StructuralModel(dict):
                     ' r=\"%s\" g=\"%s\" b=\"%s\" ' +
                     'radius=\"7\"/>\n')
             for k_2, thing in enumerate(dots):
+                color = (grey if outdot[k_2] else green if accessible[k_2]
+                         else red)
                 out += form % (1 + k_2, thing[0], thing[1], thing[2],
-                                colors[k_2][0], colors[k_2][1], colors[k_2][2])
+                                color[0], color[1], color[2])
             if superradius:
                 for k_3, thing in enumerate(superdots):
                     out += form % (1 + k_3 + k_2 + 1,
@@ -543,37 +551,38 @@ class StructuralModel(dict):
         
         avg_radii = self.contour() / size / maxd / cuts * scale
         
+        # end points of the segments of chromatin represented
+        parts = np.arange(0, size - 1, cuts)
+        segments = [np.array([coords[parts], coords[parts + 1]]).T.ravel()
+                    for coords in (np.asarray(self['x'], dtype=float),
+                                   np.asarray(self['y'], dtype=float),
+                                   np.asarray(self['z'], dtype=float))]
         results = []
         grain = grain_range[0]
         jump = 5  # to take advantage of periodicity and skip the computation of most grains
         last_up_grain = None
         while grain <= grain_range[1]:
             grain_ratio = grain / maxd
-            # create intermediate points and transorfm coordinates to integers
-            X = [int((v - minx) * grain_ratio) for p in range(0, size - 1, cuts)
-                for v in np.linspace(self['x'][p], self['x'][p + 1], 2)] + [
-                int((self['x'][-1] - minx) / dx * grain)] * (size  % 2)
-            Y = [int((v - miny) * grain_ratio) for p in range(0, size - 1, cuts)
-                for v in np.linspace(self['y'][p], self['y'][p + 1], 2)] + [
-                int((self['y'][-1] - miny) / dy * grain)] * (size  % 2)
-            Z = [int((v - minz) * grain_ratio) for p in range(0, size - 1, cuts)
-                for v in np.linspace(self['z'][p], self['z'][p + 1], 2)] + [
-                int((self['z'][-1] - minz) / dz * grain)] * (size  % 2)
-            
+            # transform coordinates to integers
+            X, Y, Z = [
+                np.concatenate((((seg - mind) * grain_ratio).astype(int),
+                                [int((coords[-1] - mind) / dd * grain)] * (size % 2)))
+                for seg, coords, mind, dd in zip(
+                    segments, (self['x'], self['y'], self['z']),
+                    (minx, miny, minz), (dx, dy, dz))]
+
             # chromatin volume represented as cubes of radii proportional
             #  to grid size (grain)
             d0 = int(grain * avg_radii)
-            d1 = d0 + 1
-            
-            # the use of integers allow to check for cell occupancy 
-            # with simple set
-            occupied = set((kx, ky, kz) for x, y, z in zip(X, Y, Z)
-                           for kx in range(x - d0, x + d1) 
-                           for ky in range(y - d0, y + d1) 
-                           for kz in range(z - d0, z + d1))
-            
+
+            # the use of integers allow to check for cell occupancy in a grid
+            occupied = np.zeros((X.max() + 2 * d0 + 1, Y.max() + 2 * d0 + 1,
+                                 Z.max() + 2 * d0 + 1), dtype=bool)
+            occupied[X + d0, Y + d0, Z + d0] = True
+            occupied = _dilate_grid(occupied, d0)
+
             # final result for this grain size
-            ratio = len(occupied) / grain**3
+            ratio = occupied.sum() / grain**3
             
             # speed up using periodicity trick:
             try:
@@ -9,29 +9,29 @@ try:
 except ImportError:
     from pickle                       import load
 from pickle                           import dump, HIGHEST_PROTOCOL
-from subprocess                       import Popen, PIPE
 from math                             import acos, degrees, pi, sqrt
-from warnings                         import warn, catch_warnings, simplefilter    
+from warnings                         import warn
 from sys                              import version_info
 if (version_info > (3, 0)):
-    from string                           import ascii_uppercase as uc, ascii_lowercase as lc
+    from string                           import ascii_lowercase as lc
 else:
-    from string                           import uppercase as uc, lowercase as lc
+    from string                           import lowercase as lc
 from random                           import random
-from os.path                          import exists
 from itertools                        import combinations
 from uuid                             import uuid5, UUID
 from hashlib                          import md5
 from copy                             import copy
+import multiprocessing as mu
 
 from numpy                            import exp as np_exp
 from numpy                            import median as np_median
 from numpy                            import mean as np_mean
 from numpy                            import std as np_std, log2
-from numpy                            import array, cross, dot, ma, isnan
+from numpy                            import array, ma, isnan
 from numpy                            import histogram, linspace, errstate
 from numpy                            import nanmin, nanmax
-from numpy.linalg                     import norm
+from numpy                            import zeros as np_zeros, fromiter, arange
+from numpy                            import where, unique, fill_diagonal
 
 from scipy.optimize                   import curve_fit
 from scipy.stats                      import spearmanr, pearsonr, chisquare
@@ -40,19 +40,21 @@ from scipy.stats                      import linregress
 from scipy.stats                      import normaltest, norm as sc_norm
 from scipy.cluster.hierarchy          import linkage, fcluster
 from scipy.spatial.distance           import squareform
+from scipy.sparse                     import coo_matrix
 
 from pytadbit                         import get_dependencies_version
 from pytadbit.utils                   import printime
 from pytadbit.utils.three_dim_stats   import calc_consistency, mass_center
 from pytadbit.utils.three_dim_stats   import dihedral, calc_eqv_rmsd
-from pytadbit.utils.three_dim_stats   import get_center_of_mass, distance
-from pytadbit.utils.tadmaths          import calinski_harabasz, nozero_log_list
-from pytadbit.utils.tadmaths          import mean_none
+from pytadbit.utils.three_dim_stats   import calc_contact_matrices
+from pytadbit.utils.tadmaths          import ward_calinski_harabasz, nozero_log_list
+from pytadbit.utils.tadmaths          import markov_clustering
 from pytadbit.utils.extraviews        import plot_3d_model, setup_plot
 from pytadbit.utils.extraviews        import chimera_view, tadbit_savefig
 from pytadbit.utils.extraviews        import augmented_dendrogram, plot_hist_box
 from pytadbit.mapping.analyze         import scc
 from pytadbit.modelling.impmodel      import IMPmodel
+from pytadbit.modelling.ensemble_stats import ModelEnsemble, windowize
 from pytadbit.centroid                import centroid_wrapper
 from pytadbit.aligner3d               import aligner3d_wrapper
 from pytadbit.squared_distance_matrix import squared_distance_matrix_calculation_wrapper
@@ -70,6 +72,40 @@ try:
 except NameError:
     basestring = str
 
+def _model_accessibility(model, radius, nump, superradius):
+    """
+    Number of accessible dots, total number of dots and proportion of
+    accessible dots per particle of a model (as used by
+    :func:`StructuralModels.accessibility`).
+    """
+    free, tot, _, _, acc_vs_inacc = model.accessible_surface(
+        radius, nump=nump, superradius=superradius, include_edges=False)
+    return free, tot, [(float(j) / (j + k)) if (j + k) else 0.0
+                       for _, j, k in acc_vs_inacc]
+
+
+def _model_volume(model, grain_range, cuts):
+    """
+    Volume of a model (as used by :func:`StructuralModels.get_volumes`).
+    """
+    return model.get_volume(grain_range=grain_range, cuts=cuts)
+
+
+def _map_models(func, jobs, n_cpus=1):
+    """
+    Applies a function to each set of arguments, using a pool of processes if
+    n_cpus is higher than 1. Results are returned in the same order as jobs.
+    """
+    n_cpus = min(n_cpus, len(jobs))
+    if n_cpus <= 1:
+        return [func(*args) for args in jobs]
+    pool = mu.Pool(n_cpus)
+    procs = [pool.apply_async(func, args=args) for args in jobs]
+    pool.close()
+    pool.join()
+    return [proc.get() for proc in procs]
+
+
 def R2_vs_L(L, P):
     """
     Calculates the persistence length (Lp) of given section of the model.
@@ -161,6 +197,7 @@ class StructuralModels(object):
         self.experiment     = experiment
         self._restraints    = restraints
         self.description    = description
+        self._ensemble      = None           # cached coordinates of models
 
     def __getitem__(self, nam):
         if isinstance(nam, basestring):
@@ -236,6 +273,7 @@ class StructuralModels(object):
                         'SKIPPING...') % (m))
                 del(models[m])
         new_models = {}
+        self._ensemble = None
         for i, m in enumerate(sorted(list(models.values()) + list(self.__models.values()),
                                      key=lambda x: x['objfun'])):
             new_models[i] = m
@@ -311,6 +349,7 @@ class StructuralModels(object):
         if in_place:
             mass_center(self[ref_model]['x'], self[ref_model]['y'],
                         self[ref_model]['z'], self._zeros)
+            self._ensemble = None
             return None
         return aligned
 
@@ -337,7 +376,8 @@ class StructuralModels(object):
         raise IndexError(('Model with initial random number: %s, not found\n' +
                           '') % (rand_init))
 
-    def centroid_model(self, models=None, cluster=None, verbose=False):
+    def centroid_model(self, models=None, cluster=None, verbose=False,
+                       n_cpus=1):
         """
         Estimates and returns the centroid model of a given group of models.
 
@@ -348,6 +388,7 @@ class StructuralModels(object):
            cluster number 'cluster'
         :param False verbose: prints the distance of each model to average model
            (in stderr)
+        :param 1 n_cpus: number of threads to use in the alignment of models
 
         :returns: the centroid model of a given group of models (the most model
            representative)
@@ -373,10 +414,11 @@ class StructuralModels(object):
                       if self._zeros[i]])
         zeros = tuple([True for _ in range(len(x[0]))])
         idx = centroid_wrapper(x, y, z, zeros, len(x[0]), len(models),
-                               int(verbose), 0)
+                               int(verbose), 0, n_cpus)
         return models[idx]
 
-    def average_model(self, models=None, cluster=None, verbose=False):
+    def average_model(self, models=None, cluster=None, verbose=False,
+                      n_cpus=1):
         """
         Builds and returns an average model representing a given group of models
 
@@ -387,6 +429,7 @@ class StructuralModels(object):
            cluster number 'cluster'
         :param False verbose: prints the distance of each model to average model
            (in stderr)
+        :param 1 n_cpus: number of threads to use in the alignment of models
 
         :returns: the average model of a given group of models (a new and
            ARTIFICIAL model)
@@ -409,7 +452,7 @@ class StructuralModels(object):
             y.append([self[model]['y'][i] for i in range(self.nloci)])
             z.append([self[model]['z'][i] for i in range(self.nloci)])
         idx = centroid_wrapper(x, y, z, self._zeros, len(x[0]), len(models),
-                               int(verbose), 1)
+                               int(verbose), 1, n_cpus)
         avgmodel = IMPmodel((('x', idx[0]), ('y', idx[1]), ('z', idx[2]),
                              ('rand_init', 'avg'), ('objfun', None),
                              ('radius', float(self.resolution *
@@ -441,18 +484,20 @@ class StructuralModels(object):
         :param None dcutoff: distance threshold (nm) to determine if two
            particles are in contact, default is 1.5 times resolution times scale
         :param 'mcl' method: clustering method to use, which can be either
-           'mcl' or 'ward'. MCL method is recommended. WARD method uses a scipy
-           implementation of this hierarchical clustering, and selects the best
-           number of clusters using the
-           :func:`pytadbit.utils.tadmaths.calinski_harabasz` function.
-        :param 'mcl' mcl_bin: path to the mcl executable file, in case of the
-           'mcl is not in the PATH' warning message
-        :param None tmp_file: path to a temporary file created during
-           the clustering computation. Default will be created in /tmp/ folder
+           'mcl' or 'ward'. MCL method is recommended, it uses
+           :func:`pytadbit.utils.tadmaths.markov_clustering`. WARD method uses
+           a scipy implementation of this hierarchical clustering, and selects
+           the best number of clusters using the
+           :func:`pytadbit.utils.tadmaths.calinski_harabasz` score.
+        :param 'mcl' mcl_bin: not used, kept for backward compatibility (MCL
+           clustering is computed without the external program)
+        :param None tmp_file: not used, kept for backward compatibility
         :param True verbose: same as print StructuralModels.clusters
-        :param 1 n_cpus: number of cpus to use in MCL clustering
-        :param mclargs: list with any other command line argument to be passed
-           to mcl (i.e,: mclargs=['-pi', '10', '-I', '2.0'])
+        :param 1 n_cpus: number of cpus to use in the pairwise comparison of
+           models
+        :param mclargs: list of MCL command line arguments, only the inflation
+           (i.e.: mclargs=['-I', '2.0']) is taken into account, other
+           arguments are ignored with a warning
         :param False external: if True returns the cluster found instead of
            storing it as StructuralModels.clusters
         :param 'score' what: Statistic used for clustering. Can be one of
@@ -462,8 +507,6 @@ class StructuralModels(object):
             the form: "chr3:110000000-120000000"
 
         """
-        tmp_file = '/tmp/tadbit_tmp_%s.txt' % (
-            ''.join([(uc + lc)[int(random() * 52)] for _ in range(4)]))
         if not dcutoff:
             dcutoff = int(1.5 * self.resolution * self._config['scale'])
         crm = None
@@ -499,36 +542,32 @@ class StructuralModels(object):
         if verbose:
             printime('Computing Equivalent RMSD positions')
         scores = calc_eqv_rmsd(self.__models, beg, end, self._zeros, dcutoff,
-                               what=what, normed=True)
-        from distutils.spawn import find_executable
-        if not find_executable(mcl_bin):
-            print('\nWARNING: MCL not found in path using WARD clustering\n')
-            method = 'ward'
+                               what=what, normed=True, n_cpus=n_cpus)
         if verbose:
             printime('Clustering')
+        # square matrix of pairwise scores
+        pairs = array(list(scores.keys()), dtype=int).reshape(-1, 2)
+        score_matrix = np_zeros((len(self), len(self)))
+        score_matrix[pairs[:, 0], pairs[:, 1]] = fromiter(
+            scores.values(), dtype=float, count=len(scores))
         # Initialize cluster definition of models:
         for model in self:
             model['cluster'] = 'Singleton'
         new_singles = 0
         if method == 'ward':
-
-            matrix = [[0.0 for _ in range(len(self))]
-                      for _ in range(len(self))]
-            for (i, j), score in list(scores.items()):
-                matrix[i][j] = score if score > fact * nloci else 0.0
-            clust = linkage(squareform(matrix), method='ward')
-            # score each possible cut in hierarchical clustering
-            solutions = {}
-            for k in clust[:, 2]:
-                clusters = ClusterOfModels()
-                [clusters.setdefault(j, []).append(i) for i, j in
-                 enumerate(fcluster(clust, k, criterion='distance'))]
-                solutions[k] = {'out': clusters}
-                solutions[k]['score'] = calinski_harabasz(scores, clusters)
-            # take best cluster according to calinski_harabasz score
-            clusters = [solutions[s] for s in sorted(
-                solutions, key=lambda x: solutions[x]['score'])
-                if solutions[s]['score'] > 0][-1]['out']
+            matrix = where(score_matrix > fact * nloci, score_matrix, 0.0)
+            clust = linkage(squareform(matrix, checks=False), method='ward')
+            # score each possible cut in hierarchical clustering and take
+            # best cluster according to calinski_harabasz score
+            ch_scores = ward_calinski_harabasz(clust, score_matrix)
+            valid = where(ch_scores > 0)[0]
+            if not len(valid):
+                raise Exception('ERROR: no valid cut found in the hierarchical '
+                                'clustering of models\n')
+            best = valid[ch_scores[valid] == ch_scores[valid].max()][-1]
+            clusters = ClusterOfModels()
+            [clusters.setdefault(j, []).append(i) for i, j in
+             enumerate(fcluster(clust, clust[best, 2], criterion='distance'))]
             # sort clusters, the more populated, the first.
             clusters = dict((i + 1, j) for i, j in
                             enumerate(sorted(list(clusters.values()),
@@ -544,37 +583,35 @@ class StructuralModels(object):
                 self.clusters[cluster].sort(
                     key=lambda x: self[str(x)]['objfun'])
         else:
-            out_f = open(tmp_file, 'w')
-            uniqs = list(set([tuple(sorted((m1, m2))) for m1, m2 in scores]))
+            inflation = _mcl_inflation(mclargs)
             cut = fact * (nloci - self._zeros[beg:end].count(False))
-            for md1, md2 in uniqs:
-                score = scores[(md1, md2)]
-                if score >= cut:
-                    out_f.write('model_%s\tmodel_%s\t%s\n' % (md1, md2, score))
-            out_f.close()
-            Popen('%s %s --abc -te %s -V all -o %s.mcl %s' % (
-                mcl_bin, tmp_file, n_cpus, tmp_file, ' '.join(
-                    mclargs or [])), stdout=PIPE, stderr=PIPE,
-                  shell=True, universal_newlines=True).communicate()
-            clusters = ClusterOfModels()
-            if not exists(tmp_file + '.mcl'):
+            edges = score_matrix >= cut
+            fill_diagonal(edges, False)
+            rows, cols = edges.nonzero()
+            nodes = unique(rows)
+            if not len(nodes):
                 raise Exception('Problem with clustering, try increasing ' +
                                 '"dcutoff", now: %s\n' % (dcutoff))
-            with open(tmp_file + '.mcl') as f_tmp_file:
-                for cluster, line in enumerate(f_tmp_file):
-                    models = line.split()
-                    if len(models) == 1:
-                        new_singles += 1
-                    else:
-                        clusters[cluster + 1] = []
-                        for model in models:
-                            model = int(model.split('_')[1])
-                            if not external:
-                                self[model]['cluster'] = cluster + 1
-                            clusters[cluster + 1].append(
-                                str(self[model]['rand_init']))
-                        clusters[cluster + 1].sort(
-                            key=lambda x: self[str(x)]['objfun'])
+            rank = np_zeros(len(self), dtype=int)
+            rank[nodes] = arange(len(nodes))
+            graph = coo_matrix((score_matrix[rows, cols],
+                                (rank[rows], rank[cols])),
+                               shape=(len(nodes), len(nodes)))
+            clusters = ClusterOfModels()
+            for cluster, members in enumerate(
+                    markov_clustering(graph, inflation=inflation)):
+                if len(members) == 1:
+                    new_singles += 1
+                    continue
+                clusters[cluster + 1] = []
+                for model in nodes[members]:
+                    model = int(model)
+                    if not external:
+                        self[model]['cluster'] = cluster + 1
+                    clusters[cluster + 1].append(
+                        str(self[model]['rand_init']))
+                clusters[cluster + 1].sort(
+                    key=lambda x: self[str(x)]['objfun'])
             if external:
                 return clusters
             self.clusters = clusters
@@ -667,7 +704,7 @@ class StructuralModels(object):
         return d
 
     def get_contact_matrix(self, models=None, cluster=None, cutoff=None,
-                           distance=False, show_bad_columns=True):
+                           distance=False, show_bad_columns=True, n_cpus=1):
         """
         Returns a matrix with the number of interactions observed below a given
         cutoff distance.
@@ -684,8 +721,9 @@ class StructuralModels(object):
         :param False distance: returns the distance matrix of all_angles against
            all_angles particles instead of a contact_map matrix using the cutoff
         :param True show_bad_columns: show bad columns in contact map
+        :param 1 n_cpus: number of threads used to compute the contacts
 
-        :returns: matrix frequency of interaction
+        :returns: matrix frequency of interaction (numpy array)
         """
         cluster = cluster or -1
         if models:
@@ -699,12 +737,10 @@ class StructuralModels(object):
         if not isinstance(cutoff, list):
             cutoff = [cutoff]
             cutoff_list = False
-        cutoff.sort(reverse=True)
+        cutoff = sorted([c for c in cutoff if c], reverse=True)
         if not cutoff:
             cutoff = [float(2 * self.resolution * self._config['scale'])]
         cutoff = [c**2 for c in cutoff]
-        matrix = dict([(c, [[0. for _ in range(self.nloci)]
-                            for _ in range(self.nloci)]) for c in cutoff])
         # remove (or not) interactions from bad columns
         if show_bad_columns:
             wloci = [i for i in range(self.nloci) if self._zeros[i]]
@@ -712,20 +748,11 @@ class StructuralModels(object):
             wloci = [i for i in range(self.nloci)]
         models = [self[mdl] for mdl in models]
 
-        frac = 1.0 / len(models)
-
-        for model in models:
-            squared_distance_matrix = squared_distance_matrix_calculation_wrapper(
-                model['x'], model['y'], model['z'], self.nloci)
-            #print model, len(x), len(y), len(z)
-            for c in cutoff:
-                for i, j in combinations(wloci, 2):
-                    if squared_distance_matrix[i][j] <= c:
-                        matrix[c][i][j] += frac  # * 100
-                        matrix[c][j][i] += frac  # * 100
+        matrix = calc_contact_matrices(models, self.nloci, cutoff, loci=wloci,
+                                       n_cpus=n_cpus)
         if cutoff_list:
             return matrix
-        return list(matrix.values())[0]
+        return matrix[cutoff[0]]
 
     def define_best_models(self, nbest):
         """
@@ -742,6 +769,7 @@ class StructuralModels(object):
         tmp_models = self.__models
         tmp_models.update(self._bad_models)
         nbest = min(len(tmp_models), nbest)
+        self._ensemble = None
         self.__models = dict((i, tmp_models[i]) for i in range(nbest))
         self._bad_models = dict((i, tmp_models[i]) for i in
                                 range(nbest, len(tmp_models)))
@@ -768,18 +796,20 @@ class StructuralModels(object):
         :param None dcutoff: distance threshold (nm) to determine if two
            particles are in contact, default is 1.5 times resolution times scale
         :param 'mcl' method: clustering method to use, which can be either
-           'mcl' or 'ward'. MCL method is recommended. WARD method uses a scipy
-           implementation of this hierarchical clustering, and selects the best
-           number of clusters using the
-           :func:`pytadbit.utils.tadmaths.calinski_harabasz` function.
-        :param 'mcl' mcl_bin: path to the mcl executable file, in case of the
-           'mcl is not in the PATH' warning message
-        :param None tmp_file: path to a temporary file created during
-           the clustering computation. Default will be created in /tmp/ folder
+           'mcl' or 'ward'. MCL method is recommended, it uses
+           :func:`pytadbit.utils.tadmaths.markov_clustering`. WARD method uses
+           a scipy implementation of this hierarchical clustering, and selects
+           the best number of clusters using the
+           :func:`pytadbit.utils.tadmaths.calinski_harabasz` score.
+        :param 'mcl' mcl_bin: not used, kept for backward compatibility (MCL
+           clustering is computed without the external program)
+        :param None tmp_file: not used, kept for backward compatibility
         :param True verbose: same as print StructuralModels.clusters
-        :param 1 n_cpus: number of cpus to use in MCL clustering
-        :param mclargs: list with any other command line argument to be passed
-           to mcl (i.e,: mclargs=['-pi', '10', '-I', '2.0'])
+        :param 1 n_cpus: number of cpus to use in the pairwise comparison of
+           models
+        :param mclargs: list of MCL command line arguments, only the inflation
+           (i.e.: mclargs=['-I', '2.0']) is taken into account, other
+           arguments are ignored with a warning
         :param 10 n_best_clusters: number of clusters to represent
         :param None clusters: provide clusters as a dictionary with keys=cluster
            number, or name, and values list of model numbers.
@@ -835,9 +865,7 @@ class StructuralModels(object):
                 except TypeError:
                     axes.set_visible(True)
                     axes.set(adjustable='box', aspect=1)
-                matrix3 = [[cmatrices[i][k][l] - cmatrices[j][k][l]
-                            for l in range(self.nloci)]
-                           for k in range(self.nloci)]
+                matrix3 = cmatrices[i] - cmatrices[j]
                 try:
                     ims = axes[i + add, j - 1].imshow(
                         matrix3, origin='lower', cmap=bwr,
@@ -1030,7 +1058,7 @@ class StructuralModels(object):
 
     def accessibility(self, radius, models=None, cluster=None, nump=100,
                       superradius=200, savefig=None, savedata=None, axe=None,
-                      plot=True, error=True, steps=(1, )):
+                      plot=True, error=True, steps=(1, ), n_cpus=1):
         """
         Calculates a mesh surface around the model (distance equal to input
         **radius**) and checks if each point of this mesh could be replaced by
@@ -1052,6 +1080,8 @@ class StructuralModels(object):
            estimation. By default 1 curve is drawn
         :param 200 superradius: radius of an object used to exclude outer
            surface of the model. Superradius must be higher than radius.
+        :param 1 n_cpus: number of processes used to compute the accessibility
+           of the models
 
         This function will first define a mesh around the chromatin,
         representing all possible position of the center of the object we want
@@ -1122,18 +1152,14 @@ class StructuralModels(object):
             models = [self[str(m)]['index'] for m in self.clusters[cluster]]
         else:
             models = [m for m in self.__models]
-        acc = []
-        total = []
-        frees = []
-        for model in models:
-            free, tot, _, _, acc_vs_inacc = self[model].accessible_surface(
-                radius, nump=nump, superradius=superradius,
-                include_edges=False)
-            acc.append([(float(j) / (j + k))  if (j + k) else 0.0
-                        for _, j, k in acc_vs_inacc])
-            frees.append(free)
-            total.append(tot)
-        accper, errorn, errorp = self._windowize(list(zip(*acc)), steps, average=True)
+        results = _map_models(_model_accessibility,
+                              [(self[model], radius, nump, superradius)
+                               for model in models], n_cpus)
+        frees = [free for free, _, _ in results]
+        total = [tot for _, tot, _ in results]
+        acc   = [acc_part for _, _, acc_part in results]
+        accper, errorn, errorp = windowize(list(zip(*acc)), steps, self.nloci,
+                                           average=True)
         if savedata:
             out = open(savedata, 'w')
             out.write('# Particle\t%s\n' % ('\t'.join([
@@ -1163,36 +1189,16 @@ class StructuralModels(object):
         return accper, errorp, errorn, frees, total
 
     def _get_density(self, models, interval, use_mass_center):
-        dists = [[None] * len(models)] * interval
-        for p in range(interval, self.nloci - interval):
-            part1, part2, part3 = p - interval, p, p + interval
-            if use_mass_center:
-                subdists = []
-                for m in models:
-                    try:
-                        coord1 = get_center_of_mass(
-                            self[m]['x'][part1:part2],
-                            self[m]['y'][part1:part2],
-                            self[m]['z'][part1:part2],
-                            self._zeros)
-                        coord2 = get_center_of_mass(
-                            self[m]['x'][part2:part3],
-                            self[m]['y'][part2:part3],
-                            self[m]['z'][part2:part3],
-                            self._zeros)
-                        subdists.append(distance(coord1, coord2))
-                    except ZeroDivisionError:  # part1==part2 or part2==part3
-                        subdists.append(float('nan'))
-                dists.append([float(interval * self.resolution) / d for d in subdists])
-            else:
-                dist1 = self.median_3d_dist(part1 + 1, part2 + 1, models,
-                                            plot=False, median=False)
-                dist2 = self.median_3d_dist(part2 + 1, part3 + 1, models,
-                                            plot=False, median=False)
-                dist = [(d1 + d2) for d1, d2 in zip(dist1, dist2)]
-                dists.append([float(interval * self.resolution * 2) / d
-                              for d in dist])
-        return dists
+        ensemble = self._get_ensemble(models)
+        dens = ensemble.densities(interval, self.resolution,
+                                  use_mass_center=use_mass_center,
+                                  zeros=self._zeros or None)
+        values = np_zeros((self.nloci - interval, len(models)))
+        values[:interval] = float('nan')
+        values[interval:] = dens.T
+        missing = np_zeros(values.shape, dtype=bool)
+        missing[:interval] = True
+        return values, missing
 
     def density_plot(self, models=None, cluster=None, steps=(1, 2, 3, 4, 5),
                      interval=1, use_mass_center=False, error=False, axe=None,
@@ -1232,11 +1238,10 @@ class StructuralModels(object):
             steps = (steps, )
 
         models = self._get_models(models, cluster)
-        dists = self._get_density(models, interval, use_mass_center)
-        with catch_warnings():
-            simplefilter("ignore", category=RuntimeWarning)
-            distsk, errorn, errorp = self._windowize(dists, steps, interval=interval,
-                                                     average=False)
+        dists, missing = self._get_density(models, interval, use_mass_center)
+        distsk, errorn, errorp = windowize(dists, steps, self.nloci,
+                                           missing=missing, interval=interval,
+                                           average=False)
         # write consistencies to file
         if savedata:
             out = open(savedata, 'w')
@@ -1262,23 +1267,9 @@ class StructuralModels(object):
         return distsk, errorp, errorn
 
     def _get_interactions(self, models, cutoff):
-        interactions = [[] for _ in range(self.nloci)]
         if not cutoff:
             cutoff = int(2 * self.resolution * self._config['scale'])
-        cutoff2 = cutoff**2
-        for i in range(self.nloci):
-            for m in models:
-                val = 0
-                mdl = self[m]
-                for j in range(self.nloci):
-                    if i == j:
-                        continue
-                    val += ((mdl['x'][i] - mdl['x'][j])**2 +
-                            (mdl['y'][i] - mdl['y'][j])**2 +
-                            (mdl['z'][i] - mdl['z'][j])**2) < cutoff2
-                    # val += self.__square_3d_dist(i + 1, j + 1, models=[m])[0] < cutoff2
-                interactions[i].append(val)
-        return interactions
+        return self._get_ensemble(models).interactions(cutoff).T
 
     def interactions(self, models=None, cluster=None, cutoff=None,
                      steps=(1, 2, 3, 4, 5), axe=None, error=False,
@@ -1320,8 +1311,8 @@ class StructuralModels(object):
 
         interactions = self._get_interactions(models, cutoff)
 
-        distsk, errorn, errorp = self._windowize(interactions, steps,
-                                                 average=average)
+        distsk, errorn, errorp = windowize(interactions, steps, self.nloci,
+                                           average=average)
         if savedata:
             out = open(savedata, 'w')
             out.write('#Particle\t%s\n' % (
@@ -1348,7 +1339,7 @@ class StructuralModels(object):
 
     def model_consistency(self, cutoffs=None, models=None,
                           cluster=None, axe=None, savefig=None, savedata=None,
-                          plot=True):
+                          plot=True, n_cpus=1):
         """
         Plots the particle consistency, over a given set of models, vs the
         modeled region bins. The consistency is a measure of the variability
@@ -1376,6 +1367,8 @@ class StructuralModels(object):
         :param None savedata: path to a file where to save the consistency data
            generated (1 column per cutoff + 1 for particle number).
         :param True plot: e.g. only saves data. No plotting done
+        :param 1 n_cpus: number of threads to use in the pairwise comparison
+           of models
 
         """
         models = self._get_models(models, cluster)
@@ -1389,7 +1382,8 @@ class StructuralModels(object):
         consistencies = {}
         for cut in cutoffs:
             consistencies[cut] = calc_consistency(models, self.nloci,
-                                                  self._zeros, cut)
+                                                  self._zeros, cut,
+                                                  n_cpus=n_cpus)
         # write consistencies to file
         if savedata:
             out = open(savedata, 'w')
@@ -1500,16 +1494,16 @@ class StructuralModels(object):
         if span[-1] < 0:
             raise ValueError('ERROR: last element of span should be negative')
 
-        rads = [[None] * len(models)] * (-span[0])
-        for res in range(-span[0], self.nloci - span[-1]):
-            subrad = self.dihedral_angle(res + span[0], res + span[1],
-                                         res + span[2],
-                                         res + span[3], res + span[4], models)
-            # rads.append([None] * abs(span[0]) + subrad + [None] * span[3])
-            rads.append(subrad)
-        rads += [[None] * len(models)] * (span[-1])
-        radsk, errorn, errorp = self._windowize(rads, steps, interval=0,
-                                                average=False, minerr=-360)
+        rads = np_zeros((self.nloci, len(models)))
+        missing = np_zeros(rads.shape, dtype=bool)
+        missing[:-span[0]] = True
+        missing[self.nloci - span[-1]:] = True
+        rads[missing] = float('nan')
+        rads[-span[0]:self.nloci - span[-1]] = self._get_ensemble(
+            models).dihedrals(span).T
+        radsk, errorn, errorp = windowize(rads, steps, self.nloci,
+                                          missing=missing, interval=0,
+                                          average=False, minerr=-360)
         if plot:
             xlabel = 'Particle number'
             ylabel = 'Dihedral angle in degrees'
@@ -1594,32 +1588,18 @@ class StructuralModels(object):
         if not isinstance(steps, tuple):
             steps = (steps,)
         models = self._get_models(models, cluster)
-        rads = []
-        ones = array([1., 1., 1.])
-        sign = 1
-        for model in models:
-            mox = self[model]['x']
-            moy = self[model]['y']
-            moz = self[model]['z']
-            subrad = [None] * 3
-            for res in range(1, self.nloci - 5):
-                subrad.append(self.angle_between_3_particles(
-                    res, res + 3, res + 6, models=[model], all_angles=False))
-                if signed:
-                    res1 = array([mox[res - 1], moy[res - 1], moz[res - 1]])  # faster than get_particle coordinate
-                    res2 = array([mox[res + 2], moy[res + 2], moz[res + 2]])
-                    res3 = array([mox[res + 5], moy[res + 5], moz[res + 5]])
-                    vec1 = res1 - res2 / norm(res1 - res2)
-                    vec2 = res1 - res3 / norm(res1 - res3)
-                    sign = dot(ones, cross(vec1, vec2))
-                    sign = -1 if sign < 0 else 1
-                subrad[-1] *= sign
-            subrad += [None] * 3
-            rads.append(subrad)
-        with catch_warnings():
-            simplefilter("ignore", category=RuntimeWarning)
-            radsk, errorn, errorp = self._windowize(list(zip(*rads)), steps, interval=0,
-                                                average=False, minerr=-360)
+        ensemble = self._get_ensemble(models)
+        rads = np_zeros((self.nloci, len(models)))
+        missing = np_zeros(rads.shape, dtype=bool)
+        missing[:3] = missing[self.nloci - 3:] = True
+        rads[missing] = float('nan')
+        subrad = ensemble.angles(step=3)
+        if signed:
+            subrad = subrad * ensemble.angle_signs(step=3)
+        rads[3:self.nloci - 3] = subrad.T
+        radsk, errorn, errorp = windowize(rads, steps, self.nloci,
+                                          missing=missing, interval=0,
+                                          average=False, minerr=-360)
         if plot:
             xlabel = 'Particle number'
             ylabel = 'Angle in degrees'
@@ -1826,7 +1806,7 @@ class StructuralModels(object):
         """
         if not cutoff:
             cutoff = 2.0 * self.resolution * self._config['scale']
-        if contact_matrix:
+        if contact_matrix is not None:
             model_matrix = contact_matrix
         else:
             model_matrix = self.get_contact_matrix(models=models, cluster=cluster,
@@ -2363,8 +2343,10 @@ class StructuralModels(object):
             models = [self[str(m)]['index'] for m in self.clusters[cluster]]
         else:
             models = self.__models
-        models = [self[mdl] for mdl in models]
-        dists = [mdl.distance(part1, part2) for mdl in models]
+        if part1 == 0 or part2 == 0:
+            raise Exception('Particle number must be strictly positive\n')
+        dists = (self._get_ensemble(models).pair_square_distances(
+            part1 - 1, part2 - 1)**0.5).tolist()
         if not plot:
             if median:
                 return np_median(dists)
@@ -2901,7 +2883,7 @@ class StructuralModels(object):
 
 
     def get_volumes(self, model_num=None, models=None, cluster=None, 
-                    grain_range=(10,80), cuts=3):
+                    grain_range=(10,80), cuts=3, n_cpus=1):
         '''
         Basically this is about computing the volume of these cubes:
             _____    _____    _____
@@ -2939,6 +2921,7 @@ class StructuralModels(object):
            model volume
         :param 3 cuts: number of cubes used to approximate the chromatin fiber.
            WARNING:should be higher or equal 2.
+        :param 1 n_cpus: number of processes used to compute the volumes
 
         :returns: List of volumes in cubic micrometers of the wanted structural models.
         '''
@@ -2953,14 +2936,14 @@ class StructuralModels(object):
             models = [self[str(m)]['index'] for m in self.clusters[cluster]]
         else:
             models = [m for m in self.__models]
-        volumes = []
+        jobs = []
         for model_num in models:
             try:
                 model = self[model_num]
             except KeyError:
                 model = self._bad_models[model_num]
-            volumes.append(model.get_volume(grain_range=grain_range, cuts=cuts))
-        return volumes
+            jobs.append((model, grain_range, cuts))
+        return _map_models(_model_volume, jobs, n_cpus)
 
     def remove_unwanted(self, rnd_factor=0):
         """
@@ -2972,6 +2955,7 @@ class StructuralModels(object):
         to create a more realistic representation.
         
         """
+        self._ensemble = None
         for m in self:
             prev = None
             X = []
@@ -3088,53 +3072,18 @@ class StructuralModels(object):
             models = [m for m in self.__models]
         return models
 
-    def _windowize(self, dists, steps, average=True, interval=0, minerr=0.):
-        lmodels = len(dists[0])
-        distsk = {1: dists}
-        for k in steps[1:] if steps[0] == 1 else steps:
-            distsk[k] = [None for _ in range(k // 2 + interval)]
-            for i in range(interval, self.nloci - k - interval + 1):
-                distsk[k].append(reduce(lambda x, y: x + y,
-                                        [dists[i + j] for j in range(k)]))
-                if k == 1:
-                    continue
-                # calculate the mean for steps larger than 1
-                distsk[k][-1] = [mean_none([distsk[k][-1][i + lmodels * j]
-                                            for j in range(k)])
-                                 for i in range(lmodels)]
-        new_distsk = {}
-        errorp     = {}
-        errorn     = {}
-        for k, dists in list(distsk.items()):
-            new_distsk[k] = []
-            errorp[k] = []
-            errorn[k] = []
-            for part in dists:
-                if not part:
-                    new_distsk[k].append(None)
-                    errorp[k].append(None)
-                    errorn[k].append(None)
-                    continue
-                try:
-                    mean_part = (np_mean([p for p in part if p is not None]) if
-                                 average else
-                                 np_median([p for p in part if p is not None]))
-                except IndexError:  # bug in new version of numpy?
-                    mean_part = float('nan')
-                new_distsk[k].append(mean_part)
-                try:
-                    errorn[k].append(mean_part - 2 * np_std(
-                        [p for p in part if p is not None]))
-                    if errorn[k][-1] < minerr:
-                        errorn[k][-1] = minerr
-                    errorp[k].append(mean_part + 2 * np_std(
-                        [p for p in part if p is not None]))
-                    if errorp[k][-1] < minerr:
-                        errorp[k][-1] = minerr
-                except TypeError:
-                    errorn[k].append(None)
-                    errorp[k].append(None)
-        return new_distsk, errorn, errorp
+    def _get_ensemble(self, models):
+        """
+        Internal function returning the coordinates of a list of models as a
+        :class:`pytadbit.modelling.ensemble_stats.ModelEnsemble`. The last one
+        is kept, with its intermediate results, to be reused by the different
+        per-particle descriptors.
+        """
+        key = tuple(models)
+        if self._ensemble is None or self._ensemble[0] != key:
+            self._ensemble = key, ModelEnsemble([self[m] for m in models],
+                                                self.nloci)
+        return self._ensemble[1]
 
     def _plot_polymer(self, axe):
         where = axe.get_ylim()[0]
@@ -3203,6 +3152,30 @@ class StructuralModels(object):
             plt.close('all')
 
 
+def _mcl_inflation(mclargs):
+    """
+    :param mclargs: list of MCL command line arguments
+
+    :returns: the inflation given with '-I' (2.0 by default), other arguments
+       are not supported and ignored, with a warning
+    """
+    inflation = 2.0
+    mclargs = [str(a) for a in (mclargs or [])]
+    ignored = []
+    pos = 0
+    while pos < len(mclargs):
+        if mclargs[pos] == '-I' and pos + 1 < len(mclargs):
+            inflation = float(mclargs[pos + 1])
+            pos += 2
+            continue
+        ignored.append(mclargs[pos])
+        pos += 1
+    if ignored:
+        warn('WARNING: MCL arguments not supported, ignored: %s' % (
+            ' '.join(ignored)))
+    return inflation
+
+
 class ClusterOfModels(dict):
     def __str__(self):
         out1 = '   Cluster #%3s has %4s models [top model: %6s]\n'
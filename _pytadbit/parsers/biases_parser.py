@@ -0,0 +1,320 @@
+"""
+October 18, 2026.
+
+Binary storage of the biases, bad columns and decay computed by TADbit
+normalization, as an alternative to pickle.
+
+File layout (version 1, little-endian):
+
+  - 8 bytes: magic string
+  - 2 bytes: version of the format
+  - 4 bytes: length of the header
+  - header: JSON description of the content (resolution, number of bins,
+    chromosome names of the decay, values of the bad columns other than
+    True, other values found in the pickle) and of the arrays stored (offset
+    from the end of the header, type and number of elements)
+  - arrays, aligned to 64 bytes:
+      - biases: float64, one per bin (NaN if not defined)
+      - biases_defined: bitmap of the bins with a bias (bitmaps are packed
+        with the most significant bit first)
+      - badcol: bitmap of the bad columns
+      - decay: float64, one per diagonal (per chromosome or genome-wide)
+      - decay_defined: bitmap of the diagonals with an expected value
+
+Arrays are read through memory-maps, only the bins of the wanted regions
+being loaded.
+"""
+
+import json
+import struct
+from warnings import warn
+
+import numpy as np
+try:
+    from pickle5 import load, dump, HIGHEST_PROTOCOL  # python < 3.8
+except ImportError:
+    from pickle  import load, dump, HIGHEST_PROTOCOL
+
+MAGIC   = b'TADBIAS\x00'
+VERSION = 1
+_ALIGN  = 64
+
+
+def is_binary_biases(fname):
+    """
+    :param fname: path to a file with biases
+
+    :returns: True if the file is stored in TADbit binary biases format
+    """
+    with open(fname, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _dict_to_arrays(values, size=None):
+    """
+    :returns: array of values (NaN where not defined) and boolean array of
+       defined positions
+    """
+    if size is None:
+        size = max(values) + 1 if values else 0
+    array   = np.full(size, np.nan)
+    defined = np.zeros(size, dtype=bool)
+    keys = np.fromiter(values.keys(), dtype=np.int64, count=len(values))
+    array[keys] = np.fromiter(values.values(), dtype=float, count=len(values))
+    defined[keys] = True
+    return array, defined
+
+
+def _arrays_to_dict(array, defined, offset=0):
+    """
+    :returns: dictionary with the defined values, keys being positions plus
+       offset
+    """
+    keys = np.flatnonzero(defined)
+    return dict(zip((keys + offset).tolist(), array[keys].tolist()))
+
+
+def write_binary_biases(fname, biases, size=None):
+    """
+    Write biases in TADbit binary format
+
+    :param fname: path to output file
+    :param biases: dictionary with, as in the pickle written by TADbit
+       normalization, 'biases' (dictionary or list of biases per bin),
+       'badcol' (dictionary of bad columns), 'decay' (dictionary of expected
+       values per distance, or dictionary of those per chromosome) and
+       'resolution'. Other JSON serializable values are also stored.
+    :param None size: number of bins, by default the largest bin found
+
+    """
+    bias   = biases.get('biases')
+    badcol = biases.get('badcol') or {}
+    decay  = biases.get('decay')
+    bias_type = None if bias is None else 'dict'
+    if isinstance(bias, (list, tuple, np.ndarray)):
+        bias_type = 'list'
+        bias = dict(enumerate(bias))
+    if size is None:
+        size = max([max(bias) + 1 if bias else 0,
+                    max(badcol) + 1 if badcol else 0])
+
+    arrays = []
+    header = {'resolution': biases.get('resolution'), 'size': size,
+              'biases': bias_type, 'decay': None, 'chromosomes': [],
+              'badcol_values': [], 'keys': list(biases),
+              'nones': [k for k, v in biases.items() if v is None],
+              'extra': {}}
+    if bias_type == 'list':
+        header['biases_length'] = len(bias)
+    if bias is not None:
+        values, defined = _dict_to_arrays(bias, size)
+        arrays.append(('biases', values))
+        arrays.append(('biases_defined', np.packbits(defined)))
+    bads = np.zeros(size, dtype=bool)
+    bads[list(badcol)] = True
+    arrays.append(('badcol', np.packbits(bads)))
+    # bad columns are flagged with True, or with the value used to filter
+    for b, val in badcol.items():
+        if val is True:
+            continue
+        if isinstance(val, np.generic):
+            val = val.item()
+        try:
+            json.dumps(val)
+        except TypeError:
+            warn('WARNING: value of bad column %s not stored in binary biases '
+                 'file' % b)
+            continue
+        header['badcol_values'].append((int(b), val))
+    if decay:
+        if all(isinstance(v, dict) for v in decay.values()):
+            header['decay'] = 'chromosome'
+            header['chromosomes'] = list(decay)
+            for i, crm in enumerate(decay):
+                values, defined = _dict_to_arrays(decay[crm])
+                arrays.append(('decay/%d' % i, values))
+                arrays.append(('decay_defined/%d' % i, np.packbits(defined)))
+        else:
+            header['decay'] = 'genome'
+            values, defined = _dict_to_arrays(decay)
+            arrays.append(('decay', values))
+            arrays.append(('decay_defined', np.packbits(defined)))
+    elif decay is not None:
+        header['decay'] = 'empty'
+    for key, val in biases.items():
+        if key in ('biases', 'badcol', 'decay', 'resolution'):
+            continue
+        try:
+            json.dumps(val)
+        except TypeError:
+            warn('WARNING: %s not stored in binary biases file' % key)
+            continue
+        header['extra'][key] = val
+
+    # offsets relative to the start of the arrays, just after the header
+    header['arrays'] = {}
+    pos = 0
+    for name, arr in arrays:
+        header['arrays'][name] = (pos, arr.dtype.str, len(arr))
+        pos += arr.nbytes + (-arr.nbytes) % _ALIGN
+    hdr = json.dumps(header).encode('utf-8')
+    start = _data_start(len(hdr))
+    with open(fname, 'wb') as out:
+        out.write(MAGIC)
+        out.write(struct.pack('<HI', VERSION, len(hdr)))
+        out.write(hdr)
+        for name, arr in arrays:
+            out.write(b'\x00' * (start + header['arrays'][name][0] - out.tell()))
+            out.write(arr.astype(arr.dtype.newbyteorder('<')).tobytes())
+
+
+def _data_start(header_length):
+    """
+    :returns: position of the first array in the file
+    """
+    pos = len(MAGIC) + 6 + header_length
+    return pos + (-pos) % _ALIGN
+
+
+def _read_header(fname):
+    with open(fname, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise Exception('ERROR: %s is not a TADbit binary biases file' % (
+                fname))
+        version, length = struct.unpack('<HI', f.read(6))
+        if version > VERSION:
+            raise Exception('ERROR: binary biases file version %d not '
+                            'supported (max %d), update TADbit' % (
+                                version, VERSION))
+        header = json.loads(f.read(length).decode('utf-8'))
+    header['start'] = _data_start(length)
+    return header
+
+
+def _memmap(fname, header, name):
+    offset, dtype, count = header['arrays'][name]
+    if not count:
+        return np.zeros(0, dtype=np.dtype(dtype))
+    return np.memmap(fname, dtype=np.dtype(dtype), mode='r',
+                     offset=header['start'] + offset, shape=(count,))
+
+
+def _bitmap_slice(bitmap, beg, end):
+    """
+    :returns: boolean array of the bits from beg to end (not included)
+    """
+    bits = np.unpackbits(bitmap[beg // 8:(end + 7) // 8]).astype(bool)
+    return bits[beg % 8:beg % 8 + end - beg]
+
+
+def _read_decay(fname, header, suffix):
+    """
+    :returns: dictionary of expected values per distance
+    """
+    values = _memmap(fname, header, 'decay' + suffix)
+    defined = _bitmap_slice(_memmap(fname, header, 'decay_defined' + suffix),
+                            0, len(values))
+    return _arrays_to_dict(values, defined)
+
+
+def read_binary_biases(fname, ranges=None):
+    """
+    Read biases stored in TADbit binary format.
+
+    :param fname: path to file
+    :param None ranges: list of tuples (first bin, last bin not included).
+       Only the biases and the bad columns of these bins are read (bins keep
+       their genome-wide index). If None, all bins are read
+
+    :returns: a dictionary as the pickle written by TADbit normalization
+    """
+    header = _read_header(fname)
+    size = header['size']
+    whole = ranges is None
+    if whole:
+        ranges = [(0, size)]
+    ranges = [(max(0, beg), min(end, size)) for beg, end in ranges]
+    ranges = [(beg, end) for beg, end in sorted(set(ranges)) if beg < end]
+    result = dict(header['extra'])
+    result['resolution'] = header['resolution']
+    result['biases'] = None
+    if header['biases'] == 'list' and whole:
+        values  = _memmap(fname, header, 'biases')
+        result['biases'] = values[:header['biases_length']].tolist()
+    elif header['biases']:
+        values  = _memmap(fname, header, 'biases')
+        defined = _memmap(fname, header, 'biases_defined')
+        result['biases'] = {}
+        for beg, end in ranges:
+            result['biases'].update(_arrays_to_dict(
+                values[beg:end], _bitmap_slice(defined, beg, end), beg))
+    bitmap = _memmap(fname, header, 'badcol')
+    result['badcol'] = {}
+    for beg, end in ranges:
+        bads = np.flatnonzero(_bitmap_slice(bitmap, beg, end)) + beg
+        result['badcol'].update((b, True) for b in bads.tolist())
+    result['badcol'].update((b, val) for b, val in header.get('badcol_values', [])
+                            if b in result['badcol'])
+    if header['decay'] == 'chromosome':
+        result['decay'] = dict((crm, _read_decay(fname, header, '/%d' % i))
+                               for i, crm in enumerate(header['chromosomes']))
+    elif header['decay'] == 'genome':
+        result['decay'] = _read_decay(fname, header, '')
+    elif header['decay'] == 'empty':
+        result['decay'] = {}
+    else:
+        result['decay'] = None
+    # keys missing from the original dictionary, or set to None
+    if 'keys' in header:
+        for key in ('biases', 'badcol', 'decay', 'resolution'):
+            if not key in header['keys']:
+                del result[key]
+            elif key in header['nones']:
+                result[key] = None
+    return result
+
+
+def read_biases(fname, ranges=None):
+    """
+    Read biases, decay and bad columns from a pickle or a binary file.
+
+    :param fname: path to file
+    :param None ranges: list of tuples (first bin, last bin not included).
+       Only the biases and the bad columns of these bins are kept (bins keep
+       their genome-wide index). If None, all bins are kept
+
+    :returns: a dictionary as the pickle written by TADbit normalization
+    """
+    if is_binary_biases(fname):
+        return read_binary_biases(fname, ranges)
+    biases = load(open(fname, 'rb'))
+    if ranges is None:
+        return biases
+
+    def _in_ranges(k):
+        return any(beg <= k < end for beg, end in ranges)
+
+    biases = dict(biases)
+    if biases.get('biases') is not None:
+        biases['biases'] = dict((k, v) for k, v in biases['biases'].items()
+                                if _in_ranges(k))
+    biases['badcol'] = dict((k, v) for k, v in biases.get('badcol', {}).items()
+                            if _in_ranges(k))
+    return biases
+
+
+def convert_biases(infile, outfile, size=None):
+    """
+    Convert biases from pickle to binary format, or from binary to pickle
+    (depending on the format of the input file).
+
+    :param infile: path to input file
+    :param outfile: path to output file
+    :param None size: number of bins (when converting to binary format)
+    """
+    if is_binary_biases(infile):
+        out = open(outfile, 'wb')
+        dump(read_binary_biases(infile), out, HIGHEST_PROTOCOL)
+        out.close()
+    else:
+        write_binary_biases(outfile, load(open(infile, 'rb')), size=size)
@@ -9,12 +9,18 @@ import os
 import datetime
 import json
 import h5py
+import multiprocessing as mu
 import numpy as np
 from warnings       import warn
 from math           import ceil
 from collections    import OrderedDict
 from time           import time
 
+try:
+    basestring
+except NameError:
+    basestring = str
+
 def printime(msg):
     print (msg +
            (' ' * (79 - len(msg.replace('\n', '')))) +
@@ -67,7 +73,7 @@ def parse_header(fname, resolution=None):
     return chroms
 
 def parse_cooler(fname, resolution=None, normalized=False,
-                 raw_values = False):
+                 raw_values = False, region=None, chunksize=10000000):
     """
     Read matrix stored in cooler
 
@@ -75,56 +81,317 @@ def parse_cooler(fname, resolution=None, normalized=False,
     :param None resolution: matrix resolution.
     :param False normalized: whether to apply weights
     :param False raw_values: return separated raw and weights
+    :param None region: chromosome name, region ('chr1:1000000-2000000' or
+       tuple (chromosome, start, end)) or list of them. Only the pixels of
+       these regions are read (see :func:`read_cooler`)
+    :param 10000000 chunksize: maximum number of pixels read at once
 
     :returns: An iterator to be converted in dictionary, matrix size, raw_names
        as list of tuples (chr, pos), dictionary of masked bins, and boolean
        reporter of symetric transformation
     """
+    (rows, cols, values, chromosomes, starts,
+     weights, resolution) = read_cooler(fname, resolution,
+                                        normalized=normalized and not raw_values,
+                                        region=region, chunksize=chunksize)
+    size = len(starts)
+    if normalized:
+        values = values.astype(float)
+    items = zip((rows + cols * size).tolist(), values.tolist())
+    if raw_values:
+        if weights is None or not normalized:
+            weights = [1 for _ in range(size)]
+        return items, weights, size, chromosomes
+    header = []
+    beg = 0
+    for crm, nbins in chromosomes.items():
+        header.extend((crm, '%d-%d' % (c + 1, c + resolution))
+                      for c in starts[beg:beg + nbins].tolist())
+        beg += nbins
+    return items, size, header, {}, False
+
+
+def read_cooler(fname, resolution=None, normalized=False, region=None,
+                chunksize=10000000):
+    """
+    Read the pixels stored in a cooler. Only the pixels of the bins of the
+    requested regions are read (using the bin1_offset index of the cooler),
+    by chunks of pixels.
 
+    :param fname: path to the cooler file
+    :param None resolution: matrix resolution, if None, the first found
+    :param False normalized: whether to apply weights
+    :param None region: chromosome name, region ('chr1:1000000-2000000' or
+       tuple (chromosome, start, end)) or list of them. Bins are those from
+       start // resolution to end // resolution (not included). If None, the
+       whole matrix is read
+    :param 10000000 chunksize: maximum number of pixels read at once
+
+    :returns: rows, columns and values of the pixels (arrays, upper half of the
+       matrix only, with indexes relative to the selected bins), an
+       OrderedDict with the number of selected bins per region, an array with
+       the start of each selected bin, an array with their weights (None if
+       the cooler has no weights), and the resolution
+    """
     with h5py.File(fname, "r") as f:
-
         resolution = resolution or list(f['resolutions'].keys())[0]
         root_grp = f['resolutions'][str(resolution)]
-
-        chrom = root_grp["chroms"]["name"][()]
-        idregion = dict(list(zip(list(range(len(chrom))), [reg for reg in chrom])))
-
-        try:
-            chrom = [idregion[c].decode() for c in root_grp["bins"]["chrom"]]
-        except (UnicodeDecodeError, AttributeError):
-            chrom = [str(idregion[c]) for c in root_grp["bins"]["chrom"]]
-
-        if raw_values:
-            starts = root_grp["bins"]["start"]
-            header = OrderedDict()
-            for chromi, starti in zip(chrom, starts):
-                header[chromi] = starti // resolution + 1
-            size = 0
-            for chromi in header:
-                size += header[chromi] 
-        else:
-            starts = ['%d-%d'%(c+1,c+int(resolution)) for c in root_grp["bins"]["start"]]
-            header = [(chromi, starti) for chromi, starti in zip(chrom, starts)]
-            size = len(header)
-        masked = {}
-        if normalized and "weight" in root_grp["bins"]:
+        resolution = int(resolution)
+        ranges = _cooler_ranges(root_grp, resolution, region)
+        nbins = len(root_grp["bins"]["start"])
+        # local index of each bin of the cooler in the selection (-1 if out)
+        local = np.full(nbins, -1, dtype=np.int64)
+        chromosomes = OrderedDict()
+        total = 0
+        for crm, lo, hi in ranges:
+            local[lo:hi] = np.arange(total, total + hi - lo)
+            chromosomes[crm] = chromosomes.get(crm, 0) + hi - lo
+            total += hi - lo
+        selected = np.concatenate([np.arange(lo, hi) for _, lo, hi in ranges]
+                                  + [np.zeros(0, dtype=np.int64)])
+        starts = root_grp["bins"]["start"][()][selected]
+        if "weight" in root_grp["bins"]:
             weights = root_grp["bins"]["weight"][()]
         else:
-            weights = [1 for _ in range(size)]
-        bin1_id = root_grp["pixels"]["bin1_id"][()]
-        bin2_id = root_grp["pixels"]["bin2_id"][()]
-        counti = root_grp["pixels"]["count"][()]
-        num = int if not normalized else float
-        if raw_values:
-            items = [(int(row) + int(col) * size, num(val))
-                 for row, col, val in zip(bin1_id, bin2_id, counti)]
+            weights = None
+        bin1_offset = root_grp["indexes"]["bin1_offset"]
+        pixels = root_grp["pixels"]
+        rows, cols, values = [], [], []
+        for _, lo, hi in ranges:
+            for beg in range(int(bin1_offset[lo]), int(bin1_offset[hi]),
+                             chunksize):
+                end = min(beg + chunksize, int(bin1_offset[hi]))
+                bin1 = pixels["bin1_id"][beg:end]
+                bin2 = pixels["bin2_id"][beg:end]
+                vals = pixels["count"][beg:end]
+                _check_pixel_bins(bin1, bin2, nbins)
+                keep = local[bin2] >= 0
+                bin1, bin2, vals = bin1[keep], bin2[keep], vals[keep]
+                if normalized and weights is not None:
+                    vals = vals * weights[bin1] * weights[bin2]
+                rows.append(local[bin1])
+                cols.append(local[bin2])
+                values.append(vals)
+    if not rows:
+        rows = cols = [np.zeros(0, dtype=np.int64)]
+        values = [np.zeros(0, dtype=float if normalized else np.int64)]
+    if weights is not None:
+        weights = weights[selected]
+    return (np.concatenate(rows), np.concatenate(cols),
+            np.concatenate(values), chromosomes, starts, weights, resolution)
+
+
+def _cooler_ranges(root_grp, resolution, region):
+    """
+    :returns: list of regions to read, as tuples (chromosome, first bin, last
+       bin not included)
+    """
+    names = root_grp["chroms"]["name"][()]
+    try:
+        names = [c.decode() for c in names]
+    except (UnicodeDecodeError, AttributeError):
+        names = [str(c) for c in names]
+    chrom_offset = root_grp["indexes"]["chrom_offset"][()]
+    if region is None:
+        region = names
+    elif isinstance(region, (basestring, tuple)):
+        region = [region]
+    ranges = []
+    for reg in region:
+        if isinstance(reg, tuple):
+            crm, beg, end = reg
+        elif ':' in reg and reg not in names:
+            crm, pos = reg.rsplit(':', 1)
+            beg, end = [int(p) for p in pos.replace(',', '').split('-')]
         else:
-            items = [(int(row) + int(col) * size, num(val)*weights[row]*weights[col])
-                     for row, col, val in zip(bin1_id, bin2_id, counti)]
-    if raw_values:
-        return items, weights, size, header
+            crm, beg, end = reg, None, None
+        try:
+            idx = names.index(crm)
+        except ValueError:
+            raise Exception('ERROR: chromosome %s not found in cooler' % crm)
+        lo, hi = int(chrom_offset[idx]), int(chrom_offset[idx + 1])
+        if beg is not None:
+            lo, hi = min(lo + beg // resolution, hi), min(lo + end // resolution, hi)
+        ranges.append((crm, lo, hi))
+    return ranges
+
+
+def coarsen_cooler(fname, resolutions, resolution=None, ncpus=1,
+                   balance=False, chunksize=10000000, verbose=False):
+    """
+    Add coarser resolutions to a cooler, summing the pixels of the coarsest
+    resolution already stored that divides each new one (e.g.: 100 kb is
+    computed from 50 kb, itself computed from 10 kb). Pixels are read by
+    chunks covering complete rows of the new matrix, and each chunk is
+    aggregated by a separate worker.
+
+    :param fname: path to the cooler file
+    :param resolutions: list of resolutions to add, multiples of the
+       starting resolution
+    :param None resolution: resolution from which to start, if None, the
+       first found
+    :param 1 ncpus: number of workers aggregating the pixels
+    :param False balance: compute the balancing weights (iterative
+       correction) of each new resolution, stored as the "weight" column of its
+       bins
+    :param 10000000 chunksize: approximate number of pixels aggregated by
+       each worker at once
+    :param False verbose: speak
+
+    :returns: list of the resolutions added
+    """
+    with h5py.File(fname, "r") as f:
+        available = [int(r) for r in f['resolutions']]
+    resolution = int(resolution or available[0])
+    if resolution not in available:
+        raise Exception('ERROR: resolution %d not found in cooler' % resolution)
+    resolutions = sorted(set(int(r) for r in resolutions))
+    for reso in resolutions:
+        if reso in available:
+            raise Exception('ERROR: resolution %d already in cooler' % reso)
+        if reso % resolution:
+            raise Exception('ERROR: resolution %d is not a multiple of %d' % (
+                reso, resolution))
+    sources = [r for r in available if r >= resolution and not r % resolution]
+    pool = mu.Pool(ncpus) if ncpus > 1 else None
+    added = []
+    for reso in resolutions:
+        source = max(r for r in sources if not reso % r)
+        if verbose:
+            printime('Coarsening %d to %d' % (source, reso))
+        _coarsen_resolution(fname, source, reso, pool, balance, chunksize,
+                            verbose)
+        sources.append(reso)
+        added.append(reso)
+    if pool:
+        pool.close()
+        pool.join()
+    return added
+
+
+def _coarsen_resolution(fname, source, resolution, pool, balance, chunksize,
+                        verbose):
+    """
+    Write one coarser resolution in the cooler from a finer one.
+    """
+    factor = resolution // source
+    with h5py.File(fname, "r") as f:
+        root_grp = f['resolutions'][str(source)]
+        names = root_grp["chroms"]["name"][()]
+        try:
+            names = [c.decode() for c in names]
+        except (UnicodeDecodeError, AttributeError):
+            names = [str(c) for c in names]
+        lengths = root_grp["chroms"]["length"][()].tolist()
+        chrom_offset = root_grp["indexes"]["chrom_offset"][()]
+        bin1_offset = root_grp["indexes"]["bin1_offset"][()]
+    new_offset = np.cumsum([0] + [int(ceil(l / resolution)) for l in lengths])
+    # pixel offsets of the first row of each new bin, used to cut the chunks
+    row_starts = np.concatenate([np.arange(lo, hi, factor) for lo, hi in
+                                 zip(chrom_offset[:-1], chrom_offset[1:])]
+                                + [chrom_offset[-1:]])
+    offsets = bin1_offset[row_starts]
+    cuts = np.unique(np.concatenate([
+        np.searchsorted(offsets, np.arange(0, offsets[-1], chunksize)),
+        [len(offsets) - 1]]))
+    jobs = [(fname, source, int(offsets[a]), int(offsets[b]), chrom_offset,
+             new_offset, factor) for a, b in zip(cuts[:-1], cuts[1:])]
+    bin1, bin2, counts = [], [], []
+    for rows, cols, vals in (pool.imap if pool else map)(_coarsen_chunk, jobs):
+        bin1.append(rows)
+        bin2.append(cols)
+        counts.append(vals)
+    empty = [np.zeros(0, dtype=np.int64)]
+    bin1, bin2, counts = [np.concatenate(p + empty)
+                          for p in (bin1, bin2, counts)]
+
+    out = cooler_file(fname, resolution, OrderedDict(zip(names, lengths)),
+                      names, verbose=verbose)
+    out.create_bins()
+    out.prepare_matrix()
+    out.write_pixels(bin1, bin2, counts)
+    out.close()
+    if balance:
+        nbins = int(new_offset[-1])
+        weights = _balance_weights(bin1, bin2, counts, nbins)
+        out.write_weights(weights, weights, 0, nbins, 0, nbins)
+
+
+def _coarsen_chunk(args):
+    """
+    Sum the pixels of a chunk of a cooler into the bins of a coarser
+    resolution.
+
+    :returns: rows, columns and counts of the coarser pixels, sorted
+    """
+    fname, source, beg, end, chrom_offset, new_offset, factor = args
+    with h5py.File(fname, "r") as f:
+        pixels = f['resolutions'][str(source)]["pixels"]
+        bin1 = pixels["bin1_id"][beg:end]
+        bin2 = pixels["bin2_id"][beg:end]
+        counts = pixels["count"][beg:end].astype(np.int64)
+    _check_pixel_bins(bin1, bin2, int(chrom_offset[-1]))
+    nbins = int(new_offset[-1])
+    keys = (_coarse_bins(bin1, chrom_offset, new_offset, factor) * nbins +
+            _coarse_bins(bin2, chrom_offset, new_offset, factor))
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    firsts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+    keys = keys[firsts]
+    return keys // nbins, keys % nbins, np.add.reduceat(counts[order], firsts)
+
+
+def _check_pixel_bins(bin1, bin2, nbins):
+    """
+    Raises an error if some pixels are out of the bins table.
+    """
+    if len(bin1) and max(bin1.max(), bin2.max()) >= nbins:
+        raise Exception('ERROR: pixels found out of the %d bins of the cooler '
+                        '(bin %d)' % (nbins, max(bin1.max(), bin2.max())))
+
+
+def _coarse_bins(bins, chrom_offset, new_offset, factor):
+    """
+    :returns: the index of each bin in a resolution 'factor' times coarser
+    """
+    crm = np.searchsorted(chrom_offset, bins, side='right') - 1
+    return new_offset[crm] + (bins - chrom_offset[crm]) // factor
+
+
+def _balance_weights(bin1, bin2, counts, nbins, max_iter=200, tol=1e-5):
+    """
+    Iterative correction (Imakaev 2012) of a symmetric matrix stored as its
+    upper half.
+
+    :returns: an array of weights, such that counts multiplied by the weights
+       of their row and column have all their marginals equal to one (weight
+       of empty bins is zero)
+    """
+    _check_pixel_bins(bin1, bin2, nbins)
+    offdiag = bin1 != bin2
+
+    def marginals(vals):
+        return (np.bincount(bin1, weights=vals, minlength=nbins) +
+                np.bincount(bin2[offdiag], weights=vals[offdiag],
+                            minlength=nbins))
+
+    counts = counts.astype(float)
+    weights = np.zeros(nbins)
+    good = marginals(counts) > 0
+    if not good.any():
+        return weights
+    weights[good] = 1.
+    for _ in range(max_iter):
+        marg = marginals(counts * weights[bin1] * weights[bin2])[good]
+        marg /= marg.mean()
+        weights[good] /= marg
+        if marg.var() < tol:
+            break
     else:
-        return items, size, header, masked, False
+        warn('WARNING: balancing weights did not converge')
+    scale = marginals(counts * weights[bin1] * weights[bin2])[good].mean()
+    return weights / scale**.5
+
 
 class cooler_file(object):
     """
@@ -323,43 +590,50 @@ class cooler_file(object):
 
         """
         if self.ichunk != ichunk:
-            self.buff.sort()
-            with h5py.File(self.outcool, "r+") as f:
-                root_grp = f[self.root_grp][str(self.resolution)]
-                grp = root_grp["pixels"]
-                dsets = ["bin1_id","bin2_id","count"]
-                for i, dset in enumerate(dsets):
-                    grp[dset].resize((self.nnz + self.nbuff,))
-                    grp[dset][self.nnz : self.nnz + self.nbuff] = [int(ch[i]) for ch in self.buff]
-            self.nnz += self.nbuff
-            self.ncontacts += sum([int(ch[2]) for ch in self.buff])
-
-            del self.buff[:]
-            self.nbuff = 0
+            self._flush_buffer()
         vals = (j+(self.startj-self.sec_offset),k+(self.startk-self.sec_offset),v)
         self.buff.append(vals)
         self.nbuff += 1
         self.ichunk = ichunk
 
+    def _flush_buffer(self):
+        """
+        Sort the buffered pixels and append them to the pixels table.
+        """
+        buff = np.array(self.buff, dtype=np.int64).reshape(-1, 3)
+        buff = buff[np.lexsort((buff[:, 2], buff[:, 1], buff[:, 0]))]
+        self.write_pixels(buff[:, 0], buff[:, 1], buff[:, 2])
+        del self.buff[:]
+        self.nbuff = 0
+
+    def write_pixels(self, bin1, bin2, counts):
+        """
+        Append pixels to the pixels table. Pixels should be sorted and come
+        after the ones already written.
+
+        :param bin1: array of row bins
+        :param bin2: array of column bins
+        :param counts: array of interaction counts
+
+        """
+        nnz = len(counts)
+        with h5py.File(self.outcool, "r+") as f:
+            root_grp = f[self.root_grp][str(self.resolution)]
+            grp = root_grp["pixels"]
+            for dset, vals in zip(["bin1_id","bin2_id","count"],
+                                  [bin1, bin2, counts]):
+                grp[dset].resize((self.nnz + nnz,))
+                grp[dset][self.nnz : self.nnz + nnz] = vals
+        self.nnz += nnz
+        self.ncontacts += int(np.sum(counts, dtype=np.int64))
+
     def close(self):
         """
         Copy remaining buffer to file, index the pixelsand complete information
         """
         # copy remaining reads in buffer
         if self.nbuff > 0:
-            self.buff.sort()
-            with h5py.File(self.outcool, "r+") as f:
-                root_grp = f[self.root_grp][str(self.resolution)]
-                grp = root_grp["pixels"]
-                dsets = ["bin1_id","bin2_id","count"]
-                for i, dset in enumerate(dsets):
-                    grp[dset].resize((self.nnz + self.nbuff,))
-                    grp[dset][self.nnz : self.nnz + self.nbuff] = [int(ch[i]) for ch in self.buff]
-            self.nnz += self.nbuff
-            self.ncontacts += sum([int(ch[2]) for ch in self.buff])
-
-            del self.buff[:]
-            self.nbuff = 0
+            self._flush_buffer()
         self.ichunk = 0
         self.write_indexes()
         self.write_info()
@@ -4,13 +4,13 @@ import gzip
 
 class gzopen(object):
    def __init__(self, fname):
-      f = open(fname)
-      magic_number = f.read(2)
-      f.seek(0)
+      with open(fname, 'rb') as f:
+         magic_number = f.read(2)
       if magic_number == b'\x1f\x8b':
-         self.f = gzip.GzipFile(fileobj=f)
+         # decompressed as it is read, in text mode
+         self.f = gzip.open(fname, 'rt')
       else:
-         self.f = f
+         self.f = open(fname)
    def __exit__(self, type, value, traceback):
       try:
          self.f.fileobj.close()
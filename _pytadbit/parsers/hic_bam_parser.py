@@ -8,23 +8,21 @@ from builtins   import next
 
 from future import standard_library
 standard_library.install_aliases()
-try:
-    from pickle5                     import load  # python < 3.8
-except ImportError:
-    from pickle                      import load
 from time                         import sleep
-from collections                  import OrderedDict
+from collections                  import OrderedDict, deque
+from functools                    import partial
 from subprocess                   import Popen, PIPE
 from math                         import isnan
-from random                       import getrandbits
 from tarfile                      import open as taropen
 from io                           import StringIO
 from shutil                       import copyfile
-from sys                          import stdout, stderr, exc_info, modules
+from sys                          import stdout, stderr, modules
 from distutils.version            import LooseVersion
 import os
 import multiprocessing as mu
 
+import numpy as np
+
 try:
     from lockfile                 import LockFile
 except ImportError:
@@ -33,11 +31,12 @@ except ImportError:
 from pysam                        import AlignmentFile
 
 from pytadbit.utils                 import printime
-from pytadbit.utils.file_handling   import mkdir, which
+from pytadbit.utils.file_handling   import which
 from pytadbit.utils.extraviews      import nicer
 from pytadbit.mapping.filter        import MASKED
+from pytadbit.parsers.biases_parser import read_biases
 try:
-    from pytadbit.parsers.cooler_parser import cooler_file
+    from pytadbit.parsers.cooler_parser import cooler_file, coarsen_cooler
 except ImportError:
     pass
 
@@ -363,138 +362,82 @@ def get_filters(infile, masked):
     return filter_line, filter_handler
 
 
-def _read_bam_frag(inbam, filter_exclude, all_bins, sections1, sections2,
-                   rand_hash, resolution, tmpdir, region, start, end,
-                   sum_columns=False):
-    bamfile = AlignmentFile(inbam, 'rb')
-    refs = bamfile.references
-    bam_start = start - 2
-    bam_start = max(0, bam_start)
-    try:
-        dico = {}
-        for r in bamfile.fetch(region=region,
-                               start=bam_start, end=end,  # coords starts at 0
-                               multiple_iterators=True):
-            if r.flag & filter_exclude:
-                continue
-            crm1 = r.reference_name
-            pos1 = r.reference_start + 1
-            crm2 = refs[r.mrnm]
-            pos2 = r.mpos + 1
-            try:
-                pos1 = sections1[(crm1, pos1 // resolution)]
-                pos2 = sections2[(crm2, pos2 // resolution)]
-            except KeyError:
-                continue  # not in the subset matrix we want
-            crm = crm1 * (crm1 == crm2)
-            try:
-                dico[(crm, pos1, pos2)] += 1
-            except KeyError:
-                dico[(crm, pos1, pos2)] = 1
-            # print '%-50s %5s %9s %5s %9s' % (r.query_name,
-            #                                  crm1, r.reference_start + 1,
-            #                                  crm2, r.mpos + 1)
-        out = open(os.path.join(tmpdir, '_tmp_%s' % (rand_hash),
-                                '%s:%d-%d.tsv' % (region, start, end)), 'w')
-        out.write(''.join('%s\t%d\t%d\t%d\n' % (c, a, b, v)
-                          for (c, a, b), v in dico.items()))
-        out.close()
-        if sum_columns:
-            sumcol = {}
-            cisprc = {}
-            for (c, i, j), v in dico.items():
-                # out.write('%d\t%d\t%d\n' % (i, j, v))
-                try:
-                    sumcol[i] += v
-                    cisprc[i][all_bins[i][0] == all_bins[j][0]] += v
-                except KeyError:
-                    sumcol[i]  = v
-                    cisprc[i]  = [0, 0]
-                    cisprc[i][all_bins[i][0] == all_bins[j][0]] += v
-            return sumcol, cisprc
-    except Exception as e:
-        exc_type, exc_obj, exc_tb = exc_info()
-        fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-        print(e)
-        print(exc_type, fname, exc_tb.tb_lineno)
-
-
-def _read_half_bam_frag(inbam, filter_exclude, all_bins, sections1, sections2,
-                        rand_hash, resolution, tmpdir, region, start, end,
-                        sum_columns=False):
+def _read_bam_frag(inbam, filter_exclude, sections1, sections2, resolution,
+                   region, start, end, half=False, masked=None):
+    """
+    Count the interactions of the reads starting in a region of the BAM file.
+
+    :param sections1: dictionary with, for each chromosome, the first and the
+       last (not included) bins in the rows of the matrix, and the index of
+       the first one
+    :param sections2: same as sections1 for the columns of the matrix
+    :param False half: only keep interactions with row lower or equal to
+       column
+    :param None masked: tuple with a resolution and, for each chromosome, the
+       set of bins (at this resolution) in which reads are not counted
+
+    :returns: the region, and arrays with, for each pixel (in order of first
+       appearance), whether it is intra-chromosomal, its row, its column and
+       its count
+    """
     bamfile = AlignmentFile(inbam, 'rb')
     refs = bamfile.references
-    bam_start = start - 2
-    bam_start = max(0, bam_start)
-    section_pos = []
-    for sec in sections1:
-        if sec not in section_pos:
-            section_pos.append(sec[0])
-    for sec in sections2:
-        if sec not in section_pos:
-            section_pos.append(sec[0])
-    try:
-        dico = {}
-        for r in bamfile.fetch(region=region,
-                               start=bam_start, end=end,  # coords starts at 0
-                               multiple_iterators=True):
-            if r.flag & filter_exclude:
-                continue
-            crm1 = r.reference_name
-            pos1 = r.reference_start + 1
-            crm2 = refs[r.mrnm]
-            pos2 = r.mpos + 1
-            try:
-                pos1 = sections1[(crm1, pos1 // resolution)]
-                pos2 = sections2[(crm2, pos2 // resolution)]
-            except KeyError:
-                continue  # not in the subset matrix we want
-            if crm1 == crm2:
-                crm = crm1
-                if pos1 > pos2:
-                    continue
-            else:
-                if pos1 > pos2:
-                    continue
-                crm = ''
-            try:
-                dico[(crm, pos1, pos2)] += 1
-            except KeyError:
-                dico[(crm, pos1, pos2)] = 1
-            # print '%-50s %5s %9s %5s %9s' % (r.query_name,
-            #                                  crm1, r.reference_start + 1,
-            #                                  crm2, r.mpos + 1)
-        out = open(os.path.join(tmpdir, '_tmp_%s' % (rand_hash),
-                                '%s:%d-%d.tsv' % (region, start, end)), 'w')
-        out.write(''.join('%s\t%d\t%d\t%d\n' % (c, a, b, v)
-                          for (c, a, b), v in dico.items()))
-        out.close()
-        if sum_columns:
-            sumcol = {}
-            cisprc = {}
-            for (c, i, j), v in dico.items():
-                # out.write('%d\t%d\t%d\n' % (i, j, v))
-                try:
-                    sumcol[i] += v
-                    cisprc[i][all_bins[i][0] == all_bins[j][0]] += v
-                except KeyError:
-                    sumcol[i]  = v
-                    cisprc[i]  = [0, 0]
-                    cisprc[i][all_bins[i][0] == all_bins[j][0]] += v
-            return sumcol, cisprc
-    except Exception as e:
-        exc_type, exc_obj, exc_tb = exc_info()
-        fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-        print(e)
-        print(exc_type, fname, exc_tb.tb_lineno)
-
-
-def read_bam(inbam, filter_exclude, resolution, ncpus=8,
+    beg1, end1, off1 = sections1.get(region, (0, 0, 0))
+    if masked:
+        mask_reso, masked = masked
+        masked1 = masked.get(region, ())
+    dico = {}
+    for r in bamfile.fetch(region=region,
+                           start=max(0, start - 2), end=end,  # coords starts at 0
+                           multiple_iterators=True):
+        if r.flag & filter_exclude:
+            continue
+        pos1 = r.reference_start + 1
+        # reads overlapping the start of the region belong to previous chunk
+        if pos1 < start:
+            continue
+        pos1 //= resolution
+        if not beg1 <= pos1 < end1:
+            continue  # not in the subset matrix we want
+        crm2 = refs[r.mrnm]
+        try:
+            beg2, end2, off2 = sections2[crm2]
+        except KeyError:
+            continue
+        pos2 = (r.mpos + 1) // resolution
+        if not beg2 <= pos2 < end2:
+            continue
+        if masked and ((r.reference_start + 1) // mask_reso in masked1 or
+                       (r.mpos + 1) // mask_reso in masked.get(crm2, ())):
+            continue
+        pos1 += off1 - beg1
+        pos2 += off2 - beg2
+        if half and pos1 > pos2:
+            continue
+        try:
+            dico[(pos1, pos2, crm2 == region)] += 1
+        except KeyError:
+            dico[(pos1, pos2, crm2 == region)] = 1
+    bamfile.close()
+    pixels = np.array(list(dico), dtype=np.int64).reshape(-1, 3)
+    counts = np.fromiter(dico.values(), dtype=np.int64, count=len(dico))
+    return region, pixels[:, 2].astype(bool), pixels[:, 0], pixels[:, 1], counts
+
+
+def read_bam(inbam, filter_exclude, resolution,
              region1=None, start1=None, end1=None,
              region2=None, start2=None, end2=None, nchunks=100,
-             tmpdir='.', verbose=True, normalize=False, max_size=None,
-             chr_order=None, half=False):
+             verbose=True, max_size=None, chr_order=None, half=False,
+             masked=None):
+    """
+    Define the chunks in which to read a BAM file to get a matrix (see
+    :func:`get_matrix` for parameters, and :func:`_read_bam_frag` for half and
+    masked).
 
+    :returns: the regions of the matrix, the coordinates of the matrix
+       (first and last bins of rows and columns) and the list of chunks to be
+       read with :func:`iter_pixel_blocks`
+    """
     bamfile = AlignmentFile(inbam, 'rb')
     bam_refs = bamfile.references
     bam_lengths = bamfile.lengths
@@ -600,10 +543,13 @@ def read_bam(inbam, filter_exclude, resolution, ncpus=8,
             begs.append(beg1 * resolution)
             ends.append(fin2 * resolution + resolution - 1)
     ends[-1] += 1  # last nucleotide included
-    # reduce dictionaries
-    all_bins = []
-    seenbins = set()
+    # bins of each chromosome in the rows of the matrix (first, last not
+    # included, and index of the first one)
+    sections1 = {}
+    nrows = 0
     for crm in regions:
+        if crm in sections1:
+            continue
         beg_crm = section_pos[crm][0]
         if region1:
             start = start_bin1 - beg_crm
@@ -611,16 +557,12 @@ def read_bam(inbam, filter_exclude, resolution, ncpus=8,
         else:
             start = 0
             end   = section_pos[crm][1] - section_pos[crm][0]
-        all_bins.extend([(crm, i) for i in range(start, end)
-                          if not (crm, i) in seenbins])
-        seenbins = set(all_bins)
-    del(seenbins)
+        sections1[crm] = (start, end, nrows)
+        nrows += max(0, end - start)
 
-    bins_dict1 = dict((j, i) for i, j in enumerate(all_bins))
     if region2:
         if not region2 in section_pos:
             raise Exception('ERROR: chromosome %s not found' % region2)
-        bins = []
         beg_crm = section_pos[region2][0]
         if start2 is not None:
             start_bin2 = section_pos[region2][0] + start2 // resolution
@@ -632,14 +574,11 @@ def read_bam(inbam, filter_exclude, resolution, ncpus=8,
         else:
             end_bin2   = section_pos[region2][1]
             end2       = sections[region2] * resolution
-        start = start_bin2 - beg_crm
-        end   = end_bin2   - beg_crm
-        bins = [(region2, i) for i in range(start, end)]
-        bins_dict2 = dict([(j, i) for i, j in enumerate(bins)])
+        sections2 = {region2: (start_bin2 - beg_crm, end_bin2 - beg_crm, 0)}
     else:
         start_bin2 = start_bin1
         end_bin2 = end_bin1
-        bins_dict2 = bins_dict1
+        sections2 = sections1
 
     size1 = end_bin1 - start_bin1
     size2 = end_bin2 - start_bin2
@@ -649,67 +588,249 @@ def read_bam(inbam, filter_exclude, resolution, ncpus=8,
         raise Exception(('ERROR: matrix too large ({0}x{1}) should be at most '
                          '{2}x{2}').format(size1, size2, int(max_size**0.5)))
 
-    pool = mu.Pool(ncpus)
-    # create random hash associated to the run:
-    rand_hash = "%016x" % getrandbits(64)
-
-    ## RUN!
-    if verbose:
-        printime('\n  - Parsing BAM (%d chunks)' % (len(regs)))
-    mkdir(os.path.join(tmpdir, '_tmp_%s' % (rand_hash)))
-    # empty all_bins array if we are not going to normalize
-    if not normalize:
-        all_bins = []
-    procs = []
-    read_bam_frag = _read_half_bam_frag if half else _read_bam_frag
-    for i, (region, b, e) in enumerate(zip(regs, begs, ends)):
-        if ncpus == 1:
-            read_bam_frag(inbam, filter_exclude, all_bins,
-                          bins_dict1, bins_dict2, rand_hash,
-                          resolution, tmpdir, region, b, e)
-        else:
-            procs.append(pool.apply_async(
-                read_bam_frag, args=(inbam, filter_exclude, all_bins,
-                                     bins_dict1, bins_dict2, rand_hash,
-                                     resolution, tmpdir, region, b, e,)))
-    pool.close()
-    if verbose:
-        print_progress(procs)
-    pool.join()
     bin_coords = start_bin1, end_bin1, start_bin2, end_bin2
-    chunks = regs, begs, ends
-    return regions, rand_hash, bin_coords, chunks
+    chunks = [(inbam, filter_exclude, sections1, sections2, resolution,
+               region, b, e, half, masked)
+              for region, b, e in zip(regs, begs, ends)]
+    return regions, bin_coords, chunks
+
+
+def _read_pixel_block(args):
+    """
+    Read a chunk of the BAM file, and pass the pixels to a function (if any)
+    """
+    func, chunk = args
+    block = _read_bam_frag(*chunk)
+    return func(*block) if func else block
+
 
+def iter_pixel_blocks(chunks, func=None, ncpus=1, verbose=True):
+    """
+    Read chunks of a BAM file in parallel and yield, in the order of the
+    chunks, their pixels. At most two chunks per CPU are read in advance, so
+    memory stays bounded whatever the number of chunks.
+
+    :param chunks: list of chunks as returned by :func:`read_bam`
+    :param None func: function applied to the pixels of each chunk in the
+       process reading it (must be picklable). It is called with the region,
+       and the arrays of the intra-chromosomal flag, row, column and count of
+       each pixel
+    :param 1 ncpus: number of processes reading the BAM file
+    :param True verbose: speak
 
-def _iter_matrix_frags(chunks, tmpdir, rand_hash, clean=False, verbose=True,
-                       include_chunk_count=False):
+    :yields: the result of func for each chunk (or the region and arrays of
+       pixels)
+    """
     if verbose:
+        printime('  - Parsing BAM (%d chunks)' % (len(chunks)))
         stdout.write('     ')
+    jobs = [(func, chunk) for chunk in chunks]
+    pool = mu.Pool(ncpus) if ncpus > 1 and len(jobs) > 1 else None
+    procs = deque()
     countbin = 0
-    for countbin, (region, start, end) in enumerate(zip(*chunks)):
-        if verbose:
-            if not countbin % 10 and countbin:
-                stdout.write(' ')
-            if not countbin % 50 and countbin:
-                stdout.write(' %9s\n     ' % ('%s/%s' % (countbin , len(chunks[0]))))
-            stdout.write('.')
-            stdout.flush()
-
-        fname = os.path.join(tmpdir, '_tmp_%s' % (rand_hash),
-                             '%s:%d-%d.tsv' % (region, start, end))
-        if include_chunk_count:
-            for l in open(fname):
-                c, a, b, v = l.split('\t')
-                yield countbin, c, int(a), int(b), int(v)
-        else:
-            for l in open(fname):
-                c, a, b, v = l.split('\t')
-                yield c, int(a), int(b), int(v)
-        if clean:
-            os.system('rm -f %s' % fname)
+    try:
+        for countbin in range(len(jobs)):
+            if pool:
+                while len(procs) < 2 * ncpus and countbin + len(procs) < len(jobs):
+                    procs.append(pool.apply_async(
+                        _read_pixel_block, args=(jobs[countbin + len(procs)], )))
+                result = procs.popleft().get()
+            else:
+                result = _read_pixel_block(jobs[countbin])
+            if verbose:
+                if not countbin % 10 and countbin:
+                    stdout.write(' ')
+                if not countbin % 50 and countbin:
+                    stdout.write(' %9s\n     ' % ('%s/%s' % (countbin , len(jobs))))
+                stdout.write('.')
+                stdout.flush()
+            yield result
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
     if verbose:
         print('%s %9s\n' % (' ' * (54 - (countbin % 50) - (countbin % 50) // 10),
-                            '%s/%s' % (len(chunks[0]),len(chunks[0]))))
+                            '%s/%s' % (len(jobs),len(jobs))))
+
+
+def _bins_to_array(values, size, default):
+    """
+    :returns: array of the values of the bins found in a dictionary
+    """
+    array = np.full(size, default, dtype=type(default))
+    keys = [k for k in values if 0 <= k < size]
+    array[keys] = [values[k] for k in keys]
+    return array
+
+
+class _PixelTransform(object):
+    """
+    Removes bad bins from the pixels read from a chunk of the BAM file and
+    normalizes them. Sent to the processes reading the BAM file.
+    """
+    def __init__(self, size1, size2, bads1=None, bads2=None, bias1=None,
+                 bias2=None, decay=None, start_bin1=0, start_bin2=0):
+        self.good1 = _bins_to_array(dict.fromkeys(bads1 or {}, False), size1, True)
+        self.good2 = _bins_to_array(dict.fromkeys(bads2 or {}, False), size2, True)
+        self.bias1 = _bins_to_array(bias1 or {}, size1, float('nan'))
+        self.bias2 = _bins_to_array(bias2 or {}, size2, float('nan'))
+        # expected values by distance in each chromosome
+        self.decay = dict((crm, _bins_to_array(dec, max(dec) + 1 if dec else 0,
+                                               float('nan')))
+                          for crm, dec in (decay or {}).items()
+                          if isinstance(dec, dict))
+        self.start_bin1 = start_bin1
+        self.start_bin2 = start_bin2
+
+    def filter(self, crm, cis, rows, cols, counts):
+        """
+        :returns: the pixels not in bad rows or columns
+        """
+        keep = self.good1[rows] & self.good2[cols]
+        return crm, cis[keep], rows[keep], cols[keep], counts[keep]
+
+    def values(self, normalization, crm, cis, rows, cols, counts):
+        """
+        :param normalization: can be 'raw', 'norm' or 'decay' ('nan' for
+           pixels without expected value)
+
+        :returns: the normalized values of the pixels
+        """
+        if normalization == 'raw':
+            return counts
+        values = counts / self.bias1[rows] / self.bias2[cols]
+        if normalization == 'norm':
+            return values
+        if normalization != 'decay':
+            raise NotImplementedError(('ERROR: %s normalization not implemented '
+                                       'here') % normalization)
+        expected = np.full(len(values), np.nan)
+        decay = self.decay.get(crm)
+        if decay is not None:
+            dists = np.abs((rows + self.start_bin1) - (cols + self.start_bin2))
+            valid = cis & (dists < len(decay))
+            expected[valid] = decay[dists[valid]]
+        return values / expected
+
+
+def _matrix_pixels(transform, normalization, *block):
+    """
+    :returns: rows, columns and normalized values of the pixels of a chunk
+    """
+    block = transform.filter(*block)
+    return block[2], block[3], transform.values(normalization, *block)
+
+
+def _cooler_bins(sections, crm_order, regions, resolution):
+    """
+    Bins of a cooler corresponding to the bins of the genomic matrix.
+
+    The genomic matrix has length // resolution + 1 bins per chromosome, while
+    coolers have ceil(length / resolution) bins, one less if the length is a
+    multiple of the resolution. In this case the last bin of the genomic
+    matrix is merged with the previous one.
+
+    :param sections: dictionary with chromosomes and lengths
+    :param crm_order: order of the chromosomes in the genomic matrix
+    :param regions: chromosomes stored in the cooler (order matters)
+    :param resolution: resolution of the matrix
+
+    :returns: an array with the bin of the cooler of each bin of the genomic
+       matrix (-1 for chromosomes not in the cooler)
+    """
+    offsets = {}
+    total = 0
+    for crm in OrderedDict.fromkeys(regions):
+        offsets[crm] = total
+        total += -(-sections[crm] // resolution)
+    bins = [np.zeros(0, dtype=np.int64)]
+    for crm in crm_order:
+        nbins = sections[crm] // resolution + 1
+        if crm in offsets:
+            last = -(-sections[crm] // resolution) - 1
+            bins.append(offsets[crm] + np.minimum(np.arange(nbins), last))
+        else:
+            bins.append(np.full(nbins, -1, dtype=np.int64))
+    return np.concatenate(bins)
+
+
+def _sum_pixels(rows, cols, counts):
+    """
+    :returns: rows, columns and counts of the pixels, sorted, summing the
+       counts of repeated pixels
+    """
+    order = np.lexsort((cols, rows))
+    rows, cols, counts = rows[order], cols[order], counts[order]
+    if not len(counts):
+        return rows, cols, counts
+    firsts = np.flatnonzero(np.concatenate((
+        [True], (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1]))))
+    return rows[firsts], cols[firsts], np.add.reduceat(counts, firsts)
+
+
+def _cooler_pixels(transform, bins1, bins2, *block):
+    """
+    :returns: rows and columns in the cooler, and counts of the pixels of a
+       chunk, sorted
+    """
+    _, _, rows, cols, counts = transform.filter(*block)
+    return _sum_pixels(bins1[rows], bins2[cols], counts)
+
+
+def _complete_rows(blocks):
+    """
+    Pixels of consecutive blocks may fall in the same row of the cooler (see
+    :func:`_cooler_bins`), the last row of each block is thus held until the
+    next block is read.
+
+    :param blocks: iterator over rows, columns and counts of sorted pixels
+
+    :returns: an iterator over rows, columns and counts of sorted pixels, the
+       pixels of each row being all in the same block
+    """
+    tail = None
+    for block in blocks:
+        if not len(block[2]):
+            continue
+        if tail is not None:
+            if block[0][0] == tail[0][-1]:
+                block = _sum_pixels(*[np.concatenate(p)
+                                      for p in zip(tail, block)])
+            else:
+                yield tail
+        last = np.searchsorted(block[0], block[0][-1])
+        yield tuple(p[:last] for p in block)
+        tail = tuple(p[last:] for p in block)
+    if tail is not None:
+        yield tail
+
+
+def _abc_lines(transform, normalizations, names1, names2, *block):
+    """
+    :returns: the lines to write for the pixels of a chunk, for each
+       normalization
+    """
+    block = transform.filter(*block)
+    rows, cols = block[2].tolist(), block[3].tolist()
+    if names1 is None:
+        names = list(map('{}\t{}\t'.format, rows, cols))
+    else:
+        names = [names1[a] + names2[b] for a, b in zip(rows, cols)]
+    lines = []
+    for norm in normalizations:
+        if norm == 'raw&decay':
+            raw = transform.values('raw', *block)
+            dec = transform.values('decay', *block)
+            # pixels without expected value are only normalized by biases
+            missing = np.isnan(dec)
+            dec[missing] = transform.values('norm', *block)[missing]
+            lines.append(''.join(map('{}\t{}\t{}\n'.format, names,
+                                     raw.tolist(), dec.tolist())))
+        else:
+            lines.append(''.join(map('{}\t{}\n'.format, names,
+                                     transform.values(norm, *block).tolist())))
+    return lines
 
 
 def get_biases_region(biases, bin_coords, check_resolution=None):
@@ -718,9 +839,10 @@ def get_biases_region(biases, bin_coords, check_resolution=None):
     according to a region of interest.
     """
     start_bin1, end_bin1, start_bin2, end_bin2 = bin_coords
-    # load decay
+    # load decay (and only biases of the region if stored in binary format)
     if isinstance(biases, basestring):
-        biases = load(open(biases, 'rb'))
+        biases = read_biases(biases, ranges=[(start_bin1, end_bin1),
+                                             (start_bin2, end_bin2)])
     resolution = biases.get('resolution', float('NaN'))
     if check_resolution is not None:
         if check_resolution != resolution:
@@ -748,6 +870,30 @@ def get_biases_region(biases, bin_coords, check_resolution=None):
     return bias1, bias2, decay, bads1, bads2
 
 
+def _masked_bins(biases, sections, chr_order=None):
+    """
+    :param biases: path to a file with biases
+    :param sections: dictionary with chromosomes and lengths
+    :param None chr_order: order of the chromosomes in the genomic matrix
+
+    :returns: the resolution of the biases and, for each chromosome, the set
+       of its bins that are bad columns
+    """
+    biases = read_biases(biases)
+    resolution = biases['resolution']
+    badcol = np.array(sorted(biases.get('badcol', {})), dtype=np.int64)
+    crm_order = ([c for c in chr_order if c in sections] if chr_order
+                 else list(sections))
+    masked = {}
+    total = 0
+    for crm in crm_order:
+        nbins = sections[crm] // resolution + 1
+        beg, end = np.searchsorted(badcol, [total, total + nbins])
+        masked[crm] = set((badcol[beg:end] - total).tolist())
+        total += nbins
+    return resolution, masked
+
+
 def get_matrix(inbam, resolution, biases=None,
                filter_exclude=(1, 2, 3, 4, 6, 7, 8, 9, 10),
                region1=None, start1=None, end1=None,
@@ -782,7 +928,8 @@ def get_matrix(inbam, resolution, biases=None,
        extract the matrix
     :param None end2: end coordinate of the second region from which to
        extract the matrix
-    :param '.' tmpdir: where to write temporary files
+    :param '.' tmpdir: not used, pixels are passed directly from the
+       processes reading the BAM file
     :param 8 ncpus: number of cpus to use to read the BAM file
     :param True verbose: speak
     :param 100 nchunks: maximum number of chunks into which to cut the BAM
@@ -796,11 +943,11 @@ def get_matrix(inbam, resolution, biases=None,
     if not isinstance(filter_exclude, int):
         filter_exclude = filters_to_bin(filter_exclude)
 
-    regions, rand_hash, bin_coords, chunks = read_bam(
-        inbam, filter_exclude, resolution, ncpus=ncpus,
+    regions, bin_coords, chunks = read_bam(
+        inbam, filter_exclude, resolution,
         region1=region1, start1=start1, end1=end1,
         region2=region2, start2=start2, end2=end2,
-        tmpdir=tmpdir, nchunks=nchunks, verbose=verbose,
+        nchunks=nchunks, verbose=verbose,
         max_size=max_size, chr_order=chr_order)
 
     if region1:
@@ -808,56 +955,41 @@ def get_matrix(inbam, resolution, biases=None,
         if region2:
             regions.append(region2)
 
+    start_bin1, end_bin1, start_bin2, end_bin2 = bin_coords
+    size1 = end_bin1 - start_bin1
+    size2 = end_bin2 - start_bin2
+    if normalization not in ('raw', 'norm', 'decay'):
+        raise NotImplementedError(('ERROR: %s normalization not implemented '
+                                   'here') % normalization)
     if biases:
         bias1, bias2, decay, bads1, bads2 = get_biases_region(biases, bin_coords)
     elif normalization != 'raw':
         raise Exception('ERROR: should provide path to file with biases (pickle).')
     else:
+        bias1 = bias2 = decay = None
         bads1 = bads2 = {}
-    start_bin1, start_bin2 = bin_coords[::2]
 
     if verbose:
         printime('  - Getting matrices')
 
-    def transform_value_raw(_, __ , ___, v):
-        return v
-    def transform_value_norm(_, a, b, v):
-        return v / bias1[a] / bias2[b]
-    def transform_value_decay(c, a, b, v):
-        return v / bias1[a] / bias2[b] / decay[c][abs(a-b)]
-    def transform_value_decay_2reg(c, a, b, v):
-        return v / bias1[a] / bias2[b] / decay[c][abs((a + start_bin1) - (b + start_bin2))]
-
-    if normalization == 'raw':
-        transform_value = transform_value_raw
-    elif normalization == 'norm':
-        transform_value = transform_value_norm
-    elif normalization == 'decay':
-        if start_bin1 == start_bin2:
-            transform_value = transform_value_decay
-        else:
-            transform_value = transform_value_decay_2reg
-    else:
-        raise NotImplementedError(('ERROR: %s normalization not implemented '
-                                   'here') % normalization)
-
     return_something = False
     if dico is None:
         return_something = True
-        dico = dict(((i, j), transform_value(c, i, j, v))
-                    for c, i, j, v in _iter_matrix_frags(
-                        chunks, tmpdir, rand_hash, clean=clean, verbose=verbose)
-                    if i not in bads1 and j not in bads2)
-        # pull all sub-matrices and write full matrix
+        dico = {}
+        transform = _PixelTransform(size1, size2, bads1, bads2, bias1, bias2,
+                                    decay, start_bin1, start_bin2)
+        func = partial(_matrix_pixels, transform, normalization)
+        for rows, cols, values in iter_pixel_blocks(chunks, func, ncpus=ncpus,
+                                                    verbose=verbose):
+            dico.update(zip(zip(rows.tolist(), cols.tolist()), values.tolist()))
     else: # dico probably an HiC data object
-        for _, i, j, v in _iter_matrix_frags(
-                chunks, tmpdir, rand_hash,
-                clean=clean, verbose=verbose):
-            if i not in bads1 and j not in bads2:
+        func = partial(_matrix_pixels,
+                       _PixelTransform(size1, size2, bads1, bads2), 'raw')
+        for rows, cols, values in iter_pixel_blocks(chunks, func, ncpus=ncpus,
+                                                    verbose=verbose):
+            for i, j, v in zip(rows.tolist(), cols.tolist(), values.tolist()):
                 dico[i, j] = v
 
-    if clean:
-        os.system('rm -rf %s' % (os.path.join(tmpdir, '_tmp_%s' % (rand_hash))))
     if return_something:
         if return_headers:
             # define output file name
@@ -892,7 +1024,8 @@ def write_matrix(inbam, resolution, biases, outdir,
                  region2=None, start2=None, end2=None, extra='',
                  half_matrix=True, nchunks=100, tmpdir='.', append_to_tar=None,
                  ncpus=8, cooler=False, cooler_name=None, row_names=False,
-                 chr_order=None, verbose=True):
+                 chr_order=None, cooler_resolutions=None, cooler_balance=False,
+                 mask_biases=None, verbose=True):
     """
     Writes matrix file from a BAM file containing interacting reads. The matrix
     will be extracted from the genomic BAM, the genomic coordinates of this
@@ -923,12 +1056,21 @@ def write_matrix(inbam, resolution, biases, outdir,
     :param None end2: end coordinate of the second region from which to
        extract the matrix
     :param True half_matrix: writes only half of the matrix (and the diagonal)
-    :param '.' tmpdir: where to write temporary files
+    :param '.' tmpdir: not used, pixels are passed directly from the
+       processes reading the BAM file
     :param None append_to_tar: path to a TAR file were generated matrices will
        be written directly
     :param 8 ncpus: number of cpus to use to read the BAM file
     :param False cooler: generate cooler file
     :param None cooler_name: append to existing multi-resolution cooler
+    :param None cooler_resolutions: list of coarser resolutions (multiples of
+       resolution) to add to the cooler, computed from the pixels written
+    :param False cooler_balance: compute balancing weights (iterative
+       correction) for each of the coarser resolutions of the cooler
+    :param None mask_biases: path to a file with biases computed at another
+       resolution. Reads falling in its bad columns are not counted (e.g. to
+       add to a cooler a zoom that is not a multiple of the resolution of
+       the biases, without the bad columns removed from the other zooms)
     :param True verbose: speak
     :param False row_names: Writes geneomic coocrdinates instead of bins.
        WARNING: results in two extra columns
@@ -952,23 +1094,29 @@ def write_matrix(inbam, resolution, biases, outdir,
     if not isinstance(filter_exclude, int):
         filter_exclude = filters_to_bin(filter_exclude)
 
-    regions, rand_hash, bin_coords, chunks = read_bam(
-        inbam, filter_exclude, resolution, ncpus=ncpus,
+    bamfile = AlignmentFile(inbam, 'rb')
+    sections = OrderedDict(list(zip(bamfile.references,
+                               [x for x in bamfile.lengths])))
+
+    masked = None
+    if mask_biases:
+        masked = _masked_bins(mask_biases, sections, chr_order)
+
+    regions, bin_coords, chunks = read_bam(
+        inbam, filter_exclude, resolution,
         region1=region1, start1=start1, end1=end1,
         region2=region2, start2=start2, end2=end2,
-        tmpdir=tmpdir, nchunks=nchunks, chr_order=chr_order,
-        verbose=verbose, half=half_matrix)
+        nchunks=nchunks, chr_order=chr_order,
+        verbose=verbose, half=half_matrix, masked=masked)
 
     if region1:
         regions = [region1]
         if region2:
             regions.append(region2)
 
-    bamfile = AlignmentFile(inbam, 'rb')
-    sections = OrderedDict(list(zip(bamfile.references,
-                               [x for x in bamfile.lengths])))
-
     start_bin1, end_bin1, start_bin2, end_bin2 = bin_coords
+    size1 = end_bin1 - start_bin1
+    size2 = end_bin2 - start_bin2
 
     section_pos1 = {}
     section_pos2 = {}
@@ -976,8 +1124,9 @@ def write_matrix(inbam, resolution, biases, outdir,
     total_num = 0
     for c in sections:
         totals[c] = total_num
-        total_num += sections[c] / resolution + 1
+        total_num += sections[c] // resolution + 1
 
+    names1 = names2 = None
     if row_names:
         if len(regions) in [1, 2]:
             offset = start_bin1 - totals[regions[0]]
@@ -989,16 +1138,22 @@ def write_matrix(inbam, resolution, biases, outdir,
                                     for i in range(end_bin2 - start_bin2))
         else:
             section_pos1 = dict((v + i, (c, i))
-                                for c, v in totals.iteritems()
+                                for c, v in totals.items()
                                 for i in range(sections[c] // resolution + 1))
             section_pos2 = section_pos1
+        names1 = ['{}\t{}\t'.format(*section_pos1[i]) for i in range(size1)]
+        names2 = (['{}\t{}\t'.format(*section_pos2[i]) for i in range(size2)]
+                  if section_pos2 else names1)
 
     if biases:
         bias1, bias2, decay, bads1, bads2 = get_biases_region(biases, bin_coords)
     elif normalizations != ('raw', ):
         raise Exception('ERROR: should provide path to file with biases (pickle).')
     else:
+        bias1 = bias2 = decay = None
         bads1 = bads2 = {}
+    transform = _PixelTransform(size1, size2, bads1, bads2, bias1, bias2,
+                                decay, start_bin1, start_bin2)
 
 
     if verbose:
@@ -1093,113 +1248,40 @@ def write_matrix(inbam, resolution, biases, outdir,
             else:
                 out_dec.write('# MASKED %s\n' % (','.join([str(b) for b in bads1])))
 
-    # functions to write lines of pairwise interactions
-    def write_raw(func=None):
-        def writer2(c, a, b, v):
-            func(c, a, b, v)
-            out_raw.write('{}\t{}\n'.format(get_name(a, b), v))
-        def writer(_, a, b, v):
-            out_raw.write('{}\t{}\n'.format(get_name(a, b), v))
-        return writer2 if func else writer
-
-    def write_bias(func=None):
-        def writer2(c, a, b, v):
-            func(c, a, b, v)
-            out_nrm.write('{}\t{}\n'.format(get_name(a, b), v / bias1[a] / bias2[b]))
-        def writer(_, a, b, v):
-            out_nrm.write('{}\t{}\n'.format(get_name(a, b), v / bias1[a] / bias2[b]))
-        return writer2 if func else writer
-
-    def write_expc(func=None):
-        def writer2(c, a, b, v):
-            func(c, a, b, v)
-            out_dec.write('{}\t{}\n'.format(
-                get_name(a, b), v / bias1[a] / bias2[b] / decay[c][abs(a-b)]))
-        def writer(c, a, b, v):
-            out_dec.write('{}\t{}\n'.format(
-                get_name(a, b), v / bias1[a] / bias2[b] / decay[c][abs(a-b)]))
-        return writer2 if func else writer
-
-    def write_expc_2reg(func=None):
-        def writer2(c, a, b, v):
-            func(c, a, b, v)
-            out_dec.write('{}\t{}\n'.format(
-                get_name(a, b), v / bias1[a] / bias2[b] / decay[c][abs((a + start_bin1) - (b + start_bin2))]))
-        def writer(c, a, b, v):
-            out_dec.write('{}\t{}\n'.format(
-                get_name(a, b), v / bias1[a] / bias2[b] / decay[c][abs((a + start_bin1) - (b + start_bin2))]))
-        return writer2 if func else writer
-
-    def write_expc_err(func=None):
-        def writer2(c, a, b, v):
-            func(c, a, b, v)
-            try:
-                out_dec.write('{}\t{}\n'.format(
-                    get_name(a, b), v / bias1[a] / bias2[b] / decay[c][abs(a-b)]))
-            except KeyError:  # different chromosomes
-                out_dec.write('{}\t{}\n'.format(get_name(a, b), 'nan'))
-        def writer(c, a, b, v):
-            try:
-                out_dec.write('{}\t{}\n'.format(
-                    get_name(a, b), v / bias1[a] / bias2[b] / decay[c][abs(a-b)]))
-            except KeyError:  # different chromosomes
-                out_dec.write('{}\t{}\n'.format(get_name(a, b), 'nan'))
-        return writer2 if func else writer
-
-    def write_raw_and_expc(func=None):
-        def writer2(c, a, b, v):
-            func(c, a, b, v)
-            try:
-                out_dec.write('{}\t{}\n'.format(
-                    get_name(a, b), v, v / bias1[a] / bias2[b] / decay[c][abs(a-b)]))
-            except KeyError:  # different chromosomes
-                out_dec.write('{}\t{}\n'.format(
-                    get_name(a, b), v, v / bias1[a] / bias2[b]))
-        def writer(c, a, b, v):
-            try:
-                out_dec.write('{}\t{}\n'.format(
-                    get_name(a, b), v, v / bias1[a] / bias2[b] / decay[c][abs(a-b)]))
-            except KeyError:  # different chromosomes
-                out_dec.write('{}\t{}\n'.format(
-                    get_name(a, b), v, v / bias1[a] / bias2[b]))
-        return writer2 if func else writer
-
-    def get_row_name(a, b):
-        return '{}\t{}\t{}\t{}\t'.format(*(section_pos1[a] + section_pos2[b]))
-
-    def get_bin_name(a, b):
-        return '{}\t{}\t'.format(a, b)
-
-    get_name = get_row_name if row_names else get_bin_name
-
-    write = None
-    if 'raw'   in normalizations:
-        write = write_raw(write)
-    if 'norm'  in normalizations and not cooler:
-        write = write_bias(write)
-    if 'decay' in normalizations and not cooler:
-        if len(regions) in [1, 2]:
-            if region2:
-                write = write_expc_2reg(write)
-            else:
-                write = write_expc(write)
-        else:
-            write = write_expc_err(write)
-    if 'raw&decay' in normalizations and not cooler:
-        write = write_raw_and_expc(write)
-
     if cooler:
-        for ichunk, c, j, k, v in _iter_matrix_frags(chunks, tmpdir, rand_hash,
-                                                     verbose=verbose, clean=clean,
-                                                     include_chunk_count=True):
-            if j not in bads1 and k not in bads2:
-                out_raw.write_iter(ichunk, j, k, v)
+        crm_order = ([c for c in chr_order if c in sections] if chr_order
+                     else list(sections))
+        cool_bins = _cooler_bins(sections, crm_order, regions, resolution)
+        cool_bins1 = cool_bins[start_bin1:end_bin1]
+        cool_bins2 = cool_bins[start_bin2:end_bin2]
+        func = partial(_cooler_pixels, transform, cool_bins1, cool_bins2)
+        for rows, cols, counts in _complete_rows(iter_pixel_blocks(
+                chunks, func, ncpus=ncpus, verbose=verbose)):
+            if len(counts):
+                out_raw.write_pixels(rows, cols, counts)
         out_raw.close()
+        if cooler_resolutions:
+            if verbose:
+                printime('  - Adding coarser resolutions to cooler')
+            coarsen_cooler(out_raw.name, cooler_resolutions, resolution,
+                           ncpus=ncpus, balance=cooler_balance)
     else:
-        for c, j, k, v in _iter_matrix_frags(chunks, tmpdir, rand_hash,
-                                             verbose=verbose, clean=clean):
-            if j not in bads1 and k not in bads2:
-                write(c, j, k, v)
+        # lines of pairwise interactions are formatted by the processes
+        # reading the BAM file, and written as they come
+        outs = OrderedDict()
+        if 'raw' in normalizations:
+            outs['raw'] = out_raw
+        if 'norm' in normalizations:
+            outs['norm'] = out_nrm
+        if 'decay' in normalizations:
+            outs['decay'] = out_dec
+        if 'raw&decay' in normalizations:
+            outs['raw&decay'] = out_dec
+        func = partial(_abc_lines, transform, tuple(outs), names1, names2)
+        for lines in iter_pixel_blocks(chunks, func, ncpus=ncpus,
+                                       verbose=verbose):
+            for out, text in zip(outs.values(), lines):
+                out.write(text)
 
     fnames = {}
     if append_to_tar:
@@ -1225,7 +1307,14 @@ def write_matrix(inbam, resolution, biases, outdir,
                                  for b in range(len(bias1))]
                 bias_data_col = [1./bias2[b] if not isnan(bias2[b]) and bias2[b] > 0 else 0
                                  for b in range(len(bias2))]
-                out_nrm.write_weights(bias_data_row, bias_data_col, *bin_coords)
+                # merged bins of the cooler keep the weight of their first bin
+                weights = np.zeros(out_nrm.nbins)
+                weights[cool_bins2[::-1]] = bias_data_col[::-1]
+                weights[cool_bins1[::-1]] = bias_data_row[::-1]
+                start = out_nrm.sec_offset
+                out_nrm.write_weights(weights, weights, start,
+                                      start + out_nrm.nbins, start,
+                                      start + out_nrm.nbins)
                 outfiles.append((os.path.join(outdir, fnam), fnam))
                 fnames['NRM'] = os.path.join(outdir, fnam)
         else:
@@ -1242,8 +1331,4 @@ def write_matrix(inbam, resolution, biases, outdir,
                 out_dec.close()
                 fnames['RAW&DEC'] = out_dec.name
 
-    # this is the last thing we do in case something goes wrong
-    if clean:
-        os.system('rm -rf %s' % (os.path.join(tmpdir, '_tmp_%s' % (rand_hash))))
-
     return fnames
@@ -8,14 +8,10 @@ from future import standard_library
 from builtins import next
 standard_library.install_aliases()
 from sys                             import stderr, modules
-from io                              import IOBase
+from io                              import IOBase, StringIO
 from collections                     import OrderedDict
 from warnings                        import warn
-from math                            import sqrt, isnan
-try:
-    from pickle5                     import load  # python < 3.8
-except ImportError:
-    from pickle                      import load
+from math                            import sqrt
 
 from pysam                           import AlignmentFile
 
@@ -23,8 +19,10 @@ import numpy as np
 from pytadbit.parsers.gzopen         import gzopen
 from pytadbit                        import HiC_data
 from pytadbit.parsers.hic_bam_parser import get_matrix
+from pytadbit.parsers.biases_parser  import read_biases
 try:
-    from pytadbit.parsers.cooler_parser import parse_cooler, is_cooler
+    from pytadbit.parsers.cooler_parser import is_cooler
+    from pytadbit.parsers.cooler_parser import read_cooler
 except ImportError:
     def is_cooler(*unused):
         stderr.write('WARNING: cannot detect if input is a cooler file. Probably ' +
@@ -56,15 +54,11 @@ def is_asymmetric(matrix):
     """
     Helper functions for the autoreader.
     """
-    maxn = len(matrix)
-    for i in range(maxn):
-        maxi = matrix[i] # slightly more efficient
-        for j in range(i+1, maxn):
-            if maxi[j] != matrix[j][i]:
-                if isnan(maxi[j]) and isnan(matrix[j][i]):
-                    continue
-                return True
-    return False
+    matrix = np.asarray(matrix)
+    diff = matrix != matrix.T
+    if matrix.dtype.kind == 'f':
+        diff &= ~(np.isnan(matrix) & np.isnan(matrix.T))
+    return bool(diff.any())
 
 
 def is_asymmetric_dico(hic):
@@ -100,22 +94,85 @@ def symmetrize(matrix):
     """
     Make a matrix symmetric by summing two halves of the matrix
     """
+    if isinstance(matrix, np.ndarray):
+        matrix += matrix.T
+        return
     maxn = len(matrix)
     for i in range(maxn):
         for j in range(i, maxn):
             matrix[i][j] = matrix[j][i] = matrix[i][j] + matrix[j][i]
 
 
+def _iter_blocks(f, size=2**24):
+    """
+    Iterates over the lines of a file by blocks of about size characters
+    """
+    while True:
+        lines = f.readlines(size)
+        if not lines:
+            break
+        yield lines
+
+
+def _split_rows(lines, trim):
+    """
+    Separates the row names (first trim columns) from the values of each line
+
+    :returns: list of row names (as tuples) and list of values (as strings)
+    """
+    if not trim:
+        return [], lines
+    splitted = [line.split(None, trim) for line in lines]
+    return ([tuple(line[:trim]) for line in splitted],
+            [line[trim] if len(line) > trim else '' for line in splitted])
+
+
+def _parse_values(lines, num):
+    """
+    Parses a block of lines with numeric values using numpy tokenizer.
+
+    If integers are wanted, non integer values are rounded, and NA or NaN
+    values are set to zero (with a warning).
+
+    :returns: a 2D array of values
+    """
+    if num is float:
+        return np.loadtxt(lines, dtype=float, ndmin=2, comments=None)
+    try:
+        return np.loadtxt(lines, dtype=np.int64, ndmin=2, comments=None)
+    except ValueError:
+        pass
+    # Dekker data 2009, uses integer but puts a comma...
+    try:
+        values = np.loadtxt(lines, dtype=float, ndmin=2, comments=None)
+        nans = np.isnan(values)
+    except ValueError:
+        nans = None
+    if nans is not None and not nans.any():
+        warn('WARNING: non integer values')
+        return np.trunc(values + .5).astype(np.int64)
+    # Some data may contain 'NaN' or 'NA'
+    values = np.loadtxt(lines, dtype=float, ndmin=2, comments=None,
+                        converters=lambda a: (0. if a.lower() in ('na', 'nan')
+                                              else float(a)))
+    warn('WARNING: NA or NaN founds, set to zero')
+    return np.trunc(values + .5).astype(np.int64)
+
+
 def optimal_reader(f, normalized=False, resolution=1):
     """
     Reads a matrix generated by TADbit.
     Can be slower than autoreader, but uses almost a third of the memory
 
+    The file is parsed by blocks of lines, only the non-zero values of each
+    block being kept.
+
     :param f: an iterable (typically an open file).
     :param False normalized: if the matrix is normalized
     :param 1 resolution: resolution of the matrix
 
     """
+    f = _seekable(f)
     # get masked bins
     masked = {}
     pos = 0
@@ -127,57 +184,94 @@ def optimal_reader(f, normalized=False, resolution=1):
             masked = dict([(int(n), True) for n in line.split()[2:]])
     f.seek(pos)
 
-    # super fast
-    header = [tuple(line.split(None, 2)[:2]) for line in f]
-
-    f.seek(pos)
+    # Get the numeric values (non-zero only) and remove extra columns
+    dtype = float if normalized else np.int64
+    header = []
+    rows, cols, values = [], [], []
+    for lines in _iter_blocks(f):
+        names, lines = _split_rows(lines, 2)
+        block = np.loadtxt(lines, dtype=dtype, ndmin=2, comments=None)
+        row, col = np.nonzero(block)
+        rows.append(row + len(header))
+        cols.append(col)
+        values.append(block[row, col])
+        header.extend(names)
 
     ncol = len(header)
-
-    # Get the numeric values and remove extra columns
-    num = float if normalized else int
     chromosomes, sections, resolution = _header_to_section(header, resolution)
-
-    #############################################################
-    # monkey patch HiC_data to make it faster
-    def fast_setitem(self, key, val):
-        "Use directly dict setitem"
-        super(HiC_data, self).__setitem__(key, val)
-
-    def fast_getitem(self, key):
-        "Use directly dict setitem"
-        try:
-            return super(HiC_data, self).__getitem__(key)
-        except KeyError:
-            return 0
-
-    original_setitem = HiC_data.__setitem__
-    original_getitem = HiC_data.__getitem__
-    # apply_async the patch
-    HiC_data.__setitem__ = fast_setitem
-    HiC_data.__getitem__ = fast_getitem
-
-    hic = HiC_data(((j, num(v))
-                    for i, line in enumerate(f)
-                    for j, v in enumerate(line.split()[2:], i * ncol)
-                    if num(v)), size=ncol, masked=masked,
-                   dict_sec=sections, chromosomes=chromosomes,
-                   resolution=resolution, symmetricized=False)
+    keys   = np.concatenate(rows) * ncol + np.concatenate(cols)
+    values = np.concatenate(values)
 
     # make it symmetric
-    if is_asymmetric_dico(hic):
-        hic.symmetricized = True
-        symmetrize_dico(hic)
-
-    # undo patching
-    HiC_data.__setitem__ = original_setitem
-    HiC_data.__getitem__ = original_getitem
-    hic.__setitem__ = original_setitem
-    hic.__getitem__ = original_getitem
-    #############################################################
+    tkeys = (keys % ncol) * ncol + keys // ncol
+    symmetricized = _is_asymmetric_sparse(keys, tkeys, values)
+    if symmetricized:
+        keys, values = _symmetrize_sparse(keys, tkeys, values)
+
+    # filled in bulk, the matrix being already symmetric
+    hic = HiC_data((), size=ncol, masked=masked, dict_sec=sections,
+                   chromosomes=chromosomes, resolution=resolution,
+                   symmetricized=symmetricized)
+    dict.update(hic, zip(keys.tolist(), values.tolist()))
     return hic
 
 
+def _is_asymmetric_sparse(keys, tkeys, values):
+    """
+    :param keys: sorted positions (row * size + col) of the non-zero cells
+    :param tkeys: positions of the same cells in the transposed matrix
+    :param values: values of the non-zero cells
+
+    :returns: True if the matrix is not symmetric
+    """
+    order = np.argsort(tkeys, kind='stable')
+    return not (np.array_equal(keys, tkeys[order]) and
+                np.array_equal(values, values[order]))
+
+
+def _symmetrize_sparse(keys, tkeys, values):
+    """
+    Make a sparse matrix symmetric by summing two halves of the matrix (the
+    diagonal is doubled). Cells whose sum is zero keep their values.
+
+    :returns: sorted positions and values of the non-zero cells
+    """
+    allkeys = np.concatenate((keys, tkeys))
+    order = np.argsort(allkeys, kind='stable')
+    allkeys = allkeys[order]
+    firsts = np.flatnonzero(np.concatenate(([True],
+                                            allkeys[1:] != allkeys[:-1])))
+    sums = np.add.reduceat(np.concatenate((values, values))[order], firsts)
+    allkeys = allkeys[firsts]
+    # where the sum is zero, keep original values (if any)
+    zeros = np.flatnonzero(sums == 0)
+    idx = np.minimum(np.searchsorted(keys, allkeys[zeros]), len(keys) - 1)
+    found = keys[idx] == allkeys[zeros]
+    sums[zeros[found]] = values[idx[found]]
+    keep = np.ones(len(sums), dtype=bool)
+    keep[zeros[~found]] = False
+    return allkeys[keep], sums[keep]
+
+
+def _seekable(f):
+    """
+    Readers go through the lines of a file more than once. Files that cannot
+    be rewound (pipes, lists of lines, generators...) are copied in memory.
+
+    :param f: an iterable (typically an open file)
+
+    :returns: f itself if it can be rewound, otherwise an in-memory file with
+       its lines
+    """
+    try:
+        if f.seekable():
+            return f
+    except (AttributeError, ValueError):
+        pass
+    return StringIO(''.join(line if line.endswith('\n') else line + '\n'
+                            for line in f if line))
+
+
 def __read_file_header(f):
     """
     Read file header, inside first commented lines of a file
@@ -225,6 +319,7 @@ def abc_reader(f):
        as list of tuples (chr, pos), dictionary of masked bins, and boolean
        reporter of symetric transformation
     """
+    f = _seekable(f)
     masked, chroms, crm, beg, end, reso = __read_file_header(f)  # TODO rest of it not used here
     sections = {}
     size = 0
@@ -238,15 +333,30 @@ def abc_reader(f):
         header = [(c, '%d-%d' % (l * reso + 1, (l + 1) * reso))
                   for c in chroms
                   for l in range(sections[c], sections[c] + chroms[c] // reso + 1)]
-    num = int if HIC_DATA else float
     offset = (beg or 0) * (1 + size)
-    def _disect(x):
-        a, b, v = x.split()
-        return (int(a) + int(b) * size + offset, num(v))
-    items = tuple(_disect(line) for line in f)
+    bin1, bin2, values = read_abc(f, int if HIC_DATA else float)
+    items = zip((bin1 + bin2 * size + offset).tolist(), values.tolist())
     return items, size, header, masked, False
 
 
+def read_abc(f, num=int):
+    """
+    Read the lines of a matrix stored in 3 column format (bin1, bin2, value)
+    by blocks, as a sparse matrix in coordinate format
+
+    :param f: an iterable (typically an open file), placed after the header
+    :param int num: type of the values
+
+    :returns: three arrays, with the rows, the columns and the values
+    """
+    dtype = [('bin1', np.int64), ('bin2', np.int64),
+             ('value', np.int64 if num is int else float)]
+    blocks = [np.loadtxt(lines, dtype=dtype, ndmin=1, comments=None)
+              for lines in _iter_blocks(f)]
+    coo = np.concatenate(blocks) if blocks else np.zeros(0, dtype=dtype)
+    return coo['bin1'], coo['bin2'], coo['value']
+
+
 def __is_abc(f):
     """
     Only works for matrices with more than 3 bins
@@ -270,37 +380,35 @@ def autoreader(f):
     """
     Auto-detect matrix format of HiC data file.
 
+    The file is read twice, first to detect its format, then to parse the
+    values by blocks of lines into a numpy array. Inputs that cannot be
+    rewound (e.g. pipes or lists of lines) are first copied in memory.
+
     :param f: an iterable (typically an open file).
 
     :returns: An iterator to be converted in dictionary, matrix size, raw_names
        as list of tuples (chr, pos), dictionary of masked bins, and boolean
        reporter of symetric transformation
     """
+    f = _seekable(f)
     masked = __read_file_header(f)[0]  # TODO rest of it not used here
 
-    # Skip initial comment lines and read in the whole file
-    # as a list of lists.
-    line = next(f)
-    items = [line.split()] + [line.split() for line in f]
-
-    # Count the number of elements per line after the first.
-    # Wrapping in a set is a trick to make sure that every line
-    # has the same number of elements.
-    S = set([len(line) for line in items[1:]])
-    ncol = S.pop()
-    # If the set 'S' is not empty, at least two lines have a
-    # different number of items.
-    if S:
-        raise AutoReadFail('ERROR: unequal column number')
-
-    # free little memory
-    del(S)
-
-    nrow = len(items)
+    # First pass, only to count lines and to look at the first two ones
+    fpos = f.tell()
+    first = next(f).split()
+    second = None
+    nrow = 1
+    for line in f:
+        if second is None:
+            second = line.split()
+        nrow += 1
+    f.seek(fpos)
+    ncol = len(first if second is None else second)
+
     # Auto-detect the format, there are only 4 cases.
     if ncol == nrow:
         try:
-            _ = [float(item) for item in items[0]
+            _ = [float(item) for item in first
                  if not item.lower() in ['na', 'nan']]
             # Case 1: pure number matrix.
             header = False
@@ -311,7 +419,7 @@ def autoreader(f):
             trim = 1
             warn('WARNING: found header')
     else:
-        if len(items[0]) == len(items[1]):
+        if second is None or len(first) == len(second):
             # Case 3: matrix with row information.
             header = False
             trim = ncol - nrow
@@ -321,43 +429,40 @@ def autoreader(f):
             header = True
             trim = ncol - nrow + 1
             warn('WARNING: found header and %d colum(s) of row names' % trim)
+    if trim < 0:
+        raise AutoReadFail('ERROR: non square matrix')
     # Remove header line if needed.
-    if header and not trim:
-        header = items.pop(0)
+    if header:
+        next(f)
         nrow -= 1
+        if not trim:
+            header = first
     elif not trim:
         header = list(range(1, nrow + 1))
-    elif not header:
-        header = [tuple([a for a in line[:trim]]) for line in items]
-    else:
-        del(items[0])
-        nrow -= 1
-        header = [tuple([a for a in line[:trim]]) for line in items]
-    # Get the numeric values and remove extra columns
+
+    # Second pass, parse the lines by blocks, with numpy tokenizer
     num = int if HIC_DATA else float
-    try:
-        items = [[num(a) for a in line[trim:]] for line in items]
-    except ValueError:
-        if not HIC_DATA:
-            raise AutoReadFail('ERROR: non numeric values')
+    names = []
+    items = []
+    for lines in _iter_blocks(f):
+        block_names, lines = _split_rows(lines, trim)
+        names.extend(block_names)
         try:
-            # Dekker data 2009, uses integer but puts a comma...
-            items = [[int(float(a)+.5) for a in line[trim:]] for line in items]
-            warn('WARNING: non integer values')
+            block = _parse_values(lines, num)
         except ValueError:
-            try:
-                # Some data may contain 'NaN' or 'NA'
-                items = [
-                    [0 if a.lower() in ['na', 'nan']
-                     else int(float(a)+.5) for a in line[trim:]]
-                for line in items]
-                warn('WARNING: NA or NaN founds, set to zero')
-            except ValueError:
-                raise AutoReadFail('ERROR: non numeric values')
+            if len(set(len(line.split()) for line in lines)) > 1:
+                raise AutoReadFail('ERROR: unequal column number')
+            raise AutoReadFail('ERROR: non numeric values')
+        if block.shape[1] != ncol - trim:
+            raise AutoReadFail('ERROR: unequal column number')
+        items.append(block)
+    if trim:
+        header = names
+    items = np.concatenate(items) if items else np.zeros((0, 0))
 
     # Check that the matrix is square.
     ncol -= trim
-    if ncol != nrow:
+    if items.shape != (nrow, ncol):
         raise AutoReadFail('ERROR: non square matrix')
 
     symmetricized = False
@@ -365,8 +470,8 @@ def autoreader(f):
         warn('WARNING: matrix not symmetric: summing cell_ij with cell_ji')
         symmetrize(items)
         symmetricized = True
-    return (((i + j * ncol, a) for i, line in enumerate(items)
-             for j, a in enumerate(line) if a),
+    rows, cols = np.nonzero(items)
+    return (zip((rows + cols * ncol).tolist(), items[rows, cols].tolist()),
             ncol, header, masked, symmetricized)
 
 
@@ -401,7 +506,33 @@ def _header_to_section(header, resolution):
     return chromosomes, sections, resolution
 
 
-def read_matrix(things, parser=None, hic=True, resolution=1, **kwargs):
+def _cooler_to_hic_data(fname, resolution=None, normalized=False, region=None):
+    """
+    Loads the pixels of a cooler file (see
+    :func:`pytadbit.parsers.cooler_parser.read_cooler`) into a HiC_data object
+
+    :returns: HiC_data object
+    """
+    (rows, cols, values, chromosomes, starts, _,
+     resolution) = read_cooler(fname, resolution, normalized=normalized,
+                               region=region)
+    size = len(starts)
+    if normalized:
+        values = values.astype(float)
+    # cooler only stores the upper half of the matrix
+    offdiag = rows != cols
+    keys   = np.concatenate((rows * size + cols, (cols * size + rows)[offdiag]))
+    values = np.concatenate((values, values[offdiag]))
+    crms = [crm for crm, nbins in chromosomes.items() for _ in range(nbins)]
+    sections = dict(zip(zip(crms, (starts // resolution).tolist()),
+                        range(size)))
+    return HiC_data(zip(keys.tolist(), values.tolist()), size,
+                    dict_sec=sections, chromosomes=chromosomes,
+                    resolution=resolution)
+
+
+def read_matrix(things, parser=None, hic=True, resolution=1, region=None,
+                **kwargs):
     """
     Read and checks a matrix from a file (using
     :func:`pytadbit.parser.hic_parser.autoreader`) or a list.
@@ -426,6 +557,9 @@ def read_matrix(things, parser=None, hic=True, resolution=1, **kwargs):
     :param 1 resolution: resolution of the matrix
     :param True hic: if False, TADbit assumes that files contains normalized
        data
+    :param None region: for cooler files, chromosome name, region
+       ('chr1:1000000-2000000') or list of them to be loaded (see
+       :func:`pytadbit.parsers.cooler_parser.read_cooler`)
     :returns: the corresponding matrix concatenated into a huge list, also
        returns number or rows
 
@@ -440,8 +574,9 @@ def read_matrix(things, parser=None, hic=True, resolution=1, **kwargs):
         if isinstance(thing, HiC_data):
             matrices.append(thing)
         elif isinstance(thing, file_types):
-            parser = parser or (abc_reader if __is_abc(thing) else autoreader)
-            matrix, size, header, masked, sym = parser(thing)
+            f_thing = _seekable(thing)
+            parser = parser or (abc_reader if __is_abc(f_thing) else autoreader)
+            matrix, size, header, masked, sym = parser(f_thing)
             thing.close()
             chromosomes, sections, resolution = _header_to_section(header,
                                                                    resolution)
@@ -449,22 +584,23 @@ def read_matrix(things, parser=None, hic=True, resolution=1, **kwargs):
                                      chromosomes=chromosomes,
                                      resolution=resolution,
                                      symmetricized=sym, masked=masked))
+        elif (isinstance(thing, basestring) and
+              is_cooler(thing, resolution if resolution > 1 else None)):
+            matrices.append(_cooler_to_hic_data(
+                thing, resolution if resolution > 1 else None, not hic,
+                region))
         elif isinstance(thing, basestring):
-            if is_cooler(thing, resolution if resolution > 1 else None):
-                matrix, size, header, masked, sym = parse_cooler(thing,
-                                                                 resolution if resolution > 1 else None,
-                                                                 not hic)
-            else:
-                try:
-                    with gzopen(thing) as f_thing:
-                        parser = parser or (abc_reader if __is_abc(f_thing) else autoreader)
-                        matrix, size, header, masked, sym = parser(f_thing)
-                except IOError:
-                    if len(thing.split('\n')) > 1:
-                        parser = parser or (abc_reader if __is_abc(thing.split('\n')) else autoreader)
-                        matrix, size, header, masked, sym = parser(thing.split('\n'))
-                    else:
-                        raise IOError('\n   ERROR: file %s not found\n' % thing)
+            try:
+                with gzopen(thing) as f_thing:
+                    parser = parser or (abc_reader if __is_abc(f_thing) else autoreader)
+                    matrix, size, header, masked, sym = parser(f_thing)
+            except IOError:
+                if len(thing.split('\n')) > 1:
+                    f_thing = _seekable(thing.split('\n'))
+                    parser = parser or (abc_reader if __is_abc(f_thing) else autoreader)
+                    matrix, size, header, masked, sym = parser(f_thing)
+                else:
+                    raise IOError('\n   ERROR: file %s not found\n' % thing)
             sections = dict([(h, i) for i, h in enumerate(header)])
             chromosomes, sections, resolution = _header_to_section(header,
                                                                    resolution)
@@ -489,14 +625,13 @@ def read_matrix(things, parser=None, hic=True, resolution=1, **kwargs):
             size = int(siz)
             matrices.append(HiC_data(matrix, size))
         elif isinstance(thing, (np.ndarray, np.generic) ):
-            try:
-                row, col = thing.shape
-                if row != col:
-                    raise Exception('matrix needs to be square.')
-                matrix  = thing.reshape(-1).tolist()[0]
-                size = row
-            except Exception as exc:
-                print('Error found:', exc)
+            if np.ndim(thing) != 2 or thing.shape[0] != thing.shape[1]:
+                raise Exception('matrix needs to be square.')
+            size = thing.shape[0]
+            # same orientation as lists of lists
+            rows, cols = np.nonzero(thing)
+            matrix = zip((rows + cols * size).tolist(),
+                         thing[rows, cols].tolist())
             matrices.append(HiC_data(matrix, size))
         else:
             raise Exception('Unable to read this file or whatever it is :)')
@@ -596,7 +731,7 @@ def load_hic_data_from_bam(fnam, resolution, biases=None, tmpdir='.', ncpus=8,
 
     if biases:
         if isinstance(biases, basestring):
-            biases = load(open(biases,'rb'))
+            biases = read_biases(biases)
         if biases['resolution'] != resolution:
             raise Exception('ERROR: resolution of biases do not match to the '
                             'one wanted (%d vs %d)' % (
@@ -10,16 +10,17 @@ Bioinformatics (Oxford, England), 26(18), 2250-8. doi:10.1093/bioinformatics/btq
 """
 from __future__ import print_function
 
-from numpy        import array, sqrt
+from numpy        import array, sqrt, asarray, empty, arange, maximum
+from numpy        import triu_indices
 from numpy        import min as npmin
 from numpy        import max as npmax
 from numpy        import sum as npsum
 from numpy        import mean
 from numpy.linalg import eigh # eigh is for symmetric matrices
 from scipy.stats  import spearmanr
-from itertools    import product
-from itertools    import combinations_with_replacement as combinations
+from itertools    import combinations
 from copy         import deepcopy
+import multiprocessing as mu
 
 # for aleigen:
 from numpy import median
@@ -28,10 +29,6 @@ import re
 from subprocess import Popen, PIPE
 
 
-def _sort_match(matches):
-    return sorted([(a, b) for a, b in enumerate(matches)],
-                  key=lambda x: x[1], reverse=True)
-
 def core_nw_long(p_scores, penalty, l_p1, l_p2):
     """
     Core of the long Needleman-Wunsch algorithm that aligns matrices
@@ -43,24 +40,31 @@ def core_nw_long(p_scores, penalty, l_p1, l_p2):
     pens = [penalty - penalty / (2 * lpen) * i for i in range(lpen + 1)] # BEST
     # pens = [penalty, penalty, penalty, penalty/1.2, 0]
     # pens = [penalty, penalty*1.5, penalty*2, penalty, penalty]
+    # the gap state (ins, rmv) is carried along the whole scan of the matrix,
+    # which is thus done cell by cell
     for i in range(1, l_p1 + 1):
+        p_scores_i = p_scores[i - 1]
+        scores_i1  = scores[i - 1]
+        scores_i   = scores[i]
         for j in range(1, l_p2 + 1):
-            mmax = max((ins, rmv))
-            match  = p_scores[i - 1][j - 1] + scores[i - 1][j - 1]
-            insert = scores[i - 1][j] + pens[mmax]
-            delete = scores[i][j - 1] + pens[mmax]
-            tmp = _sort_match((match, insert, delete))
-            if tmp[0][0] == 1:
+            pen = pens[ins if ins > rmv else rmv]
+            match  = p_scores_i[j - 1] + scores_i1[j - 1]
+            insert = scores_i1[j] + pen
+            delete = scores_i[j - 1] + pen
+            # first maximum, in the order match, insert, delete
+            if match >= insert and match >= delete:
+                ins = rmv = 0
+                scores_i[j] = match
+            elif insert >= delete:
                 if ins < lpen:
                     ins += 1
                 rmv = 0
-            elif tmp[0][0] == 2:
+                scores_i[j] = insert
+            else:
                 if rmv < lpen:
                     rmv += 1
                 ins = 0
-            else:
-                ins = rmv = 0
-            scores[i][j] = tmp[0][1]
+                scores_i[j] = delete
     align1 = []
     align2 = []
     i = l_p1 
@@ -140,13 +144,20 @@ def core_nw(p_scores, penalty, l_p1, l_p2):
     """
     Core of the fast Needleman-Wunsch algorithm that aligns matrices
     """
-    scores = virgin_score(penalty, l_p1 + 1, l_p2 + 1)
+    p_scores = asarray(p_scores, dtype=float)
+    scores = empty((l_p1 + 1, l_p2 + 1))
+    scores[0] = penalty * arange(l_p2 + 1)
+    scores[:, 0] = penalty * arange(l_p1 + 1)
+    # rows are computed at once, deletions along the row being propagated
+    # with a cumulative maximum: score[j] = max(best[j], score[j-1] + penalty)
+    pens = penalty * arange(l_p2)
     for i in range(1, l_p1 + 1):
-        for j in range(1, l_p2 + 1):
-            match  = p_scores[i - 1][j - 1] + scores[i - 1][j - 1]
-            insert = scores[i - 1][j] + penalty
-            delete = scores[i][j - 1] + penalty
-            scores[i][j] = max((match, insert, delete))
+        best = maximum(p_scores[i - 1] + scores[i - 1, :-1],
+                       scores[i - 1, 1:] + penalty)
+        best[0] = max(best[0], scores[i, 0] + penalty)
+        scores[i, 1:] = maximum.accumulate(best - pens) + pens
+    scores = scores.tolist()
+    p_scores = p_scores.tolist()
     align1 = []
     align2 = []
     i = l_p1 
@@ -182,7 +193,8 @@ def _equal(a, b, cut_off=1e-9):
 
 
 def optimal_cmo(hic1, hic2, num_v=None, max_num_v=None, verbose=False,
-                method='frobenius', long_nw=True, long_dist=True):
+                method='frobenius', long_nw=True, long_dist=True, beam=None,
+                exhaustive=False):
     """
     Calculates the optimal contact map overlap between 2 matrices
 
@@ -202,6 +214,13 @@ def optimal_cmo(hic1, hic2, num_v=None, max_num_v=None, verbose=False,
        distance will be the result of the last value of the Needleman-Wunsch
        algorithm. If 'frobenius' a modification of the Frobenius distance will
        be used
+    :param None beam: number of best combinations of eigenvector signs kept
+       when adding a new eigenvector. If None, 8 with the 'score' method, and
+       all the 2^num_v combinations are tried with the 'frobenius' method (as
+       the Frobenius distance does not improve monotonically with the number
+       of eigenvectors, pruning may miss the best alignment).
+    :param False exhaustive: try all the 2^num_v combinations of eigenvector
+       signs (beam is then ignored).
 
     :returns: two lists, one per aligned matrix, plus a dict summarizing the
         goodness of the alignment with the distance between matrices, their 
@@ -238,10 +257,22 @@ def optimal_cmo(hic1, hic2, num_v=None, max_num_v=None, verbose=False,
     nearest = float('inf')
     nw = core_nw_long if long_nw else core_nw
     dister = _get_dist_long if long_dist else _get_dist
+    if beam is None and method == 'score':
+        beam = 8
+    exhaustive = exhaustive or not beam
     best_alis = []
+    level = [((), None)]
     for num in range(1, num_v + 1):
-        for factors in product([1, -1], repeat=num):
-            vec1p = factors * vec1[:, :num]
+        # signs of the new eigenvector are tried on top of the best
+        # combinations of signs found with one eigenvector less
+        if not exhaustive:
+            level = sorted(level, key=lambda x: x[1])[:beam]
+        candidates = sorted([factors + (sign,) for factors, _ in level
+                             for sign in (1, -1)],
+                            key=lambda x: [-f for f in x])
+        level = []
+        for factors in candidates:
+            vec1p = array(factors) * vec1[:, :num]
             vec2p = vec2[:, :num]
             p_scores = _prescoring(vec1p, vec2p, l_p1, l_p2)
             penalty = min([npmin(p_scores)] + [-npmax(p_scores)])
@@ -260,6 +291,8 @@ def optimal_cmo(hic1, hic2, num_v=None, max_num_v=None, verbose=False,
                     best_pen = penalty
             except IndexError as e:
                 print(e)
+                dist = float('inf')
+            level.append((factors, dist))
     try:
         align1, align2 = best_alis
     except ValueError:
@@ -277,6 +310,35 @@ def optimal_cmo(hic1, hic2, num_v=None, max_num_v=None, verbose=False,
     return align1, align2, {'dist': nearest, 'rho': rho, 'pval': pval}
     
 
+def pairwise_cmo(tads, n_cpus=1, **kwargs):
+    """
+    Calculates the optimal contact map overlap between all pairs of matrices
+    of a list (see :func:`optimal_cmo`).
+
+    :param tads: list of matrices to align
+    :param 1 n_cpus: number of CPUs used to align the pairs of matrices
+    :param kwargs: parameters passed to :func:`optimal_cmo` (e.g. max_num_v)
+
+    :returns: a dictionary with, for each pair of indexes (i, j) with i < j,
+       the result of :func:`optimal_cmo`
+    """
+    pairs = list(combinations(range(len(tads)), 2))
+    jobs = ((tads[i], tads[j], kwargs) for i, j in pairs)
+    if n_cpus > 1:
+        pool = mu.Pool(n_cpus)
+        cmos = dict(zip(pairs, pool.imap(_pair_cmo, jobs)))
+        pool.close()
+        pool.join()
+    else:
+        cmos = dict(zip(pairs, map(_pair_cmo, jobs)))
+    return cmos
+
+
+def _pair_cmo(args):
+    tad1, tad2, kwargs = args
+    return optimal_cmo(tad1, tad2, **kwargs)
+
+
 def virgin_score(penalty, l_p1, l_p2):
     """
     Fill a matrix with zeros, except first row and first column filled with \
@@ -289,14 +351,10 @@ def virgin_score(penalty, l_p1, l_p2):
 
 def _prescoring(vc1, vc2, l_p1, l_p2):
     """
-    yes... this is the bottle neck, almost 2/3 of the time spent here
+    score of matching each position of the first matrix with each position
+    of the second: dot product of their (scaled) eigenvectors
     """
-    p_score = []
-    for i in range(l_p1):
-        vci = vc1[i].__mul__
-        p_score.append([vci(vc2[j]).sum() for j in range(l_p2)])
-    return p_score
-    #return [[sum(vc1[i] * vc2[j]) for j in xrange(l_p2)] for i in xrange(l_p1)]
+    return vc1.dot(vc2.T).tolist()
 
 
 def _get_dist(align1, align2, tad1, tad2):
@@ -309,10 +367,7 @@ def _get_dist(align1, align2, tad1, tad2):
         if i != '-' and j != '-':
             map1.append(i)
             map2.append(j)
-    pp1 = [tad1[i][j] for i, j in combinations(map1, 2)]
-    pp2 = [tad2[i][j] for i, j in combinations(map2, 2)]
-    return float(sum([(pp-pp2[p])**2 for p, pp in enumerate(pp1)]))\
-           / (len(pp1)+1)
+    return _sum_sq_diff(map1, map2, tad1, tad2)
 
 
 def _get_dist_long(align1, align2, tad1, tad2):
@@ -337,10 +392,21 @@ def _get_dist_long(align1, align2, tad1, tad2):
             xpen += pen / extd
             extd += 1
             exti = 1
-    pp1 = [tad1[i][j] for i, j in combinations(map1, 2)]
-    pp2 = [tad2[i][j] for i, j in combinations(map2, 2)]
-    return float(sum([(pp-pp2[p])**2 for p, pp in enumerate(pp1)]))\
-           / (len(pp1)+1) + xpen
+    return _sum_sq_diff(map1, map2, tad1, tad2) + xpen
+
+
+def _sum_sq_diff(map1, map2, tad1, tad2):
+    """
+    Sum of squared differences between the cells of the aligned positions
+    (upper half of the matrices, with the diagonal), divided by the number of
+    cells plus one
+    """
+    map1 = array(map1, dtype=int)
+    map2 = array(map2, dtype=int)
+    rows, cols = triu_indices(len(map1))
+    diff = (asarray(tad1, dtype=float)[map1[rows], map1[cols]] -
+            asarray(tad2, dtype=float)[map2[rows], map2[cols]])
+    return float((diff**2).sum()) / (len(rows) + 1)
 
 
 def _get_score(align1, align2, tad1, tad2):
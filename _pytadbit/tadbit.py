@@ -9,6 +9,7 @@ from pytadbit.tadbit_py           import _tadbit_wrapper
 from math                         import isnan, sqrt
 from scipy.sparse.csr             import csr_matrix
 from scipy.stats                  import mannwhitneyu
+from scipy.special                import ndtr
 import numpy as np
 
 
@@ -197,9 +198,7 @@ def TopDom(hic_data,window_size,statFilter=True):
 
     #Step 1
     csr_mat = hic_data.get_hic_data_as_csr()
-    for i in range(n_bins):
-        diamond_mean = Get_Diamond_Matrix_Mean(data=csr_mat, i=i, size=window_size)
-        mean_cf[i] = diamond_mean
+    mean_cf[:] = Get_Diamond_Matrix_Mean(data=csr_mat, size=window_size)
 
     #Step 2
     gap_idx = Which_Gap_Region(data=csr_mat)
@@ -216,31 +215,18 @@ def TopDom(hic_data,window_size,statFilter=True):
 
     if statFilter:
         #Step 3
-        lil_mat = csr_mat.todense()
-        for k in range(1,(2*window_size)):
-
-            mat_row = []
-            mat_column = []
-            my_range = list(range((n_bins*k), (n_bins*n_bins), 1+n_bins))
-            mat_values = np.empty(len(my_range))
-            col_arr = 0
-            for j in my_range:
-                mat_row.append(int(round(j//lil_mat.shape[0])))
-                mat_column.append(j%lil_mat.shape[0])
-                mat_values[col_arr] = lil_mat[int(round(j//lil_mat.shape[0])),j%lil_mat.shape[0]]
-                col_arr = col_arr + 1
-            
-            scale_values = scale(mat_values)
-            
-            for i in range(len(mat_row)):
-                lil_mat[mat_column[i],mat_row[i]] = scale_values[i]
-
+        mat = csr_mat.toarray()
+        # scale each of the first diagonals of the lower triangle, and copy
+        # it to the upper triangle
+        for k in range(1, min(2 * window_size, n_bins)):
+            idx = np.arange(n_bins - k)
+            mat[idx, idx + k] = scale(mat[idx + k, idx])
 
         for key in proc_regions:
             start = proc_regions[key]['start']
             end = proc_regions[key]['end']
 
-            pvalue[start:end] = Get_Pvalue(data=lil_mat[start:end+1, start:end+1], size=window_size, scale=1)
+            pvalue[start:end] = Get_Pvalue(data=mat[start:end+1, start:end+1], size=window_size, scale=1)
 
         for i in range(len(local_ext)):
             if local_ext[i] == -1 and pvalue[i] < 0.05:
@@ -262,38 +248,68 @@ def TopDom(hic_data,window_size,statFilter=True):
 
     return domains
 
-def Get_Diamond_Matrix_Mean(data, i, size):
+def Get_Diamond_Matrix_Mean(data, size):
+    """
+    Mean of the interactions in the diamond (between the size bins upstream,
+    and the size bins downstream) of each bin, computed from the non-zero
+    cells of the sparse matrix.
+
+    :param data: sparse matrix
+    :param size: window size
 
+    :returns: an array with the mean of each bin (NaN for the last one)
+    """
     n_bins = data.shape[1]
-    if i==n_bins-1:
-        return
-    
-    lowerbound = max( 0, i-size+1 )
-    upperbound = min( i+size+1, n_bins)
-    
-    return (data[lowerbound:(i+1),(i+1):upperbound].mean())
+    coo = csr_matrix(data).tocoo()
+    # only the cells above the diagonal, close enough to it, fall in a diamond
+    keep = (coo.row < coo.col) & (coo.col - coo.row < 2 * size)
+    rows, cols, vals = coo.row[keep], coo.col[keep], coo.data[keep]
+    # cell (row, col) is in the diamond of the bins from first to last
+    first = np.maximum(rows, cols - size)
+    last = np.minimum(cols - 1, rows + size - 1)
+    sums = np.cumsum(np.bincount(first, weights=vals, minlength=n_bins) -
+                     np.bincount(last + 1, weights=vals, minlength=n_bins))
+
+    i = np.arange(n_bins - 1)
+    lowerbound = np.maximum(0, i - size + 1)
+    upperbound = np.minimum(i + size + 1, n_bins)
+
+    means = np.full(n_bins, np.nan)
+    means[:-1] = sums[:-1] / ((i + 1 - lowerbound) * (upperbound - i - 1))
+    return means
 
 def Which_Gap_Region(data):
 
     n_bins = data.shape[1]
-    
+    coo = csr_matrix(data).tocoo()
+    nonzero = coo.data != 0
+    rows, cols = coo.row[nonzero], coo.col[nonzero]
+    # the square from i to j is empty if, for all the bins from i to j, the
+    # closest non-zero cell in their row or column (before the diagonal) is
+    # before i
+    closest = np.full(n_bins, -1)
+    np.maximum.at(closest, np.maximum(rows, cols), np.minimum(rows, cols))
+    closest = closest.tolist()
+
     gap = np.zeros(n_bins)
-    
+
     i=0
     while i < n_bins:
-    
+
         j = i + 1
+        last = closest[i]
         while j < n_bins:
-            if data[i:j+1, i:j+1].sum() == 0:
+            last = max(last, closest[j])
+            if last < i:
                 gap[i:j+1] = -0.5
                 j = j+1
             else:
                 break
-        
+
         i = j
-    
+
     idx = np.where(gap==-0.5)[0]
-    
+
     #return dict(zip(idx,idx))
     return idx
 
@@ -395,9 +411,9 @@ def Change_Point(x, y):
 
     n_bins = len(x)
     Fv = np.empty(n_bins)
-    Fv[:] = np.NAN
+    Fv[:] = np.nan
     Ev = np.empty(n_bins)
-    Ev[:] = np.NAN
+    Ev[:] = np.nan
     cp = []
     cp.append(0)
     #print x
@@ -476,62 +492,129 @@ def scale(y):
 
     return x
 
-def Get_Pvalue(data, size, scale):
+def Get_Pvalue(data, size, scale, chunk=4096):
+    """
+    One-sided Wilcoxon rank-sum test (Mann-Whitney U, with continuity
+    correction) of the interactions in the diamond of each bin being lower
+    than the interactions in the upstream and downstream triangles. Bins are
+    tested in batches of chunk bins.
 
+    :returns: an array with the p-value of each bin but the first
+    """
+    data = np.asarray(data)
     n_bins = data.shape[0]
     pvalue = np.ones(n_bins-1)
 
-    for i in range(1,n_bins):
-        dia = Get_Diamond_Matrix2(data, i, size=size)
-        ups = Get_Upstream_Triangle(data, i, size=size)
-        downs = Get_Downstream_Triangle(data, i, size=size)
-
-        wil_test =  mannwhitneyu(x=dia*scale, y=ups+downs, use_continuity=True, alternative='less')
-        pvalue[i-1] = wil_test.pvalue
+    for beg in range(1, n_bins, chunk):
+        bins = np.arange(beg, min(beg + chunk, n_bins))
+        dia, dia_ok = Get_Diamond_Matrix2(data, bins, size=size)
+        ups, ups_ok = Get_Upstream_Triangle(data, bins, size=size)
+        downs, downs_ok = Get_Downstream_Triangle(data, bins, size=size)
 
+        pvalue[bins - 1] = _mannwhitneyu_less(
+            dia * scale, dia_ok & ~np.isnan(dia),
+            np.concatenate((ups, downs), axis=1),
+            np.concatenate((ups_ok & (ups != 0), downs_ok & (downs != 0)),
+                           axis=1))
 
     pvalue[ np.isnan(pvalue) ] = 1
 
     return(pvalue)
 
-def Get_Diamond_Matrix2(data, i, size):
-
+def _window_values(data, rows, cols):
+    """
+    :returns: values of data at rows and cols, and a mask of the cells
+       inside the matrix
+    """
     n_bins = data.shape[0]
-    #new_mat = np.ones_like(data)*np.NaN
-    new_mat = np.ones(shape=(size,size))*np.NaN
-
-    for k in range(1,size+1):
-        if i-(k-1) >= 1 and i < n_bins:
-            lower = min(i+1, n_bins)
-            upper = min(i+size, n_bins)
-            new_mat[size-(k-1)-1,0:(upper-lower+1)] = data[i-(k-1)-1,lower-1:upper]
-
-    new_mat = new_mat[np.logical_not(np.isnan(new_mat))]
-
-    return ((new_mat.transpose()).flatten()).tolist()
-
-def Get_Upstream_Triangle(data, i, size):
-
-    lower = max(1, i-size)
-    tmp_mat = data[lower-1:i,lower-1:i]
-
-    triag = (np.triu(tmp_mat,k=1).flatten())
-
-    return triag[triag!=0].tolist()
+    inside = (rows >= 0) & (cols >= 0) & (rows < n_bins) & (cols < n_bins)
+    values = data[np.clip(rows, 0, n_bins - 1), np.clip(cols, 0, n_bins - 1)]
+    return values, inside
 
-def Get_Downstream_Triangle(data, i, size):
-
-    n_bins = data.shape[0]
-    if i==n_bins:
-        return NaN
+def Get_Diamond_Matrix2(data, bins, size):
+    """
+    :returns: for each bin, the interactions between the size bins upstream
+       and the bin plus the size - 1 bins downstream, with the mask of the
+       ones inside the matrix
+    """
+    up, down = np.meshgrid(np.arange(1, size + 1), np.arange(size),
+                           indexing='ij')
+    return _window_values(data, bins[:, None] - up.ravel(),
+                          bins[:, None] + down.ravel())
 
-    upperbound = min(i+size, n_bins)
-    tmp_mat = data[i:upperbound, i:upperbound]
+def Get_Upstream_Triangle(data, bins, size):
+    """
+    :returns: for each bin, the interactions within the size + 1 bins
+       upstream (upper triangle without diagonal), with the mask of the ones
+       inside the matrix
+    """
+    rows, cols = np.triu_indices(size + 1, 1)
+    return _window_values(data, bins[:, None] - size - 1 + rows,
+                          bins[:, None] - size - 1 + cols)
 
-    triag = (np.triu(tmp_mat,k=1).flatten())
+def Get_Downstream_Triangle(data, bins, size):
+    """
+    :returns: for each bin, the interactions within the bin and the size - 1
+       bins downstream (upper triangle without diagonal), with the mask of
+       the ones inside the matrix
+    """
+    rows, cols = np.triu_indices(size, 1)
+    return _window_values(data, bins[:, None] + rows, bins[:, None] + cols)
 
-    return triag[triag!=0].tolist()
+def _mannwhitneyu_less(x, x_ok, y, y_ok):
+    """
+    Mann-Whitney U test, with alternative 'less' and continuity correction,
+    of each row of x against the same row of y (only values in x_ok and y_ok
+    are used). Computed as scipy.stats.mannwhitneyu, which is directly used
+    for the rows where it would use the exact distribution.
 
+    :returns: an array with the p-value of each row (NaN if there are NaNs
+       or no values in one of the samples)
+    """
+    n1 = x_ok.sum(axis=1)
+    n2 = y_ok.sum(axis=1)
+    values = np.concatenate((x, y), axis=1)
+    valid  = np.concatenate((x_ok, y_ok), axis=1)
+    from_x = np.zeros(valid.shape, dtype=bool)
+    from_x[:, :x.shape[1]] = True
+    # average ranks of valid values, others being sorted at the end
+    values = np.where(valid, values, np.inf)
+    order  = np.argsort(values, axis=1, kind='stable')
+    values = np.take_along_axis(values, order, axis=1)
+    valid  = np.take_along_axis(valid, order, axis=1)
+    from_x = np.take_along_axis(from_x, order, axis=1)
+    pos = np.arange(values.shape[1])
+    first = np.ones(values.shape, dtype=bool)
+    first[:, 1:] = ((values[:, 1:] != values[:, :-1]) |
+                    (valid[:, 1:] != valid[:, :-1]))
+    last = np.ones(values.shape, dtype=bool)
+    last[:, :-1] = first[:, 1:]
+    first = np.maximum.accumulate(np.where(first, pos, 0), axis=1)
+    last = np.minimum.accumulate(np.where(last, pos, len(pos))[:, ::-1],
+                                 axis=1)[:, ::-1]
+    counts = (last - first + 1).astype(float)
+    ranks = (first + 1) + (counts - 1) / 2
+    ties = ((counts > 1) & valid).any(axis=1)
+
+    R1 = np.where(from_x & valid, ranks, 0).sum(axis=1)
+    U1 = R1 - n1 * (n1 + 1) / 2
+    U2 = n1 * n2 - U1
+    # normal approximation with tie correction
+    n = n1 + n2
+    tie_term = np.where(valid, counts**2 - 1, 0).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s = np.sqrt(n1 * n2 / 12 * ((n + 1) - tie_term / (n * (n - 1))))
+        z = (U2 - n1 * n2 / 2 - 0.5) / s
+    pvalue = np.clip(ndtr(-z), 0., 1.)
+
+    pvalue[np.isnan(values).any(axis=1)] = np.nan
+    pvalue[(n1 == 0) | (n2 == 0)] = np.nan
+    exact = ((n1 <= 8) | (n2 <= 8)) & ~ties & (n1 > 0) & (n2 > 0)
+    for row in np.flatnonzero(exact):
+        pvalue[row] = mannwhitneyu(x=x[row][x_ok[row]], y=y[row][y_ok[row]],
+                                   use_continuity=True,
+                                   alternative='less').pvalue
+    return pvalue
 
 def insulation_score(hic_data, dists, normalize=False, resolution=1,
                      delta=0, silent=False, savedata=None, savedeltas=None):
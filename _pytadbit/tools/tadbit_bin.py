@@ -13,10 +13,6 @@ from sys                             import stdout
 from shutil                          import copyfile
 from string                          import ascii_letters
 from random                          import random
-try:
-    from pickle5                     import load  # python < 3.8
-except ImportError:
-    from pickle                      import load
 from warnings                        import warn
 from multiprocessing                 import cpu_count
 from collections                     import OrderedDict
@@ -190,7 +186,7 @@ def run(opts):
             try:
                 matrix, bads1, bads2, regions, name, bin_coords = get_matrix(
                     mreads, opts.reso,
-                    load(open(biases, 'rb')) if biases and norm != 'raw' else None,
+                    biases if biases and norm != 'raw' else None,
                     normalization=norm, filter_exclude=opts.filter,
                     region1=region1, start1=start1, end1=end1,
                     region2=region2, start2=start2, end2=end2,
@@ -306,7 +302,7 @@ def run(opts):
         printime('Getting and writing matrices')
         out_files.update(write_matrix(
             mreads, opts.reso,
-            load(open(biases, 'rb')) if biases else None,
+            biases if biases else None,
             outdir, filter_exclude=opts.filter,
             normalizations=opts.normalizations,
             region1=region1, start1=start1, end1=end1,
@@ -314,6 +310,8 @@ def run(opts):
             tmpdir=tmpdir, append_to_tar=None, ncpus=opts.cpus,
             nchunks=opts.nchunks, verbose=not opts.quiet,
             extra=param_hash, cooler=opts.cooler, clean=clean,
+            cooler_resolutions=opts.cooler_resolutions,
+            cooler_balance=opts.cooler_balance,
             chr_order=opts.chr_name))
 
     if clean:
@@ -428,6 +426,14 @@ def check_options(opts):
         raise NotImplementedError('ERROR: triangular is only available for '
                                   'symmetric matrices.')
 
+    # coarser resolutions of the cooler
+    if opts.cooler_resolutions:
+        if not opts.cooler:
+            raise Exception('ERROR: --cooler_resolutions requires --cooler')
+        if any(r % opts.reso for r in opts.cooler_resolutions):
+            raise Exception('ERROR: cooler resolutions should be multiples of '
+                            'the resolution (%d)' % opts.reso)
+
     # for LUSTRE file system....
     if 'tmpdb' in opts and opts.tmpdb:
         dbdir = opts.tmpdb
@@ -540,6 +546,19 @@ def populate_args(parser):
                         help='''Write i,j,v matrix in cooler format instead of text.
                         ''')
 
+    outopt.add_argument('--cooler_resolutions', dest='cooler_resolutions',
+                        metavar='INT', nargs='+', type=int, default=None,
+                        help='''coarser resolutions (multiples of the
+                        resolution) to add to the cooler, computed by summing the
+                        pixels of the cooler (no need to read the BAM again).
+                        e.g.: --cooler_resolutions 50000 100000 1000000''')
+
+    outopt.add_argument('--cooler_balance', dest='cooler_balance',
+                        action='store_true', default=False,
+                        help='''store balancing weights (iterative
+                        correction) for each of the coarser resolutions added to
+                        the cooler''')
+
     outopt.add_argument('--rownames', dest='row_names', action='store_true',
                         default=False,
                         help='''To store row names in the output text matrix.
@@ -10,9 +10,9 @@ standard_library.install_aliases()
 from argparse                        import HelpFormatter
 from os                              import path, remove, system, rename
 from sys                             import stdout
-from pickle                          import load
 from multiprocessing                 import cpu_count
 from collections                     import OrderedDict
+from functools                       import partial
 from subprocess                      import Popen, PIPE
 
 from pysam                           import AlignmentFile
@@ -22,6 +22,8 @@ from pytadbit.mapping.filter         import MASKED
 from pytadbit.utils.file_handling    import mkdir
 from pytadbit.parsers.hic_bam_parser import filters_to_bin, printime
 from pytadbit.parsers.hic_bam_parser import write_matrix, get_matrix
+from pytadbit.parsers.hic_bam_parser import read_bam, iter_pixel_blocks
+from pytadbit.parsers.hic_bam_parser import get_biases_region, _PixelTransform
 from pytadbit.utils.sqlite_utils     import digest_parameters
 
 DESC = 'export Hi-C data to other formats'
@@ -90,9 +92,11 @@ def run(opts):
 
     outdir = path.join(opts.workdir, '05_sub-matrices')
     mkdir(outdir)
+    # only needed to pass data to juicer
     tmpdir = path.join(opts.workdir, '05_sub-matrices',
                        '_tmp_sub-matrices_%s' % param_hash)
-    mkdir(tmpdir)
+    if opts.format == 'hic':
+        mkdir(tmpdir)
 
     if region1:
         if region1:
@@ -139,23 +143,22 @@ def run(opts):
                                                      for bam_ref_idx in bam_refs_idx]]
         sections = OrderedDict(list(zip(bam_refs,
                                    [x for x in bam_lengths])))
-        printime('Getting %s matrices' % norm)
-        matrix, bads1, bads2, regions, name, bin_coords = get_matrix(
-            mreads, opts.reso,
-            load(open(biases, 'rb')) if biases and norm != 'raw' else None,
-            normalization=norm, filter_exclude=opts.filter,
-            region1=region1, start1=start1, end1=end1,
-            region2=region2, start2=start2, end2=end2,
-            tmpdir=tmpdir, ncpus=opts.cpus,
-            return_headers=True,
-            nchunks=opts.nchunks, verbose=not opts.quiet,
-            clean=clean, chr_order=opts.chr_name)
+        if opts.format == 'matrix':
+            printime('Getting %s matrices' % norm)
+            matrix, bads1, bads2, regions, name, bin_coords = get_matrix(
+                mreads, opts.reso,
+                biases if biases and norm != 'raw' else None,
+                normalization=norm, filter_exclude=opts.filter,
+                region1=region1, start1=start1, end1=end1,
+                region2=region2, start2=start2, end2=end2,
+                ncpus=opts.cpus, return_headers=True,
+                nchunks=opts.nchunks, verbose=not opts.quiet,
+                chr_order=opts.chr_name)
 
-        b1, e1, b2, e2 = bin_coords
-        b1, e1 = 0, e1 - b1
-        b2, e2 = 0, e2 - b2
+            b1, e1, b2, e2 = bin_coords
+            b1, e1 = 0, e1 - b1
+            b2, e2 = 0, e2 - b2
 
-        if opts.format == 'matrix':
             if opts.row_names:
                 starts = [start1, start2]
                 ends = [end1, end2]
@@ -177,18 +180,41 @@ def run(opts):
                 out.write('# BADCOLS %s\n' % (','.join([str(b) for b in bads2])))
             else:
                 out.write('# MASKED %s\n' % (','.join([str(b) for b in bads1])))
-            if opts.row_names:
-                out.write('\n'.join('%s\t%d\t%d\t' % (next(row_names)) +
-                                    '\t'.join(str(matrix.get((i, j), 0))
-                                              for i in range(b1, e1))
-                                    for j in range(b2, e2)) + '\n')
-            else:
-                out.write('\n'.join('\t'.join(str(matrix.get((i, j), 0))
-                                              for i in range(b1, e1))
-                                    for j in range(b2, e2)) + '\n')
+            for line in _matrix_lines(matrix, e1 - b1, e2 - b2):
+                if opts.row_names:
+                    out.write('%s\t%d\t%d\t' % (next(row_names)))
+                out.write(line + '\n')
             out.close()
         else:
-            printime(' - Writing: %s' % norm)
+            # interactions are written to the juicer input as they are read
+            # from the BAM file
+            printime('Getting and writing %s interactions' % norm)
+            regions, bin_coords, chunks = read_bam(
+                mreads, opts.filter, opts.reso,
+                region1=region1, start1=start1, end1=end1,
+                region2=region2, start2=start2, end2=end2,
+                nchunks=opts.nchunks, verbose=not opts.quiet,
+                chr_order=opts.chr_name, half=not region2)
+            if region1:
+                regions = [region1] + ([region2] if region2 else [])
+            start_bin1, end_bin1, start_bin2, end_bin2 = bin_coords
+            if biases and norm != 'raw':
+                bias1, bias2, decay, bads1, bads2 = get_biases_region(
+                    biases, bin_coords)
+            else:
+                bias1 = bias2 = decay = None
+                bads1 = bads2 = {}
+            transform = _PixelTransform(end_bin1 - start_bin1,
+                                        end_bin2 - start_bin2,
+                                        bads1, bads2, bias1, bias2, decay,
+                                        start_bin1, start_bin2)
+            # chromosome and position of each bin of the genomic matrix
+            bin_names = ['%s\t%d' % (crm, pos + 1) for crm in sections
+                         for pos in range(0, (sections[crm] // opts.reso + 1)
+                                          * opts.reso, opts.reso)]
+            func = partial(_juicer_lines, transform, norm,
+                           bin_names[start_bin1:end_bin1],
+                           bin_names[start_bin2:end_bin2])
             tmp_chromsize = path.join(tmpdir,'hic_%s.chrom.sizes'% param_hash)
             out = open(tmp_chromsize, 'w')
             for reg in regions:
@@ -196,43 +222,14 @@ def run(opts):
             out.close()
             tmpfl = path.join(tmpdir,'hic_export_%s.tsv'% param_hash)
             out = open(tmpfl, 'w')
-            out_ln = '0\t%s\t%d\t0\t1\t%s\t%d\t1\t1%f'if opts.norm else '0\t%s\t%d\t0\t1\t%s\t%d\t1\t1%d'                
-            if region1:
-                starts = [start1, start2]
-                ends = [end1, end2]
-                row_names = [(reg, pos+1) for r, reg in enumerate(regions)
-                             for pos in range(starts[r] if r < len(starts)
-                                            and starts[r] else 0,
-                                            ends[r] if r < len(ends)
-                                            and ends[r] else sections[reg],
-                                            opts.reso)]
-                out.write('\n'.join(out_ln % (row_names[i][0],
-                                          row_names[i][1],
-                                          row_names[j][0],
-                                          row_names[j][1],
-                                          matrix.get((i,j),0))
-                                    for i in range(b1, e1)
-                                    for j in range(i, e2)))
-            else:
-                totals = OrderedDict()
-                total_num = 0
-                for c in sections:
-                    totals[c] = (total_num, total_num + sections[c] // opts.reso + 1)
-                    total_num += sections[c] // opts.reso + 1
-                
-                for crm1_id, crm1 in enumerate(sections):
-                    b1, e1 = totals[crm1]
-                    row_names1 = dict((b1+ipos,pos+1) for ipos,pos in enumerate(range(0,sections[crm1],opts.reso)))
-                    for crm2 in list(sections.keys())[crm1_id:]:
-                        b2, e2 = totals[crm2]
-                        row_names2 = dict((b2+ipos,pos+1) for ipos,pos in enumerate(range(0,sections[crm2],opts.reso)))
-                        out.write('\n'.join(out_ln % (crm1,row_names1[i],
-                                                      crm2,row_names2[j],
-                                                      matrix.get((i,j),0))
-                                    for i in range(b1, e1)
-                                    for j in range(max(b2,i), e2)))
-            
+            for lines in iter_pixel_blocks(chunks, func, ncpus=opts.cpus,
+                                           verbose=not opts.quiet):
+                out.write(lines)
             out.close()
+            # juicer needs the interactions grouped by pair of chromosomes
+            if not region1:
+                _ = Popen(['sort', '-s', '-t', '\t', '-k2,2', '-k6,6',
+                           '-T', tmpdir, '-o', tmpfl, tmpfl]).communicate()
             do_norm = '-n' if opts.norm else ''
             _ = Popen('java -Xmx32g -jar %s pre -j %d %s %s %s %s'%(opts.juicerjar,
                                                          opts.cpus,
@@ -244,29 +241,17 @@ def run(opts):
         printime('Getting and writing matrix to text format')
         fnames = write_matrix(
             mreads, opts.reso,
-            load(open(biases, 'rb')) if biases else None,
+            biases if biases else None,
             outdir, filter_exclude=opts.filter,
             normalizations=[norm],
             region1=region1, start1=start1, end1=end1,
             region2=region2, start2=start2, end2=end2,
-            tmpdir=tmpdir, append_to_tar=None, ncpus=opts.cpus,
+            append_to_tar=None, ncpus=opts.cpus,
             nchunks=opts.nchunks, verbose=not opts.quiet,
-            extra=param_hash, cooler=False, clean=clean,
-            chr_order=opts.chr_name)
+            extra=param_hash, cooler=False, chr_order=opts.chr_name)
         rename(list(fnames.values())[0],opts.out)
     elif opts.format == 'cooler':
-        printime('Getting and writing matrix to cooler format')
-        fnames = write_matrix(
-            mreads, opts.reso,
-            load(open(biases, 'rb')) if biases else None,
-            outdir, filter_exclude=opts.filter,
-            normalizations=[norm],
-            region1=region1, start1=start1, end1=end1,
-            region2=region2, start2=start2, end2=end2,
-            tmpdir=tmpdir, append_to_tar=None, ncpus=opts.cpus,
-            nchunks=opts.nchunks, verbose=not opts.quiet,
-            extra=param_hash, cooler=True, clean=clean,
-            chr_order=opts.chr_name)
+        zooms = []
         for zoom_c in ZOOMS_COOLER:
             if opts.reso >= zoom_c:
                 continue
@@ -276,6 +261,25 @@ def run(opts):
             if start2 is not None and end2:
                 if end2 - start2 < zoom_c:
                     continue
+            zooms.append(zoom_c)
+        # zooms multiple of the resolution are summed from the written pixels,
+        # the others are read from the BAM file skipping the reads in the bad
+        # columns of the biases, so that all the zooms exclude them
+        printime('Getting and writing matrix to cooler format')
+        fnames = write_matrix(
+            mreads, opts.reso,
+            biases if biases else None,
+            outdir, filter_exclude=opts.filter,
+            normalizations=[norm],
+            region1=region1, start1=start1, end1=end1,
+            region2=region2, start2=start2, end2=end2,
+            append_to_tar=None, ncpus=opts.cpus,
+            nchunks=opts.nchunks, verbose=not opts.quiet,
+            extra=param_hash, cooler=True, chr_order=opts.chr_name,
+            cooler_resolutions=[z for z in zooms if not z % opts.reso])
+        for zoom_c in zooms:
+            if not zoom_c % opts.reso:
+                continue
             printime('Building cooler zoom %d'%zoom_c)
             _ = write_matrix(
                 mreads, zoom_c,
@@ -284,22 +288,62 @@ def run(opts):
                 normalizations=['raw'],
                 region1=region1, start1=start1, end1=end1,
                 region2=region2, start2=start2, end2=end2,
-                tmpdir=tmpdir, append_to_tar=None, ncpus=opts.cpus,
+                append_to_tar=None, ncpus=opts.cpus,
                 nchunks=opts.nchunks, verbose=not opts.quiet,
                 extra=param_hash, cooler=True,
                 cooler_name=fnames['NRM' if opts.norm else 'RAW'],
-                clean=clean, chr_order=opts.chr_name)
+                chr_order=opts.chr_name, mask_biases=biases)
         rename(fnames['NRM' if opts.norm else 'RAW'],opts.out)
         if 'NRM' in fnames and not opts.norm:
             remove(fnames['NRM'])
         if 'RAW' in fnames and opts.norm:
             remove(fnames['RAW'])
 
-    if clean:
+    if clean and opts.format == 'hic':
         printime('Cleaning')
         system('rm -rf %s '% tmpdir)
 
 
+def _matrix_lines(matrix, size1, size2):
+    """
+    :param matrix: dictionary of interactions, with tuples of row and column
+       as keys
+    :param size1: number of rows
+    :param size2: number of columns
+
+    :returns: an iterator over the lines of the transposed matrix (line j
+       has the values of the cells (i, j), 0 for empty cells)
+    """
+    cells = sorted((j, i, v) for (i, j), v in matrix.items()
+                   if 0 <= i < size1 and 0 <= j < size2)
+    pos = 0
+    for j in range(size2):
+        line = [0] * size1
+        while pos < len(cells) and cells[pos][0] == j:
+            line[cells[pos][1]] = cells[pos][2]
+            pos += 1
+        yield '\t'.join(map(str, line))
+
+
+def _juicer_lines(transform, normalization, names1, names2, *block):
+    """
+    :param transform: _PixelTransform removing bad bins and normalizing
+    :param normalization: 'raw' or 'norm'
+    :param names1: chromosome and position of each row, separated by a tab
+    :param names2: chromosome and position of each column
+
+    :returns: the lines of the non-empty pixels of a chunk in the short
+       format with score of juicer pre
+    """
+    block = transform.filter(*block)
+    values = transform.values(normalization, *block).tolist()
+    out_ln = ('0\t%s\t0\t1\t%s\t1\t%d\n' if normalization == 'raw' else
+              '0\t%s\t0\t1\t%s\t1\t%f\n')
+    return ''.join(out_ln % (names1[i], names2[j], v)
+                   for i, j, v in zip(block[2].tolist(), block[3].tolist(),
+                                      values) if v)
+
+
 def check_options(opts):
     mkdir(opts.workdir)
 
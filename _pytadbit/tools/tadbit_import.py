@@ -20,7 +20,7 @@ from distutils.version               import LooseVersion
 
 from pytadbit                        import HiC_data
 from pytadbit.parsers.gzopen         import gzopen
-from pytadbit.parsers.hic_parser     import autoreader
+from pytadbit.parsers.hic_parser     import autoreader, read_abc
 from pytadbit.parsers.cooler_parser  import parse_cooler, is_cooler, parse_header
 from pytadbit.utils.file_handling    import mkdir, which
 from pytadbit                        import get_dependencies_version
@@ -112,7 +112,8 @@ def run(opts):
         matrix, weights, size, header = parse_cooler(opts.input,
                                                      opts.reso if opts.reso > 1 else None,
                                                      normalized = True,
-                                                     raw_values = True)
+                                                     raw_values = True,
+                                                     region = coord1)
         masked={}
         size_mat = size
         if len(set(weights)) > 1:
@@ -164,11 +165,8 @@ def abc_reader(f, size, beg):
         fpos += len(line)
     f.seek(fpos)
     offset = (beg or 0) * (1 + size)
-    def _disect(x):
-        a, b, v = x.split()
-        return (int(a) + int(b) * size + offset, int(v))
-    items = tuple(_disect(line) for line in f)
-    return items
+    bin1, bin2, values = read_abc(f)
+    return zip((bin1 + bin2 * size + offset).tolist(), values.tolist())
 
 def create_BAMhic(hic, ncpus, outbam, chromosomes, reso,
                   masked=None, samtools='samtools'):
@@ -641,10 +641,11 @@ def run(opts):
                     outdir, 'models', 'Singletons'),
                                  models=singletons)
             # Write best model and centroid model
-            models[models.centroid_model()].write_cmm(
+            centroid = models.centroid_model(n_cpus=int(opts.cpus))
+            models[centroid].write_cmm(
                 directory=path.join(outdir, 'models'),
                 filename='centroid.cmm')
-            models[models.centroid_model()].write_xyz(
+            models[centroid].write_xyz(
                 directory=path.join(outdir, 'models'),
                 filename='centroid.xyz')
             models[0].write_cmm(
@@ -681,7 +682,7 @@ def run(opts):
         if "centroid" in opts.analyze_list:
             # Get the centroid model of cluster #1
             logging.info("\tGetting centroid...")
-            centroid = models.centroid_model(cluster=1)
+            centroid = models.centroid_model(cluster=1, n_cpus=int(opts.cpus))
             logging.info("\t\tThe model centroid (closest to the average) " +
                          "for cluster 1 is: {}".format(centroid))
 
@@ -690,6 +691,7 @@ def run(opts):
             logging.info("\tGetting consistency data...")
             models.model_consistency(
                 cluster=1, cutoffs=list(range(50, dcutoff + 50, 50)),
+                n_cpus=int(opts.cpus),
                 savefig =path.join(outdir, batch_job_hash + '_consistency.' + opts.fig_format),
                 savedata=path.join(outdir, batch_job_hash + '_consistency.dat'))
 
@@ -737,7 +739,7 @@ def run(opts):
             nump   = 30   # number of particles (resolution)
             logging.info("\tGetting accessibility data (this can take long)...")
             models.accessibility(radius, nump=nump,
-                error=True,
+                error=True, n_cpus=int(opts.cpus),
                 savefig =path.join(outdir, batch_job_hash + '_accessibility.' + opts.fig_format),
                 savedata=path.join(outdir, batch_job_hash + '_accessibility.dat'))
 
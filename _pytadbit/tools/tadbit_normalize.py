@@ -25,6 +25,7 @@ import time
 
 from pysam                                import AlignmentFile
 from numpy                                import nanmean, isnan, nansum, nanpercentile, seterr
+import numpy as np
 from matplotlib                           import pyplot as plt
 
 from pytadbit                             import load_hic_data_from_bam
@@ -37,11 +38,13 @@ from pytadbit.utils                       import printime
 from pytadbit.parsers.hic_bam_parser      import print_progress
 from pytadbit.parsers.hic_bam_parser      import filters_to_bin
 from pytadbit.parsers.bed_parser          import parse_mappability_bedGraph
+from pytadbit.parsers.biases_parser       import write_binary_biases
 from pytadbit.utils.extraviews            import nicer
 # from pytadbit.utils.hic_filtering         import filter_by_local_ratio
 from pytadbit.utils.hic_filtering         import plot_filtering
 # from pytadbit.utils.hic_filtering         import filter_by_zero_count
 from pytadbit.utils.normalize_hic         import oneD
+from pytadbit.utils.normalize_hic         import _group_diagonals, _diagonal_cell_counts
 from pytadbit.mapping.restriction_enzymes import RESTRICTION_ENZYMES
 from pytadbit.parsers.genome_parser       import parse_fasta, get_gc_content
 from functools import reduce
@@ -170,15 +173,19 @@ def run(opts):
 
     printime('  - Saving biases and badcol columns')
     # biases
-    bias_file = path.join(outdir, 'biases_%s_%s.pickle' % (
-        nicer(opts.reso).replace(' ', ''), param_hash))
-    out = open(bias_file, 'wb')
-
-    dump({'biases'    : biases,
-          'decay'     : decay,
-          'badcol'    : badcol,
-          'resolution': opts.reso}, out, HIGHEST_PROTOCOL)
-    out.close()
+    bias_file = path.join(outdir, 'biases_%s_%s.%s' % (
+        nicer(opts.reso).replace(' ', ''), param_hash,
+        'biases' if opts.binary_biases else 'pickle'))
+    content = {'biases'    : biases,
+               'decay'     : decay,
+               'badcol'    : badcol,
+               'resolution': opts.reso}
+    if opts.binary_biases:
+        write_binary_biases(bias_file, content)
+    else:
+        out = open(bias_file, 'wb')
+        dump(content, out, HIGHEST_PROTOCOL)
+        out.close()
 
     finish_time = time.localtime()
 
@@ -420,6 +427,12 @@ def populate_args(parser):
 
     glopts.add_argument('--noX', action='store_true', help='no display server (X screen)')
 
+    glopts.add_argument('--binary_biases', dest='binary_biases',
+                        action='store_true', default=False,
+                        help='''store biases, bad columns and decay in TADbit
+                        binary format (memory-mappable, faster to load by
+                        region) instead of pickle''')
+
     normpt.add_argument('--normalization', dest='normalization', metavar="STR",
                         action='store', default='Vanilla', type=str,
                         choices=['Vanilla', 'ICE', 'SQRT', 'oneD', 'custom'],
@@ -1032,74 +1045,23 @@ def read_bam(inbam, filter_exclude, resolution, min_count=2500, biases_path='',
                     except KeyError:
                         nrmdec[c] = {k: v}
                         rawdec[c] = {k: tmpraw[c][k]}
-    # count the number of cells per diagonal
-    # TODO: parallelize
-    # find largest chromosome
-    len_crms = dict((c, section_pos[c][1] - section_pos[c][0]) for c in section_pos)
-    # initialize dictionary
-    ndiags = dict((c, dict((k, 0) for k in range(len_crms[c]))) for c in sections)
-    for crm in section_pos:
-        beg_chr, end_chr = section_pos[crm][0], section_pos[crm][1]
-        chr_size = end_chr - beg_chr
-        thesebads = [b for b in badcol if beg_chr <= b <= end_chr]
-        for dist in range(1, chr_size):
-            ndiags[crm][dist] += chr_size - dist
-            # from this we remove bad columns
-            # bad columns will only affect if they are at least as distant from
-            # a border as the distance between the longest diagonal and the
-            # current diagonal.
-            bad_diag = set()  # 2 bad rows can point to the same bad cell in diagonal
-            maxp = end_chr - dist
-            minp = beg_chr + dist
-            for b in thesebads:
-                if b < maxp:  # not inclusive!!
-                    bad_diag.add(b)
-                if b >= minp:
-                    bad_diag.add(b - dist)
-            ndiags[crm][dist] -= len(bad_diag)
-        # different behavior for longest diagonal:
-        ndiags[crm][0] += chr_size - sum(beg_chr <= b < end_chr for b in thesebads)
-
     # normalize sum per diagonal by total number of cells in diagonal
+    # (diagonals are grouped until reaching enough raw interactions)
     signal_to_noise = 0.05
     min_n = signal_to_noise ** -2. # equals 400 when default
     for crm in sections:
-        if not crm in nrmdec:
-            nrmdec[crm] = {}
-            rawdec[crm] = {}
-        tmpdec = 0  # store count by diagonal
-        tmpsum = 0  # store count by diagonal
-        ndiag  = 0
-        val    = 0
-        previous = [] # store diagonals to be summed in case not reaching the minimum
-        for k in ndiags[crm]:
-            tmpdec += nrmdec[crm].get(k, 0.)
-            tmpsum += rawdec[crm].get(k, 0.)
-            previous.append(k)
-            if tmpsum > min_n:
-                ndiag = sum(ndiags[crm][k] for k in previous)
-                val = tmpdec  # backup of tmpdec kept for last ones outside the loop
-                try:
-                    ratio = val / ndiag
-                    for l in previous:
-                        nrmdec[crm][l] = ratio
-                except ZeroDivisionError:  # all columns at this distance are "bad"
-                    pass
-                previous = []
-                tmpdec = 0
-                tmpsum = 0
-        # last ones we average with previous result
-        if  len(previous) == len(ndiags[crm]):
-            nrmdec[crm] = {}
-        elif tmpsum < min_n:
-            ndiag += sum(ndiags[crm][k] for k in previous)
-            val += tmpdec
-            try:
-                ratio = val / ndiag
-                for k in previous:
-                    nrmdec[crm][k] = ratio
-            except ZeroDivisionError:  # all columns at this distance are "bad"
-                pass
+        beg_chr, end_chr = section_pos[crm]
+        size = end_chr - beg_chr
+        good = np.ones(size, dtype=bool)
+        good[[b - beg_chr for b in badcol if beg_chr <= b < end_chr]] = False
+        nrms = np.zeros(size + 1)
+        raws = np.zeros(size + 1)
+        for k, v in nrmdec.get(crm, {}).items():
+            nrms[k] = v
+            raws[k] = rawdec[crm][k]
+        nrmdec[crm] = _group_diagonals(nrms, _diagonal_cell_counts(good, size),
+                                       min_n, size, raw_sums=raws)
+        rawdec.setdefault(crm, {})
     return biases, nrmdec, badcol, raw_cisprc, norm_cisprc
 
 
@@ -1107,27 +1069,31 @@ def sum_dec_matrix(fname, biases, badcol, bins):
     dico = load(open(fname,'rb'))
     rawdec = {}
     nrmdec = {}
-    for (i, j), v in dico.items():
-        if i < j:
-            continue
-        # different chromosome
-        c = bins[i][0]
-        if c != bins[j][0]:
-            continue
-        if i in badcol or j in badcol:
-            continue
-        k = i - j
-        val = v / biases[i] / biases[j]
-        try:
-            nrmdec[c][k] += val
-            rawdec[c][k] += v
-        except KeyError:
-            try:
-                nrmdec[c][k] = val
-                rawdec[c][k] = v
-            except KeyError:
-                nrmdec[c] = {k: val}
-                rawdec[c] = {k: v}
+    if dico:
+        pos  = np.array(list(dico.keys()), dtype=int)
+        vals = np.fromiter(dico.values(), dtype=float, count=len(dico))
+        # chromosome, bias and filtering of each bin found
+        uniq, pos = np.unique(pos, return_inverse=True)
+        pos   = pos.reshape(-1, 2)
+        crms  = [bins[b][0] for b in uniq]
+        crmid = np.unique(crms, return_inverse=True)[1].ravel()
+        bias  = np.array([biases[b] for b in uniq], dtype=float)
+        isbad = np.array([b in badcol for b in uniq], dtype=bool)
+        i, j  = pos[:, 0], pos[:, 1]
+        keep  = ((uniq[i] >= uniq[j]) & (crmid[i] == crmid[j]) &
+                 ~isbad[i] & ~isbad[j])
+        i, j, vals = i[keep], j[keep], vals[keep]
+        k = uniq[i] - uniq[j]
+        # sum by chromosome and diagonal
+        keys, which = np.unique(np.column_stack((crmid[i], k)), axis=0,
+                                return_inverse=True)
+        which = which.ravel()
+        nrms = np.bincount(which, weights=vals / bias[i] / bias[j])
+        raws = np.bincount(which, weights=vals)
+        for (c, k), nrm, raw in zip(keys.tolist(), nrms.tolist(), raws.tolist()):
+            c = crms[np.flatnonzero(crmid == c)[0]]
+            nrmdec.setdefault(c, {})[k] = nrm
+            rawdec.setdefault(c, {})[k] = raw
     system('rm -f %s' % (fname))
     return nrmdec, rawdec
 
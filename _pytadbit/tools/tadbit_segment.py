@@ -14,18 +14,22 @@ from shutil                         import copyfile
 from string                         import ascii_letters
 from random                         import random
 from warnings                       import warn
-from pickle                        import load
 from multiprocessing                import cpu_count
 from traceback                      import print_exc
+from queue                          import Queue
+import multiprocessing as mu
 import sqlite3 as lite
 import time
 
+import numpy as np
+
 from pytadbit                       import load_hic_data_from_bam
 from pytadbit                       import tadbit
 from pytadbit.utils.sqlite_utils    import already_run, digest_parameters
 from pytadbit.utils.sqlite_utils    import add_path, get_jobid, print_db, retry
 from pytadbit.utils.file_handling   import mkdir
 from pytadbit.parsers.tad_parser    import parse_tads
+from pytadbit.parsers.biases_parser import read_biases
 from pytadbit.parsers.genome_parser import parse_fasta, get_gc_content
 from pytadbit.mapping.filter        import MASKED
 from pytadbit.utils.extraviews      import nicer
@@ -96,7 +100,7 @@ def run(opts):
             savecorr=cmprt_dir if opts.savecorr else None,
             max_ev=n_evs,
             ev_index=opts.ev_index, smoothing_window=opts.smoothing_window,
-            vmin=None if opts.fix_corr_scale else 'auto',
+            n_cpus=opts.cpus, vmin=None if opts.fix_corr_scale else 'auto',
             vmax=None if opts.fix_corr_scale else 'auto')
 
         for ncrm, crm in enumerate(opts.crms or hic_data.chromosomes):
@@ -139,37 +143,29 @@ def run(opts):
         tad_dir = path.join(opts.workdir, '06_segmentation',
                              'tads_%s' % (nice(reso)))
         mkdir(tad_dir)
-        for crm in hic_data.chromosomes:
-            if opts.crms and not crm in opts.crms:
-                continue
-            print('  - %s' % crm)
-            matrix = hic_data.get_matrix(focus=crm)
-            beg, end = hic_data.section_pos[crm]
-            size = len(matrix)
+        jobs = []
+        for crm, size, interactions in _intra_interactions(hic_data, opts.crms):
             if size < 10:
+                print('  - %s' % crm)
                 print("     Chromosome too short (%d bins), skipping..." % size)
                 continue
             # transform bad column in chromosome referential
             if hic_data.bads:
-                to_rm = tuple([1 if i in hic_data.bads else 0 for i in range(beg, end)])
+                beg, end = hic_data.section_pos[crm]
+                to_rm = tuple(np.isin(np.arange(beg, end),
+                                      list(hic_data.bads)).astype(int).tolist())
             else:
                 to_rm = None
-            # maximum size of a TAD
-            max_tad_size = (size - 1) if opts.max_tad_size is None else opts.max_tad_size
-            result = tadbit([matrix], remove=to_rm,
-                            n_cpus=opts.cpus, verbose=opts.verbose,
-                            max_tad_size=max_tad_size,
-                            no_heuristic=False)
-
-            # use normalization to compute height on TADs called
-            if opts.all_bins:
-                if opts.nosql:
-                    biases = load(open(biases, 'rb'))
-                else:
-                    biases = load(open(path.join(opts.workdir, biases), 'rb'))
-                hic_data.bads = biases['badcol']
-                hic_data.bias = biases['biases']
-            tads = load_tad_height(result, size, beg, end, hic_data)
+            jobs.append((crm, size, interactions, to_rm))
+        # use normalization to compute height on TADs called
+        if opts.all_bins:
+            biases = read_biases(biases if opts.nosql else
+                                 path.join(opts.workdir, biases))
+            hic_data.bads = biases['badcol']
+            hic_data.bias = biases['biases']
+        for crm, tads in _run_tadbit_jobs(jobs, opts):
+            beg, end = hic_data.section_pos[crm]
+            tads = load_tad_height(tads, end - beg, beg, end, hic_data)
             table = ''
             table += '%s\t%s\t%s\t%s\t%s\n' % ('#', 'start', 'end', 'score', 'density')
             for tad in tads:
@@ -607,6 +603,107 @@ def check_options(opts):
         exit('WARNING: exact same job already computed, see JOBs table above')
 
 
+def _intra_interactions(hic_data, crms=None):
+    """
+    Split intra-chromosomal interactions by chromosome.
+
+    :param hic_data: HiC_data object
+    :param None crms: list of chromosomes to keep (all by default)
+
+    :returns: a generator of tuples with chromosome name, number of bins and
+       a tuple of arrays with rows, columns (relative to the start of the
+       chromosome) and values of the interactions
+    """
+    size  = len(hic_data)
+    keys  = np.fromiter(hic_data.keys(), dtype=np.int64)
+    vals  = np.array(list(hic_data.values()))
+    rows  = keys // size
+    cols  = keys % size
+    names = [crm for crm in hic_data.chromosomes if not crms or crm in crms]
+    begs  = np.array([hic_data.section_pos[crm][0] for crm in names], dtype=int)
+    ends  = np.array([hic_data.section_pos[crm][1] for crm in names], dtype=int)
+    # index of the chromosome of each row (-1 if not wanted)
+    idx   = np.searchsorted(ends, rows, side='right')
+    idx[idx >= len(names)] = -1
+    kept  = idx >= 0
+    kept[kept] = ((rows[kept] >= begs[idx[kept]]) &
+                  (cols[kept] >= begs[idx[kept]]) &
+                  (cols[kept] < ends[idx[kept]]))
+    idx, rows, cols, vals = idx[kept], rows[kept], cols[kept], vals[kept]
+    order  = np.argsort(idx, kind='stable')
+    bounds = np.searchsorted(idx[order], np.arange(len(names) + 1))
+    for num, crm in enumerate(names):
+        beg, end = hic_data.section_pos[crm]
+        pos = order[bounds[num]:bounds[num + 1]]
+        yield crm, end - beg, (rows[pos] - beg, cols[pos] - beg, vals[pos])
+
+
+def _tadbit_job(crm, size, interactions, to_rm, n_cpus, verbose,
+                max_tad_size):
+    rows, cols, vals = interactions
+    matrix = np.zeros((size, size), dtype=vals.dtype if len(vals) else int)
+    matrix[rows, cols] = vals
+    return crm, tadbit([matrix], remove=to_rm, n_cpus=n_cpus, verbose=verbose,
+                       max_tad_size=max_tad_size, no_heuristic=False)
+
+
+def _run_tadbit_jobs(jobs, opts):
+    """
+    Call TADs on several chromosomes at once, without using more than
+    opts.cpus CPUs in total. Biggest chromosomes are launched first, and
+    each one gets a share of the CPUs proportional to its computational
+    cost.
+
+    :param jobs: list of tuples with chromosome name, number of bins,
+       interactions (as returned by :func:`_intra_interactions`) and columns
+       to remove
+    :param opts: options of tadbit segment
+
+    :returns: a generator of tuples with chromosome name and the TADs found,
+       in the order in which chromosomes are done
+    """
+    if not jobs:
+        return
+    costs   = dict((job[0], float(job[1])**2) for job in jobs)
+    total   = sum(costs.values())
+    pending = sorted(jobs, key=lambda job: costs[job[0]], reverse=True)
+    running = {}
+    free    = opts.cpus
+    done    = Queue()
+    pool    = mu.Pool(min(opts.cpus, len(jobs)))
+    try:
+        while pending or running:
+            # launch all the chromosomes that fit, biggest first
+            for job in pending[:]:
+                crm, size, interactions, to_rm = job
+                n_cpus = max(1, int(round(opts.cpus * costs[crm] / total)))
+                n_cpus = min(n_cpus, opts.cpus)
+                if n_cpus > free:
+                    continue
+                pending.remove(job)
+                free -= n_cpus
+                running[crm] = n_cpus
+                # maximum size of a TAD
+                max_tad_size = (size - 1) if opts.max_tad_size is None else opts.max_tad_size
+                print('  - %s (%d bins, %d CPU%s)' % (
+                    crm, size, n_cpus, 's' if n_cpus > 1 else ''))
+                pool.apply_async(
+                    _tadbit_job, args=(crm, size, interactions, to_rm, n_cpus,
+                                       opts.verbose, max_tad_size),
+                    callback=done.put,
+                    error_callback=lambda exc, crm=crm: done.put((crm, exc)))
+            crm, result = done.get()
+            if isinstance(result, BaseException):
+                raise result
+            free += running.pop(crm)
+            yield crm, result
+    except BaseException:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+
+
 def nice(reso):
     if reso >= 1000000:
         return '%dMb' % (reso / 1000000)
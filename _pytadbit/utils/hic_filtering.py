@@ -17,11 +17,53 @@ except ImportError:
 
 
 def get_r2 (fun, X, Y, *args):
-    sstot = sum([(Y[i]-np.mean(Y))**2 for i in range(len(Y))])
-    sserr = sum([(Y[i] - fun(X[i], *args))**2 for i in range(len(Y))])
+    X = np.asarray(X)
+    Y = np.asarray(Y)
+    sstot = np.sum((Y - np.mean(Y))**2)
+    sserr = np.sum((Y - fun(X, *args))**2)
     return 1 - sserr/sstot
 
 
+def _sparse_entries(matrx):
+    """
+    :param matrx: Hi-C matrix stored as a dictionary (i.e. HiC_data)
+
+    :returns: positions and values of the cells stored in the matrix (in the
+       order of the dictionary)
+    """
+    keys = np.fromiter(dict.keys(matrx), dtype=np.int64,
+                       count=dict.__len__(matrx))
+    vals = np.array(list(dict.values(matrx)))
+    if not len(vals):
+        vals = np.zeros(0, dtype=int)
+    return keys, vals
+
+
+def _line_sums(index, vals, size):
+    """
+    :returns: sum of the values grouped by index (rows or columns), with
+       the type of vals
+    """
+    sums = np.bincount(index, weights=vals, minlength=size)[:size]
+    if vals.dtype.kind in 'iub':
+        sums = sums.astype(np.int64)
+    return sums
+
+
+def _sorted_histogram(cols, nbins):
+    """
+    Same as counting the values of np.digitize(cols, y) from 1 to nbins, y
+    being nbins evenly spaced values between the minimum and the maximum of
+    cols. Values in cols must be sorted.
+
+    :returns: y and the number of values in each bin
+    """
+    y = np.linspace(cols.min(), cols.max(), nbins)
+    # number of values lower than each limit
+    lower = np.searchsorted(cols, y, side='left')
+    return y, np.diff(np.append(lower, len(cols)))
+
+
 def filter_by_mean(matrx, draw_hist=False, silent=False, bads=None, savefig=None):
     """
     fits the distribution of Hi-C interaction count by column in the matrix to
@@ -30,13 +72,24 @@ def filter_by_mean(matrx, draw_hist=False, silent=False, bads=None, savefig=None
     nbins = 100
     if not bads:
         bads = {}
-    # get sum of columns
-    cols = []
     size = len(matrx)
-    for c in sorted([[matrx.get(i+j*size, 0) for j in range(size) if not j in bads]
-                     for i in range(size) if not i in bads], key=sum):
-        cols.append(sum(c))
-    cols = np.array(cols)
+    keys, vals = _sparse_entries(matrx)
+    # sort cells by column and row, to sum them in the same order
+    order = np.argsort(keys, kind='stable')
+    keys, vals = keys[order], vals[order]
+    rows = keys // size
+    columns = keys % size
+    # get sum of columns (skipping bad rows and columns)
+    good = ~np.isin(rows, list(bads))
+    cols = _line_sums(columns[good], vals[good], size)
+    cols = np.sort(cols[~np.isin(np.arange(size), list(bads))])
+    # columns with NaN can not be placed in the distribution (they are
+    # removed by hic_filtering_for_modelling)
+    if not np.isfinite(cols).all():
+        if not silent:
+            stderr.write('WARNING: NaN values found, skipping the filtering '
+                         'of columns based on mean value.\n')
+        return bads
     if draw_hist:
         plt.figure(figsize=(9, 9))
     try:
@@ -47,30 +100,20 @@ def filter_by_mean(matrx, draw_hist=False, silent=False, bads=None, savefig=None
     # mad = np.median([abs(median - c ) for c in cols])
     best =(float('-inf'), float('-inf'), float('-inf'), float('-inf'))
     # bin the sum of columns
-    xmin = min(cols)
-    xmax = max(cols)
-    y = np.linspace(xmin, xmax, nbins)
-    hist = np.digitize(cols, y)
-    x = [sum(hist == i) for i in range(1, nbins + 1)]
+    y, x = _sorted_histogram(cols, nbins)
     if draw_hist:
-        hist = plt.hist(cols, bins=100, alpha=.3, color='grey')
-    xp = list(range(0, int(cols[-1])))
+        plt.hist(cols, bins=100, alpha=.3, color='grey')
     # check if the binning is correct
     # we want at list half of the bins with some data
     try:
         cnt = 0
-        while list(x).count(0) > len(x)/2:
+        while np.sum(x == 0) > nbins / 2:
             cnt += 1
             cols = cols[:-1]
-            xmin = min(cols)
-            xmax = max(cols)
-            y = np.linspace(xmin, xmax, nbins)
-            hist = np.digitize(cols, y)
-            x = [sum(hist == i) for i in range(1, nbins + 1)]
+            y, x = _sorted_histogram(cols, nbins)
             if draw_hist:
                 plt.clf()
-                hist = plt.hist(cols, bins=100, alpha=.3, color='grey')
-            xp = list(range(0, int(cols[-1])))
+                plt.hist(cols, bins=100, alpha=.3, color='grey')
             if cnt > 10000:
                 raise ValueError
         # find best polynomial fit in a given range
@@ -100,6 +143,7 @@ def filter_by_mean(matrx, draw_hist=False, silent=False, bads=None, savefig=None
         try:
             p, z, root = best[2:]
             if draw_hist:
+                xp = np.arange(int(cols[-1]))
                 xlims = plt.xlim()
                 ylims = plt.ylim()
                 a = plt.plot(xp, p(xp), "--", color='k')
@@ -138,11 +182,9 @@ def filter_by_mean(matrx, draw_hist=False, silent=False, bads=None, savefig=None
                 else:
                     plt.show()
             # label as bad the columns with sums lower than the root
-            for i, col in enumerate([[matrx.get(i+j*size, 0)
-                                      for j in range(size)]
-                                     for i in range(size)]):
-                if sum(col) < root:
-                    bads[i] = sum(col)
+            sums = _line_sums(columns, vals, size)
+            for i in np.flatnonzero(sums < root).tolist():
+                bads[i] = sums[i].item()
             # now stored in Experiment._zeros, used for getting more accurate z-scores
             if bads and not silent:
                 stderr.write(('\nWARNING: removing columns having less than %s ' +
@@ -182,30 +224,22 @@ def filter_by_zero_count(matrx, perc_zero, min_count=None, silent=True):
     :returns: a dicitionary, which has as keys the index of the filtered out
        columns.
     """
-    bads = {}
     size = len(matrx)
+    keys, vals = _sparse_entries(matrx)  # linear representation of the matrix
     if min_count is None:
-        cols = [size for i in range(size)]
-        for k in matrx:
-            cols[k // size] -= 1
+        cols = size - np.bincount(keys // size, minlength=size)[:size]
         min_val = int(size * float(perc_zero) / 100)
+        check = cols > min_val
     else:
         if matrx.symmetricized:
             stderr.write('\nWARNING: Using twice min_count as the matrix was '
                          'symmetricized and contains twice as many '
                          'interactions as the original\n')
             min_count *= 2
-        cols = [0 for i in range(size)]
-        for k, v in matrx.items(): # linear representation of the matrix
-            cols[k // size] += v
+        cols = _line_sums(keys // size, vals, size)
         min_val = size - min_count
-    if min_count is None:
-        check = lambda x: x > min_val
-    else:
-        check = lambda x: x < min_count
-    for i, col in enumerate(cols):
-        if check(col):
-            bads[i] = True
+        check = cols < min_count
+    bads = dict((i, True) for i in np.flatnonzero(check).tolist())
     if bads and not silent:
         if min_count is None:
             stderr.write(('\nWARNING: removing columns having more than %s ' +
@@ -254,17 +288,22 @@ def hic_filtering_for_modelling(matrx, silent=False, perc_zero=90, auto=True,
         bads.update(filter_by_mean(matrx, draw_hist=draw_hist, silent=silent,
                                    savefig=savefig, bads=bads))
     # also removes rows or columns containing a NaN
-    has_nans = False
-    for i in range(len(matrx)):
-        if matrx.get(i + i * len(matrx), 0) == 0 and diagonal:
-            if not i in bads:
-                bads[i] = None
-        elif repr(sum([matrx.get(i + j * len(matrx), 0)
-                       for j in range(len(matrx))])) == 'nan':
-            has_nans = True
-            if not i in bads:
-                bads[i] = None
-    return bads, has_nans
+    size = len(matrx)
+    keys, vals = _sparse_entries(matrx)
+    empty_diag = np.ones(size, dtype=bool)
+    is_diag = keys // size == keys % size
+    empty_diag[(keys // size)[is_diag]] = vals[is_diag] == 0
+    nans = np.zeros(size, dtype=bool)
+    if vals.dtype.kind == 'f':
+        nans = np.isnan(_line_sums(keys % size, vals, size))
+    if diagonal:
+        nans &= ~empty_diag
+    else:
+        empty_diag[:] = False
+    for i in np.flatnonzero(empty_diag | nans).tolist():
+        if not i in bads:
+            bads[i] = None
+    return bads, bool(nans.any())
 
 
 def _best_window_size(sorted_prc, size, beg, end, verbose=False):
@@ -569,36 +608,42 @@ def filter_by_local_ratio(hic_data, min_ratio=1, min_count=None,
     if last_position is None:
         last_position = next_position * 5
 
-    ratio = {}
-    nears = {}
-
+    keys, vals = _sparse_entries(hic_data)
+    rows = keys // size
+    cols = keys % size
+    dist = cols - rows
+    is_near = (dist >= base_position) & (dist < next_position)
+    is_away = (dist >= next_position) & (dist < last_position)
+
+    def _sums(order, index, selected):
+        order = order[selected[order]]
+        return _line_sums(index[order], vals[order], size)
+
+    # forward: interactions of each row, sorted by column
+    fwd = np.argsort(keys, kind='stable')
+    near_fwd, away_fwd = _sums(fwd, rows, is_near), _sums(fwd, rows, is_away)
+    # backward: interactions of each column, sorted by decreasing row
+    bwd = np.lexsort((-rows, cols))
+    near_bwd, away_bwd = _sums(bwd, cols, is_near), _sums(bwd, cols, is_away)
+
+    ratio = np.zeros(size)
+    nears = np.zeros(size)
     for beg, end in hic_data.section_pos.values():
-        for i in range(beg, end - last_position):
-            near = sum(hic_data[i, i + j] for j in range(base_position, next_position))
-            away = sum(hic_data[i, i + j] for j in range(next_position, last_position))
-            try:
-                ratio[i] = near / away
-                nears[i] = near
-            except ZeroDivisionError:
-                pass
         # if we are at the end of the chromosome we look for interactions backward
-        for i in range(end - last_position, end):
-            near = sum(hic_data[i - j, i] for j in range(base_position, next_position))
-            away = sum(hic_data[i - j, i] for j in range(next_position, last_position))
-            try:
-                ratio[i] = near / away
-                nears[i] = near
-            except ZeroDivisionError:
-                pass
+        for bins, near, away in (
+                (np.arange(beg, end - last_position), near_fwd, away_fwd),
+                (np.arange(max(0, end - last_position), end), near_bwd, away_bwd)):
+            bins = bins[away[bins] != 0]
+            ratio[bins] = near[bins] / away[bins]
+            nears[bins] = near[bins]
 
     # define filter for minimum interactions per bin
-    if min_count is not None:
+    if min_count is None:
         min_count = np.percentile(
-            [nears[k] for k in range(size) 
-             if ratio.get(k, 0) < min_ratio and nears.get(k, 0) >= 10], 95)
-    
-    return dict((k, True) for k in range(size) 
-                if ratio.get(k, 0) < min_ratio or nears[k] < min_count)
+            nears[(ratio < min_ratio) & (nears >= 10)], 95)
+
+    return dict((k, True) for k in np.flatnonzero(
+        (ratio < min_ratio) | (nears < min_count)).tolist())
 
 def plot_filtering(nears, ratio, size, cut_count, cut_ratio, outfile,
                    base_position=None, next_position=None, last_position=None,
@@ -1,118 +1,242 @@
+"""
+Hidden Markov model with gaussian emissions, used to refine A/B compartments.
+
+Forward-backward, Baum-Welch and Viterbi computations are done with numpy
+arrays over all states at once and, for the training, over all the
+observation sequences at once (sequences are padded to the longest one).
+"""
 from __future__ import print_function
-from numpy import log, pi as pi_num, exp
 import sys
 
+import numpy as np
+
+
+def _log(values):
+    """
+    log of probabilities, negative values being set to -inf
+    """
+    values = np.asarray(values, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(values < 0., -np.inf, np.log(values))
+
+
 def best_path(probs, pi, T):
     """
-    Viterbi algorithm with backpointers
+    Viterbi algorithm with backpointers (in log space)
+
+    :param probs: emission probabilities, array of shape (states, observations)
+    :param pi: initial probabilities of each state
+    :param T: transition probabilities between states
+
+    :returns: the most probable list of states and its log-likelihood
     """
-    n = len(T)
-    m = len(probs[0])
-    log_V     = [[0. for _ in range(m)] for _ in range(n)]
-    backpt    = [[0  for _ in range(m)] for _ in range(n)]
-    states    =  [0  for _ in range(m)]
-    log_pi    =  [float('-inf') if pi[i] < 0. else log(pi[i]) for i in range(len(pi))]
-    log_T     =  [float('-inf') if T [i] < 0. else log(T[i]) for i in range(len(T))]
-    log_probs = [[float('-inf') if probs[i][j] < 0. else log(probs[i][j])
-                  for j in range(m)]
-                 for i in range(n)]
-    for i in range(n):
-        log_V[i][0] = log_probs[i][0] + log_pi[i]
+    log_probs = _log(probs)
+    log_pi    = _log(pi)
+    log_T     = _log(T)
+    n, m = log_probs.shape
+    backpt = np.zeros((n, m), dtype=int)
+    log_V  = log_probs[:, 0] + log_pi
     for k in range(1, m):
-        for stat in range(n):
-            log_V[stat][k] = float('-inf')
-            for prev in range(n):
-                # original state prob times transition prob
-                prob = log_V[prev][k-1] + log_T[prev][stat]
-                if prob > log_V[stat][k]:
-                    log_V[stat][k] = prob
-                    backpt[stat][k-1] = prev
-            log_V[stat][k] += log_probs[stat][k]
+        # original state prob times transition prob (previous x current)
+        trans = log_V[:, None] + log_T
+        backpt[:, k - 1] = trans.argmax(axis=0)
+        log_V = trans.max(axis=0) + log_probs[:, k]
     # get the likelihood of the most probable path
-    prob = log_V[0][-1]
-    for i in range(1, n):
-        if log_V[i][-1] > prob:
-            prob = log_V[i][-1]
-            states[-1] = i
+    states = np.zeros(m, dtype=int)
+    states[-1] = log_V.argmax()
+    prob = log_V[states[-1]]
     # Follow the backtrack: get the path which maximize the path prob.
     for i in range(m - 2, -1, -1):
-        states[i] = backpt[states[i + 1]][i]
-    return states, prob
+        states[i] = backpt[states[i + 1], i]
+    return states.tolist(), float(prob)
+
+
+def _pad_observations(observations):
+    """
+    :returns: an array of shape (sequences, longest length) with the
+       observations, padded with zeros, and the length of each sequence
+    """
+    lengths = np.array([len(x) for x in observations], dtype=int)
+    xs = np.zeros((len(observations), lengths.max() if len(lengths) else 0))
+    for h, x in enumerate(observations):
+        xs[h, :lengths[h]] = x
+    return xs, lengths
+
+
+def _gaussian_probs(xs, E):
+    """
+    Emission probabilities of padded observations.
+
+    :returns: an array of shape (sequences, length, states)
+    """
+    E = np.asarray(E, dtype=float)
+    pi2sd  = (2. * np.pi * E[:, 1])**-0.5
+    inv2sd = 1. / (2. * E[:, 1])
+    return pi2sd * np.exp(-(xs[..., None] - E[:, 0])**2 * inv2sd)
+
+
+def _forward(probs, pi, T):
+    """
+    Scaled forward algorithm on a batch of sequences.
+
+    :param probs: emission probabilities, array of shape (sequences, length,
+       states)
+
+    :returns: alphas with the same shape as probs, and scaling factors of
+       shape (sequences, length)
+    """
+    nseq, m, n = probs.shape
+    T = np.asarray(T, dtype=float)
+    alphas  = np.zeros((nseq, m, n))
+    scalars = np.ones((nseq, m))
+    alpha = np.asarray(pi, dtype=float) * probs[:, 0]
+    for k in range(m):
+        if k:
+            # all transition probabilities to become "i" times previous
+            # alpha, times probablity to belong to this states
+            alpha = alphas[:, k - 1].dot(T) * probs[:, k]
+        scalars[:, k] = alpha.sum(axis=1)
+        alphas[:, k] = alpha / scalars[:, k, None]
+    return alphas, scalars
+
+
+def _backward(probs, T, scalars, lengths):
+    """
+    Scaled backward algorithm on a batch of sequences, each sequence starting
+    at its own end.
+
+    :returns: betas, with the same shape as probs
+    """
+    nseq, m, n = probs.shape
+    T = np.asarray(T, dtype=float)
+    betas = np.ones((nseq, m, n))
+    for k in range(m - 2, -1, -1):
+        beta = (betas[:, k + 1] * probs[:, k + 1]).dot(T.T) / scalars[:, k + 1, None]
+        betas[:, k] = np.where((k < lengths - 1)[:, None], beta, 1.)
+    return betas
+
+
+def _expectations(probs, T, alphas, betas, lengths):
+    """
+    for Baum-Welch: probability of being in states i and j at times t and t+1
+    (etas), and of being in state i at time t (gammas), on a batch of
+    sequences. Values beyond the end of each sequence are set to 0.
+
+    :returns: etas of shape (sequences, length - 1, states, states) and
+       gammas of shape (sequences, length, states)
+    """
+    m = probs.shape[1]
+    T = np.asarray(T, dtype=float)
+    etas = (alphas[:, :-1, :, None] * T * probs[:, 1:, None, :] *
+            betas[:, 1:, None, :])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        etas /= etas.sum(axis=(2, 3))[..., None, None]
+    etas[np.arange(m - 1) >= (lengths - 1)[:, None]] = 0.
+    gammas = alphas * betas
+    gammas[np.arange(m) >= lengths[:, None]] = 0.
+    return etas, gammas
+
 
 def baum_welch_optimization(xh, T, E, new_pi, new_T, corrector,
                             new_E, etas, gammas):
     """
-    implementation of the baum-welch algorithm
+    implementation of the baum-welch algorithm, accumulates the new
+    parameters of one sequence in new_pi, new_T, corrector and new_E
     """
+    etas   = np.asarray(etas)
+    gammas = np.asarray(gammas)
+    xh     = np.asarray(xh, dtype=float)
+    E      = np.asarray(E, dtype=float)
     n = len(T)
-    m = len(gammas[0])
-    for i in range(n):
-        for j in range(n):
-            new_pi[i] += etas[i][j][0]
+    if etas.shape[-1]:
+        pis = etas[:, :, 0].sum(axis=1)
+        trs = etas.sum(axis=2)
+    else:
+        pis = np.zeros(n)
+        trs = np.zeros((n, n))
+    cor = gammas.sum(axis=1)
+    em0 = (gammas * xh).sum(axis=1)
+    em1 = (gammas * (xh - E[:, 0, None])**2).sum(axis=1)
     for i in range(n):
+        new_pi[i] += pis[i]
+        corrector[i] += cor[i]
+        new_E[i][0] += em0[i]
+        new_E[i][1] += em1[i]
         for j in range(n):
-            new_T[i][j] += sum(etas[i][j][k] for k in range(m - 1))
+            new_T[i][j] += trs[i][j]
+
+
+def _max_change(new, old, delta):
+    """
+    maximum absolute difference between new and old values, NaN differences
+    being ignored
+    """
+    diff = np.abs(np.asarray(new, dtype=float) - np.asarray(old, dtype=float))
+    return np.fmax.reduce(diff.ravel(), initial=delta)
 
-    for k in range(m):
-        for i in range(n):
-            gik = gammas[i][k]
-            corrector[i] += gik
-            new_E[i][0] += gik * xh[k]
-            new_E[i][1] += gik * (xh[k] - E[i][0])**2
 
 def update_parameters(corrector, pi, new_pi, T, new_T, E, new_E):
     """
-    final round of the baum-welch
+    final round of the baum-welch, parameters are updated in place
+
+    :returns: the maximum change in parameters
     """
+    corrector = np.asarray(corrector, dtype=float)
     ### update initial probabilities
-    n = len(T)
-    total = 0.
-    delta = 0.
-    for i in range(n):
-        total += new_pi[i]
-    for i in range(n):
-        new_pi[i] /= total
-        delta = max(delta, abs(new_pi[i] - pi[i]))
-        pi[i] = new_pi[i]
+    new_pi = np.asarray(new_pi, dtype=float)
+    new_pi = new_pi / new_pi.sum()
+    delta = _max_change(new_pi, pi, 0.)
     ### update transitions
-    for i in range(n):
-        total = 0.
-        for j in range(n):
-            total += new_T[i][j]
-        for j in range(n):
-            new_T[i][j] /= total
-            delta = max(delta, abs(new_T[i][j] - T[i][j]))
-            T[i][j] = new_T[i][j]
-    ### update emissions
-    for i in range(n):
-        # update the means
-        if corrector[i] > 0.:
-            new_E[i][0] /= corrector[i]
-            new_E[i][1] /= corrector[i]
-            # corrector[i] = 1.
-            delta = max(delta, abs(new_E[i][0] - E[i][0]))
-            E[i][0] = new_E[i][0]
-            # update the stdevs
-            delta = max(delta, abs(new_E[i][1] - E[i][1]))
-            E[i][1] = new_E[i][1]
-    return delta
+    new_T = np.asarray(new_T, dtype=float)
+    new_T = new_T / new_T.sum(axis=1)[:, None]
+    delta = _max_change(new_T, T, delta)
+    ### update emissions (means and stdevs)
+    new_E = np.asarray(new_E, dtype=float)
+    updated = corrector > 0.
+    if updated.any():
+        new_E[updated] /= corrector[updated, None]
+        delta = _max_change(new_E[updated], np.asarray(E, dtype=float)[updated],
+                            delta)
+    for i in range(len(T)):
+        pi[i] = new_pi[i]
+        for j in range(len(T)):
+            T[i][j] = new_T[i, j]
+        if updated[i]:
+            E[i][0] = new_E[i, 0]
+            E[i][1] = new_E[i, 1]
+    return float(delta)
+
 
 def train(pi, T, E, observations, verbose=False, threshold=1e-6, n_iter=1000):
+    """
+    Baum-Welch training of the HMM on a list of observation sequences, all
+    processed together. Initial probabilities (pi), transitions (T) and
+    emissions (E) are updated in place.
+
+    :param pi: initial probabilities of each state
+    :param T: transition probabilities between states
+    :param E: mean and variance of the emissions of each state
+    :param observations: list of sequences of observations
+    :param False verbose: print the change in parameters at each iteration
+    :param 1e-6 threshold: stop when parameters change less than this value
+    :param 1000 n_iter: maximum number of iterations
+    """
+    xs, lengths = _pad_observations(observations)
+    valid = np.arange(xs.shape[1]) < lengths[:, None]
     delta = float('inf')
     for it in range(n_iter):
-        # reset for new iteration
-        new_pi = [0. for _ in pi]
-        new_T  = [[0. for _ in i] for i in T]
-        new_E  = [[0. for _ in i] for i in E]
-        corrector = [0. for _ in range(len(T))]
-        for h in range(len(observations)):
-            probs  = gaussian_prob(observations[h], E)
-            alphas, scalars = get_alpha(probs, pi, T)
-            betas  = get_beta(probs, T, scalars)
-            etas   = get_eta(probs, T, alphas, betas)
-            gammas = get_gamma(T, alphas, betas)
-            baum_welch_optimization(observations[h], T, E, new_pi, new_T, corrector,
-                                    new_E, etas, gammas)
+        probs = _gaussian_probs(xs, E)
+        # padded positions should not affect scaling factors
+        probs[~valid] = 1.
+        alphas, scalars = _forward(probs, pi, T)
+        betas = _backward(probs, T, scalars, lengths)
+        etas, gammas = _expectations(probs, T, alphas, betas, lengths)
+        means = np.asarray(E, dtype=float)[:, 0]
+        new_pi = etas[:, 0].sum(axis=(0, 2)) if etas.shape[1] else np.zeros(len(T))
+        new_T  = etas.sum(axis=(0, 1))
+        corrector = gammas.sum(axis=(0, 1))
+        new_E  = np.array([(gammas * xs[..., None]).sum(axis=(0, 1)),
+                           (gammas * (xs[..., None] - means)**2).sum(axis=(0, 1))]).T
         delta = update_parameters(corrector, pi, new_pi, T, new_T, E, new_E)
         if verbose:
             print("\rTraining: %03i/%04i (diff: %.8f)" % (it, n_iter, delta), end=' ')
@@ -122,86 +246,54 @@ def train(pi, T, E, observations, verbose=False, threshold=1e-6, n_iter=1000):
     if verbose:
         print("\n")
 
+
 def get_eta(probs, T, alphas, betas):
     """
     for Baum-Welch: probability of being in states i and j at times t and t+1
+
+    :returns: array of shape (states, states, observations - 1)
     """
-    n = len(T)
-    m = len(probs[0])
-    etas = [[[0.  for _ in range(m - 1)] for _ in range(n)] for _ in range(n)]
-    for k in range(m - 1):
-        tot = 0.
-        for i in range(n):
-            for j in range(n):
-                etas[i][j][k] += alphas[i][k] * T[i][j] * probs[j][k+1] * betas[j][k+1]
-                tot += etas[i][j][k]
-        for i in range(n):
-            for j in range(n):
-                etas[i][j][k] /= tot
-    return etas
+    probs = np.asarray(probs, dtype=float).T[None]
+    m = probs.shape[1]
+    etas, _ = _expectations(probs, T, np.asarray(alphas).T[None],
+                            np.asarray(betas).T[None], np.array([m]))
+    return etas[0].transpose(1, 2, 0)
+
 
 def get_gamma(T, alphas, betas):
     """
     for Baum-Welch: probability of being in state i at time t
     """
-    n = len(T)
-    m = len(alphas[0])
-    return [[alphas[i][k] * betas[i][k]  for k in range(m)] for i in range(n)]
+    return np.asarray(alphas) * np.asarray(betas)
+
 
 def gaussian_prob(x, E):
     """
     of x to follow the gaussian with given E
     https://en.wikipedia.org/wiki/Normal_distribution
+
+    :returns: array of shape (states, observations)
     """
-    probs = []
-    for d, (mu, sd) in enumerate(E):
-        pi2sd = (2. * pi_num * sd)**-0.5
-        inv2sd = 1. / (2. * sd)
-        probs.append([])
-        for obs in x:
-            p = pi2sd * exp(-(obs - mu)**2 * inv2sd)
-            probs[d].append(p)
-    return probs
+    return _gaussian_probs(np.asarray(x, dtype=float)[None], E)[0].T
+
 
 def get_alpha(probs, pi, T):
     """
     computes alphas using forward algorithm
+
+    :returns: array of shape (states, observations) and the scaling factors
     """
-    n = len(T)
-    m = len(probs[0])
-    alphas = [[0. for _ in range(m)] for _ in range(n)]
-    scalars = [0. for _ in range(m)]
+    alphas, scalars = _forward(np.asarray(probs, dtype=float).T[None], pi, T)
+    return alphas[0].T, scalars[0]
 
-    # initialize alpha for each state
-    for i in range(n):
-        alphas[i][0] = pi[i] * probs[i][0]
-        scalars[0] += alphas[i][0]
-    for i in range(n):
-        alphas[i][0] /= scalars[0]
-    for k in range(1, m):
-        for i in range(n):
-            for j in range(n):
-                # all transition probabilities to become "i" times previous alpha
-                alphas[i][k] += alphas[j][k-1] * T[j][i]
-            # times probablity to belong to this states
-            alphas[i][k] *= probs[i][k]
-            scalars[k] += alphas[i][k]
-        for i in range(n):
-            alphas[i][k] /= scalars[k]
-    return alphas, scalars
 
 def get_beta(probs, T, scalars):
     """
     computes betas using backward algorithm
-    """
-    n = len(T)
-    m = len(probs[0])
-    # intialize beta at 1.0
-    betas = [[0. for _ in range(m - 1)] + [1.0] for _ in range(n)]
-    for k in range(-2, -m - 1, -1):
-        for i in range(n):
-            for j in range(n):
-                betas[i][k] += betas[j][k + 1] * probs[j][k + 1] * T[i][j]
-            betas[i][k] /= scalars[k + 1]
-    return betas
 
+    :returns: array of shape (states, observations)
+    """
+    probs = np.asarray(probs, dtype=float).T[None]
+    betas = _backward(probs, T, np.asarray(scalars, dtype=float)[None],
+                      np.array([probs.shape[1]]))
+    return betas[0].T
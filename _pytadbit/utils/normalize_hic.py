@@ -69,6 +69,9 @@ from subprocess import Popen, PIPE
 from os import path
 
 from numpy import genfromtxt
+from scipy.sparse import csr_matrix, triu
+from scipy.signal import fftconvolve
+import numpy as np
 
 from pytadbit.utils.file_handling import which
 
@@ -231,21 +234,30 @@ def iterative(hic_data, bads=None, iterations=0, max_dev=0.00001,
     return B
 
 
-def expected(hic_data, bads=None, signal_to_noise=0.05, inter_chrom=False, **kwargs):
+def expected(hic_data, bads=None, signal_to_noise=0.05, inter_chrom=False,
+             by_chrom=False, **kwargs):
     """
     Computes the expected values by averaging observed interactions at a given
     distance in a given HiC matrix.
 
-    :param hic_data: dictionary containing the interaction data
+    All intra-chromosomal cells are read at once from the sparse storage, and
+    summed by distance to the diagonal.
+
+    :param hic_data: dictionary containing the interaction data (or a square
+       matrix)
     :param None bads: dictionary with column not to be considered
     :param 0.05 signal_to_noise: to calculate expected interaction counts,
        if not enough reads are observed at a given distance the observations
        of the distance+1 are summed. a signal to noise ratio of < 0.05
        corresponds to > 400 reads.
+    :param False by_chrom: computes the expected values of each chromosome
+       independently
 
-    :returns: a vector of biases (length equal to the size of the matrix)
+    :returns: a dictionary with the expected value at each distance or, if
+       by_chrom, a dictionary of such dictionaries, one per chromosome
     """
     min_n = signal_to_noise ** -2. # equals 400 when default
+    bads = bads or {}
 
     size = len(hic_data)
     try:
@@ -254,38 +266,104 @@ def expected(hic_data, bads=None, signal_to_noise=0.05, inter_chrom=False, **kwa
     except AttributeError:
         pass
 
-    if size > 1200:
-        import sys
-        sys.setrecursionlimit(size + 100)
+    sections = getattr(hic_data, 'section_pos', None)
+    sections = list(sections.items()) if sections else [(None, (0, size))]
+    sums, counts = _diagonal_sums(hic_data, sections, bads, size)
+    if by_chrom:
+        return dict((crm, _group_diagonals(sums[n], counts[n], min_n, end - beg))
+                    for n, (crm, (beg, end)) in enumerate(sections))
+    return _group_diagonals(sums.sum(axis=0), counts.sum(axis=0), min_n, size)
+
+
+def _diagonal_sums(hic_data, sections, bads, size):
+    """
+    Sums of the interactions at each distance from the diagonal, and number of
+    cells summed, in each chromosome. Only rows that are not bad are used.
+
+    :returns: two arrays of shape (number of chromosomes, size + 1)
+    """
+    if hasattr(hic_data, 'get_hic_data_as_csr'):
+        matrix = hic_data.get_hic_data_as_csr()
+    else:
+        matrix = csr_matrix(np.asarray(hic_data, dtype=float))
+    matrix = triu(matrix).tocoo()
+    nbins  = matrix.shape[0]
+    # index of the chromosome of each bin, and bins to use as rows
+    secidx = np.full(nbins, -1)
+    for n, (_, (beg, end)) in enumerate(sections):
+        secidx[beg:end] = n
+    good = np.ones(nbins, dtype=bool)
+    good[[b for b in bads if 0 <= b < nbins]] = False
+    rows, cols = matrix.row, matrix.col
+    keep = ((secidx[rows] == secidx[cols]) & (secidx[rows] >= 0) & good[rows] &
+            (cols - rows <= size))
+    rows, cols = rows[keep], cols[keep]
+    sums = np.bincount(secidx[rows] * (size + 1) + cols - rows,
+                       weights=matrix.data[keep],
+                       minlength=len(sections) * (size + 1))
+    sums = sums[:len(sections) * (size + 1)].reshape(len(sections), size + 1)
+    counts = np.zeros((len(sections), size + 1))
+    for n, (_, (beg, end)) in enumerate(sections):
+        # row i is used for all distances lower than end - i
+        maxd = end - 1 - np.flatnonzero(good[beg:end]) - beg
+        counts[n] = np.bincount(maxd[maxd <= size],
+                                minlength=size + 1)[::-1].cumsum()[::-1]
+    return sums, counts
+
+
+def _diagonal_cell_counts(good, size):
+    """
+    Number of cells at each distance from the diagonal of a chromosomal
+    matrix, without the ones in bad columns or rows.
+
+    :param good: boolean array flagging the bins of the chromosome to be used
+    :param size: largest distance to be returned
 
+    :returns: an array of length size + 1 with the number of cells at each
+       distance
+    """
+    good   = np.asarray(good, dtype=float)
+    counts = np.zeros(size + 1)
+    if len(good):
+        # pairs of good bins separated by each distance
+        pairs = np.rint(fftconvolve(good, good[::-1])[len(good) - 1:])
+        counts[:min(len(pairs), size + 1)] = pairs[:size + 1]
+    return counts
+
+
+def _group_diagonals(sums, counts, min_n, size, raw_sums=None):
+    """
+    Average interactions by distance, if not enough interactions are observed
+    at a given distance (less than min_n) the following diagonals are added.
+
+    :param None raw_sums: interactions used to decide how to group diagonals,
+       if different from the ones averaged (e.g. raw counts, while averaging
+       normalized counts)
+
+    :returns: a dictionary with the expected value at each distance
+    """
+    cvals   = np.concatenate(([0.], np.cumsum(sums)))
+    csums   = cvals if raw_sums is None else np.concatenate(
+        ([0.], np.cumsum(raw_sums)))
+    ccounts = np.concatenate(([0.], np.cumsum(counts)))
     expc = {}
     dist = 0
     while dist < size:
-        diag = []
-        new_dist, val = _meandiag(hic_data, dist, diag, min_n, size, bads)
+        if not counts[dist]:
+            new_dist, val = dist + 1, 0.
+        else:
+            # first distance at which the sum of interactions reaches min_n
+            # (search is refined comparing differences, as rounding of
+            # csums[dist] + min_n can move the limit)
+            new_dist = np.searchsorted(csums, csums[dist] + min_n, side='right')
+            while new_dist - 1 > dist and csums[new_dist - 1] - csums[dist] > min_n:
+                new_dist -= 1
+            while (new_dist < len(csums) - 1 and
+                   not csums[new_dist] - csums[dist] > min_n):
+                new_dist += 1
+            new_dist = min(new_dist, size + 1)
+            val = float(cvals[new_dist] - cvals[dist]) / (
+                ccounts[new_dist] - ccounts[dist])
         for dist in range(dist, new_dist + 1):
             expc[dist] = val
     return expc
-
-
-def _meandiag(hic_data, dist, diag, min_n, size, bads):
-    if hic_data.section_pos:
-        for crm in hic_data.section_pos:
-            for i in range(hic_data.section_pos[crm][0],
-                            hic_data.section_pos[crm][1] - dist):
-                if i in bads:
-                    continue
-                diag.append(hic_data[i, i + dist])
-    else:
-        for i in range(size - dist):
-            if i in bads:
-                continue
-            diag.append(hic_data[i, i + dist])
-    sum_diag = sum(diag)
-    if not diag:
-        return dist + 1, 0.
-    if sum_diag > min_n:
-        return dist + 1, float(sum_diag) / len(diag)
-    if dist >= size:
-        return dist + 1, float(sum_diag) / len(diag)
-    return _meandiag(hic_data, dist + 1, diag, min_n, size, bads)
@@ -3,9 +3,11 @@
 """
 
 from bisect    import bisect_left
+from collections.abc import Mapping
 from itertools import combinations
 from warnings  import warn
 import numpy as np
+from scipy import sparse
 
 def mad(arr):
     """ Median Absolute Deviation: a "Robust" version of standard deviation.
@@ -172,6 +174,60 @@ def zscore(values):
         values[i] = (values[i] - mean_v) / std_v
 
 
+def zscore_array(values):
+    """
+    Calculates the log10, Z-score of an array of values (as :func:`zscore`,
+    but on all values at once).
+
+    :param values: array of values
+
+    :returns: a new array with the z-scores
+    """
+    values = transform(np.asarray(values, dtype=float))
+    return (values - np.mean(values)) / np.std(values)
+
+
+class ZscoreDict(Mapping):
+    """
+    Read-only nested dictionary of z-scores, zscores[str(i)][str(j)] being the
+    value between bins i and j (with i < j). Values are kept in arrays, and
+    each row is converted to a dictionary only when accessed. Pickled (or
+    copied) as a plain dictionary.
+
+    :param rows: array of first bins, sorted
+    :param cols: array of second bins, sorted within each row
+    :param values: array of values
+    """
+    def __init__(self, rows, cols, values):
+        self._cols   = np.asarray(cols)
+        self._values = np.asarray(values)
+        rows, starts = np.unique(np.asarray(rows, dtype=np.int64),
+                                 return_index=True)
+        ends = np.append(starts[1:], len(self._cols)).tolist()
+        self._index = dict((str(r), (b, e)) for r, b, e in
+                           zip(rows.tolist(), starts.tolist(), ends))
+        self._rows = {}
+
+    def __getitem__(self, key):
+        try:
+            return self._rows[key]
+        except KeyError:
+            beg, end = self._index[key]
+        row = dict(zip([str(c) for c in self._cols[beg:end].tolist()],
+                       self._values[beg:end].tolist()))
+        self._rows[key] = row
+        return row
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __reduce__(self):
+        return dict, (dict((k, self[k]) for k in self),)
+
+
 def calinski_harabasz(scores, clusters):
     """
     Implementation of the CH score [CalinskiHarabasz1974]_, that has shown to be
@@ -218,6 +274,146 @@ def calinski_harabasz(scores, clusters):
             (within_cluster / (nmodels - len(cluster_list))))
 
 
+def markov_clustering(matrix, inflation=2.0, expansion=2, prune=1e-5,
+                      max_iter=100, tol=1e-9):
+    """
+    Markov clustering (MCL) [Enright2002]_ of a weighted graph, computed on a
+    sparse matrix.
+
+    As in the MCL program, loops are added to each node, with the weight of
+    its strongest edge, before starting the alternation of expansion and
+    inflation steps.
+
+    :param matrix: square symmetric matrix of edge weights (scipy sparse
+       matrix or numpy array)
+    :param 2.0 inflation: inflation parameter, controls the granularity of
+       the clustering (the higher the more clusters)
+    :param 2 expansion: expansion parameter (power of the matrix)
+    :param 1e-5 prune: values below this fraction of the largest value of
+       their column are removed after each inflation step, in order to keep
+       the matrix sparse
+    :param 100 max_iter: maximum number of iterations
+    :param 1e-9 tol: stops when the change between two iterations is below
+       this value
+
+    :returns: a list of clusters (lists of node indices), sorted by size (the
+       larger first)
+    """
+    mtx = sparse.csc_matrix(matrix, dtype=float)
+    size = mtx.shape[0]
+    if not size:
+        return []
+    # add loops
+    loops = mtx.max(axis=0).toarray().ravel()
+    loops[loops == 0] = 1
+    mtx = (mtx + sparse.diags(loops)).tocsc()
+    mtx = _mcl_normalize(mtx)
+    for _ in range(max_iter):
+        prev = mtx
+        for _ in range(expansion - 1):
+            mtx = mtx.dot(prev)
+        mtx = mtx.power(inflation)
+        # prune each column relative to its own maximum
+        colmax = mtx.max(axis=0).toarray().ravel()
+        cols = np.repeat(np.arange(size), np.diff(mtx.indptr))
+        mtx.data[mtx.data < prune * colmax[cols]] = 0
+        mtx.eliminate_zeros()
+        mtx = _mcl_normalize(mtx)
+        if abs(mtx - prev).max() < tol:
+            break
+    # attractors are the nodes with some flow left in their row
+    mtx = mtx.tocsr()
+    clusters = []
+    seen = np.zeros(size, dtype=bool)
+    for row in np.unique(mtx.nonzero()[0]):
+        members = mtx.indices[mtx.indptr[row]:mtx.indptr[row + 1]]
+        members = sorted(m for m in members if not seen[m])
+        if members:
+            seen[members] = True
+            clusters.append(members)
+    # nodes that ended up with no flow are singletons
+    clusters.extend([i] for i in np.where(~seen)[0])
+    clusters.sort(key=lambda x: (-len(x), x[0]))
+    return [[int(m) for m in cl] for cl in clusters]
+
+
+def _mcl_normalize(mtx):
+    """
+    Normalizes columns of a sparse matrix to sum 1
+    """
+    sums = np.asarray(mtx.sum(axis=0)).ravel()
+    sums[sums == 0] = 1
+    return (mtx.dot(sparse.diags(1. / sums))).tocsc()
+
+
+def ward_calinski_harabasz(clust, scores):
+    """
+    Computes the Calinski-Harabasz score (as in :func:`calinski_harabasz`) of
+    each cut of a hierarchical clustering. The sums of squares between and
+    within clusters are updated at each merge, instead of being computed from
+    scratch for each cut.
+
+    :param clust: linkage matrix, as returned by
+       :func:`scipy.cluster.hierarchy.linkage`
+    :param scores: square numpy array with the distance between each pair of
+       elements
+
+    :returns: a numpy array with the CH score after each merge (the scores of
+       merges with the same height are equal to the score of the last of
+       these merges, as in a cut at this height)
+    """
+    nelts = len(scores)
+    # sums of square distances between (and within) clusters of elements,
+    # rows and columns are recycled when clusters are merged
+    sqsums = np.array(scores, dtype=float)**2
+    np.fill_diagonal(sqsums, 0)
+    within = np.zeros(nelts)
+    sizes = np.ones(nelts, dtype=int)
+    active = np.ones(nelts, dtype=bool)
+    position = list(range(nelts))  # cluster id to row in sqsums
+    # sums over the clusters with more than one element
+    between_sum = 0.
+    within_sum = 0.
+    nclust = 0
+    nmodels = 0
+    ch_scores = np.zeros(len(clust))
+    for step, (id1, id2) in enumerate(clust[:, :2].astype(int)):
+        pos1 = position[id1]
+        pos2 = position[id2]
+        big = active & (sizes > 1)
+        for pos in (pos1, pos2):
+            if sizes[pos] > 1:
+                big[pos] = False
+                between_sum -= (sqsums[pos, big] / (sizes[big] * sizes[pos])).sum()
+                within_sum -= within[pos] / (sizes[pos] * (sizes[pos] - 1) / 2.)
+                nclust -= 1
+                nmodels -= sizes[pos]
+        big[pos1] = big[pos2] = False
+        # merge second cluster into the first one
+        within[pos1] += within[pos2] + sqsums[pos1, pos2]
+        sizes[pos1] += sizes[pos2]
+        sqsums[pos1] += sqsums[pos2]
+        sqsums[:, pos1] += sqsums[:, pos2]
+        sqsums[pos1, pos1] = 0
+        active[pos2] = False
+        position.append(pos1)
+        between_sum += (sqsums[pos1, big] / (sizes[big] * sizes[pos1])).sum()
+        within_sum += within[pos1] / (sizes[pos1] * (sizes[pos1] - 1) / 2.)
+        nclust += 1
+        nmodels += sizes[pos1]
+        if nclust <= 1:
+            continue
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ch_scores[step] = ((between_sum / ((nclust - 1.0) / 2))
+                               / (nclust - 1)
+                               / (within_sum / (nmodels - nclust)))
+    # cuts at a given height include all merges at this height
+    for step in range(len(clust) - 2, -1, -1):
+        if clust[step, 2] == clust[step + 1, 2]:
+            ch_scores[step] = ch_scores[step + 1]
+    return ch_scores
+
+
 def mean_none(values):
     """
     Calculates the mean of a list of values without taking into account the None
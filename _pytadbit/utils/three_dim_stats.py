@@ -9,10 +9,10 @@ import sys
 from warnings  import catch_warnings, simplefilter
 from itertools import combinations
 from math      import pi, sqrt, cos, sin, acos
-from copy      import deepcopy
+from multiprocessing.pool import ThreadPool
+import multiprocessing as mu
 
 import numpy as np
-from numpy.random import shuffle as np_shuffle
 from scipy.stats  import skew, kurtosis, norm as sc_norm
 from matplotlib import pyplot as plt
 import matplotlib.gridspec as gridspec
@@ -294,7 +294,7 @@ def angle_between_3_points(point1, point2, point3):
     return g
 
 
-def calc_consistency(models, nloci, zeros, dcutoff=200):
+def calc_consistency(models, nloci, zeros, dcutoff=200, n_cpus=1):
     combines = list(combinations(models, 2))
     parts = [0 for _ in range(nloci)]
     for pm in consistency_wrapper([model['x'] for model in models],
@@ -302,14 +302,98 @@ def calc_consistency(models, nloci, zeros, dcutoff=200):
                                   [model['z'] for model in models],
                                   zeros,
                                   nloci, dcutoff, list(range(len(models))),
-                                  len(models)):
+                                  len(models), n_cpus):
         for i, p in enumerate(pm):
             parts[i] += p
     return [float(p)/len(combines) * 100 for p in parts]
 
 
+def models_to_array(models, nloci):
+    """
+    Stacks the coordinates of a list of models into a single array.
+
+    :param models: list of models (dictionaries with 'x', 'y' and 'z' keys)
+    :param nloci: number of particles in each model
+
+    :returns: numpy array of shape (number of models, nloci, 3)
+    """
+    return np.array([np.column_stack((model['x'][:nloci],
+                                      model['y'][:nloci],
+                                      model['z'][:nloci]))
+                     for model in models], dtype=float)
+
+
+def calc_contact_matrices(models, nloci, cutoffs, loci=None, n_cpus=1,
+                          block_size=2**22):
+    """
+    Computes, for several distance cutoffs at once, the fraction of models in
+    which each pair of particles is found below the cutoff distance.
+
+    Squared distances are computed by blocks of models and of rows (NumPy
+    broadcasting) and directly accumulated into the contact counts, so that
+    the full distance matrices of all models are never held in memory.
+
+    :param models: list of models (dictionaries with 'x', 'y' and 'z' keys) or
+       numpy array of coordinates as returned by :func:`models_to_array`
+    :param nloci: number of particles
+    :param cutoffs: list of squared distance cutoffs
+    :param None loci: list of particles to consider, interactions with other
+       particles are set to zero (default: all particles)
+    :param 1 n_cpus: number of threads to use (blocks of rows are distributed
+       among threads, NumPy releasing the GIL during computation)
+    :param 2**22 block_size: maximum number of pairwise distances computed at
+       once
+
+    :returns: a dictionary with squared cutoffs as keys and, as values, numpy
+       arrays of shape (nloci, nloci) with the frequency of contacts
+    """
+    if isinstance(models, np.ndarray):
+        coords = models
+    else:
+        coords = models_to_array(models, nloci)
+    if loci is None:
+        loci = list(range(nloci))
+    loci = np.asarray(loci, dtype=int)
+    cutoffs = list(cutoffs)
+    nmodels = len(coords)
+    coords = coords[:, loci]
+    nwloci = len(loci)
+    counts = dict((c, np.zeros((nwloci, nwloci), dtype=np.int64))
+                  for c in cutoffs)
+    if nmodels and nwloci:
+        mchunk = max(1, block_size // (nwloci * nwloci))
+        rchunk = max(1, block_size // (min(mchunk, nmodels) * nwloci))
+
+        def _count_rows(beg):
+            end = min(beg + rchunk, nwloci)
+            for mbeg in range(0, nmodels, mchunk):
+                sub = coords[mbeg:mbeg + mchunk]
+                diff = sub[:, beg:end, None, :] - sub[:, None, :, :]
+                sqd = (diff * diff).sum(axis=-1)
+                for c in cutoffs:
+                    counts[c][beg:end] += (sqd <= c).sum(axis=0)
+
+        blocks = list(range(0, nwloci, rchunk))
+        if n_cpus > 1 and len(blocks) > 1:
+            pool = ThreadPool(min(n_cpus, len(blocks)))
+            pool.map(_count_rows, blocks)
+            pool.close()
+            pool.join()
+        else:
+            for beg in blocks:
+                _count_rows(beg)
+    matrices = {}
+    for c in cutoffs:
+        np.fill_diagonal(counts[c], 0)
+        matrix = np.zeros((nloci, nloci))
+        if nmodels:
+            matrix[np.ix_(loci, loci)] = counts[c] / float(nmodels)
+        matrices[c] = matrix
+    return matrices
+
+
 def calc_eqv_rmsd(models, beg, end, zeros, dcutoff=200, one=False, what='score',
-                  normed=True):
+                  normed=True, n_cpus=1):
     """
     Calculates the RMSD, dRMSD, the number of equivalent positions and a score
     combining these three measures. The measure are done between a group of
@@ -327,6 +411,8 @@ def calc_eqv_rmsd(models, beg, end, zeros, dcutoff=200, one=False, what='score',
        'drmsd' or 'eqv'
     :param True normed: normalize result by maximum value (only applies to rmsd
        and drmsd)
+    :param 1 n_cpus: number of threads among which to distribute the pairwise
+       comparisons (results do not depend on this number)
 
     :returns: a score of each pairwise comparison according to:
 
@@ -354,7 +440,7 @@ def calc_eqv_rmsd(models, beg, end, zeros, dcutoff=200, one=False, what='score',
     zeros = tuple([True for _ in range(len(x[0]))])
     scores = rmsdRMSD_wrapper(x, y, z, zeros, len(zeros),
                               dcutoff, list(range(len(models))), len(models),
-                              int(one), what, int(normed))
+                              int(one), what, int(normed), n_cpus)
     return scores
 
 
@@ -388,6 +474,15 @@ def getAngle(v1v2, v2v3):
 def build_mesh(xis, yis, zis, nloci, nump, radius, superradius, include_edges):
     """
     Main function for the calculation of the accessibility of a model.
+
+    The sphere of dots (and the circles of dots around edges) is computed once
+    and translated to each particle (or point along edges), dots too close to
+    the neighbor edges being removed in batch.
+
+    :returns: the coordinates of the particles (and of the points along edges),
+       the coordinates of the dots in the mesh, the same for the super mesh (as
+       numpy arrays of shape (N, 3)) and a dictionary with, for each particle
+       (or point along edges), the list of indexes of its dots
     """
     superradius = superradius or 1
     # number of dots in a circle is dependent the ones in a sphere
@@ -405,23 +500,13 @@ def build_mesh(xis, yis, zis, nloci, nump, radius, superradius, include_edges):
     subpoints = [] # store the coordinates of each dot in the mesh
     supersubpoints = [] # store the coordinates of each dot in the mesh
     positions = {} # a dict to get dots belonging to a given point
-    sphere    = generate_sphere_points(nump)
+    nsub      = 0  # number of dots in the mesh
+    sphere    = np.array(generate_sphere_points(nump)).reshape(-1, 3)
+    coords    = np.array([xis[:nloci], yis[:nloci], zis[:nloci]], dtype=float).T
     i = 0
     for i in range(nloci - 1):
-        modelx   = xis[i]
-        modely   = yis[i]
-        modelz   = zis[i]
-        modelx1  = xis[i+1]
-        modely1  = yis[i+1]
-        modelz1  = zis[i+1]
-        if i < nloci - 2:
-            modelx2  = xis[i+2]
-            modely2  = yis[i+2]
-            modelz2  = zis[i+2]
-        if i:
-            modelx_1 = xis[i-1]
-            modely_1 = yis[i-1]
-            modelz_1 = zis[i-1]
+        modelx, modely, modelz = xis[i], yis[i], zis[i]
+        modelx1, modely1, modelz1 = xis[i+1], yis[i+1], zis[i+1]
         point = [modelx, modely, modelz]
         points.append(point)
         # get minimum length from next particle to display the sphere dot
@@ -435,26 +520,17 @@ def build_mesh(xis, yis, zis, nloci, nump, radius, superradius, include_edges):
             orthox = 1.
             orthoy = 1.
             orthoz = -(difx + dify) / difz
-            #normer = sqrt(orthox**2 + orthoy**2 + orthoz**2) / radius
-            normer = sqrt(2. + orthoz**2)# / radius
+            normer = sqrt(2. + orthoz**2)
         except ZeroDivisionError:
             try:
                 orthox = 1.
                 orthoy = -(difx + difz) / dify
                 orthoz = 1.
-                #normer = sqrt(orthox**2 + orthoy**2 + orthoz**2) / radius
-                normer = sqrt(2. + orthoz**2)# / radius
+                normer = sqrt(2. + orthoz**2)
             except ZeroDivisionError:
-                try:
-                    orthox = 1.
-                    orthoy = -(difx + difz) / dify
-                    orthoz = 1.
-                    #normer = sqrt(orthox**2 + orthoy**2 + orthoz**2) / radius
-                    normer = sqrt(2. + orthoz**2)# / radius
-                except ZeroDivisionError:
-                    orthox = 1.
-                    orthoy = 1.
-                    orthoz = 1.
+                orthox = 1.
+                orthoy = 1.
+                orthoz = 1.
         orthox /= normer
         orthoy /= normer
         orthoz /= normer
@@ -472,117 +548,136 @@ def build_mesh(xis, yis, zis, nloci, nump, radius, superradius, include_edges):
         # uses intercept theorem
         hyp1 = (hyp1 - hyp1 / (2 * (1 + between)))**2
 
+        # set sphere around each particle, only place mesh outside torsion
+        # angle
+        things = sphere * radius + coords[i]
+        keep = _square_distances(things, coords[i + 1]) > hyp1
         # get minimum length from prev particle to display the sphere dot
         if i:
-            adj2 = distance(point, [modelx_1, modely_1, modelz_1])
+            adj2 = distance(point, coords[i - 1])
             hyp2 = sqrt(adj2**2 + radius**2)
             # this is an attempt of correction for the integrity of dots
             hyp2 = (hyp2 - hyp2 / (2 * (1 + between)))**2
-
-        # set sphere around each particle
-        for xxx, yyy, zzz in sphere:
-            thing = [xxx * radius + modelx,
-                     yyy * radius + modely,
-                     zzz * radius + modelz]
-            # same for super mesh
-            superthing = [xxx * superradius + modelx,
-                          yyy * superradius + modely,
-                          zzz * superradius + modelz]
-            # only place mesh outside torsion angle
-            if fast_square_distance(modelx1, modely1, modelz1,
-                                    thing[0], thing[1], thing[2]) > hyp1:
-                if not i:
-                    subpoints.append(thing)
-                    supersubpoints.append(superthing)
-                elif fast_square_distance(modelx_1, modely_1, modelz_1,
-                                          thing[0], thing[1], thing[2]) > hyp2:
-                    subpoints.append(thing)
-                    supersubpoints.append(superthing)
-                else:
-                    continue
-                positions.setdefault(i, []).append(len(subpoints)-1)
-
-        def _add_circle(k, ptx, pty, ptz):
-            for spoint in generate_circle_points(
-                orthox, orthoy, orthoz, difx ,dify, difz,
-                # correction for integer of numc
-                numc + (1 if c_count%100 < remaining else 0)):
-                dot = [spoint[0] * radius + ptx,
-                       spoint[1] * radius + pty,
-                       spoint[2] * radius + ptz]
-                superdot = [spoint[0] * superradius + ptx,
-                            spoint[1] * superradius + pty,
-                            spoint[2] * superradius + ptz]
-                # check that dot in circle is not too close from next edge
-                if i < nloci - 2:
-                    hyp = distance((modelx1, modely1, modelz1), dot)
-                    ang = angle_between_3_points(dot,
-                                                 (modelx1, modely1, modelz1),
-                                                 (modelx2, modely2, modelz2))
-                    if ang < right_angle:
-                        if sin(ang) * hyp < radius:
-                            continue
-                # check that dot in circle is not too close from previous edge
-                if i:
-                    hyp = distance((modelx, modely, modelz), dot)
-                    ang = angle_between_3_points(dot,
-                                                 (modelx, modely, modelz),
-                                                 (modelx_1, modely_1, modelz_1))
-                    if ang < right_angle:
-                        if sin(ang) * hyp < radius:
-                            continue
-                # print 'here'
-                subpoints.append([dot[0], dot[1], dot[2]])
-                supersubpoints.append([superdot[0], superdot[1], superdot[2]])
-                positions.setdefault(i + float(k)/between, []).append(
-                    len(subpoints) - 1)
+            keep &= _square_distances(things, coords[i - 1]) > hyp2
+        nkeep = int(keep.sum())
+        if nkeep:
+            subpoints.append(things[keep])
+            supersubpoints.append(sphere[keep] * superradius + coords[i])
+            positions[i] = list(range(nsub, nsub + nkeep))
+            nsub += nkeep
 
         # define slices
-        for k in range(between - 1, 0, -1):
-            point = [modelx - k * stepx, modely - k * stepy, modelz - k * stepz]
-            points.append(point)
-            pointx, pointy, pointz = point
-
-            if not include_edges:
-                continue
-            # define circles
-            _add_circle(k, pointx, pointy, pointz)
+        slices = [(k, [modelx - k * stepx, modely - k * stepy, modelz - k * stepz])
+                  for k in range(between - 1, 0, -1)]
+        points.extend(point for _, point in slices)
+        if not include_edges or not slices:
+            continue
+        # define circles (the correction for integer of numc gives two
+        # possible numbers of dots per circle)
+        circles = {}
+        ks      = []
+        centers = []
+        templates = []
+        for k, point in slices:
+            numd = numc + (1 if c_count%100 < remaining else 0)
+            if not numd in circles:
+                circles[numd] = np.array(generate_circle_points(
+                    orthox, orthoy, orthoz, difx ,dify, difz, numd)).reshape(-1, 3)
+            templates.append(circles[numd])
+            centers.append(np.repeat([point], len(circles[numd]), axis=0))
+            ks.extend([k] * len(circles[numd]))
             c_count += 1
+        spoints = np.concatenate(templates)
+        centers = np.concatenate(centers)
+        dots    = spoints * radius + centers
+        keep = np.ones(len(dots), dtype=bool)
+        # check that dot in circle is not too close from next edge
+        if i < nloci - 2:
+            keep &= ~_close_to_edge(dots, coords[i + 1], coords[i + 2],
+                                    right_angle, radius)
+        # check that dot in circle is not too close from previous edge
+        if i:
+            keep &= ~_close_to_edge(dots, coords[i], coords[i - 1],
+                                    right_angle, radius)
+        nkeep = int(keep.sum())
+        if not nkeep:
+            continue
+        subpoints.append(dots[keep])
+        supersubpoints.append(spoints[keep] * superradius + centers[keep])
+        for n, k in enumerate(np.array(ks)[keep], nsub):
+            positions.setdefault(i + float(k)/between, []).append(n)
+        nsub += nkeep
 
     # add last point!!
     point = [xis[i+1], yis[i+1], zis[i+1]]
     points.append(point)
     # and its sphere
-    adj = distance(point, [modelx, modely, modelz])
+    adj = distance(point, coords[i])
     hyp2 = sqrt(adj**2 + radius**2)
     hyp2 = (hyp2 - hyp2 / (2 * (1 + between)))**2
-    for xxx, yyy, zzz in sphere:
-        thing = [xxx * radius + modelx1,
-                 yyy * radius + modely1,
-                 zzz * radius + modelz1]
-        superthing = [xxx * superradius + modelx1,
-                      yyy * superradius + modely1,
-                      zzz * superradius + modelz1]
-        if fast_square_distance(modelx, modely, modelz,
-                                thing[0], thing[1], thing[2]) > hyp2:
-            subpoints.append(thing)
-            supersubpoints.append(superthing)
-        positions.setdefault(i+1, []).append(len(subpoints)-1)
-
-    return points, subpoints, supersubpoints, positions
-
-
-def randomize_matrix(data, savefig=None):
+    things = sphere * radius + coords[i + 1]
+    keep = _square_distances(things, coords[i]) > hyp2
+    subpoints.append(things[keep])
+    supersubpoints.append(sphere[keep] * superradius + coords[i + 1])
+    positions[i+1] = (np.cumsum(keep) + (nsub - 1)).tolist()
+
+    return (np.array(points, dtype=float),
+            np.concatenate(subpoints), np.concatenate(supersubpoints),
+            positions)
+
+
+def _square_distances(dots, point):
+    """
+    Square distances between an array of coordinates and a point.
+    """
+    diff = dots - point
+    return (diff[:, 0]**2 + diff[:, 1]**2) + diff[:, 2]**2
+
+
+def _close_to_edge(dots, point1, point2, right_angle, radius):
+    """
+    Checks, for an array of dots, which ones are closer than radius from the
+    edge starting in point1 and going to point2 (see
+    :func:`angle_between_3_points`).
+    """
+    a = sqrt(_square_distances(point1[None], point2)[0])
+    hyp = np.sqrt(_square_distances(dots, point1))
+    b = np.sqrt(_square_distances(dots, point2))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ang = (a**2 - b**2 + hyp**2) / (2 * a * hyp)
+        ang = np.where(abs(ang) > 1, 0., np.arccos(ang))
+        return (ang < right_angle) & (np.sin(ang) * hyp < radius)
+
+
+def randomize_matrix(data, savefig=None, rng=None):
+    """
+    Shuffles the values inside each diagonal of a symmetric matrix.
+
+    All the diagonals are shuffled at once: cells of the upper triangle are
+    listed by diagonal and, inside each diagonal, by row (original positions)
+    or by a random key (new positions).
+
+    :param data: square symmetric matrix (list of lists or numpy array)
+    :param None savefig: path where to save a figure comparing the original
+       and the randomized matrices
+    :param None rng: numpy random Generator used to shuffle the diagonals (by
+       default, numpy global random state)
+
+    :returns: the randomized matrix as a numpy array
+    """
+    data = np.asarray(data, dtype=float)
     size = len(data)
-    rand_data = deepcopy(data)
-    for d in range(size):
-        diag = list(zip(*[list(range(d, size)), list(range(size - d))]))
-        rdiag = diag[:]
-        np_shuffle(rdiag)
-        for v in range(len(diag)):
-            val = data[diag[v][0]][diag[v][1]]
-            a, b = rdiag[v][0], rdiag[v][1]
-            rand_data[b][a] = rand_data[a][b] = val
+    diags = np.repeat(np.arange(size), np.arange(size, 0, -1))
+    starts = np.concatenate(([0], np.cumsum(np.arange(size, 1, -1))))
+    rows = np.arange(len(diags)) - starts[diags]
+    cols = rows + diags
+    # random keys are lower than 0.5 so that cells do not change of diagonal
+    keys = (np.random.random_sample if rng is None else rng.random)(len(rows))
+    dst = np.argsort(diags + keys / 2)
+    vals = data[cols, rows]
+    rand_data = np.empty_like(data)
+    rand_data[rows[dst], cols[dst]] = vals
+    rand_data[cols[dst], rows[dst]] = vals
     if savefig:
         plt.subplot(211)
         plt.imshow(np.log2(data), interpolation='none')
@@ -593,54 +688,72 @@ def randomize_matrix(data, savefig=None):
     return rand_data
 
 
-def mmp_score(matrix, nrand=10, verbose=False, savefig=None):
+def _randomized_eigenvalues(args):
+    """
+    Absolute eigenvalues (in decreasing order) of randomized matrices, one per
+    seed.
+    """
+    data, seeds = args
+    return [np.sort(np.abs(np.linalg.eigvalsh(randomize_matrix(
+        data, rng=np.random.default_rng(seed)))))[::-1] for seed in seeds]
+
+
+def mmp_score(matrix, nrand=10, verbose=False, savefig=None, n_cpus=1,
+              seed=None):
     """
     :param matrix: list of lists
     :param 10 nrand: number of randomizations
     :param None savefig: path where to save figure
+    :param 1 n_cpus: number of processes used for the randomizations
+    :param None seed: seed used to generate the random seeds of each
+       randomization (by default taken from numpy global random state). Results
+       do not depend on the number of CPUs used.
 
     :returns: 1- MMP score which ranges from 0 (bad) to 1 (good), and 2- the
        expected correlation of the contact matrices of the modeled chromatin
        with the original Hi-C data (plus the 3- lower and 4- upper values
        expected in 95% of the cases)
     """
-    data = np.array([np.array([v for v in l]) for l in matrix])
+    data = np.array(matrix, dtype=float)
 
     if verbose:
-        sys.stdout.write('  - getting EigenVectors\n')
-    egval, _ = np.linalg.eigh(data)
-    # sort eigenvalues/vectors
-    idx = (-egval).argsort()
-    egval = egval[idx]
-
-    regvals = []
+        sys.stdout.write('  - getting EigenValues\n')
+    egval = np.linalg.eigvalsh(data)
 
     if verbose:
         sys.stdout.write('  - randomization\n')
-    for i in range(int(nrand)):
+    if seed is None:
+        seed = np.random.randint(2**31)
+    seeds = np.random.SeedSequence(seed).spawn(int(nrand))
+    nchunks = min(len(seeds), max(1, n_cpus) * 4)
+    chunks = [(data, list(chunk)) for chunk in
+              np.array_split(np.array(seeds, dtype=object), nchunks)]
+    if n_cpus > 1 and nchunks > 1:
+        pool = mu.Pool(min(n_cpus, nchunks))
+        results = pool.imap(_randomized_eigenvalues, chunks)
+    else:
+        pool = None
+        results = map(_randomized_eigenvalues, chunks)
+    regvals = []
+    for result in results:
+        regvals.extend(result)
         if verbose:
-            sys.stdout.write('\r    ' + str(i + 1) + ' / ' + str(nrand))
+            sys.stdout.write('\r    ' + str(len(regvals)) + ' / ' + str(nrand))
             sys.stdout.flush()
-        regval, _ = np.linalg.eigh(randomize_matrix(data))
-        regval = [abs(j) for j in regval]
-        regval.sort(reverse=True)
-        regvals.append( regval)
+    if pool:
+        pool.close()
+        pool.join()
     if verbose:
         sys.stdout.write('\n')
-    regvals = list(zip(*regvals))
-    rvmean = []
-    for rv in regvals:
-        rvmean.append(np.mean(rv))
+    regvals = np.array(regvals)
+    rvmean = regvals.mean(axis=0)
     total = sum(rvmean)/100
-    rvmean = [i/total for i in rvmean]
+    rvmean = (rvmean / total).tolist()
 
-    err = []
-    for rv in regvals:
-        rvstd = np.std(rv/total)
-        err.append(2 * rvstd)
+    err = (2 * np.std(regvals / total, axis=0)).tolist()
 
-    zdata = sorted(np.log2([data[i][j] for i in range(len(data))
-                            for j in range(i, len(data)) if data[i][j]]))
+    zdata = data[np.triu_indices(len(data))]
+    zdata = np.sort(np.log2(zdata[zdata != 0]))
     skewness = skew(zdata)
     kurtness = kurtosis(zdata)
 
@@ -732,10 +845,6 @@ def mmp_score(matrix, nrand=10, verbose=False, savefig=None):
         #img = Image.open(opts.outdir + '/matrix_small.png')
         #fig.figimage(img, 640, -160)
 
-    minv = float(min([i for d in data for i in d if i])) / 2
-    if minv == 0.5:
-        minv = 1./(len(data)**2)
-
     mmp = -0.0002 * size + 0.0335 * skewness - 0.0229 * kurtness + 0.0069 * sev + 0.8126
 
     if verbose:
@@ -33,9 +33,12 @@ Marie Trussart, Francois Serra, Davide Bau, Ivan Junier, Luis Serrano and Marc A
 """
 
 from argparse     import ArgumentParser
-from numpy        import linalg, array, copy, log2, std, mean
-from numpy.random import shuffle as np_shuffle
+from numpy        import linalg, array, log2, std, mean, empty_like
+from numpy        import arange, repeat, concatenate, cumsum, argsort
+from numpy        import sort, triu_indices
+from numpy.random import SeedSequence, default_rng
 from scipy.stats  import skew, kurtosis, norm as sc_norm
+from multiprocessing import Pool
 import sys, os
 
 try:
@@ -48,17 +51,23 @@ except ImportError:
     sys.stderr.write('WARNING: Matplotlib not installed trying to plot ' +
              'something will raise uggly errors\n')
 
-def randomize_matrix(data, savefig=None):
+def randomize_matrix(data, savefig=None, rng=None):
+    """
+    Shuffles the values inside each diagonal of the matrix (all diagonals at
+    once, cells being sorted by diagonal and by a random key)
+    """
     size = len(data)
-    rand_data = copy(data)
-    for d in range(size):
-        diag = list(zip(*[range(d, size), range(size - d)]))
-        rdiag = diag[:]
-        np_shuffle(rdiag)
-        for v in range(len(diag)):
-            val = data[diag[v][0]][diag[v][1]]
-            a, b = rdiag[v][0], rdiag[v][1]
-            rand_data[b][a] = rand_data[a][b] = val
+    diags = repeat(arange(size), arange(size, 0, -1))
+    starts = concatenate(([0], cumsum(arange(size, 1, -1))))
+    rows = arange(len(diags)) - starts[diags]
+    cols = rows + diags
+    rng = rng or default_rng()
+    # random keys are lower than 0.5 so that cells do not change of diagonal
+    dst = argsort(diags + rng.random(len(rows)) / 2)
+    vals = data[cols, rows]
+    rand_data = empty_like(data)
+    rand_data[rows[dst], cols[dst]] = vals
+    rand_data[cols[dst], rows[dst]] = vals
     if savefig:
         plt.subplot(211)
         plt.imshow(log2(data), interpolation='none')
@@ -68,6 +77,15 @@ def randomize_matrix(data, savefig=None):
         plt.close('all')
     return rand_data
 
+def randomized_eigenvalues(args):
+    """
+    absolute eigenvalues (decreasing order) of randomized matrices, one per
+    seed
+    """
+    data, seeds = args
+    return [sort(abs(linalg.eigvalsh(randomize_matrix(
+        data, rng=default_rng(seed)))))[::-1] for seed in seeds]
+
 def read_pw_file(fnam):
     vals = {}
     mv = 0
@@ -110,22 +128,26 @@ def main():
         data = array([array([i for i in d[opts.start-1:opts.end]])
                       for d in data[opts.start-1:opts.end]])
 
-    sys.stdout.write('  - getting EigenVectors\n')
-    egval, _ = linalg.eigh(data)
-    # sort eigenvalues/vectors
-    idx = (-egval).argsort()
-    egval = egval[idx]
+    sys.stdout.write('  - getting EigenValues\n')
+    egval = linalg.eigvalsh(data)
 
     regvals = []
 
     sys.stdout.write('  - randomization\n')
-    for i in range(int(opts.nrand)):
-        sys.stdout.write('\r    ' + str(i + 1) + ' / ' + str(opts.nrand))
+    # one independent seed per randomization, results do not depend on the
+    # number of CPUs
+    seeds = SeedSequence(opts.seed).spawn(int(opts.nrand))
+    nchunks = min(len(seeds), opts.cpus * 4)
+    chunks = [(data, seeds[i * len(seeds) // nchunks:
+                           (i + 1) * len(seeds) // nchunks])
+              for i in range(nchunks)]
+    pool = Pool(opts.cpus)
+    for result in pool.imap(randomized_eigenvalues, chunks):
+        regvals.extend(result)
+        sys.stdout.write('\r    ' + str(len(regvals)) + ' / ' + str(opts.nrand))
         sys.stdout.flush()
-        regval, _ = linalg.eigh(randomize_matrix(data))
-        regval = [abs(j) for j in regval]
-        regval.sort(reverse=True)
-        regvals.append( regval)
+    pool.close()
+    pool.join()
     sys.stdout.write('\n')
     regvals = list(zip(*regvals))
     rvmean = []
@@ -139,8 +161,8 @@ def main():
         rvstd = std(rv/total)
         err.append(2 * rvstd)
 
-    zdata = sorted(log2([data[i][j] for i in range(len(data))
-                         for j in range(i, len(data)) if data[i][j]]))
+    zdata = data[triu_indices(len(data))]
+    zdata = sort(log2(zdata[zdata != 0]))
     skewness = skew(zdata)
     kurtness = kurtosis(zdata)
 
@@ -329,6 +351,14 @@ def get_options():
     parser.add_argument('--nrand', dest='nrand',
                         default=10,metavar='INT',
                         help='''[%(default)s] number of randomizations''')
+    parser.add_argument('--cpus', dest='cpus', default=1, type=int,
+                        metavar='INT',
+                        help='''[%(default)s] number of CPUs used for the
+                        randomizations''')
+    parser.add_argument('--seed', dest='seed', default=None, type=int,
+                        metavar='INT',
+                        help='''random seed (for reproducible
+                        randomizations)''')
 
     opts = parser.parse_args()
     return opts
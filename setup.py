@@ -6,7 +6,6 @@ from os import path, system
 from io import open
 from re import sub
 from subprocess import Popen, PIPE
-from distutils.spawn import find_executable
 import sys
 # import os
 # os.environ["CC"] = "g++"
@@ -76,15 +75,6 @@ class InstallCommand(install):
         if missing:
             exit("Essential dependencies missing, please review and install.\n")
 
-        # check if MCL is installed
-        if not self.bypasscheck and not find_executable('mcl'):
-            print('\nWARNING: It is HIGHLY RECOMMENDED to have MCL installed '
-                  '(which do not seems to be).\nIf you are under Debian/Ubuntu'
-                  ' just run "apt-get-install mcl".')
-            follow = input('\n  You still have the option to follow with the '
-                           'installation. Do you want to follow? [y/N]')
-            if follow.upper() != 'Y' :
-                exit('\n    Wise choice :)\n')
         install.run(self)
 
 def can_import(modname):
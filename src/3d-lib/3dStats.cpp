@@ -4,6 +4,7 @@
 #include <math.h>
 #include "align.h"
 #include <cstring>
+#include <pthread.h>
 
 // #include <iostream>
 using namespace std;
@@ -159,3 +160,88 @@ float** populateMap(int size, float** xyz) {
 
 }
 
+
+
+float** copyCoords(float** xyz, int size) {
+  float **cpy;
+
+  cpy = new float*[size];
+  for (int i=0; i<size; i++) {
+    cpy[i] = new float[3];
+    cpy[i][0] = xyz[i][0];
+    cpy[i][1] = xyz[i][1];
+    cpy[i][2] = xyz[i][2];
+  }
+  return cpy;
+}
+
+
+void freeCoords(float** xyz, int size) {
+  for (int i=0; i<size; i++)
+    delete[] xyz[i];
+  delete[] xyz;
+}
+
+
+// Shared state of the threads consuming a queue of independent jobs
+typedef struct {
+  int njobs;
+  int next;
+  void (*func)(int, void*);
+  void *data;
+  pthread_mutex_t lock;
+} job_queue_t;
+
+
+void *consume_jobs(void *arg) {
+  job_queue_t *queue = (job_queue_t *) arg;
+  int k;
+
+  while (1) {
+    pthread_mutex_lock(&queue->lock);
+    k = queue->next++;
+    pthread_mutex_unlock(&queue->lock);
+    if (k >= queue->njobs)
+      break;
+    queue->func(k, queue->data);
+  }
+  return NULL;
+}
+
+
+void runJobs(int njobs, int n_threads, void (*func)(int, void*), void *data) {
+  job_queue_t queue;
+  pthread_t *tid;
+  int i;
+  int started;
+
+  if (n_threads > njobs)
+    n_threads = njobs;
+  if (n_threads < 2) {
+    for (i=0; i<njobs; i++)
+      func(i, data);
+    return;
+  }
+
+  queue.njobs = njobs;
+  queue.next  = 0;
+  queue.func  = func;
+  queue.data  = data;
+  pthread_mutex_init(&queue.lock, NULL);
+
+  tid = new pthread_t[n_threads];
+  started = 0;
+  for (i=0; i<n_threads; i++) {
+    if (pthread_create(&(tid[i]), NULL, &consume_jobs, &queue) != 0)
+      break;
+    started++;
+  }
+  // the calling thread also consumes jobs (and all of them if no thread
+  // could be created)
+  consume_jobs(&queue);
+  for (i=0; i<started; i++)
+    pthread_join(tid[i], NULL);
+
+  pthread_mutex_destroy(&queue.lock);
+  delete[] tid;
+}
@@ -20,6 +20,9 @@ extern void consistency(float** xyzA, float** xyzB, int *zeros, int size, float
 
 extern float findCenrtroid (map<string, float**>::iterator it1, float** avg, int size);
 extern float** populateMap(int size, float** xyz);
+extern float** copyCoords(float** xyz, int size);
+extern void freeCoords(float** xyz, int size);
+extern void runJobs(int njobs, int n_threads, void (*func)(int, void*), void *data);
 
 #endif /* _3DSTATS_H */
 
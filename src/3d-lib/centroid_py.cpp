@@ -1,6 +1,8 @@
 #include "Python.h"
 #include "3dStats.h"
+#include "align.h"
 #include <iostream>
+#include <vector>
 // #include <string>
 // using namespace std;
 // cout << "START" << endl << flush;
@@ -19,11 +21,34 @@ number of equivalent positions, the RMSD and the dRMSD.\n\
    :param nmodels: number of models or list of lists passed as first argument\n\
    :param verbose: prints the distance of each model to average model (in stderr)\n\
    :param getavg: return a list for each x, y, z coordinates, representing the average model\n\
+   :param 1 n_cpus: number of threads among which to distribute the alignments\n\
 \n\
    :returns: the index of the model that is found to be the centroid\n\
 ");
 
 
+// data shared by the threads aligning models onto the reference one
+typedef struct {
+  float **ref;
+  vector<float**> *others;
+  int *zeros;
+  int size;
+} centroid_jobs_t;
+
+
+// aligns one model onto a copy of the reference model (the alignment also
+// modifies the reference coordinates)
+void centroid_job(int k, void *arg)
+{
+  centroid_jobs_t *data = (centroid_jobs_t *) arg;
+  float **ref;
+
+  ref = copyCoords(data->ref, data->size);
+  align((*data->others)[k], ref, data->zeros, data->size);
+  freeCoords(ref, data->size);
+}
+
+
 static PyObject* centroid_wrapper(PyObject* self, PyObject* args)
 {
   PyObject *py_xs;
@@ -34,9 +59,10 @@ static PyObject* centroid_wrapper(PyObject* self, PyObject* args)
   int nmodels;
   int verbose;
   int getavg;
+  int n_cpus = 1;
 
-  if (!PyArg_ParseTuple(args, "OOOOiiii", &py_xs, &py_ys, &py_zs, &py_zeros, &size, 
-			&nmodels, &verbose, &getavg))
+  if (!PyArg_ParseTuple(args, "OOOOiiii|i", &py_xs, &py_ys, &py_zs, &py_zeros, &size, 
+			&nmodels, &verbose, &getavg, &n_cpus))
     return NULL;
  
   float **xyz;
@@ -49,9 +75,9 @@ static PyObject* centroid_wrapper(PyObject* self, PyObject* args)
   map<string, float**>::iterator it2;
   map<float, string>::iterator it3;
   float **avg;
-  bool add_first;
+  vector<float**> others;
+  centroid_jobs_t jobs;
   map<float, string> dist2Centroid;
-  set<string> modelList;
   string modelId;
   ostringstream tmpStr;
 
@@ -89,16 +115,34 @@ static PyObject* centroid_wrapper(PyObject* self, PyObject* args)
     xyzlist.insert(make_pair(modelId, populateMap(size, xyz)));
   }
 
-  numP = 1; 
-  add_first = 1;
+  // align all models onto the first one. The first alignment is done in
+  // place, in order to center the reference model, the others are
+  // distributed among threads
   it1=xyzlist.begin();
-  for ((it2=it1)++; it2!=xyzlist.end(); it2++) {
-    //cout << it1->first << " " << it2->first << endl;
-    // avgCoord(it1->second, it2->second, size, avg);
-    avgCoord(it1, it2, zeros, size, modelList, add_first, avg);
-    add_first = 0;
+  for ((it2=it1)++; it2!=xyzlist.end(); it2++)
+    others.push_back(it2->second);
+  if (!others.empty())
+    align(others[0], it1->second, zeros, size);
+  jobs.ref    = it1->second;
+  jobs.others = &others;
+  jobs.zeros  = zeros;
+  jobs.size   = size;
+  if (others.size() > 1) {
+    // skip first model, already aligned
+    others.erase(others.begin());
+    Py_BEGIN_ALLOW_THREADS
+    runJobs(others.size(), n_cpus, &centroid_job, &jobs);
+    Py_END_ALLOW_THREADS
+  }
+
+  numP = 0;
+  for (it2=xyzlist.begin(); it2!=xyzlist.end(); it2++) {
+    for (int i=0; i < size; i++) {
+      avg[i][0] += it2->second[i][0];
+      avg[i][1] += it2->second[i][1];
+      avg[i][2] += it2->second[i][2];
+    }
     numP++;
-    // cout << "\n";
   }
 
   for (int i = 0; i < size; ++i) {
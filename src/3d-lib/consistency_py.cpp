@@ -18,12 +18,42 @@ number of equivalent positions, the RMSD and the dRMSD.\n\
    :param dcutoff: distance cutoff to consider 2 particles as equivalent \n\
       in position (nm)\n\
    :param nmodels: number of models passed\n\
+   :param 1 n_cpus: number of threads among which to distribute the pairwise \n\
+      comparisons\n\
 \n\
    :returns: a list with the number of equivalent positions, the RMSD and \n\
       the dRMSD, of the alignment. If consistency is True, returns list of \n\
       0 or 1 if a given particle is in equivalent position in both strands.\n\
 ");
 
+// data shared by the threads computing pairwise comparisons
+typedef struct {
+  float ***xyzn;
+  int *zeros;
+  int size;
+  float thres;
+  int *pairs_a;
+  int *pairs_b;
+  int **scores;
+} consistency_jobs_t;
+
+
+// compares one pair of models, working on copies of their coordinates as
+// the alignment modifies them
+void consistency_job(int k, void *arg)
+{
+  consistency_jobs_t *data = (consistency_jobs_t *) arg;
+  float **xyzA;
+  float **xyzB;
+
+  xyzA = copyCoords(data->xyzn[data->pairs_a[k]], data->size);
+  xyzB = copyCoords(data->xyzn[data->pairs_b[k]], data->size);
+  consistency(xyzA, xyzB, data->zeros, data->size, data->thres,
+	      data->scores[k]);
+  freeCoords(xyzA, data->size);
+  freeCoords(xyzB, data->size);
+}
+
 float maximumValue(float *vals, int size)
 {
   float max = vals[0];
@@ -43,16 +73,19 @@ static PyObject* consistency_wrapper(PyObject* self, PyObject* args)
   int size;
   int nmodels;
   float thres;
+  int n_cpus = 1;
   //cout << "START" << endl << flush;
  
-  if (!PyArg_ParseTuple(args, "OOOOifOi", &py_xs, &py_ys, &py_zs, &py_zeros, &size, 
-			&thres, &py_models, &nmodels))
+  if (!PyArg_ParseTuple(args, "OOOOifOi|i", &py_xs, &py_ys, &py_zs, &py_zeros, &size, 
+			&thres, &py_models, &nmodels, &n_cpus))
     return NULL;
  
   float ***xyzn;
   int zeros[size];
-  int   *cons_list;
   int **scores;
+  int *pairs_a;
+  int *pairs_b;
+  consistency_jobs_t jobs;
   int i;
   int j;
   int jj;
@@ -81,18 +114,30 @@ static PyObject* consistency_wrapper(PyObject* self, PyObject* args)
   }
   //cout << "START3" << endl << flush;
   scores = new int*[msize];
+  pairs_a = new int[msize];
+  pairs_b = new int[msize];
 
   k = 0;
   for (j=0; j<nmodels-1; j++){
     for (jj=j+1; jj<nmodels; jj++){
-      cons_list = new int[size];
       scores[k] = new int[size];
-      consistency(xyzn[j], xyzn[jj], zeros, size, thres, cons_list);
-      scores[k] = cons_list;
+      pairs_a[k] = j;
+      pairs_b[k] = jj;
       k++;
-      // scores[j+jj-1] = cons_list;
     }
   }
+  jobs.xyzn    = xyzn;
+  jobs.zeros   = zeros;
+  jobs.size    = size;
+  jobs.thres   = thres;
+  jobs.pairs_a = pairs_a;
+  jobs.pairs_b = pairs_b;
+  jobs.scores  = scores;
+  Py_BEGIN_ALLOW_THREADS
+  runJobs(msize, n_cpus, &consistency_job, &jobs);
+  Py_END_ALLOW_THREADS
+  delete[] pairs_a;
+  delete[] pairs_b;
 
   //cout << "START4" << endl << flush;
   PyObject * py_result = NULL;
@@ -110,7 +155,6 @@ static PyObject* consistency_wrapper(PyObject* self, PyObject* args)
   }
 
   // free
-  delete[] cons_list;
   //cout << "START5" << endl << flush;
   for (int j=0; j<nmodels; j++){
     for (int i=0; i<size; i++)
@@ -119,7 +163,7 @@ static PyObject* consistency_wrapper(PyObject* self, PyObject* args)
   }
   delete[] xyzn;
   
-  for (int i=0; i<msize-1; i++){
+  for (int i=0; i<msize; i++){
     //cout << i << " "<<msize<<endl << flush;
     delete[] scores[i];
   }
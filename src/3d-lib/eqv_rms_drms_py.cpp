@@ -14,11 +14,48 @@ number of equivalent positions, the RMSD and the dRMSD.\n\
    :param dcutoff: distance cutoff to consider 2 particles as equivalent \n\
       in position (nm)\n\
    :param nmodels: number of models passed\n\
+   :param 1 n_cpus: number of threads among which to distribute the pairwise \n\
+      comparisons\n\
 \n\
    :returns: a list with the number of equivalent positions, the RMSD and \n\
       the dRMSD, of the alignment.\n\
 ");
 
+// data shared by the threads computing pairwise comparisons
+typedef struct {
+  float ***xyzn;
+  int *zeros;
+  int size;
+  float thres;
+  int *pairs_a;
+  int *pairs_b;
+  float *nrmsds;
+  float *drmsds;
+  float *scores;
+} rmsd_jobs_t;
+
+
+// compares one pair of models, working on copies of their coordinates as
+// the alignment modifies them
+void rmsd_job(int k, void *arg)
+{
+  rmsd_jobs_t *data = (rmsd_jobs_t *) arg;
+  float **xyzA;
+  float **xyzB;
+  float rms = 0;
+  float drms = 0;
+  int   eqv = 0;
+
+  xyzA = copyCoords(data->xyzn[data->pairs_a[k]], data->size);
+  xyzB = copyCoords(data->xyzn[data->pairs_b[k]], data->size);
+  rmsdRMSD(xyzA, xyzB, data->zeros, data->size, data->thres, eqv, rms, drms);
+  data->nrmsds[k] = rms;
+  data->drmsds[k] = drms;
+  data->scores[k] = eqv * drms / rms;
+  freeCoords(xyzA, data->size);
+  freeCoords(xyzB, data->size);
+}
+
 float maximumValue(float *vals, int size)
 {
   float max = vals[0];
@@ -41,10 +78,12 @@ static PyObject* rmsdRMSD_wrapper(PyObject* self, PyObject* args)
   float thres;
   char *what;
   int normed;
+  int n_cpus = 1;
   // cout << "START" << endl << flush;
  
-  if (!PyArg_ParseTuple(args, "OOOOifOiisi", &py_xs, &py_ys, &py_zs, &py_zeros, 
-			&size, &thres, &py_models, &nmodels, &one, &what, &normed))
+  if (!PyArg_ParseTuple(args, "OOOOifOiisi|i", &py_xs, &py_ys, &py_zs, &py_zeros, 
+			&size, &thres, &py_models, &nmodels, &one, &what, &normed,
+			&n_cpus))
     return NULL;
  
   float ***xyzn;
@@ -52,15 +91,15 @@ static PyObject* rmsdRMSD_wrapper(PyObject* self, PyObject* args)
   float *nrmsds;
   float *drmsds;
   float *scores;
+  int *pairs_a;
+  int *pairs_b;
+  rmsd_jobs_t jobs;
   float max_normed;
   int i;
   int j;
   int jj;
   int k;
   int msize;
-  float rms = 0;
-  float drms = 0;
-  int   eqv = 0;
   // cout << "START" << endl << flush;
 
   msize = nmodels*(nmodels-1)/2;
@@ -70,6 +109,8 @@ static PyObject* rmsdRMSD_wrapper(PyObject* self, PyObject* args)
   nrmsds = new float[msize];
   drmsds = new float[msize];
   scores = new float[msize];
+  pairs_a = new int[msize];
+  pairs_b = new int[msize];
   // cout << "START" << endl << flush;
 
 
@@ -93,17 +134,25 @@ static PyObject* rmsdRMSD_wrapper(PyObject* self, PyObject* args)
   k = 0;
   for (j=0; j<nmodels; j++){
     for (jj=j+1; jj<nmodels; jj++){
-      rms = 0;
-      drms = 0;
-      eqv = 0;
-      rmsdRMSD(xyzn[j], xyzn[jj], zeros, size, thres, eqv, rms, drms);
-      nrmsds[k] = rms;
-      drmsds[k] = drms;
-      scores[k] = eqv * drms / rms;
-      // cout << j<<" " <<jj<<" " <<eqv<<" " <<drms<<" " <<rms<<" "<<scores[k]<< endl << flush;
+      pairs_a[k] = j;
+      pairs_b[k] = jj;
       k++;
     }
   }
+  jobs.xyzn    = xyzn;
+  jobs.zeros   = zeros;
+  jobs.size    = size;
+  jobs.thres   = thres;
+  jobs.pairs_a = pairs_a;
+  jobs.pairs_b = pairs_b;
+  jobs.nrmsds  = nrmsds;
+  jobs.drmsds  = drmsds;
+  jobs.scores  = scores;
+  Py_BEGIN_ALLOW_THREADS
+  runJobs(msize, n_cpus, &rmsd_job, &jobs);
+  Py_END_ALLOW_THREADS
+  delete[] pairs_a;
+  delete[] pairs_b;
   // cout << "START5" << endl << flush;
   if (one){
     // free
@@ -13,6 +13,7 @@ matplotlib.use('Agg')
 import unittest
 from pytadbit                             import Chromosome, load_chromosome
 from pytadbit                             import tadbit, batch_tadbit
+from pytadbit                             import HiC_data
 from pytadbit.tad_clustering.tad_cmo      import optimal_cmo
 from pytadbit.modelling.structuralmodels        import load_structuralmodels
 from pytadbit.modelling.impmodel                import load_impmodel_from_cmm
@@ -29,7 +30,6 @@ from random                               import random, seed
 from os                                   import system, path, chdir
 from re                                   import finditer
 from warnings                             import warn, catch_warnings, simplefilter
-from distutils.spawn                      import find_executable
 
 import sys
 
@@ -518,10 +518,9 @@ class TestTadbit(unittest.TestCase):
         else:
             refmodels_path = PATH + "/models_py3.pick"
         models = load_structuralmodels(refmodels_path)
-        if find_executable("mcl"):
-            models.cluster_models(method="mcl", fact=0.9, verbose=False,
-                                  dcutoff=200)
-            self.assertTrue(5 <= len(list(models.clusters.keys())) <= 7)
+        models.cluster_models(method="mcl", fact=0.9, verbose=False,
+                              dcutoff=200)
+        self.assertTrue(5 <= len(list(models.clusters.keys())) <= 7)
         models.cluster_models(method="ward", verbose=False, dcutoff=200)
         self.assertTrue(2 <= len(list(models.clusters.keys())) <= 3)
         d = models.cluster_analysis_dendrogram()
@@ -847,6 +846,596 @@ class TestTadbit(unittest.TestCase):
             self.assertEqual(True, True)
             print("20", time() - t0)
 
+    def test_21_3d_modelling_checkpoint(self):
+        """
+        resume model generation from a checkpoint, and stop it on convergence
+        """
+        if ONLY and not "21" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+
+        try:
+            __import__("IMP")
+        except ImportError:
+            warn("IMP not found, skipping test\n")
+            return
+        test_chr = Chromosome(name="Test Chromosome", max_tad_size=260000)
+        test_chr.add_experiment("exp1", 20000, tad_def=exp4,
+                                hic_data=PATH + "/20Kb/chrT/chrT_D.tsv",
+                                silent=True)
+        exp = test_chr.experiments[0]
+        exp.load_hic_data(PATH + "/20Kb/chrT/chrT_A.tsv", silent=True)
+        exp.filter_columns(silent=True)
+        exp.normalize_hic(silent=True, factor=None)
+        config = {'kforce': 5, 'maxdist': 500, 'scale': 0.01, 'kbending': 0.0,
+                  'upfreq': 1.0, 'lowfreq': -0.6}
+        system("rm -rf lala-checkpoint~")
+        # interrupted run, then resumed with more models
+        models = exp.model_region(51, 71, n_models=6, n_keep=3, n_cpus=2,
+                                  config=dict(config),
+                                  checkpoint="lala-checkpoint~")
+        self.assertEqual(models._config['generated_models'], 6)
+        resumed = exp.model_region(51, 71, n_models=10, n_keep=3, n_cpus=2,
+                                   config=dict(config),
+                                   checkpoint="lala-checkpoint~")
+        self.assertEqual(resumed._config['generated_models'], 10)
+        models = exp.model_region(51, 71, n_models=10, n_keep=3, n_cpus=2,
+                                  config=dict(config))
+        self.assertEqual([(m['rand_init'], round(m['objfun'], 3))
+                          for m in resumed],
+                         [(m['rand_init'], round(m['objfun'], 3))
+                          for m in models])
+        # with a large tolerance, generation stops long before n_models
+        models = exp.model_region(51, 71, n_models=100, n_keep=5, n_cpus=2,
+                                  config=dict(config), convergence=1.0,
+                                  round_size=5)
+        self.assertEqual(len(models), 5)
+        self.assertTrue(10 <= models._config['generated_models'] < 100)
+        self.assertEqual(models._config['generated_models'] % 5, 0)
+        system("rm -rf lala*")
+        if CHKTIME:
+            print("21", time() - t0)
+
+    def test_22_eig_correlate_small_matrix(self):
+        """
+        eigenvectors of matrices too small for the sparse eigensolver
+        """
+        if ONLY and not "22" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        size = 8
+        hic_datas = []
+        for shift in range(2):
+            items = {}
+            for i in range(size):
+                for j in range(size):
+                    items[i * size + j] = 20 // (1 + abs(i - j)) + (i * j + shift) % 3
+            hic_data = HiC_data(items, size)
+            hic_data.bads = {3: True}
+            hic_datas.append(hic_data)
+        # 7 bins left to compare 6 eigenvectors
+        corr = eig_correlate_matrices(hic_datas[0], hic_datas[0], nvect=6)
+        self.assertEqual([round(corr[i][i], 3) for i in range(6)], [1.0] * 6)
+        corr = eig_correlate_matrices(hic_datas[0], hic_datas[1], nvect=6)
+        self.assertEqual(len(corr), 6)
+        self.assertTrue(all(0 <= v <= 1.000001 for row in corr for v in row))
+        self.assertRaises(Exception, eig_correlate_matrices, hic_datas[0],
+                          hic_datas[1], nvect=8)
+        if CHKTIME:
+            print("22", time() - t0)
+
+    def test_23_hmm(self):
+        """
+        Viterbi path with transitions given as lists of lists, and training on
+        sequences of a single observation
+        """
+        if ONLY and not "23" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from itertools import product
+        from math import log
+        from pytadbit.utils.hmm import best_path, train, gaussian_prob
+        pi = [0.6, 0.4]
+        T = [[0.7, 0.3], [0.4, 0.6]]
+        E = [[-1., 0.5], [1., 0.8]]
+        obs = [-1.2, -0.3, 0.9, 1.4, -0.8, 0.2]
+        probs = [list(p) for p in gaussian_prob(obs, E)]
+        states, prob = best_path(probs, pi, T)
+        # all possible paths
+        best = max((log(pi[path[0]]) + log(probs[path[0]][0]) +
+                    sum(log(T[a][b]) + log(probs[b][k + 1])
+                        for k, (a, b) in enumerate(zip(path[:-1], path[1:]))),
+                    list(path)) for path in product(range(2), repeat=len(obs)))
+        self.assertEqual(states, best[1])
+        self.assertEqual(round(prob, 8), round(best[0], 8))
+        train(pi, T, E, [obs, [0.5]], n_iter=5)
+        self.assertEqual(round(sum(pi), 6), 1)
+        self.assertEqual([round(sum(t), 6) for t in T], [1, 1])
+        if CHKTIME:
+            print("23", time() - t0)
+
+
+    def test_24_cmo_pruned_search(self):
+        """
+        Pruned search of eigenvector signs against the exhaustive one
+        """
+        if ONLY and not "24" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        test_chr = Chromosome(name="Test Chromosome",
+                              experiment_tads=[exp4],
+                              experiment_names=["exp1"],
+                              experiment_hic_data=[
+                                  PATH + "/20Kb/chrT/chrT_D.tsv"],
+                              experiment_resolutions=[20000,20000],
+                              silent=True)
+        all_tads = [tad for _, tad in test_chr.iter_tads("exp1", normed=False)]
+        tad1, tad2 = all_tads[1], all_tads[3]
+        pruned = optimal_cmo(tad1, tad2, 7, method="score")
+        exhaus = optimal_cmo(tad1, tad2, 7, method="score", exhaustive=True)
+        self.assertEqual(pruned[:2], exhaus[:2])
+        self.assertEqual(pruned[2]["dist"], exhaus[2]["dist"])
+        # a beam as large as the number of combinations is exhaustive
+        pruned = optimal_cmo(tad1, tad2, 4, beam=8)
+        exhaus = optimal_cmo(tad1, tad2, 4, exhaustive=True)
+        self.assertEqual(pruned[:2], exhaus[:2])
+        self.assertEqual(pruned[2]["dist"], exhaus[2]["dist"])
+        # with the Frobenius distance the default search is exhaustive
+        for tad1, tad2 in ((all_tads[1], all_tads[6]),
+                           (all_tads[4], all_tads[6])):
+            default = optimal_cmo(tad1, tad2, 8)
+            exhaus = optimal_cmo(tad1, tad2, 8, exhaustive=True)
+            self.assertEqual(default[:2], exhaus[:2])
+            self.assertEqual(default[2]["dist"], exhaus[2]["dist"])
+            # pruning can only miss the best alignment
+            pruned = optimal_cmo(tad1, tad2, 8, beam=2)
+            self.assertTrue(pruned[2]["dist"] >= exhaus[2]["dist"])
+        if CHKTIME:
+            print("24", time() - t0)
+
+
+    def test_25_cooler_region(self):
+        """
+        Reads regions of a cooler file
+        """
+        if ONLY and not "25" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        try:
+            __import__("h5py")
+        except ImportError:
+            warn("h5py not found, skipping test\n")
+            return
+        import numpy as np
+        rnd = np.random.RandomState(1)
+        matrix = rnd.randint(0, 20, size=(10, 10))
+        matrix = matrix + matrix.T
+        names = [("chrA", 6), ("chrB", 4)]
+        out = open("lala.tsv", "w")
+        i = 0
+        for crm, nbins in names:
+            for pos in range(nbins):
+                out.write("%s\t%d-%d\t%s\n" % (
+                    crm, pos * 10 + 1, (pos + 1) * 10,
+                    "\t".join(str(v) for v in matrix[i])))
+                i += 1
+        out.close()
+        hic = read_matrix("lala.tsv", resolution=10)
+        hic.write_cooler("lala.cool")
+        whole = read_matrix("lala.cool")
+        self.assertEqual(whole.chromosomes, OrderedDict(names))
+        self.assertEqual(whole.get_matrix(), matrix.tolist())
+        chrb = read_matrix("lala.cool", region="chrB")
+        self.assertEqual(chrb.chromosomes, OrderedDict([("chrB", 4)]))
+        self.assertEqual(chrb.get_matrix(), matrix[6:, 6:].tolist())
+        regs = read_matrix("lala.cool", region=["chrA:20-50", ("chrB", 10, 30)])
+        sub = list(range(2, 5)) + list(range(7, 9))
+        self.assertEqual(regs.get_matrix(), matrix[np.ix_(sub, sub)].tolist())
+        system("rm -rf lala*")
+        if CHKTIME:
+            print("25", time() - t0)
+
+
+    def test_26_matrix_readers(self):
+        """
+        Reads gzipped matrices, and matrices from inputs that cannot be rewound
+        """
+        if ONLY and not "26" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        import numpy as np
+        rnd = np.random.RandomState(2)
+        matrix = rnd.randint(0, 20, size=(8, 8))
+        matrix = matrix + matrix.T
+        lines = ["# MASKED 3"] + ["\t".join(str(v) for v in row)
+                                  for row in matrix]
+        out = open("lala.tsv", "w")
+        out.write("\n".join(lines) + "\n")
+        out.close()
+        system("gzip -c lala.tsv > lala.tsv.gz")
+        plain = read_matrix("lala.tsv")
+        gzipd = read_matrix("lala.tsv.gz")
+        self.assertEqual(plain.get_matrix(), matrix.tolist())
+        self.assertEqual(gzipd.get_matrix(), matrix.tolist())
+        self.assertEqual(gzipd.bads, {3: True})
+        # a matrix passed as a string is split in a list of lines
+        text = read_matrix("\n".join(lines))
+        self.assertEqual(text.get_matrix(), matrix.tolist())
+        self.assertEqual(text.bads, {3: True})
+        system("rm -rf lala*")
+        if CHKTIME:
+            print("26", time() - t0)
+
+
+    def test_27_cooler_exact_multiple(self):
+        """
+        Cooler from a BAM file with a chromosome length multiple of the
+        resolution
+        """
+        if ONLY and not "27" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        try:
+            __import__("h5py")
+        except ImportError:
+            warn("h5py not found, skipping test\n")
+            return
+        import h5py
+        from pysam import AlignmentFile
+        from pytadbit.parsers.hic_bam_parser import write_matrix
+        reso = 10000
+        lengths = OrderedDict([("chrA", 100000), ("chrB", 45000)])
+        generate_pairs_bam("lala.bam", lengths, 2000)
+        fnames = write_matrix("lala.bam", reso, None, ".", filter_exclude=0,
+                              normalizations=("raw",), cooler=True,
+                              cooler_resolutions=[20000], cooler_balance=True,
+                              ncpus=1, nchunks=7, verbose=False)
+        # expected counts in the bins of the cooler, the last position of chrA
+        # goes to its last bin
+        nbins = OrderedDict((c, -(-l // reso)) for c, l in lengths.items())
+        tb_offset = {"chrA": 0, "chrB": lengths["chrA"] // reso + 1}
+        cl_offset = {"chrA": 0, "chrB": nbins["chrA"]}
+        bam = AlignmentFile("lala.bam")
+        expected = {}
+        for read in bam.fetch():
+            crm1, crm2 = read.reference_name, bam.references[read.mrnm]
+            pos1 = (read.reference_start + 1) // reso
+            pos2 = (read.mpos + 1) // reso
+            if tb_offset[crm1] + pos1 > tb_offset[crm2] + pos2:
+                continue
+            key = (cl_offset[crm1] + min(pos1, nbins[crm1] - 1),
+                   cl_offset[crm2] + min(pos2, nbins[crm2] - 1))
+            expected[key] = expected.get(key, 0) + 1
+        bam.close()
+        with h5py.File(fnames["RAW"], "r") as cool:
+            grp = cool["resolutions/%d" % reso]
+            self.assertEqual(len(grp["bins/start"]), sum(nbins.values()))
+            pixels = dict(((int(i), int(j)), int(v)) for i, j, v in zip(
+                grp["pixels/bin1_id"][()], grp["pixels/bin2_id"][()],
+                grp["pixels/count"][()]))
+            self.assertEqual(pixels, expected)
+            grp = cool["resolutions/20000"]
+            self.assertEqual(int(grp["pixels/count"][()].sum()),
+                             sum(expected.values()))
+            self.assertEqual(len(grp["bins/weight"]), 5 + 3)
+        hic = read_matrix(fnames["RAW"])
+        self.assertEqual(len(hic), sum(nbins.values()))
+        self.assertEqual(hic[nbins["chrA"] - 1, nbins["chrA"] - 1],
+                         expected.get((nbins["chrA"] - 1, nbins["chrA"] - 1), 0))
+        system("rm -rf lala* *.mcool")
+        if CHKTIME:
+            print("27", time() - t0)
+
+
+    def test_28_binary_biases(self):
+        """
+        Conversion of biases from pickle to binary format and back
+        """
+        if ONLY and not "28" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from pickle import dump, load
+        from pytadbit.parsers.biases_parser import convert_biases, read_biases
+        from pytadbit.parsers.biases_parser import is_binary_biases
+        all_biases = [
+            {"biases": {0: 1.2, 2: 0.8, 5: 1.1, 9: 0.5},
+             "badcol": {1: True, 3: 0, 4: "manual", 6: 12, 7: 0.5, 8: None},
+             "decay": {"chr1": {0: 1.5, 1: 0.5, 4: 0.25}, "chr2": {}},
+             "resolution": 10000, "note": "normalized"},
+            {"biases": None, "badcol": {}, "decay": None, "resolution": None},
+            {"biases": [1., 2., 3.], "badcol": {2: True}, "decay": {0: 1.,
+                                                                     3: .2}}]
+        for biases in all_biases:
+            dump(biases, open("lala.pickle", "wb"))
+            convert_biases("lala.pickle", "lala.biases")
+            self.assertTrue(is_binary_biases("lala.biases"))
+            convert_biases("lala.biases", "lala2.pickle")
+            self.assertEqual(load(open("lala2.pickle", "rb")), biases)
+            self.assertEqual(read_biases("lala.biases"), biases)
+            if isinstance(biases["biases"], list):
+                continue
+            ranges = [(0, 3), (5, 8)]
+            self.assertEqual(read_biases("lala.biases", ranges=ranges),
+                             read_biases("lala.pickle", ranges=ranges))
+        system("rm -rf lala*")
+        if CHKTIME:
+            print("28", time() - t0)
+
+
+    def test_29_matrix_from_bam(self):
+        """
+        Matrices read from a BAM file by chunks, compared to the counts of
+        each pair of reads
+        """
+        if ONLY and not "29" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from pysam import AlignmentFile
+        from pytadbit.parsers.hic_bam_parser import get_matrix, write_matrix
+        reso = 5000
+        lengths = OrderedDict([("chrA", 95001), ("chrB", 62003),
+                               ("chrC", 40007)])
+        generate_pairs_bam("lala.bam", lengths, 3000)
+        offset = {}
+        size = 0
+        for crm, length in lengths.items():
+            offset[crm] = size
+            size += length // reso + 1
+        bam = AlignmentFile("lala.bam")
+        counts = {}
+        for read in bam.fetch():
+            key = (offset[read.reference_name] +
+                   (read.reference_start + 1) // reso,
+                   offset[bam.references[read.mrnm]] + (read.mpos + 1) // reso)
+            counts[key] = counts.get(key, 0) + 1
+        bam.close()
+        expected = [[counts.get((i, j), 0) for j in range(size)]
+                    for i in range(size)]
+        # dictionary of the whole matrix, and of a region
+        matrix = get_matrix("lala.bam", reso, filter_exclude=0, ncpus=2,
+                            nchunks=9, verbose=False)
+        self.assertEqual(matrix, counts)
+        beg, end = offset["chrB"], offset["chrC"]
+        matrix = get_matrix("lala.bam", reso, filter_exclude=0, ncpus=2,
+                            nchunks=9, region1="chrB", verbose=False)
+        self.assertEqual(matrix, dict(((i - beg, j - beg), v)
+                                      for (i, j), v in counts.items()
+                                      if beg <= i < end and beg <= j < end))
+        # text and cooler outputs
+        fnames = write_matrix("lala.bam", reso, None, ".", filter_exclude=0,
+                              normalizations=("raw",), half_matrix=False,
+                              ncpus=2, nchunks=9, verbose=False)
+        self.assertEqual(read_matrix(fnames["RAW"]).get_matrix(), expected)
+        try:
+            __import__("h5py")
+        except ImportError:
+            warn("h5py not found, skipping cooler output\n")
+        else:
+            fnames = write_matrix("lala.bam", reso, None, ".", filter_exclude=0,
+                                  normalizations=("raw",), cooler=True,
+                                  ncpus=2, nchunks=9, verbose=False)
+            self.assertEqual(read_matrix(fnames["RAW"]).get_matrix(), expected)
+        system("rm -rf lala* *.abc *.mcool")
+        if CHKTIME:
+            print("29", time() - t0)
+
+
+    def test_30_alignment_randomization(self):
+        """
+        Randomization test of the alignment of TAD borders, with a fixed seed
+        and early stop
+        """
+        if ONLY and not "30" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        test_chr = Chromosome(name="Test Chromosome",
+                              experiment_tads=[exp2, exp3],
+                              experiment_names=["exp2", "exp3"],
+                              experiment_resolutions=[20000, 20000],
+                              silent=True)
+        pvals = []
+        for n_cpus in (1, 2):
+            _, (_, pval, _, _) = test_chr.align_experiments(
+                randomize=True, rnd_num=200, seed=3,
+                n_cpus=n_cpus)
+            pvals.append(pval)
+        self.assertEqual(pvals[0], pvals[1])
+        # with alpha, only the first block of randomizations is needed
+        _, (_, pval, _, _) = test_chr.align_experiments(
+            randomize=True, rnd_num=1000, seed=3, alpha=0.5, chunk_size=50)
+        _, (_, pval50, _, _) = test_chr.align_experiments(
+            randomize=True, rnd_num=50, seed=3, chunk_size=50)
+        _, (_, pval1000, _, _) = test_chr.align_experiments(
+            randomize=True, rnd_num=1000, seed=3, chunk_size=50)
+        self.assertEqual(pval, pval50)
+        self.assertNotEqual(pval, pval1000)
+        if CHKTIME:
+            print("30", time() - t0)
+
+
+    def test_31_hic_filtering(self):
+        """
+        Detection of bad columns, compared to the expected ones and to the
+        counts of each cell
+        """
+        if ONLY and not "31" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        from pytadbit.utils.hic_filtering import filter_by_mean, filter_by_zero_count
+        from pytadbit.utils.hic_filtering import hic_filtering_for_modelling
+        import numpy as np
+        from pytadbit.utils.hic_filtering import filter_by_local_ratio
+        hic = read_matrix(PATH + "/20Kb/chrT/chrT_C.tsv", one=False)[0]
+        size = len(hic)
+        self.assertEqual(filter_by_mean(hic, silent=True), {22: 57, 38: 0})
+        self.assertEqual(hic_filtering_for_modelling(hic, silent=True),
+                         ({22: 57, 38: 0}, False))
+        # columns with too many zeroes or too few counts
+        zeros = [sum(1 for j in range(size) if not hic[i, j])
+                 for i in range(size)]
+        counts = [sum(hic[i, j] for j in range(size)) for i in range(size)]
+        self.assertEqual(filter_by_zero_count(hic, 50),
+                         dict((i, True) for i in range(size)
+                              if zeros[i] > size // 2))
+        self.assertEqual(filter_by_zero_count(hic, 90, min_count=2000),
+                         dict((i, True) for i in range(size)
+                              if counts[i] < 2000))
+        # ratio between interactions close to the diagonal and further away,
+        # the last bins of the chromosome are looked upstream
+        nears = [0] * size
+        ratio = [0] * size
+        for i in range(size):
+            if i < size - 10:
+                near = sum(hic[i, i + d] for d in range(2) if i + d < size)
+                away = sum(hic[i, i + d] for d in range(2, 10) if i + d < size)
+            else:
+                near = sum(hic[i - d, i] for d in range(2) if i >= d)
+                away = sum(hic[i - d, i] for d in range(2, 10) if i >= d)
+            if away:
+                nears[i] = near
+                ratio[i] = float(near) / away
+        self.assertEqual(
+            filter_by_local_ratio(hic, min_count=100, next_position=2),
+            dict((i, True) for i in range(size)
+                 if ratio[i] < 1 or nears[i] < 100))
+        # by default the minimum count is estimated from the low ratio bins
+        min_count = np.percentile([n for n, r in zip(nears, ratio)
+                                   if r < 1 and n >= 10], 95)
+        self.assertEqual(
+            filter_by_local_ratio(hic, next_position=2),
+            dict((i, True) for i in range(size)
+                 if ratio[i] < 1 or nears[i] < min_count))
+        # a NaN skips the filtering by mean, its column is removed
+        hic = read_matrix(PATH + "/20Kb/chrT/chrT_A.tsv", one=False)[0]
+        hic[0, 0] = float("nan")
+        self.assertEqual(filter_by_mean(hic, silent=True), {})
+        self.assertEqual(hic_filtering_for_modelling(hic, silent=True),
+                         ({0: None, 22: None}, True))
+        if CHKTIME:
+            print("31", time() - t0)
+
+
+    def test_32_cooler_zoom_bad_columns(self):
+        """
+        Zoom of a cooler that is not a multiple of the resolution of the biases
+        without the reads in bad columns
+        """
+        if ONLY and not "32" in ONLY:
+            return
+        if CHKTIME:
+            t0 = time()
+        try:
+            __import__("h5py")
+        except ImportError:
+            warn("h5py not found, skipping test\n")
+            return
+        import h5py
+        from pickle import dump
+        from pysam import AlignmentFile
+        from pytadbit.parsers.hic_bam_parser import write_matrix
+        reso, zoom = 10000, 25000
+        lengths = OrderedDict([("chrA", 100000), ("chrB", 45000)])
+        generate_pairs_bam("lala.bam", lengths, 2000)
+        # genomic bins 2 of chrA and 1 of chrB are bad columns
+        tb_offset = {"chrA": 0, "chrB": lengths["chrA"] // reso + 1}
+        nbins = tb_offset["chrB"] + lengths["chrB"] // reso + 1
+        dump({"biases": dict((i, 1.) for i in range(nbins)),
+              "badcol": {2: True, tb_offset["chrB"] + 1: True},
+              "decay": {}, "resolution": reso}, open("lala.pickle", "wb"))
+        fnames = write_matrix("lala.bam", reso, "lala.pickle", ".",
+                              filter_exclude=0, normalizations=("raw",),
+                              cooler=True, ncpus=1, nchunks=7, verbose=False)
+        write_matrix("lala.bam", zoom, None, ".", filter_exclude=0,
+                     normalizations=("raw",), cooler=True,
+                     cooler_name=fnames["RAW"], mask_biases="lala.pickle",
+                     ncpus=1, nchunks=7, verbose=False)
+        # expected counts in the bins of the zoom
+        zm_nbins = OrderedDict((c, -(-l // zoom)) for c, l in lengths.items())
+        zm_offset = {"chrA": 0, "chrB": lengths["chrA"] // zoom + 1}
+        cl_offset = {"chrA": 0, "chrB": zm_nbins["chrA"]}
+        bam = AlignmentFile("lala.bam")
+        expected = {}
+        for read in bam.fetch():
+            crm1, crm2 = read.reference_name, bam.references[read.mrnm]
+            bin1 = tb_offset[crm1] + (read.reference_start + 1) // reso
+            bin2 = tb_offset[crm2] + (read.mpos + 1) // reso
+            if bin1 in (2, 12) or bin2 in (2, 12):
+                continue
+            pos1 = (read.reference_start + 1) // zoom
+            pos2 = (read.mpos + 1) // zoom
+            if zm_offset[crm1] + pos1 > zm_offset[crm2] + pos2:
+                continue
+            key = (cl_offset[crm1] + min(pos1, zm_nbins[crm1] - 1),
+                   cl_offset[crm2] + min(pos2, zm_nbins[crm2] - 1))
+            expected[key] = expected.get(key, 0) + 1
+        bam.close()
+        with h5py.File(fnames["RAW"], "r") as cool:
+            grp = cool["resolutions/%d" % zoom]
+            pixels = dict(((int(i), int(j)), int(v)) for i, j, v in zip(
+                grp["pixels/bin1_id"][()], grp["pixels/bin2_id"][()],
+                grp["pixels/count"][()]))
+            self.assertEqual(pixels, expected)
+            # no pixel of the main resolution in the bad columns
+            grp = cool["resolutions/%d" % reso]
+            bins = set(grp["pixels/bin1_id"][()].tolist() +
+                       grp["pixels/bin2_id"][()].tolist())
+            self.assertFalse(bins & set([2, 11]))
+        system("rm -rf lala* *.mcool")
+        if CHKTIME:
+            print("32", time() - t0)
+
+
+def generate_pairs_bam(fname, lengths, npairs):
+    """
+    Writes a sorted and indexed BAM file of interacting reads, each pair of
+    reads is stored twice (once from each read). Some reads are placed at the
+    last position of the chromosomes.
+
+    :param fname: path to the BAM file
+    :param lengths: dictionary with chromosomes and lengths
+    :param npairs: number of pairs of reads
+    """
+    from pysam import AlignmentFile, AlignedSegment, sort, index
+    crms = list(lengths)
+    header = {"HD": {"VN": "1.0"},
+              "SQ": [{"SN": c, "LN": l} for c, l in lengths.items()]}
+    out = AlignmentFile(fname + "~", "wb", header=header)
+    for i in range(npairs):
+        reads = []
+        for _ in range(2):
+            crm = int(random() * len(crms))
+            if random() < 0.05:
+                pos = lengths[crms[crm]] - 1
+            else:
+                pos = int(random() * lengths[crms[crm]])
+            reads.append((crm, pos))
+        for (crm1, pos1), (crm2, pos2) in (reads, reads[::-1]):
+            read = AlignedSegment()
+            read.query_name = "read%d" % i
+            read.query_sequence = "A" * 20
+            read.flag = 0
+            read.reference_id = crm1
+            read.reference_start = pos1
+            read.mapping_quality = 60
+            read.cigarstring = "20M"
+            read.next_reference_id = crm2
+            read.next_reference_start = pos2
+            out.write(read)
+    out.close()
+    sort("-o", fname, fname + "~")
+    index(fname)
+
 
 def generate_random_ali(ali="map"):
     # VARIABLES